@@ -35,7 +35,8 @@ def should_show_sort_by_relevance():
     """True if configuration support sorting
     questions by search relevance
     """
-    return ('postgresql_psycopg2' in askbot.get_database_engine_name())
+    from askbot.search.backends import get_backend
+    return get_backend().supports_relevance()
 
 def get_tag_display_filter_strategy_choices():
     from askbot import const
@@ -19,12 +19,40 @@ for the most part, so actual values are reliably available only
 at run time
 
 askbot.deps.livesettings is a module developed for satchmo project
+
+To avoid a cache backend round-trip per setting lookup,
+values are served from a process-local snapshot of all settings.
+The snapshot is reloaded only when the settings version
+stored in the cache changes. The version is checked at most
+once per request (and at most once per
+``ASKBOT_LIVESETTINGS_CHECK_INTERVAL`` seconds outside of
+the request cycle, e.g. in the celery workers).
+
+The snapshot can be disabled with
+``ASKBOT_LIVESETTINGS_SNAPSHOT = False`` in the django settings,
+which is useful to compare the number of backend lookups
+reported by :meth:`ConfigSettings.get_backend_lookup_count`.
 """
+import logging
+import threading
+import time
+import uuid
+from django.conf import settings as django_settings
+from django.core import signals as django_signals
 from django.core.cache import cache
+from django.db.models import loading
+from askbot import const
 from askbot.deps.livesettings import SortedDotDict, config_register
 from askbot.deps.livesettings.functions import config_get
 from askbot.deps.livesettings import signals
 
+SETTINGS_CACHE_KEY = 'askbot-livesettings'
+SETTINGS_VERSION_CACHE_KEY = 'askbot-livesettings-version'
+
+def get_new_version():
+    """returns a unique opaque version token"""
+    return uuid.uuid4().hex
+
 class ConfigSettings(object):
     """A very simple Singleton wrapper for settings
     a limitation is that all settings names using this class
@@ -33,6 +61,12 @@ class ConfigSettings(object):
     """
     __instance = None
     __group_map = {}
+    #process-local snapshot of all settings and its version
+    __snapshot = None
+    __snapshot_version = None
+    #per-thread bookkeeping: time of the last version check
+    #and the number of backend lookups since the request start
+    __local = threading.local()
 
     def __init__(self):
         """assigns SortedDotDict to self.__instance if not set"""
@@ -47,6 +81,17 @@ class ConfigSettings(object):
         will be required in code to convert an app
         depending on django.conf.settings to askbot.deps.livesettings
         """
+        if getattr(django_settings, 'ASKBOT_LIVESETTINGS_SNAPSHOT', True):
+            snapshot = self.get_snapshot()
+            if snapshot is not None and key in snapshot:
+                return snapshot[key]
+        return self.lookup(key)
+
+    def lookup(self, key):
+        """returns value of the setting from the
+        livesettings backend, bypassing the snapshot"""
+        local = ConfigSettings.__local
+        local.lookup_count = getattr(local, 'lookup_count', 0) + 1
         return getattr(self.__instance, key).value
 
     def get_default(self, key):
@@ -66,7 +111,8 @@ class ConfigSettings(object):
             setting = Setting.objects.get(key=key)
             setting.value = value
             setting.save()
-        #self.prime_cache()
+            #signal is not sent when saving the model directly
+            self.on_configuration_value_changed()
 
     def register(self, value):
         """registers the setting
@@ -89,12 +135,11 @@ class ConfigSettings(object):
             self.__group_map[key] = group_key
 
     def as_dict(self):
-        settings = cache.get('askbot-livesettings')
+        settings = cache.get(SETTINGS_CACHE_KEY)
         if settings:
             return settings
         else:
-            self.prime_cache()
-            return cache.get('askbot-livesettings')
+            return self.prime_cache()
 
     @classmethod
     def prime_cache(cls, **kwargs):
@@ -104,9 +149,113 @@ class ConfigSettings(object):
         for key in cls.__instance.keys():
             #todo: this is odd that I could not use self.__instance.items() mapping here
             out[key] = cls.__instance[key].value
-        cache.set('askbot-livesettings', out)
+        local = cls.__local
+        local.lookup_count = getattr(local, 'lookup_count', 0) + len(out)
+        cache.set(SETTINGS_CACHE_KEY, out)
+        return out
+
+    @classmethod
+    def get_version(cls):
+        """returns current version of the settings
+        stored in the cache, if the version is
+        missing - initializes it"""
+        version = cache.get(SETTINGS_VERSION_CACHE_KEY)
+        if version is None:
+            #a new unique token, so that the snapshots built
+            #before the entry was evicted are reloaded
+            cache.add(SETTINGS_VERSION_CACHE_KEY, get_new_version(), const.LONG_TIME)
+            version = cache.get(SETTINGS_VERSION_CACHE_KEY)
+        return version
+
+    @classmethod
+    def bump_version(cls, **kwargs):
+        """replaces the settings version with a new token, so that
+        all processes reload their settings snapshots,
+        and drops the snapshot of the current process"""
+        cache.set(SETTINGS_VERSION_CACHE_KEY, get_new_version(), const.LONG_TIME)
+        cls.__snapshot = None
+        cls.__snapshot_version = None
+
+    @classmethod
+    def on_configuration_value_changed(cls, **kwargs):
+        """reloads the settings dictionary in the cache
+        and replaces the settings version"""
+        cls.prime_cache()
+        cls.bump_version()
+
+    @classmethod
+    def get_snapshot(cls):
+        """returns process-local dictionary of all settings,
+        or ``None`` if the snapshot cannot be built yet
+        (when models are still being loaded)
+
+        version of the settings is compared with
+        the version of the snapshot at most once per request
+        """
+        local = cls.__local
+        checked_at = getattr(local, 'checked_at', None)
+        now = time.time()
+        interval = getattr(
+                        django_settings,
+                        'ASKBOT_LIVESETTINGS_CHECK_INTERVAL',
+                        10
+                    )
+        if cls.__snapshot is not None \
+            and checked_at is not None and now - checked_at < interval:
+            return cls.__snapshot
+
+        if loading.app_cache_ready() is False:
+            return None
+
+        version = cls.get_version()
+        local.checked_at = now
+        if cls.__snapshot is None or version != cls.__snapshot_version:
+            local.lookup_count = getattr(local, 'lookup_count', 0) + 1
+            snapshot = cache.get(SETTINGS_CACHE_KEY)
+            if not snapshot:
+                snapshot = cls.prime_cache()
+            cls.__snapshot = snapshot
+            cls.__snapshot_version = version
+        return cls.__snapshot
+
+    @classmethod
+    def get_snapshot_version(cls):
+        """returns version of the settings snapshot
+        of the current process, or ``None`` if the snapshot
+        cannot be built yet; objects derived from the setting
+        values may be rebuilt when the version changes"""
+        if cls.get_snapshot() is None:
+            return None
+        return cls.__snapshot_version
+
+    @classmethod
+    def get_backend_lookup_count(cls):
+        """returns number of setting lookups
+        that went to the livesettings backend or the cache
+        since the start of the current request"""
+        return getattr(cls.__local, 'lookup_count', 0)
+
+    @classmethod
+    def on_request_started(cls, **kwargs):
+        """forces version check on the first access to
+        settings within the request and resets the
+        lookup counter"""
+        cls.__local.checked_at = None
+        cls.__local.lookup_count = 0
+
+    @classmethod
+    def on_request_finished(cls, **kwargs):
+        """logs the number of backend lookups in the request"""
+        logging.debug(
+            'livesettings backend lookups in request: %d',
+            cls.get_backend_lookup_count()
+        )
 
 
-signals.configuration_value_changed.connect(ConfigSettings.prime_cache)
+signals.configuration_value_changed.connect(
+                    ConfigSettings.on_configuration_value_changed
+                )
+django_signals.request_started.connect(ConfigSettings.on_request_started)
+django_signals.request_finished.connect(ConfigSettings.on_request_finished)
 #settings instance to be used elsewhere in the project
 settings = ConfigSettings()
@@ -123,6 +123,8 @@ TAG_LIST_FORMAT_CHOICES = (
 
 PAGE_SIZE_CHOICES = (('10', '10',), ('30', '30',), ('50', '50',),)
 ANSWERS_PAGE_SIZE = 10
+#max number of posts in one request of the post permissions
+POST_PERMISSIONS_BATCH_SIZE = 200
 QUESTIONS_PER_PAGE_USER_CHOICES = ((10, u'10'), (30, u'30'), (50, u'50'),)
 
 UNANSWERED_QUESTION_MEANING_CHOICES = (
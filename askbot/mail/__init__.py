@@ -2,14 +2,19 @@
 these automatically catch email-related exceptions
 """
 import os
+import time
+import socket
 import smtplib
 import logging
+import cPickle
+import tempfile
 from django.core import mail
 from django.conf import settings as django_settings
 from django.core.exceptions import PermissionDenied
 from django.forms import ValidationError
 from django.utils.translation import ugettext_lazy as _
 from django.utils.translation import string_concat
+from django.utils.encoding import force_unicode
 from django.template import Context
 from askbot import exceptions
 from askbot import const
@@ -77,6 +82,242 @@ def thread_headers(post, orig_post, update):
 
     return headers
 
+#max number of messages sent through one smtp connection
+MESSAGES_PER_CONNECTION = getattr(
+    django_settings, 'ASKBOT_EMAIL_MESSAGES_PER_CONNECTION', 100
+)
+#number of attempts to re-send the message after a transient failure,
+#used only when the messages are sent outside of the web requests -
+#from the outbox directory, by the email alerts command
+#and by the celery worker sending the instant notifications
+SEND_RETRIES = getattr(django_settings, 'ASKBOT_EMAIL_SEND_RETRIES', 3)
+#delay in seconds before the first retry, doubled for each next attempt
+RETRY_DELAY = getattr(django_settings, 'ASKBOT_EMAIL_RETRY_DELAY', 1)
+#how often the outbox directory is checked by the celery worker
+OUTBOX_DRAIN_INTERVAL = getattr(
+    django_settings, 'ASKBOT_EMAIL_OUTBOX_DRAIN_INTERVAL', 30
+)
+#seconds after which a message claimed by a worker that
+#did not finish sending it is claimed again
+SENDING_TIMEOUT = getattr(django_settings, 'ASKBOT_EMAIL_SENDING_TIMEOUT', 3600)
+#spool files in the outbox directory
+SPOOLED_MESSAGE_SUFFIX = '.msg'
+SENDING_MESSAGE_SUFFIX = '.sending'
+FAILED_MESSAGE_SUFFIX = '.failed'
+
+def get_outbox_dir():
+    """returns path to the directory where the outgoing
+    messages are spooled, if ``ASKBOT_EMAIL_OUTBOX_DIR``
+    is set, otherwise ``None`` - the messages are sent
+    right away
+    """
+    return getattr(django_settings, 'ASKBOT_EMAIL_OUTBOX_DIR', None)
+
+def build_message(
+            subject_line = None,
+            body_text = None,
+            from_email = django_settings.DEFAULT_FROM_EMAIL,
+            recipient_list = None,
+            headers = None,
+        ):
+    """returns html email message with the prefixed subject line"""
+    assert(subject_line is not None)
+    subject_line = prefix_the_subject_line(subject_line)
+    msg = mail.EmailMessage(
+                    subject_line,
+                    body_text,
+                    from_email,
+                    recipient_list,
+                    headers = headers
+                )
+    msg.content_subtype = 'html'
+    return msg
+
+def is_transient_error(error):
+    """``True`` if sending of the message may
+    succeed if tried again later"""
+    if isinstance(error, (
+                smtplib.SMTPServerDisconnected,
+                smtplib.SMTPConnectError,
+                socket.error
+            )
+        ):
+        return True
+    if isinstance(error, smtplib.SMTPResponseException):
+        #4xx are temporary errors, per rfc 5321
+        return 400 <= error.smtp_code < 500
+    return False
+
+def deliver_messages(messages, retries = 0):
+    """sends messages through the connections to the mail server,
+    each connection is reused for up to ``MESSAGES_PER_CONNECTION``
+    messages, after a transient error connection is re-opened and
+    the message is re-sent up to ``retries`` times with
+    an exponential backoff - by default the message is tried once,
+    so that the web requests do not wait for the mail server
+
+    returns list of pairs (message, error) of the messages
+    that were not sent
+    """
+    failures = list()
+    for start in range(0, len(messages), MESSAGES_PER_CONNECTION):
+        batch = messages[start:start + MESSAGES_PER_CONNECTION]
+        connection = mail.get_connection()
+        try:
+            for msg in batch:
+                attempt = 0
+                while True:
+                    try:
+                        connection.open()
+                        connection.send_messages([msg])
+                        break
+                    except Exception, error:
+                        connection.close()
+                        if attempt < retries and is_transient_error(error):
+                            time.sleep(RETRY_DELAY * 2 ** attempt)
+                            attempt += 1
+                            continue
+                        logging.critical(unicode(error))
+                        failures.append((msg, error))
+                        break
+        finally:
+            connection.close()
+    return failures
+
+def spool_messages(messages, outbox_dir = None):
+    """saves messages into the outbox directory,
+    from where they are sent by :func:`send_spooled_messages`"""
+    outbox_dir = outbox_dir or get_outbox_dir()
+    for msg in messages:
+        #lazy translation strings can't be pickled
+        msg.subject = force_unicode(msg.subject)
+        msg.body = force_unicode(msg.body)
+        #time in the file name keeps order of the messages
+        handle, temp_path = tempfile.mkstemp(
+                                    dir = outbox_dir,
+                                    prefix = '%.6f-' % time.time(),
+                                    suffix = '.tmp'
+                                )
+        temp_file = os.fdopen(handle, 'wb')
+        try:
+            cPickle.dump(msg, temp_file, cPickle.HIGHEST_PROTOCOL)
+        finally:
+            temp_file.close()
+        #rename is atomic, so the worker never reads a partial file
+        os.rename(temp_path, temp_path[:-4] + SPOOLED_MESSAGE_SUFFIX)
+
+def release_stale_messages(outbox_dir):
+    """returns to the outbox the messages claimed more than
+    ``SENDING_TIMEOUT`` seconds ago, by the workers
+    that were stopped before sending them"""
+    stale_time = time.time() - SENDING_TIMEOUT
+    for file_name in os.listdir(outbox_dir):
+        if not file_name.endswith(SENDING_MESSAGE_SUFFIX):
+            continue
+        path = os.path.join(outbox_dir, file_name)
+        base_path = path[:-len(SENDING_MESSAGE_SUFFIX)]
+        try:
+            if os.path.getmtime(path) < stale_time:
+                os.rename(path, base_path + SPOOLED_MESSAGE_SUFFIX)
+        except OSError:
+            #claimed by another worker
+            continue
+
+def load_spooled_message(path):
+    """returns message unpickled from the file"""
+    spool_file = open(path, 'rb')
+    try:
+        return cPickle.load(spool_file)
+    finally:
+        spool_file.close()
+
+def send_spooled_messages(outbox_dir = None, max_count = None):
+    """sends messages saved in the outbox directory,
+    messages that failed to send due to transient errors
+    are left in the outbox, the others, as well as the
+    files that can't be read, are renamed to ``*.failed``
+
+    returns number of the sent messages
+    """
+    outbox_dir = outbox_dir or get_outbox_dir()
+    release_stale_messages(outbox_dir)
+    file_names = sorted([
+        name for name in os.listdir(outbox_dir)
+        if name.endswith(SPOOLED_MESSAGE_SUFFIX)
+    ])
+    if max_count is not None:
+        file_names = file_names[:max_count]
+
+    messages = list()
+    for file_name in file_names:
+        path = os.path.join(outbox_dir, file_name)
+        base_path = path[:-len(SPOOLED_MESSAGE_SUFFIX)]
+        sending_path = base_path + SENDING_MESSAGE_SUFFIX
+        try:
+            #claim the message, in case there are several workers,
+            #the claim time is recorded as the modification time
+            os.rename(path, sending_path)
+            os.utime(sending_path, None)
+        except OSError:
+            continue
+        try:
+            msg = load_spooled_message(sending_path)
+        except Exception, error:
+            logging.critical(
+                'could not load spooled email %s: %s' % (sending_path, error)
+            )
+            os.rename(sending_path, base_path + FAILED_MESSAGE_SUFFIX)
+            continue
+        msg.spool_path = sending_path
+        messages.append(msg)
+
+    failures = deliver_messages(messages, retries = SEND_RETRIES)
+    failed_paths = dict()
+    for msg, error in failures:
+        failed_paths[msg.spool_path] = error
+
+    for msg in messages:
+        path = msg.spool_path
+        base_path = path[:-len(SENDING_MESSAGE_SUFFIX)]
+        if path not in failed_paths:
+            os.remove(path)
+        elif is_transient_error(failed_paths[path]):
+            os.rename(path, base_path + SPOOLED_MESSAGE_SUFFIX)
+        else:
+            os.rename(path, base_path + FAILED_MESSAGE_SUFFIX)
+    return len(messages) - len(failures)
+
+def send_messages(messages, raise_on_failure = False, retries = 0):
+    """sends a list of email messages in batches, or
+    spools them, if the outbox directory is configured,
+    ``retries`` - number of re-sends after the transient
+    errors, see :func:`deliver_messages`
+
+    returns list of pairs (message, error) of the messages
+    that were not sent
+
+    if raise_on_failure is True and some message was not sent,
+    exceptions.EmailNotSent is raised
+    """
+    messages = list(messages)
+    if len(messages) == 0:
+        return list()
+
+    outbox_dir = get_outbox_dir()
+    if outbox_dir:
+        try:
+            spool_messages(messages, outbox_dir)
+            return list()
+        except (IOError, OSError), error:
+            logging.critical(
+                'could not spool email to %s: %s' % (outbox_dir, error)
+            )
+
+    failures = deliver_messages(messages, retries = retries)
+    if failures and raise_on_failure == True:
+        raise exceptions.EmailNotSent(unicode(failures[0][1]))
+    return failures
+
 def send_mail(
             subject_line = None,
             body_text = None,
@@ -101,23 +342,21 @@ def send_mail(
     if raise_on_failure is True, exceptions.EmailNotSent is raised
     """
     try:
-        assert(subject_line is not None)
-        subject_line = prefix_the_subject_line(subject_line)
-        msg = mail.EmailMessage(
-                        subject_line, 
-                        body_text, 
-                        from_email,
-                        recipient_list,
+        msg = build_message(
+                        subject_line = subject_line,
+                        body_text = body_text,
+                        from_email = from_email,
+                        recipient_list = recipient_list,
                         headers = headers
                     )
-        msg.content_subtype = 'html'
-        msg.send()
         if related_object is not None:
             assert(activity_type is not None)
     except Exception, error:
         logging.critical(unicode(error))
         if raise_on_failure == True:
             raise exceptions.EmailNotSent(unicode(error))
+        return
+    send_messages([msg], raise_on_failure = raise_on_failure)
 
 def mail_moderators(
             subject_line = '',
@@ -140,20 +379,15 @@ def mail_moderators(
     if hasattr(django_settings, 'DEFAULT_FROM_EMAIL'):
         from_email = django_settings.DEFAULT_FROM_EMAIL
 
-    try:
-        msg = mail.EmailMessage(
-                        subject_line, 
-                        body_text, 
-                        from_email,
-                        recipient_list,
-                        headers = headers or {}
-                    )
-        msg.content_subtype = 'html'
-        msg.send()
-    except smtplib.SMTPException, error:
-        logging.critical(unicode(error))
-        if raise_on_failure == True:
-            raise exceptions.EmailNotSent(unicode(error))
+    msg = mail.EmailMessage(
+                    subject_line, 
+                    body_text, 
+                    from_email,
+                    recipient_list,
+                    headers = headers or {}
+                )
+    msg.content_subtype = 'html'
+    send_messages([msg], raise_on_failure = raise_on_failure)
 
 INSTRUCTIONS_PREAMBLE = _('<p>To ask by email, please:</p>')
 QUESTION_TITLE_INSTRUCTION = _(
@@ -73,8 +73,7 @@ class NoArgsJob(NoArgsCommand):
                 changed_count += 1
             checked_count += 1
 
-            progress = 100*float(checked_count)/float(total_count)
-            console.print_progress(FORMAT_STRING, progress)
+            console.print_progress(checked_count, total_count)
         print FORMAT_STRING % 100
 
         if changed_count:
@@ -0,0 +1,813 @@
+"""askbot_benchmark management command
+adds a synthetic forum to the database and measures the typical
+requests against it: listing of the questions with the filters,
+question page, voting, answering, email alerts and search.
+
+The forum is generated from the random seed, with the bulk inserts,
+the same seed and sizes give the same forum on an empty database.
+The report - percentiles of the latency and the numbers of the
+database queries per scenario - is printed in json format,
+with ``--baseline`` the report of another commit is compared
+with the new one and the regressions are listed.
+
+The command adds content to the current database, run it
+on a scratch database:
+
+python manage.py askbot_benchmark --seed=1 --threads=1000 --output=new.json
+python manage.py askbot_benchmark --seed=1 --threads=1000 --baseline=old.json
+"""
+import datetime
+import functools
+import random
+import sys
+import time
+from optparse import make_option
+from django.conf import settings as django_settings
+from django.core import cache  # import cache, not from cache import cache, to be able to monkey-patch cache.cache in test cases
+from django.core import management
+from django.core import signals
+from django.core.management.base import NoArgsCommand, CommandError
+from django.core.management.color import no_style
+from django.core.urlresolvers import reverse
+from django.db import connection, connections, reset_queries, transaction
+from django.db.models import Max
+from django.test.client import Client
+from django.utils import simplejson
+import askbot
+from askbot import const
+from askbot import models
+from askbot.models.base import bulk_insert_objects
+from askbot.models.tag import get_global_group
+from askbot.models.user import AuthUserGroups
+from askbot.search import backends as search_backends
+from askbot.search import similarity
+from askbot.search.state_manager import SearchState
+from askbot.utils.console import choice_dialog
+
+SCENARIOS = (
+    'question_list',
+    'question_list_anonymous',
+    'question_page',
+    'question_page_anonymous',
+    'search',
+    'vote',
+    'answer',
+    'send_email_alerts',
+)
+LIST_SORT_METHODS = ('activity-desc', 'age-desc', 'answers-desc', 'votes-desc')
+PERCENTILES = (50, 90, 99)
+
+SYLLABLES = (
+    'ba', 'ko', 'ri', 'tem', 'lo', 'sun', 'ar', 'vel', 'di', 'nox',
+    'pra', 'mi', 'qua', 'zen', 'tor', 'el', 'fi', 'gan', 'hu', 'ste',
+)
+VOCABULARY_SIZE = 2000
+MAX_THREAD_TAGS = 5
+#probabilities
+GROUP_JOIN_RATE = 0.3
+PRIVATE_THREAD_RATE = 0.1
+ACCEPTED_ANSWER_RATE = 0.3
+DOWNVOTE_RATE = 0.1
+#frequencies of the email alerts, repeated values are picked more often
+FEED_FREQUENCIES = ('i', 'd', 'd', 'w', 'n')
+
+USER_PASSWORD = 'benchmark'
+#enough to vote and to answer
+RUNNER_REPUTATION = 10000
+
+
+def get_percentile(values, percent):
+    """nearest-rank percentile of the sorted values"""
+    index = int(round(percent / 100.0 * len(values) + 0.4999)) - 1
+    return values[min(max(index, 0), len(values) - 1)]
+
+def describe_values(values):
+    """returns mean, min, max and percentiles of the values"""
+    if len(values) == 0:
+        return None
+    values = sorted(values)
+    description = {
+        'mean': round(float(sum(values)) / len(values), 3),
+        'min': round(values[0], 3),
+        'max': round(values[-1], 3),
+    }
+    for percent in PERCENTILES:
+        description['p%d' % percent] = round(get_percentile(values, percent), 3)
+    return description
+
+def get_change(current, previous):
+    """change of the value in percent of the previous value"""
+    if previous == 0:
+        if current == 0:
+            return 0.0
+        return 100.0
+    return round(100.0 * (current - previous) / previous, 1)
+
+def compare_reports(report, baseline, tolerance):
+    """adds the changes against the baseline report to the
+    scenarios of the report, returns names of the scenarios
+    where the median latency or the mean number of the queries
+    grew by more than ``tolerance`` percent"""
+    regressions = list()
+    for name, current in report['scenarios'].items():
+        previous = baseline.get('scenarios', {}).get(name)
+        if previous is None:
+            continue
+        changes = dict()
+        for metric, stat in (
+            ('latency_ms', 'p50'),
+            ('latency_ms', 'p90'),
+            ('queries', 'mean'),
+        ):
+            changes['%s_%s' % (metric, stat)] = get_change(
+                                                current[metric][stat],
+                                                previous[metric][stat]
+                                            )
+        current['change_from_baseline'] = changes
+        if changes['latency_ms_p50'] > tolerance \
+            or changes['queries_mean'] > tolerance:
+            regressions.append(name)
+    regressions.sort()
+    return regressions
+
+
+class ForumGenerator(object):
+    """adds to the database a forum of the given size,
+    the content is determined by the random seed
+
+    counts of the answers, comments, votes and the tag uses
+    are consistent with the content, but the reputation of the
+    users does not follow the votes, no activity (inbox) records
+    and no personal groups are created
+    """
+
+    def __init__(self, seed, sizes):
+        self.random = random.Random(seed)
+        self.sizes = sizes
+        self.now = datetime.datetime.now()
+        self.start_time = self.now - datetime.timedelta(365)
+        self.next_ids = dict()
+        #unsaved objects per model, in the order of insertion
+        self.objects = dict()
+        self.model_order = list()
+
+        self.users = list()
+        self.groups = list()
+        self.user_groups = dict()
+        self.tags = list()
+        self.threads = list()
+        self.thread_group_ids = dict()
+        self.questions = list()
+        self.feed_ids = list()
+        self.vocabulary = self.make_vocabulary(VOCABULARY_SIZE)
+
+    def new_id(self, model):
+        if model not in self.next_ids:
+            max_id = model._default_manager.aggregate(Max('id'))['id__max']
+            self.next_ids[model] = (max_id or 0) + 1
+        value = self.next_ids[model]
+        self.next_ids[model] += 1
+        return value
+
+    def add(self, obj):
+        model = obj.__class__
+        if model not in self.objects:
+            self.objects[model] = list()
+            self.model_order.append(model)
+        self.objects[model].append(obj)
+        return obj
+
+    def random_time(self, after):
+        delta = self.now - after
+        seconds = delta.days * 24 * 60 * 60 + delta.seconds
+        return after + datetime.timedelta(0, self.random.randint(0, seconds))
+
+    def skewed_choice(self, items):
+        """picks an item, the first items are picked more often"""
+        return items[int(len(items) * self.random.random() ** 2)]
+
+    def random_count(self, mean):
+        return self.random.randint(0, 2 * mean)
+
+    def make_vocabulary(self, size):
+        words = set()
+        while len(words) < size:
+            length = self.random.randint(1, 4)
+            words.add(''.join([
+                self.random.choice(SYLLABLES) for i in range(length)
+            ]))
+        words = list(words)
+        words.sort()
+        self.random.shuffle(words)
+        return words
+
+    def make_words(self, count):
+        return ' '.join([
+            self.skewed_choice(self.vocabulary) for i in range(count)
+        ])
+
+    def make_text(self, max_paragraphs):
+        paragraphs = list()
+        for i in range(self.random.randint(1, max_paragraphs)):
+            paragraphs.append(
+                self.make_words(self.random.randint(5, 60)).capitalize() + '.'
+            )
+        return '\n\n'.join(paragraphs)
+
+    def make_post(self, post_type, thread, author, added_at, parent = None):
+        if post_type == 'comment':
+            text = self.make_words(self.random.randint(5, 30)).capitalize()
+        else:
+            text = self.make_text(4)
+        html = ''.join(['<p>%s</p>' % p for p in text.split('\n\n')])
+        post = self.add(models.Post(
+                    id = self.new_id(models.Post),
+                    post_type = post_type,
+                    thread_id = thread.id,
+                    parent_id = parent and parent.id,
+                    author_id = author.id,
+                    added_at = added_at,
+                    text = text,
+                    html = html,
+                    summary = text[:120]
+                ))
+        revision = models.PostRevision(
+                    id = self.new_id(models.PostRevision),
+                    post_id = post.id,
+                    revision = 1,
+                    author_id = author.id,
+                    revised_at = added_at,
+                    summary = unicode(const.POST_STATUS['default_version']),
+                    text = text,
+                    approved = True
+                )
+        if post_type == 'question':
+            revision.title = thread.title
+            revision.tagnames = thread.tagnames
+        self.add(revision)
+        for group_id in self.thread_group_ids[thread.id]:
+            self.add(models.PostToGroup(
+                    id = self.new_id(models.PostToGroup),
+                    post_id = post.id,
+                    group_id = group_id
+                ))
+        if post_type != 'comment':
+            self.add_votes(post)
+            comment_count = self.random_count(self.sizes['comments'])
+            for i in range(comment_count):
+                self.make_post(
+                    'comment',
+                    thread,
+                    self.skewed_choice(self.users),
+                    self.random_time(added_at),
+                    parent = post
+                )
+            post.comment_count = comment_count
+        return post
+
+    def add_votes(self, post):
+        count = min(self.random_count(self.sizes['votes']), len(self.users))
+        for voter in self.random.sample(self.users, count):
+            if voter.id == post.author_id:
+                continue
+            if self.random.random() < DOWNVOTE_RATE:
+                vote = models.Vote.VOTE_DOWN
+                post.vote_down_count += 1
+            else:
+                vote = models.Vote.VOTE_UP
+                post.vote_up_count += 1
+            self.add(models.Vote(
+                    id = self.new_id(models.Vote),
+                    user_id = voter.id,
+                    voted_post_id = post.id,
+                    vote = vote,
+                    voted_at = self.random_time(post.added_at)
+                ))
+        post.score = post.vote_up_count - post.vote_down_count
+
+    def create_users(self):
+        password_holder = models.User()
+        password_holder.set_password(USER_PASSWORD)
+        for i in range(self.sizes['users']):
+            user_id = self.new_id(models.User)
+            joined_at = self.random_time(self.start_time)
+            last_seen = self.random_time(joined_at)
+            self.users.append(self.add(models.User(
+                    id = user_id,
+                    username = 'benchmark_user_%d' % user_id,
+                    email = 'benchmark_user_%d@example.com' % user_id,
+                    password = password_holder.password,
+                    date_joined = joined_at,
+                    last_login = last_seen,
+                    last_seen = last_seen,
+                    email_isvalid = True,
+                    reputation = 1 + int(1000 * self.random.random() ** 3)
+                )))
+
+    def create_groups(self):
+        self.global_group = get_global_group()
+        for i in range(self.sizes['groups']):
+            self.groups.append(
+                models.Group.objects.get_or_create(name = 'benchmark-group-%d' % i)
+            )
+        for user in self.users:
+            groups = [self.global_group] + [
+                group for group in self.groups
+                if self.random.random() < GROUP_JOIN_RATE
+            ]
+            self.user_groups[user.id] = groups
+            for group in groups:
+                link = self.add(AuthUserGroups(
+                        id = self.new_id(AuthUserGroups),
+                        user_id = user.id,
+                        group_id = group.id
+                    ))
+                self.add(models.GroupMembership(
+                        authusergroups_ptr_id = link.id,
+                        level = models.GroupMembership.FULL
+                    ))
+
+    def create_tags(self):
+        creator = self.users[0]
+        for i in range(self.sizes['tags']):
+            tag_id = self.new_id(models.Tag)
+            name = '%s%d' % (self.vocabulary[i % len(self.vocabulary)], tag_id)
+            self.tags.append(self.add(models.Tag(
+                    id = tag_id,
+                    name = name,
+                    created_by_id = creator.id
+                )))
+
+    def create_threads(self):
+        through_tags = models.Thread.tags.through
+        through_followers = models.Thread.followed_by.through
+        for i in range(self.sizes['threads']):
+            author = self.skewed_choice(self.users)
+            asked_at = self.random_time(author.date_joined)
+
+            tags = list()
+            for j in range(self.random.randint(1, MAX_THREAD_TAGS)):
+                tag = self.skewed_choice(self.tags)
+                if tag not in tags:
+                    tags.append(tag)
+
+            thread = self.add(models.Thread(
+                        id = self.new_id(models.Thread),
+                        title = self.make_words(
+                                    self.random.randint(4, 10)
+                                ).capitalize()[:250] + '?',
+                        tagnames = ' '.join([tag.name for tag in tags]),
+                        added_at = asked_at,
+                        last_activity_at = asked_at,
+                        last_activity_by_id = author.id,
+                        view_count = self.random.randint(0, 1000)
+                    ))
+            self.threads.append(thread)
+
+            for tag in tags:
+                tag.used_count += 1
+                self.add(through_tags(
+                        id = self.new_id(through_tags),
+                        thread_id = thread.id,
+                        tag_id = tag.id
+                    ))
+
+            if self.groups and self.random.random() < PRIVATE_THREAD_RATE:
+                group_ids = [self.random.choice(self.groups).id]
+            else:
+                group_ids = [self.global_group.id]
+            self.thread_group_ids[thread.id] = group_ids
+            for group_id in group_ids:
+                self.add(models.ThreadToGroup(
+                        id = self.new_id(models.ThreadToGroup),
+                        thread_id = thread.id,
+                        group_id = group_id
+                    ))
+
+            question = self.make_post('question', thread, author, asked_at)
+            self.questions.append(question)
+            thread.score = question.score
+
+            followers = set([author.id])
+            answers = list()
+            for j in range(self.random_count(self.sizes['answers'])):
+                answerer = self.skewed_choice(self.users)
+                answer = self.make_post(
+                                'answer',
+                                thread,
+                                answerer,
+                                self.random_time(asked_at)
+                            )
+                answers.append(answer)
+                followers.add(answerer.id)
+                if answer.added_at > thread.last_activity_at:
+                    thread.last_activity_at = answer.added_at
+                    thread.last_activity_by_id = answerer.id
+            thread.answer_count = len(answers)
+
+            if answers and self.random.random() < ACCEPTED_ANSWER_RATE:
+                accepted = self.random.choice(answers)
+                thread.accepted_answer_id = accepted.id
+                thread.answer_accepted_at = self.random_time(accepted.added_at)
+
+            for j in range(self.random_count(self.sizes['subscriptions'])):
+                followers.add(self.skewed_choice(self.users).id)
+            for user_id in sorted(followers):
+                self.add(through_followers(
+                        id = self.new_id(through_followers),
+                        thread_id = thread.id,
+                        user_id = user_id
+                    ))
+
+    def create_email_subscriptions(self):
+        for user in self.users:
+            for feed_type in models.EmailFeedSetting.FEED_TYPES:
+                feed = self.add(models.EmailFeedSetting(
+                            id = self.new_id(models.EmailFeedSetting),
+                            subscriber_id = user.id,
+                            feed_type = feed_type,
+                            frequency = self.random.choice(FEED_FREQUENCIES),
+                            added_at = user.date_joined
+                        ))
+                self.feed_ids.append(feed.id)
+
+    def save(self):
+        """inserts the objects and resets the sequences
+        of the primary keys, which were assigned explicitly"""
+        for model in self.model_order:
+            bulk_insert_objects(self.objects[model])
+        cursor = connection.cursor()
+        sequence_models = [model for model in self.model_order if model in self.next_ids]
+        for statement in connection.ops.sequence_reset_sql(no_style(), sequence_models):
+            cursor.execute(statement)
+
+    def rebuild_indexes(self):
+        """rebuilds the data derived from the tags and the
+        texts of the threads, which is normally maintained
+        on save of the posts"""
+        thread_tags = models.Thread.tags.through.objects.order_by(
+                                'thread', 'tag'
+                            ).values_list('thread', 'tag')
+        models.TagCooccurrence.objects.rebuild(thread_tags.iterator())
+
+        index = similarity.build_index()
+        for thread_id in index.get_thread_ids():
+            similarity.save_similar_threads(
+                            thread_id,
+                            index.get_neighbors(thread_id, max_candidates = None)
+                        )
+
+        thread_ids = list(
+            models.Thread.objects.order_by('id').values_list('id', flat = True)
+        )
+        batch_size = 200
+        search_backends.get_backend().rebuild([
+            thread_ids[start:start + batch_size]
+            for start in range(0, len(thread_ids), batch_size)
+        ])
+
+    @transaction.commit_on_success
+    def generate(self):
+        self.create_users()
+        self.create_groups()
+        self.create_tags()
+        self.create_threads()
+        self.create_email_subscriptions()
+        self.save()
+        self.rebuild_indexes()
+        #content was added bypassing the cache invalidation
+        cache.cache.clear()
+
+    def get_counts(self):
+        counts = dict()
+        for name, model in (
+            ('users', models.User),
+            ('threads', models.Thread),
+            ('posts', models.Post),
+            ('votes', models.Vote),
+        ):
+            counts[name] = len(self.objects.get(model, ()))
+        return counts
+
+
+class Benchmark(object):
+    """runs the scenarios of requests against the forum,
+    records the latency and the database queries of each request
+    """
+
+    def __init__(self, forum, seed, request_count, alert_runs):
+        self.forum = forum
+        self.random = random.Random(seed)
+        self.request_count = request_count
+        self.alert_runs = alert_runs
+
+        user_id = forum.new_id(models.User)
+        self.user = models.User.objects.create_user(
+                                'benchmark_runner_%d' % user_id,
+                                'benchmark_runner_%d@example.com' % user_id,
+                                USER_PASSWORD
+                            )
+        self.user.reputation = RUNNER_REPUTATION
+        self.user.save()
+
+        self.client = Client()
+        self.client.login(method = 'force', user_id = self.user.id)
+        self.anonymous_client = Client()
+
+    def get_list_url(self, query = None):
+        if query:
+            sort = 'relevance-desc'
+            scope = 'all'
+            tags = None
+        else:
+            sort = self.random.choice(LIST_SORT_METHODS)
+            scope = self.random.choice(('all', 'all', 'unanswered'))
+            tags = None
+            if self.random.random() < 0.5:
+                tags = self.forum.skewed_choice(self.forum.tags).name
+        return SearchState(
+                    scope = scope,
+                    sort = sort,
+                    query = query,
+                    tags = tags,
+                    author = None,
+                    page = self.random.randint(1, 3),
+                    user_logged_in = True
+                ).full_url()
+
+    def sample_questions(self):
+        count = min(self.request_count, len(self.forum.questions))
+        return self.random.sample(self.forum.questions, count)
+
+    def get_list_requests(self, client):
+        return [
+            (None, functools.partial(client.get, self.get_list_url()))
+            for i in range(self.request_count)
+        ]
+
+    def get_page_requests(self, client):
+        return [
+            (None, functools.partial(client.get, question.get_absolute_url()))
+            for question in self.sample_questions()
+        ]
+
+    def get_question_list_requests(self):
+        return self.get_list_requests(self.client)
+
+    def get_question_list_anonymous_requests(self):
+        return self.get_list_requests(self.anonymous_client)
+
+    def get_question_page_requests(self):
+        return self.get_page_requests(self.client)
+
+    def get_question_page_anonymous_requests(self):
+        return self.get_page_requests(self.anonymous_client)
+
+    def get_search_requests(self):
+        requests = list()
+        for i in range(self.request_count):
+            query = self.forum.make_words(self.random.randint(1, 2))
+            url = self.get_list_url(query = query)
+            requests.append((None, functools.partial(self.client.get, url)))
+        return requests
+
+    def get_vote_requests(self):
+        return [
+            (None, functools.partial(
+                    self.client.post,
+                    reverse('vote', kwargs = {'id': question.id}),
+                    {'type': '1'},
+                    HTTP_X_REQUESTED_WITH = 'XMLHttpRequest'
+                ))
+            for question in self.sample_questions()
+        ]
+
+    def get_answer_requests(self):
+        return [
+            (None, functools.partial(
+                    self.client.post,
+                    reverse('answer', kwargs = {'id': question.id}),
+                    {'text': self.forum.make_text(3)}
+                ))
+            for question in self.sample_questions()
+        ]
+
+    def get_send_email_alerts_requests(self):
+        def reset_reports():
+            models.EmailFeedSetting.objects.filter(
+                            id__in = self.forum.feed_ids
+                        ).update(reported_at = None)
+        send_alerts = functools.partial(
+                            management.call_command,
+                            'send_email_alerts',
+                            verbosity = 0
+                        )
+        return [(reset_reports, send_alerts)] * self.alert_runs
+
+    def measure(self, request):
+        for db_connection in connections.all():
+            db_connection.queries = list()
+        start_time = time.time()
+        response = request()
+        latency = 1000 * (time.time() - start_time)
+        queries = list()
+        for db_connection in connections.all():
+            queries.extend(db_connection.queries)
+        sql_time = 1000 * sum([float(query['time']) for query in queries])
+        return response, latency, len(queries), sql_time
+
+    def run_scenario(self, name):
+        requests = getattr(self, 'get_%s_requests' % name)()
+        latencies = list()
+        query_counts = list()
+        sql_times = list()
+        status_codes = dict()
+        for prepare, request in requests:
+            if prepare:
+                prepare()
+            response, latency, query_count, sql_time = self.measure(request)
+            latencies.append(latency)
+            query_counts.append(query_count)
+            sql_times.append(sql_time)
+            if response is not None:
+                code = str(response.status_code)
+                status_codes[code] = status_codes.get(code, 0) + 1
+        return {
+            'requests': len(requests),
+            'errors': sum([
+                count for code, count in status_codes.items()
+                if int(code) >= 400
+            ]),
+            'status_codes': status_codes,
+            'latency_ms': describe_values(latencies),
+            'queries': describe_values(query_counts),
+            'sql_ms': describe_values(sql_times),
+        }
+
+    def warm_up(self):
+        """first requests load the settings and fill the caches"""
+        url = reverse('questions')
+        self.client.get(url)
+        self.anonymous_client.get(url)
+
+    def run(self, scenarios):
+        """returns dictionary of the statistics per scenario"""
+        debug_cursors = list()
+        for db_connection in connections.all():
+            debug_cursors.append((db_connection, db_connection.use_debug_cursor))
+            db_connection.use_debug_cursor = True
+        #queries are cleared before each measured request instead
+        signals.request_started.disconnect(reset_queries)
+        email_backend = django_settings.EMAIL_BACKEND
+        django_settings.EMAIL_BACKEND = 'django.core.mail.backends.locmem.EmailBackend'
+        try:
+            self.warm_up()
+            results = dict()
+            for name in scenarios:
+                results[name] = self.run_scenario(name)
+            return results
+        finally:
+            django_settings.EMAIL_BACKEND = email_backend
+            signals.request_started.connect(reset_queries)
+            for db_connection, use_debug_cursor in debug_cursors:
+                db_connection.use_debug_cursor = use_debug_cursor
+                db_connection.queries = list()
+
+
+class Command(NoArgsCommand):
+    help = 'Adds a synthetic forum to the database and reports ' + \
+        'the latency and the numbers of the queries of the typical ' + \
+        'requests in json format, times are in milliseconds'
+    option_list = NoArgsCommand.option_list + (
+        make_option('--seed', action = 'store', type = 'int',
+            dest = 'seed', default = 1,
+            help = 'seed of the random content and requests'),
+        make_option('--users', action = 'store', type = 'int',
+            dest = 'users', default = 100,
+            help = 'number of the users'),
+        make_option('--threads', action = 'store', type = 'int',
+            dest = 'threads', default = 200,
+            help = 'number of the questions'),
+        make_option('--answers', action = 'store', type = 'int',
+            dest = 'answers', default = 3,
+            help = 'mean number of the answers per question'),
+        make_option('--comments', action = 'store', type = 'int',
+            dest = 'comments', default = 1,
+            help = 'mean number of the comments per question and answer'),
+        make_option('--votes', action = 'store', type = 'int',
+            dest = 'votes', default = 2,
+            help = 'mean number of the votes per question and answer'),
+        make_option('--tags', action = 'store', type = 'int',
+            dest = 'tags', default = 50,
+            help = 'number of the tags'),
+        make_option('--groups', action = 'store', type = 'int',
+            dest = 'groups', default = 3,
+            help = 'number of the groups, besides the global group'),
+        make_option('--subscriptions', action = 'store', type = 'int',
+            dest = 'subscriptions', default = 2,
+            help = 'mean number of the followers per question, ' + \
+                'besides the author and the answerers'),
+        make_option('--requests', action = 'store', type = 'int',
+            dest = 'requests', default = 20,
+            help = 'number of the requests per scenario'),
+        make_option('--alert-runs', action = 'store', type = 'int',
+            dest = 'alert_runs', default = 3,
+            help = 'number of the runs of the send_email_alerts command'),
+        make_option('--scenarios', action = 'store', type = 'string',
+            dest = 'scenarios', default = ','.join(SCENARIOS),
+            help = 'comma separated scenarios to run, of: ' + \
+                ', '.join(SCENARIOS)),
+        make_option('--output', action = 'store', type = 'string',
+            dest = 'output', default = None,
+            help = 'file to save the report, by default it is printed'),
+        make_option('--baseline', action = 'store', type = 'string',
+            dest = 'baseline', default = None,
+            help = 'report to compare with, the command fails ' + \
+                'if any scenario regressed'),
+        make_option('--tolerance', action = 'store', type = 'float',
+            dest = 'tolerance', default = 20,
+            help = 'allowed growth, in percent, of the median latency ' + \
+                'and the mean number of the queries against the baseline'),
+        make_option('--noinput', action = 'store_false',
+            dest = 'interactive', default = True,
+            help = 'Do not prompt the user for input of any kind.'),
+    )
+
+    def handle_noargs(self, **options):
+        scenarios = [
+            name.strip() for name in options['scenarios'].split(',')
+            if name.strip()
+        ]
+        for name in scenarios:
+            if name not in SCENARIOS:
+                raise CommandError('unknown scenario %s' % name)
+
+        baseline = None
+        if options['baseline']:
+            baseline = simplejson.load(open(options['baseline']))
+
+        if options.get('interactive', True):
+            answer = choice_dialog(
+                'This command will ADD the synthetic content to the '
+                'current database. Are you sure you want to proceed?',
+                choices = ('yes', 'no',)
+            )
+            if answer != 'yes':
+                return
+
+        sizes = dict()
+        for key in (
+            'users', 'threads', 'answers', 'comments', 'votes',
+            'tags', 'groups', 'subscriptions'
+        ):
+            sizes[key] = options[key]
+        if sizes['users'] < 1 or sizes['threads'] < 1 or sizes['tags'] < 1:
+            raise CommandError('at least one user, thread and tag is required')
+
+        verbosity = int(options.get('verbosity', 1))
+        if verbosity > 1:
+            sys.stderr.write('generating the forum\n')
+        start_time = time.time()
+        forum = ForumGenerator(options['seed'], sizes)
+        forum.generate()
+        generation_time = time.time() - start_time
+
+        if verbosity > 1:
+            sys.stderr.write('running the scenarios\n')
+        benchmark = Benchmark(
+                        forum,
+                        options['seed'],
+                        options['requests'],
+                        options['alert_runs']
+                    )
+        report = {
+            'askbot_version': askbot.get_version(),
+            'database': connection.vendor,
+            'seed': options['seed'],
+            'sizes': sizes,
+            'generation': {
+                'seconds': round(generation_time, 3),
+                'counts': forum.get_counts(),
+            },
+            'scenarios': benchmark.run(scenarios),
+        }
+
+        regressions = list()
+        if baseline:
+            regressions = compare_reports(report, baseline, options['tolerance'])
+            report['regressions'] = regressions
+
+        output = simplejson.dumps(report, indent = 2, sort_keys = True) + '\n'
+        if options['output']:
+            output_file = open(options['output'], 'w')
+            try:
+                output_file.write(output)
+            finally:
+                output_file.close()
+        else:
+            self.stdout.write(output)
+
+        if regressions:
+            raise CommandError(
+                'performance regressions in: %s' % ', '.join(regressions)
+            )
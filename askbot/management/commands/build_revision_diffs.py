@@ -0,0 +1,29 @@
+"""Computes and stores the html diffs of the post revisions
+saved before the diffs were stored with the revisions
+"""
+from askbot.management import NoArgsJob
+from askbot import models
+
+def build_revision_diff(revision):
+    """a unit of job - returns True if the diff was stored"""
+    if revision.diff is not None:
+        return False
+    revision.update_diff()
+    return True
+
+class Command(NoArgsJob):
+    """definition of the job that stores the
+    diffs of the post revisions
+    """
+    def __init__(self, *args, **kwargs):
+        self.batches = ({
+            'title': 'Building diffs of the post revisions: ',
+            'query_set': models.PostRevision.objects.filter(
+                                    diff__isnull = True,
+                                    post__post_type__in = ('question', 'answer')
+                                ),
+            'function': build_revision_diff,
+            'changed_count_message': 'Stored diffs of %d revisions',
+            'nothing_changed_message': 'All revisions have diffs'
+        },)
+        super(Command, self).__init__(*args, **kwargs)
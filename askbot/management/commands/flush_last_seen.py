@@ -0,0 +1,16 @@
+"""flush_last_seen management command
+saves times of the last visits of the users accumulated
+in the cache to the database, may be run from cron:
+
+python manage.py flush_last_seen
+"""
+from django.core.management.base import NoArgsCommand
+from askbot.models.user import flush_last_seen
+
+class Command(NoArgsCommand):
+    help = 'Saves buffered times of the last visits of the users to the database'
+
+    def handle_noargs(self, **options):
+        count = flush_last_seen()
+        if int(options.get('verbosity', 1)) > 1:
+            print 'updated last visit times of %d users' % count
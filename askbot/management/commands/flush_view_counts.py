@@ -0,0 +1,16 @@
+"""flush_view_counts management command
+saves thread view counts accumulated in the cache
+to the database, may be run from cron:
+
+python manage.py flush_view_counts
+"""
+from django.core.management.base import NoArgsCommand
+from askbot.models import Thread
+
+class Command(NoArgsCommand):
+    help = 'Saves buffered thread view counts to the database'
+
+    def handle_noargs(self, **options):
+        count = Thread.objects.flush_view_counts()
+        if int(options.get('verbosity', 1)) > 1:
+            print 'updated view counts of %d threads' % count
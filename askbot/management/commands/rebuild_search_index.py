@@ -0,0 +1,40 @@
+"""Builds the index of the search backend from scratch,
+see :mod:`askbot.search.backends`
+"""
+from optparse import make_option
+from django.core.management.base import NoArgsCommand
+from askbot.models import Thread
+from askbot.search import backends as search_backends
+from askbot.utils.console import ProgressBar
+
+def iter_thread_id_batches(thread_ids, batch_size):
+    batch = list()
+    for thread_id in thread_ids:
+        batch.append(thread_id)
+        if len(batch) == batch_size:
+            yield batch
+            batch = list()
+    if batch:
+        yield batch
+
+class Command(NoArgsCommand):
+    help = 'Builds the index of the search backend from scratch'
+    option_list = NoArgsCommand.option_list + (
+        make_option('--batch-size',
+            action = 'store',
+            type = 'int',
+            dest = 'batch_size',
+            default = 200,
+            help = 'number of threads loaded from the database at once'
+        ),
+    )
+
+    def handle_noargs(self, **options):
+        batch_size = options['batch_size']
+        thread_ids = Thread.objects.order_by('id').values_list('id', flat = True)
+        count = thread_ids.count()
+        message = 'Indexing threads'
+        thread_ids = ProgressBar(thread_ids.iterator(), count, message)
+        search_backends.get_backend().rebuild(
+            iter_thread_id_batches(thread_ids, batch_size)
+        )
@@ -0,0 +1,38 @@
+"""Precomputes lists of similar threads for all threads,
+see :mod:`askbot.search.similarity`
+"""
+from optparse import make_option
+from django.core.management.base import NoArgsCommand
+from django.db import transaction
+from askbot.search import similarity
+from askbot.utils.console import ProgressBar
+
+class Command(NoArgsCommand):
+    help = 'Precomputes lists of similar threads for all threads'
+    option_list = NoArgsCommand.option_list + (
+        make_option('--chunk-size',
+            action = 'store',
+            type = 'int',
+            dest = 'chunk_size',
+            default = 200,
+            help = 'number of threads saved in one transaction'
+        ),
+    )
+
+    @transaction.commit_manually
+    def handle_noargs(self, **options):
+        index = similarity.build_index()
+        thread_ids = sorted(index.get_thread_ids())
+        chunk_size = options['chunk_size']
+        message = 'Computing similar threads'
+        count = len(thread_ids)
+        done = 0
+        for thread_id in ProgressBar(iter(thread_ids), count, message):
+            neighbors = index.get_neighbors(
+                                thread_id, max_candidates = None
+                            )
+            similarity.save_similar_threads(thread_id, neighbors)
+            done += 1
+            if done % chunk_size == 0:
+                transaction.commit()
+        transaction.commit()
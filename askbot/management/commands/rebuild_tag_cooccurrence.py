@@ -0,0 +1,21 @@
+from django.core.management.base import NoArgsCommand
+from django.db import transaction
+from askbot.models import Thread, TagCooccurrence
+from askbot.search import similarity
+
+class Command(NoArgsCommand):
+    help = 'Recounts the numbers of threads shared by the pairs of tags'
+
+    @transaction.commit_on_success
+    def handle_noargs(self, **options):
+        #tags of the deleted questions are not counted
+        deleted_ids = similarity.get_deleted_thread_ids()
+        thread_tags = Thread.tags.through.objects.order_by(
+                                'thread', 'tag'
+                            ).values_list('thread', 'tag')
+        count = TagCooccurrence.objects.rebuild(
+                    item for item in thread_tags.iterator()
+                    if item[0] not in deleted_ids
+                )
+        if int(options.get('verbosity', 1)) > 0:
+            print 'Saved counts of %d pairs of tags' % count
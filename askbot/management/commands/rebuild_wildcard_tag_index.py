@@ -0,0 +1,20 @@
+from django.core.management.base import NoArgsCommand
+from django.db import transaction
+from askbot.models import User, WildcardTagPrefix
+from askbot.utils.console import ProgressBar
+
+class Command(NoArgsCommand):
+    help = 'Rebuilds index of wildcard tag selections of the users'
+
+    @transaction.commit_manually
+    def handle_noargs(self, **options):
+        WildcardTagPrefix.objects.all().delete()
+        users = User.objects.exclude(
+                                interesting_tags = '', ignored_tags = ''
+                            )
+        message = "Rebuilding wildcard tag index"
+        count = users.count()
+        for user in ProgressBar(users.iterator(), count, message):
+            WildcardTagPrefix.objects.rebuild_for_user(user)
+            transaction.commit()
+        transaction.commit()
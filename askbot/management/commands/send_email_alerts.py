@@ -1,10 +1,36 @@
+"""Sends delayed (daily and weekly) email digests of updated questions.
+
+The digests are built for chunks of users at a time with a small
+number of set-based queries per chunk instead of running
+a separate series of queries per user and per question:
+
+* subscriptions - email feed settings of the users are loaded
+  in bulk and the ripe feeds are marked as reported with one update
+* candidates - followed, asked and answered questions,
+  comments and mentions are loaded for the whole chunk,
+  "entire forum" feeds walk a shared stream of the recently
+  active questions, loaded page by page
+* activities - records of the previously sent emails are loaded
+  for all (user, question) pairs at once
+* news - revisions and answers of the candidate questions
+  are loaded in bulk and counted in python
+* write - email activity records are updated and created in bulk
+* send - the emails are composed and sent in a batch,
+  see :func:`askbot.mail.send_messages`
+
+The chunks can be processed in a pool of worker processes
+(option ``--processes``), time spent in each phase is printed
+when the command is run with ``--verbosity=2``.
+"""
 import datetime
+import time
+from optparse import make_option
 from django.core.management.base import NoArgsCommand
 from django.core.urlresolvers import reverse
-from django.db import connection
-from django.db.models import Q, F
-from askbot.models import User, Post, PostRevision, Thread
-from askbot.models import Activity, EmailFeedSetting
+from django.db import connection, transaction
+from askbot.models import User, Post, PostRevision, PostToGroup, Thread
+from askbot.models import Activity, ActivityAuditStatus, EmailFeedSetting
+from askbot.models import MarkedTag, QuestionView
 from django.utils.translation import ugettext as _
 from django.utils.translation import ungettext
 from django.conf import settings as django_settings
@@ -12,25 +38,44 @@ from askbot.conf import settings as askbot_settings
 from django.utils.datastructures import SortedDict
 from django.contrib.contenttypes.models import ContentType
 from askbot import const
+from askbot import forms
 from askbot import mail
 from askbot.utils.slug import slugify
 
 DEBUG_THIS_COMMAND = False
 
-def get_all_origin_posts(mentions):
-    origin_posts = set()
-    for mention in mentions:
-        post = mention.content_object
-        origin_posts.add(post.get_origin_post())
-    return list(origin_posts)
+#number of users whose digests are built together
+CHUNK_SIZE = getattr(django_settings, 'ASKBOT_EMAIL_ALERTS_CHUNK_SIZE', 200)
+#max number of values in the sql "in" clauses
+IN_CLAUSE_SIZE = 500
+#number of questions loaded per page of the "entire forum" stream
+STREAM_PAGE_SIZE = 500
+#"email sent" timestamp of the questions never emailed about
+NEVER_EMAILED = datetime.datetime(1970, 1, 1)
+
+#visit status of the question per user
+NOT_SEEN = 'not_seen'
+SEEN_BEFORE_UPDATE = 'seen_before_update'
+
+QUESTION_FIELDS = (
+    'id',
+    'thread',
+    'author',
+    'added_at',
+    'deleted',
+    'approved',
+    'thread__last_activity_at',
+    'thread__last_activity_by',
+    'thread__closed',
+)
 
 #todo: refactor this as class
 def extend_question_list(
-                    src, dst, cutoff_time = None, 
+                    src, dst, cutoff_time = None,
                     limit=False, add_mention=False,
                     add_comment = False
                 ):
-    """src is a query set with questions
+    """src is a list of question ids
     or None
     dst - is an ordered dictionary
     update reporting cutoff time for each question
@@ -41,10 +86,7 @@ def extend_question_list(
     if limit and len(dst.keys()) >= askbot_settings.MAX_ALERTS_PER_EMAIL:
         return
     if cutoff_time is None:
-        if hasattr(src, 'cutoff_time'):
-            cutoff_time = src.cutoff_time
-        else:
-            raise ValueError('cutoff_time is a mandatory parameter')
+        raise ValueError('cutoff_time is a mandatory parameter')
 
     for q in src:
         if q in dst:
@@ -73,421 +115,912 @@ def format_action_count(string, number, output):
     if number > 0:
         output.append(_(string) % {'num':number})
 
-class Command(NoArgsCommand):
-    def handle_noargs(self, **options):
-        if askbot_settings.ENABLE_EMAIL_ALERTS:
-            try:
-                try:
-                    self.send_email_alerts()
-                except Exception, e:
-                    print e
-            finally:
-                connection.close()
+def iter_chunks(items, size):
+    """yields consecutive slices of the list"""
+    items = list(items)
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+def filter_in_chunks(queryset, field_name, values):
+    """yields rows of the query set filtered by
+    ``<field_name>__in`` the values, splitting
+    the values to limit size of the queries"""
+    lookup = field_name + '__in'
+    for chunk in iter_chunks(values, IN_CLAUSE_SIZE):
+        for row in queryset.filter(**{lookup: chunk}):
+            yield row
+
+
+class PhaseTimer(object):
+    """accumulates wall clock time spent in the phases
+    of the digest building"""
+    def __init__(self):
+        self.timings = SortedDict()
+        self.phase = None
+        self.started_at = None
+
+    def start(self, phase):
+        self.stop()
+        self.phase = phase
+        self.started_at = time.time()
+
+    def stop(self):
+        if self.phase is not None:
+            elapsed = time.time() - self.started_at
+            self.timings[self.phase] = self.timings.get(self.phase, 0) + elapsed
+            self.phase = None
+
+    def add(self, timings):
+        """adds timings collected elsewhere, e.g. in a worker process"""
+        for phase, elapsed in timings.items():
+            self.timings[phase] = self.timings.get(phase, 0) + elapsed
+
+    def format_report(self):
+        lines = list()
+        for phase, elapsed in self.timings.items():
+            lines.append('%-16s %8.3fs' % (phase, elapsed))
+        lines.append('%-16s %8.3fs' % ('total', sum(self.timings.values())))
+        return '\n'.join(lines) + '\n'
+
+
+class QuestionRecord(object):
+    """fields of a question needed to build the digests,
+    loaded without instantiating the model objects"""
+    def __init__(self, row):
+        (
+            self.id,
+            self.thread_id,
+            self.author_id,
+            self.added_at,
+            self.deleted,
+            self.approved,
+            self.last_activity_at,
+            self.last_activity_by_id,
+            self.closed
+        ) = row
+        self.tag_ids = set()
+        self.tag_names = list()
+
+    def get_order_key(self):
+        """most recently active questions go first"""
+        return (self.last_activity_at, self.id)
+
+
+class QuestionIndex(object):
+    """question records loaded within the run of the command,
+    shared by the chunks of users processed in the same process
+
+    ``stream`` is the list of open questions ordered by
+    the last activity, loaded page by page on demand
+    for the "entire forum" subscriptions
+    """
+    def __init__(self, require_approval = False):
+        self.require_approval = require_approval
+        self.by_id = dict()
+        self.by_thread_id = dict()
+        self.stream = list()
+        self.stream_exhausted = False
+
+    def add_rows(self, rows):
+        records = list()
+        for row in rows:
+            record = QuestionRecord(row)
+            self.by_id[record.id] = record
+            self.by_thread_id[record.thread_id] = record
+            records.append(record)
+        return records
+
+    def load_questions(self, question_ids):
+        missing_ids = [qid for qid in set(question_ids) if qid not in self.by_id]
+        questions = Post.objects.get_questions().values_list(*QUESTION_FIELDS)
+        self.add_rows(filter_in_chunks(questions, 'id', missing_ids))
+
+    def load_threads(self, thread_ids):
+        missing_ids = [
+            tid for tid in set(thread_ids) if tid not in self.by_thread_id
+        ]
+        questions = Post.objects.get_questions().values_list(*QUESTION_FIELDS)
+        self.add_rows(filter_in_chunks(questions, 'thread', missing_ids))
+
+    def get_question_by_thread_id(self, thread_id):
+        return self.by_thread_id.get(thread_id, None)
+
+    def load_stream_page(self):
+        questions = Post.objects.get_questions().filter(
+                                deleted = False, thread__closed = False
+                            )
+        if self.require_approval:
+            questions = questions.filter(approved = True)
+        start = len(self.stream)
+        rows = questions.order_by(
+                            '-thread__last_activity_at', '-id'
+                        ).values_list(
+                            *QUESTION_FIELDS
+                        )[start:start + STREAM_PAGE_SIZE]
+        records = self.add_rows(rows)
+        if len(records) < STREAM_PAGE_SIZE:
+            self.stream_exhausted = True
+
+        threads = dict((record.thread_id, record) for record in records)
+        thread_tags = Thread.tags.through.objects.filter(
+                                thread__in = threads.keys()
+                            ).values_list('thread', 'tag', 'tag__name')
+        for thread_id, tag_id, tag_name in thread_tags:
+            record = threads[thread_id]
+            record.tag_ids.add(tag_id)
+            record.tag_names.append(tag_name)
+        self.stream.extend(records)
+
+    def get_stream_record(self, position):
+        """returns record at the position of the stream
+        or ``None`` if the stream is shorter"""
+        while position >= len(self.stream) and not self.stream_exhausted:
+            self.load_stream_page()
+        if position < len(self.stream):
+            return self.stream[position]
+        return None
 
-    def get_updated_questions_for_user(self, user):
+
+class UserDigest(object):
+    """data of the email digest for one user"""
+    def __init__(self, user):
+        self.user = user
+        #feed type -> cutoff time, only for the feeds due to be sent
+        self.cutoffs = dict()
+        #question id -> list of the visit timestamps
+        self.views = dict()
+        self.followed_thread_ids = set()
+        self.asked_question_ids = set()
+        self.answered_thread_ids = set()
+        #thread ids, one per comment
+        self.commented_thread_ids = list()
+        self.mentioned_thread_ids = set()
+        self.marked_tag_ids = {'good': set(), 'bad': set(), 'subscribed': set()}
+        self.group_ids = set()
+        #question id -> meta data, see extend_question_list()
+        self.q_list = SortedDict()
+
+    def is_candidate(self, record, require_approval = False):
+        """same conditions as in the base query set of the
+        questions in the previous version of this command"""
+        if record.deleted or record.closed:
+            return False
+        if require_approval and not record.approved:
+            return False
+        if record.last_activity_by_id == self.user.id:
+            return False
+        return record.last_activity_at >= self.user.date_joined
+
+    def get_visit_status(self, record):
+        """returns ``NOT_SEEN``, ``SEEN_BEFORE_UPDATE`` or ``None``
+        if the question was visited after the last update"""
+        visit_times = self.views.get(record.id, None)
+        if visit_times is None:
+            return NOT_SEEN
+        for visit_time in visit_times:
+            if visit_time < record.last_activity_at:
+                return SEEN_BEFORE_UPDATE
+        return None
+
+    def split_by_visit_status(self, records, require_approval, limit = None):
+        """returns lists of ids of the not seen questions
+        and the questions seen before the latest update,
+        most recently active questions go first
         """
-        retreive relevant question updates for the user
-        according to their subscriptions and recorded question
-        views
+        not_seen = list()
+        seen = list()
+        records = dict((record.id, record) for record in records).values()
+        records.sort(key = lambda record: record.get_order_key(), reverse = True)
+        for record in records:
+            if not self.is_candidate(record, require_approval):
+                continue
+            status = self.get_visit_status(record)
+            if status == NOT_SEEN:
+                not_seen.append(record.id)
+            elif status == SEEN_BEFORE_UPDATE:
+                seen.append(record.id)
+        if limit is not None:
+            return not_seen[:limit], seen[:limit]
+        return not_seen, seen
+
+    def get_tag_filter(self):
+        """returns function telling whether the question passes
+        the tag filter of the "entire forum" subscription,
+        same as :meth:`~askbot.models.User.get_tag_filtered_questions`
+
+        returns ``None`` if no question can pass the filter
         """
+        strategy = self.user.email_tag_filter_strategy
+        if strategy == const.EXCLUDE_IGNORED:
+            tag_ids = self.marked_tag_ids['bad']
+            wildcards = self.user.ignored_tags.strip().split()
+        elif strategy == const.INCLUDE_INTERESTING:
+            if askbot_settings.SUBSCRIBED_TAG_SELECTOR_ENABLED:
+                tag_ids = self.marked_tag_ids['subscribed']
+                wildcards = self.user.subscribed_tags.strip().split()
+            else:
+                tag_ids = self.marked_tag_ids['good']
+                wildcards = self.user.interesting_tags.strip().split()
+            if len(tag_ids) == 0 and len(wildcards) == 0:
+                return None
+        else:
+            return None
 
-        user_feeds = EmailFeedSetting.objects.filter(
-                                                subscriber=user
-                                            ).exclude(
-                                                frequency__in=('n', 'i')
-                                            )
+        prefixes = tuple([wildcard[:-1] for wildcard in wildcards])
 
-        should_proceed = False
-        for feed in user_feeds:
-            if feed.should_send_now() == True:
-                should_proceed = True
-                break
+        def tags_match(record):
+            if tag_ids & record.tag_ids:
+                return True
+            if prefixes:
+                for tag_name in record.tag_names:
+                    if tag_name.startswith(prefixes):
+                        return True
+            return False
 
-        #shortcircuit - if there is no ripe feed to work on for this user
-        if should_proceed == False:
-            return {}
-
-        #these are placeholders for separate query sets per question group
-        #there are four groups - one for each EmailFeedSetting.feed_type
-        #and each group has subtypes A and B
-        #that's because of the strange thing commented below
-        #see note on Q and F objects marked with todo tag
-        q_sel_A = None
-        q_sel_B = None
-
-        q_ask_A = None
-        q_ask_B = None
-
-        q_ans_A = None
-        q_ans_B = None
-
-        q_all_A = None
-        q_all_B = None
-
-        #base question query set for this user
-        #basic things - not deleted, not closed, not too old
-        #not last edited by the same user
-        base_qs = Post.objects.get_questions().exclude(
-                                thread__last_activity_by=user
-                            ).exclude(
-                                thread__last_activity_at__lt=user.date_joined#exclude old stuff
-                            ).exclude(
-                                deleted=True
-                            ).exclude(
-                                thread__closed=True
-                            ).order_by('-thread__last_activity_at')
-
-        if askbot_settings.ENABLE_CONTENT_MODERATION:
-            base_qs = base_qs.filter(approved = True)
-        #todo: for some reason filter on did not work as expected ~Q(viewed__who=user) | 
-        #      Q(viewed__who=user,viewed__when__lt=F('thread__last_activity_at'))
-        #returns way more questions than you might think it should
-        #so because of that I've created separate query sets Q_set2 and Q_set3
-        #plus two separate queries run faster!
-
-        #build two two queries based
-
-        #questions that are not seen by the user at all
-        not_seen_qs = base_qs.filter(~Q(viewed__who=user))
-        #questions that were seen, but before last modification
-        seen_before_last_mod_qs = base_qs.filter(
-                                    Q(
-                                        viewed__who=user,
-                                        viewed__when__lt=F('thread__last_activity_at')
-                                    )
-                                )
+        if strategy == const.EXCLUDE_IGNORED:
+            return lambda record: not tags_match(record)
+        return tags_match
 
-        #shorten variables for convenience
-        Q_set_A = not_seen_qs
-        Q_set_B = seen_before_last_mod_qs
 
-        for feed in user_feeds:
-            if feed.feed_type == 'm_and_c':
-                #alerts on mentions and comments are processed separately
-                #because comments to questions do not trigger change of last_updated
-                #this may be changed in the future though, see
-                #http://askbot.org/en/question/96/
-                continue
+class DigestBuilder(object):
+    """builds and sends email digests for chunks of users"""
 
-            #each group of updates represented by the corresponding
-            #query set has it's own cutoff time
-            #that cutoff time is computed for each user individually
-            #and stored as a parameter "cutoff_time"
-
-            #we won't send email for a given question if an email has been
-            #sent after that cutoff_time
-            if feed.should_send_now():
-                if DEBUG_THIS_COMMAND == False:
-                    feed.mark_reported_now()
-                cutoff_time = feed.get_previous_report_cutoff_time() 
-
-                if feed.feed_type == 'q_sel':
-                    q_sel_A = Q_set_A.filter(thread__followed_by=user)
-                    q_sel_A.cutoff_time = cutoff_time #store cutoff time per query set
-                    q_sel_B = Q_set_B.filter(thread__followed_by=user)
-                    q_sel_B.cutoff_time = cutoff_time #store cutoff time per query set
-
-                elif feed.feed_type == 'q_ask':
-                    q_ask_A = Q_set_A.filter(author=user)
-                    q_ask_A.cutoff_time = cutoff_time
-                    q_ask_B = Q_set_B.filter(author=user)
-                    q_ask_B.cutoff_time = cutoff_time
-
-                elif feed.feed_type == 'q_ans':
-                    q_ans_A = Q_set_A.filter(thread__posts__author=user, thread__posts__post_type='answer')
-                    q_ans_A = q_ans_A[:askbot_settings.MAX_ALERTS_PER_EMAIL]
-                    q_ans_A.cutoff_time = cutoff_time
-
-                    q_ans_B = Q_set_B.filter(thread__posts__author=user, thread__posts__post_type='answer')
-                    q_ans_B = q_ans_B[:askbot_settings.MAX_ALERTS_PER_EMAIL]
-                    q_ans_B.cutoff_time = cutoff_time
-
-                elif feed.feed_type == 'q_all':
-                    q_all_A = user.get_tag_filtered_questions(Q_set_A)
-                    q_all_B = user.get_tag_filtered_questions(Q_set_B)
-
-                    q_all_A = q_all_A[:askbot_settings.MAX_ALERTS_PER_EMAIL]
-                    q_all_B = q_all_B[:askbot_settings.MAX_ALERTS_PER_EMAIL]
-                    q_all_A.cutoff_time = cutoff_time
-                    q_all_B.cutoff_time = cutoff_time
-
-        #build ordered list questions for the email report
-        q_list = SortedDict()
-
-        #todo: refactor q_list into a separate class?
-        extend_question_list(q_sel_A, q_list)
-        extend_question_list(q_sel_B, q_list)
+    def __init__(self, question_index, timer):
+        self.index = question_index
+        self.timer = timer
+        self.require_approval = question_index.require_approval
+        self.max_alerts = askbot_settings.MAX_ALERTS_PER_EMAIL
+        self.post_content_type = ContentType.objects.get_for_model(Post)
 
-        #build list of comment and mention responses here
-        #it is separate because posts are not marked as changed
-        #when people add comments
-        #mention responses could be collected in the loop above, but
-        #it is inconvenient, because feed_type m_and_c bundles the two
-        #also we collect metadata for these here
-        try:
-            feed = user_feeds.get(feed_type='m_and_c')
-            if feed.should_send_now():
-                cutoff_time = feed.get_previous_report_cutoff_time()
-                comments = Post.objects.get_comments().filter(
-                                            added_at__lt = cutoff_time,
-                                        ).exclude(
-                                            author = user
-                                        )
-                q_commented = list() 
-                for c in comments:
-                    post = c.parent
-                    if post.author != user:
-                        continue
+    def process_users(self, user_ids):
+        self.timer.start('subscriptions')
+        digests = self.load_subscriptions(user_ids)
+        if len(digests) > 0:
+            self.timer.start('candidates')
+            self.load_candidates(digests)
+            for digest in digests:
+                self.build_question_list(digest)
+            self.timer.start('activities')
+            activities = self.load_email_activities(digests)
+            self.timer.start('news')
+            updated_ids, new_pairs = self.count_news(digests, activities)
+            self.timer.start('write')
+            if DEBUG_THIS_COMMAND == False:
+                self.save_email_activities(updated_ids, new_pairs)
+            self.timer.start('send')
+            self.send_digests(digests)
+        self.timer.stop()
 
-                    #skip is post was seen by the user after
-                    #the comment posting time
-                    q_commented.append(post.get_origin_post())
+    def load_subscriptions(self, user_ids):
+        """returns list of digests for the users
+        who have feeds due to be sent, marks those feeds
+        as reported"""
+        feeds_by_user = dict()
+        feeds = EmailFeedSetting.objects.filter(subscriber__in = user_ids)
+        for feed in feeds:
+            feeds_by_user.setdefault(feed.subscriber_id, list()).append(feed)
 
-                extend_question_list(
-                                q_commented,
-                                q_list,
-                                cutoff_time = cutoff_time,
-                                add_comment = True
+        form = forms.EditUserEmailFeedsForm()
+        need_feed_types = set(form.get_db_model_subscription_type_names())
+
+        digests = list()
+        reported_feed_ids = list()
+        for user in User.objects.filter(id__in = user_ids).order_by('id'):
+            user_feeds = feeds_by_user.get(user.id, list())
+            have_feed_types = set([feed.feed_type for feed in user_feeds])
+            if need_feed_types - have_feed_types:
+                user.add_missing_askbot_subscriptions()
+                user_feeds = EmailFeedSetting.objects.filter(subscriber = user)
+
+            digest = UserDigest(user)
+            for feed in user_feeds:
+                if feed.frequency in ('n', 'i'):
+                    continue
+                if feed.should_send_now():
+                    #each group of updates has it's own cutoff time
+                    #we won't send email for a given question if an email has been
+                    #sent after that cutoff_time
+                    digest.cutoffs[feed.feed_type] = \
+                                    feed.get_previous_report_cutoff_time()
+                    #alerts on mentions and comments are processed separately
+                    #because comments to questions do not trigger change of last_updated
+                    #this may be changed in the future though, see
+                    #http://askbot.org/en/question/96/
+                    if feed.feed_type != 'm_and_c':
+                        reported_feed_ids.append(feed.id)
+
+            #shortcircuit - if there is no ripe feed to work on for this user
+            if len(digest.cutoffs) > 0:
+                digests.append(digest)
+
+        if DEBUG_THIS_COMMAND == False and len(reported_feed_ids) > 0:
+            EmailFeedSetting.objects.filter(
+                                id__in = reported_feed_ids
+                            ).update(
+                                reported_at = datetime.datetime.now()
                             )
+        return digests
 
-                mentions = Activity.objects.get_mentions(
-                                                    mentioned_at__lt = cutoff_time,
-                                                    mentioned_whom = user
-                                                )
+    def get_user_ids_with_feed(self, digests, feed_type):
+        return [
+            digest.user.id for digest in digests
+            if feed_type in digest.cutoffs
+        ]
 
-                #print 'have %d mentions' % len(mentions)
-                #MM = Activity.objects.filter(activity_type = const.TYPE_ACTIVITY_MENTION)
-                #print 'have %d total mentions' % len(MM)
-                #for m in MM:
-                #    print m
+    def load_candidates(self, digests):
+        """loads data necessary to select questions for the digests
+        of all users in the chunk"""
+        digests_by_user = dict((digest.user.id, digest) for digest in digests)
+        user_ids = digests_by_user.keys()
 
-                mention_posts = get_all_origin_posts(mentions)
-                q_mentions_id = [q.id for q in mention_posts]
+        views = QuestionView.objects.filter(
+                                    who__in = user_ids
+                                ).values_list('who', 'question', 'when')
+        for user_id, question_id, visit_time in views:
+            user_views = digests_by_user[user_id].views
+            user_views.setdefault(question_id, list()).append(visit_time)
 
-                q_mentions_A = Q_set_A.filter(id__in = q_mentions_id)
-                q_mentions_A.cutoff_time = cutoff_time
-                extend_question_list(q_mentions_A, q_list, add_mention=True)
+        q_sel_user_ids = self.get_user_ids_with_feed(digests, 'q_sel')
+        if q_sel_user_ids:
+            followed = Thread.followed_by.through.objects.filter(
+                                    user__in = q_sel_user_ids
+                                ).values_list('user', 'thread')
+            for user_id, thread_id in followed:
+                digests_by_user[user_id].followed_thread_ids.add(thread_id)
 
-                q_mentions_B = Q_set_B.filter(id__in = q_mentions_id)
-                q_mentions_B.cutoff_time = cutoff_time
-                extend_question_list(q_mentions_B, q_list, add_mention=True)
-        except EmailFeedSetting.DoesNotExist:
-            pass
+        q_ask_user_ids = self.get_user_ids_with_feed(digests, 'q_ask')
+        if q_ask_user_ids:
+            asked = Post.objects.get_questions().filter(
+                                    author__in = q_ask_user_ids
+                                ).values_list('author', 'id')
+            for user_id, question_id in asked:
+                digests_by_user[user_id].asked_question_ids.add(question_id)
 
-        if user.email_tag_filter_strategy == const.INCLUDE_INTERESTING:
-            extend_question_list(q_all_A, q_list)
-            extend_question_list(q_all_B, q_list)
+        q_ans_user_ids = self.get_user_ids_with_feed(digests, 'q_ans')
+        if q_ans_user_ids:
+            answered = Post.objects.filter(
+                                    post_type = 'answer',
+                                    author__in = q_ans_user_ids
+                                ).values_list('author', 'thread')
+            for user_id, thread_id in answered:
+                digests_by_user[user_id].answered_thread_ids.add(thread_id)
 
-        extend_question_list(q_ask_A, q_list, limit=True)
-        extend_question_list(q_ask_B, q_list, limit=True)
+        m_and_c_user_ids = self.get_user_ids_with_feed(digests, 'm_and_c')
+        if m_and_c_user_ids:
+            self.load_comments_and_mentions(digests_by_user, m_and_c_user_ids)
 
-        extend_question_list(q_ans_A, q_list, limit=True)
-        extend_question_list(q_ans_B, q_list, limit=True)
+        q_all_user_ids = self.get_user_ids_with_feed(digests, 'q_all')
+        if q_all_user_ids:
+            marked_tags = MarkedTag.objects.filter(
+                                    user__in = q_all_user_ids
+                                ).values_list('user', 'tag', 'reason')
+            for user_id, tag_id, reason in marked_tags:
+                digests_by_user[user_id].marked_tag_ids[reason].add(tag_id)
 
-        if user.email_tag_filter_strategy == const.EXCLUDE_IGNORED:
-            extend_question_list(q_all_A, q_list, limit=True)
-            extend_question_list(q_all_B, q_list, limit=True)
+        thread_ids = set()
+        question_ids = set()
+        for digest in digests:
+            thread_ids.update(digest.followed_thread_ids)
+            thread_ids.update(digest.answered_thread_ids)
+            thread_ids.update(digest.commented_thread_ids)
+            thread_ids.update(digest.mentioned_thread_ids)
+            question_ids.update(digest.asked_question_ids)
+        self.index.load_threads(thread_ids)
+        self.index.load_questions(question_ids)
 
-        ctype = ContentType.objects.get_for_model(Post)
-        EMAIL_UPDATE_ACTIVITY = const.TYPE_ACTIVITY_EMAIL_UPDATE_SENT
+    def load_comments_and_mentions(self, digests_by_user, user_ids):
+        """collects threads where users received comments
+        to their posts and mentions, posted before the cutoff time
+        """
+        comments = Post.objects.get_comments().filter(
+                                    parent__author__in = user_ids
+                                ).order_by(
+                                    'id'
+                                ).values_list(
+                                    'parent__author', 'author',
+                                    'added_at', 'parent__thread'
+                                )
+        for parent_author_id, author_id, added_at, thread_id in comments:
+            if author_id == parent_author_id:
+                continue
+            digest = digests_by_user[parent_author_id]
+            if added_at < digest.cutoffs['m_and_c']:
+                digest.commented_thread_ids.append(thread_id)
 
-        #up to this point we still don't know if emails about
-        #collected questions were sent recently
-        #the next loop examines activity record and decides
-        #for each question, whether it needs to be included or not
-        #into the report
+        mentions = ActivityAuditStatus.objects.filter(
+                            user__in = user_ids,
+                            activity__activity_type = const.TYPE_ACTIVITY_MENTION,
+                            activity__content_type = self.post_content_type
+                        ).values_list(
+                            'user', 'activity__object_id', 'activity__active_at'
+                        )
+        mentioned_post_ids = dict()
+        for user_id, post_id, mentioned_at in mentions:
+            if mentioned_at < digests_by_user[user_id].cutoffs['m_and_c']:
+                mentioned_post_ids.setdefault(post_id, set()).add(user_id)
 
-        for q, meta_data in q_list.items():
-            #this loop edits meta_data for each question
-            #so that user will receive counts on new edits new answers, etc
-            #and marks questions that need to be skipped
-            #because an email about them was sent recently enough
+        posts = Post.objects.values_list('id', 'post_type', 'thread')
+        for post_id, post_type, thread_id in \
+                filter_in_chunks(posts, 'id', mentioned_post_ids.keys()):
+            if post_type in ('tag_wiki', 'reject_reason'):
+                continue #these posts don't have origin posts
+            for user_id in mentioned_post_ids[post_id]:
+                digests_by_user[user_id].mentioned_thread_ids.add(thread_id)
 
-            #also it keeps a record of latest email activity per question per user
-            try:
-                #todo: is it possible to use content_object here, instead of
-                #content type and object_id pair?
-                update_info = Activity.objects.get(
-                                            user=user,
-                                            content_type=ctype,
-                                            object_id=q.id,
-                                            activity_type=EMAIL_UPDATE_ACTIVITY
-                                        )
-                emailed_at = update_info.active_at
-            except Activity.DoesNotExist:
-                update_info = Activity(
-                                        user=user, 
-                                        content_object=q, 
-                                        activity_type=EMAIL_UPDATE_ACTIVITY
-                                    )
-                emailed_at = datetime.datetime(1970, 1, 1)#long time ago
-            except Activity.MultipleObjectsReturned:
+    def get_thread_questions(self, thread_ids):
+        records = list()
+        for thread_id in thread_ids:
+            record = self.index.get_question_by_thread_id(thread_id)
+            if record is not None:
+                records.append(record)
+        return records
+
+    def get_whole_forum_questions(self, digest):
+        """walks the stream of the recently active questions
+        and returns lists of up to ``max_alerts`` ids of the not seen
+        and the seen before update questions passing the tag filter
+        """
+        not_seen = list()
+        seen = list()
+        tag_filter = digest.get_tag_filter()
+        if tag_filter is None:
+            return not_seen, seen
+
+        position = 0
+        while len(not_seen) < self.max_alerts or len(seen) < self.max_alerts:
+            record = self.index.get_stream_record(position)
+            position += 1
+            if record is None:
+                break
+            if record.last_activity_at < digest.user.date_joined:
+                break #stream is ordered by the last activity
+            if not digest.is_candidate(record, self.require_approval):
+                continue
+            if not tag_filter(record):
+                continue
+            status = digest.get_visit_status(record)
+            if status == NOT_SEEN and len(not_seen) < self.max_alerts:
+                not_seen.append(record.id)
+            elif status == SEEN_BEFORE_UPDATE and len(seen) < self.max_alerts:
+                seen.append(record.id)
+        return not_seen, seen
+
+    def build_question_list(self, digest):
+        """builds ordered list of questions for the email report
+        in the same order of the feed types as before"""
+        q_list = digest.q_list
+        cutoffs = digest.cutoffs
+        split = digest.split_by_visit_status
+        require_approval = self.require_approval
+
+        if 'q_sel' in cutoffs:
+            records = self.get_thread_questions(digest.followed_thread_ids)
+            for ids in split(records, require_approval):
+                extend_question_list(ids, q_list, cutoff_time = cutoffs['q_sel'])
+
+        #build list of comment and mention responses here
+        #it is separate because posts are not marked as changed
+        #when people add comments
+        if 'm_and_c' in cutoffs:
+            cutoff_time = cutoffs['m_and_c']
+            commented_ids = [
+                record.id for record in
+                self.get_thread_questions(digest.commented_thread_ids)
+            ]
+            extend_question_list(
+                            commented_ids,
+                            q_list,
+                            cutoff_time = cutoff_time,
+                            add_comment = True
+                        )
+            records = self.get_thread_questions(digest.mentioned_thread_ids)
+            for ids in split(records, require_approval):
+                extend_question_list(
+                            ids, q_list,
+                            cutoff_time = cutoff_time,
+                            add_mention = True
+                        )
+
+        if 'q_all' in cutoffs:
+            q_all = self.get_whole_forum_questions(digest)
+        else:
+            q_all = (None, None)
+
+        strategy = digest.user.email_tag_filter_strategy
+        if strategy == const.INCLUDE_INTERESTING:
+            for ids in q_all:
+                extend_question_list(ids, q_list, cutoff_time = cutoffs.get('q_all'))
+
+        if 'q_ask' in cutoffs:
+            records = [
+                self.index.by_id[qid] for qid in digest.asked_question_ids
+                if qid in self.index.by_id
+            ]
+            for ids in split(records, require_approval):
+                extend_question_list(
+                            ids, q_list,
+                            cutoff_time = cutoffs['q_ask'],
+                            limit = True
+                        )
+
+        if 'q_ans' in cutoffs:
+            records = self.get_thread_questions(digest.answered_thread_ids)
+            for ids in split(records, require_approval, limit = self.max_alerts):
+                extend_question_list(
+                            ids, q_list,
+                            cutoff_time = cutoffs['q_ans'],
+                            limit = True
+                        )
+
+        if strategy == const.EXCLUDE_IGNORED:
+            for ids in q_all:
+                extend_question_list(
+                            ids, q_list,
+                            cutoff_time = cutoffs.get('q_all'),
+                            limit = True
+                        )
+
+    def load_email_activities(self, digests):
+        """returns dictionary (user id, question id) -> (id, active_at)
+        of the records of the previously sent email updates"""
+        user_ids = [digest.user.id for digest in digests]
+        question_ids = set()
+        for digest in digests:
+            question_ids.update(digest.q_list.keys())
+
+        activities = Activity.objects.filter(
+                                user__in = user_ids,
+                                content_type = self.post_content_type,
+                                activity_type = const.TYPE_ACTIVITY_EMAIL_UPDATE_SENT
+                            ).values_list('id', 'user', 'object_id', 'active_at')
+
+        activity_map = dict()
+        for activity_id, user_id, question_id, active_at in \
+                filter_in_chunks(activities, 'object_id', question_ids):
+            key = (user_id, question_id)
+            if key in activity_map:
                 raise Exception(
                                 'server error - multiple question email activities '
                                 'found per user-question pair'
                                 )
+            activity_map[key] = (activity_id, active_at)
+        return activity_map
 
-            cutoff_time = meta_data['cutoff_time']#cutoff time for the question
+    def count_news(self, digests, activities):
+        """edits meta_data for each question of the digests,
+        so that user will receive counts on new edits new answers, etc
+        and marks questions that need to be skipped
+        because an email about them was sent recently enough
 
-            #skip question if we need to wait longer because
-            #the delay before the next email has not yet elapsed
-            #or if last email was sent after the most recent modification
-            if emailed_at > cutoff_time or emailed_at > q.thread.last_activity_at:
-                meta_data['skip'] = True
-                continue
+        returns ids of the email activity records to update
+        and list of (user id, question id) pairs of the records to create
+        """
+        question_ids = set()
+        for digest in digests:
+            question_ids.update(digest.q_list.keys())
+        questions = dict(
+            (qid, self.index.by_id[qid]) for qid in question_ids
+        )
+        thread_ids = [record.thread_id for record in questions.values()]
 
-            #collect info on all sorts of news that happened after
-            #the most recent emailing to the user about this question
-            q_rev = q.revisions.filter(revised_at__gt=emailed_at)
-            q_rev = q_rev.exclude(author=user)
+        question_revisions = dict()
+        revisions = PostRevision.objects.values_list(
+                                'post', 'author', 'revised_at', 'revision'
+                            )
+        for post_id, author_id, revised_at, revision in \
+                filter_in_chunks(revisions, 'post', question_ids):
+            question_revisions.setdefault(post_id, list()).append(
+                                        (revision, revised_at, author_id)
+                                    )
 
-            #now update all sorts of metadata per question
-            meta_data['q_rev'] = len(q_rev)
-            if len(q_rev) > 0 and q.added_at == q_rev[0].revised_at:
-                meta_data['q_rev'] = 0
-                meta_data['new_q'] = True
-            else:
-                meta_data['new_q'] = False
-                
-            new_ans = Post.objects.get_answers(user).filter(
-                                            thread=q.thread,
-                                            added_at__gt=emailed_at,
-                                            deleted=False,
-                                        )
-            new_ans = new_ans.exclude(author=user)
-            meta_data['new_ans'] = len(new_ans)
-
-            ans_ids = Post.objects.get_answers(user).filter(
-                                            thread=q.thread,
-                                            added_at__gt=emailed_at,
-                                            deleted=False,
-                                        ).values_list(
-                                            'id', flat = True
-                                        )
-            ans_rev = PostRevision.objects.filter(post__id__in = ans_ids)
-            ans_rev = ans_rev.exclude(author=user).distinct()
-            meta_data['ans_rev'] = len(ans_rev)
-
-            comments = meta_data.get('comments', 0)
-            mentions = meta_data.get('mentions', 0)
-
-            #print meta_data
-            #finally skip question if there are no news indeed
-            if len(q_rev) + len(new_ans) + len(ans_rev) + comments + mentions == 0:
-                meta_data['skip'] = True
-                #print 'skipping'
-            else:
-                meta_data['skip'] = False
-                #print 'not skipping'
-                update_info.active_at = datetime.datetime.now() 
-                if DEBUG_THIS_COMMAND == False:
-                    update_info.save() #save question email update activity 
-        #q_list is actually an ordered dictionary
-        #print 'user %s gets %d' % (user.username, len(q_list.keys()))
-        #todo: sort question list by update time
-        return q_list 
-
-    def send_email_alerts(self):
-        #does not change the database, only sends the email
-        #todo: move this to template
-        for user in User.objects.all():
-            user.add_missing_askbot_subscriptions()
-            #todo: q_list is a dictionary, not a list
-            q_list = self.get_updated_questions_for_user(user)
-            if len(q_list.keys()) == 0:
-                continue
-            num_q = 0
-            for question, meta_data in q_list.items():
-                if meta_data['skip']:
-                    del q_list[question]
+        thread_answers = dict()
+        answer_ids = list()
+        answers = Post.objects.filter(
+                            post_type = 'answer', deleted = False
+                        ).values_list('id', 'thread', 'author', 'added_at')
+        for answer_id, thread_id, author_id, added_at in \
+                filter_in_chunks(answers, 'thread', thread_ids):
+            thread_answers.setdefault(thread_id, list()).append(
+                                        (answer_id, author_id, added_at)
+                                    )
+            answer_ids.append(answer_id)
+
+        answer_revision_authors = dict()
+        revisions = PostRevision.objects.values_list('post', 'author')
+        for answer_id, author_id in filter_in_chunks(revisions, 'post', answer_ids):
+            answer_revision_authors.setdefault(answer_id, list()).append(author_id)
+
+        groups_enabled = askbot_settings.GROUPS_ENABLED
+        if groups_enabled:
+            answer_groups = dict()
+            post_groups = PostToGroup.objects.values_list('post', 'group')
+            for answer_id, group_id in \
+                    filter_in_chunks(post_groups, 'post', answer_ids):
+                answer_groups.setdefault(answer_id, set()).add(group_id)
+
+            digests_by_user = dict((digest.user.id, digest) for digest in digests)
+            memberships = User.groups.through.objects.filter(
+                                user__in = digests_by_user.keys()
+                            ).values_list('user', 'group')
+            for user_id, group_id in memberships:
+                digests_by_user[user_id].group_ids.add(group_id)
+
+        updated_ids = list()
+        new_pairs = list()
+        for digest in digests:
+            user_id = digest.user.id
+            for question_id, meta_data in digest.q_list.items():
+                question = questions[question_id]
+                activity = activities.get((user_id, question_id), None)
+                if activity is None:
+                    emailed_at = NEVER_EMAILED
                 else:
-                    num_q += 1
-            if num_q > 0:
-                url_prefix = askbot_settings.APP_URL
-
-                threads = Thread.objects.filter(id__in=[qq.thread_id for qq in q_list.keys()])
-                tag_summary = Thread.objects.get_tag_summary_from_threads(threads)
-
-                question_count = len(q_list.keys())
-
-                subject_line = ungettext(
-                    '%(question_count)d updated question about %(topics)s',
-                    '%(question_count)d updated questions about %(topics)s',
-                    question_count
-                ) % {
-                    'question_count': question_count,
-                    'topics': tag_summary
-                }
-
-                #todo: send this to special log
-                #print 'have %d updated questions for %s' % (num_q, user.username)
-                text = ungettext(
-                    '<p>Dear %(name)s,</p><p>The following question has been updated '
-                    '%(sitename)s</p>',
-                    '<p>Dear %(name)s,</p><p>The following %(num)d questions have been '
-                    'updated on %(sitename)s:</p>',
-                    num_q
-                ) % {
-                    'num':num_q,
-                    'name':user.username,
-                    'sitename': askbot_settings.APP_SHORT_NAME
-                }
-
-                text += '<ul>'
-                items_added = 0
-                items_unreported = 0
-                for q, meta_data in q_list.items():
-                    act_list = []
-                    if meta_data['skip']:
+                    emailed_at = activity[1]
+
+                #skip question if we need to wait longer because
+                #the delay before the next email has not yet elapsed
+                #or if last email was sent after the most recent modification
+                if emailed_at > meta_data['cutoff_time'] \
+                        or emailed_at > question.last_activity_at:
+                    meta_data['skip'] = True
+                    continue
+
+                #collect info on all sorts of news that happened after
+                #the most recent emailing to the user about this question
+                q_rev = [
+                    item for item in question_revisions.get(question_id, ())
+                    if item[1] > emailed_at and item[2] != user_id
+                ]
+                meta_data['q_rev'] = len(q_rev)
+                if len(q_rev) > 0 and question.added_at == max(q_rev)[1]:
+                    meta_data['q_rev'] = 0
+                    meta_data['new_q'] = True
+                else:
+                    meta_data['new_q'] = False
+
+                new_ans = 0
+                ans_rev = 0
+                for answer_id, author_id, added_at in \
+                        thread_answers.get(question.thread_id, ()):
+                    if added_at <= emailed_at:
                         continue
-                    if items_added >= askbot_settings.MAX_ALERTS_PER_EMAIL:
-                        items_unreported = num_q - items_added #may be inaccurate actually, but it's ok
-                        
+                    if groups_enabled:
+                        if not (answer_groups.get(answer_id, set()) & digest.group_ids):
+                            continue
+                    if author_id != user_id:
+                        new_ans += 1
+                    for revision_author_id in \
+                            answer_revision_authors.get(answer_id, ()):
+                        if revision_author_id != user_id:
+                            ans_rev += 1
+                meta_data['new_ans'] = new_ans
+                meta_data['ans_rev'] = ans_rev
+
+                comments = meta_data.get('comments', 0)
+                mentions = meta_data.get('mentions', 0)
+
+                #finally skip question if there are no news indeed
+                if len(q_rev) + new_ans + ans_rev + comments + mentions == 0:
+                    meta_data['skip'] = True
+                else:
+                    meta_data['skip'] = False
+                    if activity is None:
+                        new_pairs.append((user_id, question_id))
                     else:
-                        items_added += 1
-                        if meta_data['new_q']:
-                            act_list.append(_('new question'))
-                        format_action_count('%(num)d rev', meta_data['q_rev'],act_list)
-                        format_action_count('%(num)d ans', meta_data['new_ans'],act_list)
-                        format_action_count('%(num)d ans rev',meta_data['ans_rev'],act_list)
-                        act_token = ', '.join(act_list)
-                        text += '<li><a href="%s?sort=latest">%s</a> <font color="#777777">(%s)</font></li>' \
-                                    % (url_prefix + q.get_absolute_url(), q.thread.title, act_token)
-                text += '</ul>'
-                text += '<p></p>'
-                #if len(q_list.keys()) >= askbot_settings.MAX_ALERTS_PER_EMAIL:
-                #    text += _('There may be more questions updated since '
-                #                'you have logged in last time as this list is '
-                #                'abridged for your convinience. Please visit '
-                #                'the askbot and see what\'s new!<br>'
-                #              )
-
-                link = url_prefix + reverse(
-                                        'user_subscriptions', 
-                                        kwargs = {
-                                            'id': user.id,
-                                            'slug': slugify(user.username)
-                                        }
-                                    )
+                        updated_ids.append(activity[0])
+        return updated_ids, new_pairs
+
+    @transaction.commit_on_success
+    def save_email_activities(self, updated_ids, new_pairs):
+        """keeps a record of latest email activity per question per user
+        (no bulk insert in this version of django, so the new records
+        are created one by one within a single transaction)"""
+        now = datetime.datetime.now()
+        for chunk in iter_chunks(updated_ids, IN_CLAUSE_SIZE):
+            Activity.objects.filter(id__in = chunk).update(active_at = now)
+        for user_id, question_id in new_pairs:
+            Activity.objects.create(
+                            user_id = user_id,
+                            content_type = self.post_content_type,
+                            object_id = question_id,
+                            activity_type = const.TYPE_ACTIVITY_EMAIL_UPDATE_SENT,
+                            active_at = now
+                        )
 
-                text += _(
-                    '<p>Please remember that you can always <a '
-                    'href="%(email_settings_link)s">adjust</a> frequency of the email updates or '
-                    'turn them off entirely.<br/>If you believe that this message was sent in an '
-                    'error, please email about it the forum administrator at %(admin_email)s.</'
-                    'p><p>Sincerely,</p><p>Your friendly %(sitename)s server.</p>'
-                ) % {
-                    'email_settings_link': link,
-                    'admin_email': django_settings.ADMINS[0][1],
-                    'sitename': askbot_settings.APP_SHORT_NAME
-                }
-                if DEBUG_THIS_COMMAND == True:
-                    recipient_email = django_settings.ADMINS[0][1]
+    def send_digests(self, digests):
+        question_ids = set()
+        for digest in digests:
+            for question_id, meta_data in digest.q_list.items():
+                if meta_data['skip']:
+                    del digest.q_list[question_id]
                 else:
-                    recipient_email = user.email
+                    question_ids.add(question_id)
+
+        questions = Post.objects.select_related('thread')
+        questions = dict(
+            (question.id, question) for question in
+            filter_in_chunks(questions, 'id', question_ids)
+        )
+        messages = list()
+        for digest in digests:
+            if len(digest.q_list) == 0:
+                continue
+            q_list = SortedDict()
+            for question_id, meta_data in digest.q_list.items():
+                q_list[questions[question_id]] = meta_data
+            messages.append(build_digest_message(digest.user, q_list))
+        mail.send_messages(messages, retries = mail.SEND_RETRIES)
+
+
+def build_digest_message(user, q_list):
+    """returns email message to the user about the questions
+    in the ordered dictionary question -> meta data"""
+    #todo: move this to template
+    num_q = len(q_list)
+    url_prefix = askbot_settings.APP_URL
+
+    threads = [question.thread for question in q_list.keys()]
+    tag_summary = Thread.objects.get_tag_summary_from_threads(threads)
+
+    question_count = len(q_list.keys())
+
+    subject_line = ungettext(
+        '%(question_count)d updated question about %(topics)s',
+        '%(question_count)d updated questions about %(topics)s',
+        question_count
+    ) % {
+        'question_count': question_count,
+        'topics': tag_summary
+    }
+
+    #todo: send this to special log
+    #print 'have %d updated questions for %s' % (num_q, user.username)
+    text = ungettext(
+        '<p>Dear %(name)s,</p><p>The following question has been updated '
+        '%(sitename)s</p>',
+        '<p>Dear %(name)s,</p><p>The following %(num)d questions have been '
+        'updated on %(sitename)s:</p>',
+        num_q
+    ) % {
+        'num':num_q,
+        'name':user.username,
+        'sitename': askbot_settings.APP_SHORT_NAME
+    }
+
+    text += '<ul>'
+    items_added = 0
+    items_unreported = 0
+    for q, meta_data in q_list.items():
+        act_list = []
+        if items_added >= askbot_settings.MAX_ALERTS_PER_EMAIL:
+            items_unreported = num_q - items_added #may be inaccurate actually, but it's ok
+
+        else:
+            items_added += 1
+            if meta_data['new_q']:
+                act_list.append(_('new question'))
+            format_action_count('%(num)d rev', meta_data['q_rev'],act_list)
+            format_action_count('%(num)d ans', meta_data['new_ans'],act_list)
+            format_action_count('%(num)d ans rev',meta_data['ans_rev'],act_list)
+            act_token = ', '.join(act_list)
+            text += '<li><a href="%s?sort=latest">%s</a> <font color="#777777">(%s)</font></li>' \
+                        % (url_prefix + q.get_absolute_url(), q.thread.title, act_token)
+    text += '</ul>'
+    text += '<p></p>'
+    #if len(q_list.keys()) >= askbot_settings.MAX_ALERTS_PER_EMAIL:
+    #    text += _('There may be more questions updated since '
+    #                'you have logged in last time as this list is '
+    #                'abridged for your convinience. Please visit '
+    #                'the askbot and see what\'s new!<br>'
+    #              )
+
+    link = url_prefix + reverse(
+                            'user_subscriptions',
+                            kwargs = {
+                                'id': user.id,
+                                'slug': slugify(user.username)
+                            }
+                        )
+
+    text += _(
+        '<p>Please remember that you can always <a '
+        'href="%(email_settings_link)s">adjust</a> frequency of the email updates or '
+        'turn them off entirely.<br/>If you believe that this message was sent in an '
+        'error, please email about it the forum administrator at %(admin_email)s.</'
+        'p><p>Sincerely,</p><p>Your friendly %(sitename)s server.</p>'
+    ) % {
+        'email_settings_link': link,
+        'admin_email': django_settings.ADMINS[0][1],
+        'sitename': askbot_settings.APP_SHORT_NAME
+    }
+    if DEBUG_THIS_COMMAND == True:
+        recipient_email = django_settings.ADMINS[0][1]
+    else:
+        recipient_email = user.email
+
+    return mail.build_message(
+        subject_line = subject_line,
+        body_text = text,
+        recipient_list = [recipient_email]
+    )
+
+
+#question index of the current process, reset on each run of the command
+_question_index = None
+
+def reset_question_index():
+    global _question_index
+    _question_index = QuestionIndex(
+        require_approval = askbot_settings.ENABLE_CONTENT_MODERATION
+    )
+
+def init_worker():
+    """initializer of the worker processes:
+    each process must use it's own database connection"""
+    connection.close()
+    reset_question_index()
+
+def process_user_chunk(user_ids):
+    """builds and sends digests for the users,
+    returns timings of the phases"""
+    timer = PhaseTimer()
+    DigestBuilder(_question_index, timer).process_users(user_ids)
+    return timer.timings
+
+
+class Command(NoArgsCommand):
+    option_list = NoArgsCommand.option_list + (
+        make_option('--chunk-size',
+            action = 'store',
+            type = 'int',
+            dest = 'chunk_size',
+            default = CHUNK_SIZE,
+            help = 'number of users whose digests are built together'
+        ),
+        make_option('--processes',
+            action = 'store',
+            type = 'int',
+            dest = 'processes',
+            default = 1,
+            help = 'number of worker processes building the digests'
+        ),
+    )
+
+    def handle_noargs(self, **options):
+        if askbot_settings.ENABLE_EMAIL_ALERTS:
+            try:
+                try:
+                    self.send_email_alerts(
+                        chunk_size = options.get('chunk_size') or CHUNK_SIZE,
+                        processes = options.get('processes') or 1,
+                        verbosity = int(options.get('verbosity', 1))
+                    )
+                except Exception, e:
+                    print e
+            finally:
+                connection.close()
+
+    def send_email_alerts(self, chunk_size = CHUNK_SIZE, processes = 1, verbosity = 1):
+        timer = PhaseTimer()
+        timer.start('users')
+        user_ids = list(User.objects.order_by('id').values_list('id', flat = True))
+        chunks = list(iter_chunks(user_ids, chunk_size))
+        timer.stop()
+
+        reset_question_index()
+        if processes > 1:
+            import multiprocessing
+            connection.close()
+            pool = multiprocessing.Pool(processes, initializer = init_worker)
+            try:
+                for timings in pool.imap_unordered(process_user_chunk, chunks):
+                    timer.add(timings)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            for chunk in chunks:
+                timer.add(process_user_chunk(chunk))
 
-                mail.send_mail(
-                    subject_line = subject_line,
-                    body_text = text,
-                    recipient_list = [recipient_email]
-                )
+        if verbosity > 1:
+            self.stdout.write(timer.format_report())
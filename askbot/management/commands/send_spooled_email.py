@@ -0,0 +1,18 @@
+"""send_spooled_email management command
+sends email messages spooled to the directory
+``ASKBOT_EMAIL_OUTBOX_DIR``, may be run from cron:
+
+python manage.py send_spooled_email
+"""
+from django.core.management.base import NoArgsCommand, CommandError
+from askbot import mail
+
+class Command(NoArgsCommand):
+    help = 'Sends email messages spooled to the outbox directory'
+
+    def handle_noargs(self, **options):
+        if not mail.get_outbox_dir():
+            raise CommandError('ASKBOT_EMAIL_OUTBOX_DIR is not set')
+        count = mail.send_spooled_messages()
+        if int(options.get('verbosity', 1)) > 1:
+            print 'sent %d messages' % count
@@ -0,0 +1,95 @@
+"""show_profiling_stats management command
+prints statistics of the requests profiled by the
+``askbot.middleware.profiling.ProfilingMiddleware``,
+published to the cache by all processes of the site,
+see :mod:`askbot.utils.profiling`
+
+python manage.py show_profiling_stats
+"""
+import optparse
+from django.core.management.base import NoArgsCommand
+from django.utils import simplejson
+from askbot.utils import profiling
+
+COLUMNS = (
+    ('count', 'requests'),
+    ('wall_time', 'p50'),
+    ('wall_time', 'p90'),
+    ('wall_time', 'p99'),
+    ('wall_time', 'max'),
+    ('cpu_time', 'mean'),
+    ('sql_count', 'mean'),
+    ('sql_time', 'mean'),
+    ('cache_gets', 'mean'),
+    ('cache_sets', 'mean'),
+    ('template_time', 'mean'),
+)
+
+class Command(NoArgsCommand):
+    help = 'Prints statistics of the profiled requests per view, ' + \
+        'times are in milliseconds'
+    option_list = NoArgsCommand.option_list + (
+        optparse.make_option('--json',
+            action = 'store_true',
+            dest = 'json',
+            default = False,
+            help = 'print the statistics in json format'
+        ),
+        optparse.make_option('--sort',
+            action = 'store',
+            dest = 'sort',
+            default = 'wall_time',
+            help = 'metric to sort the views by its mean value, ' + \
+                'one of: ' + ', '.join(profiling.METRICS)
+        ),
+        optparse.make_option('--clear',
+            action = 'store_true',
+            dest = 'clear',
+            default = False,
+            help = 'delete the published statistics'
+        ),
+    )
+
+    def handle_noargs(self, **options):
+        if options['clear']:
+            profiling.clear_published_summaries()
+            return
+
+        summary = profiling.get_published_summary()
+        if options['json']:
+            print simplejson.dumps(summary, indent = 2)
+            return
+
+        sort_metric = options['sort']
+        if sort_metric not in profiling.METRICS:
+            sort_metric = 'wall_time'
+        views = summary['views'].items()
+        views.sort(key = lambda item: item[1][sort_metric]['mean'], reverse = True)
+
+        header = ['view'] + [
+            name == 'count' and stat or '%s %s' % (name, stat)
+            for name, stat in COLUMNS
+        ]
+        rows = [header]
+        for view_name, view_summary in views:
+            row = [view_name]
+            for name, stat in COLUMNS:
+                if name == 'count':
+                    row.append(str(view_summary['count']))
+                else:
+                    row.append('%.1f' % view_summary[name][stat])
+            rows.append(row)
+        widths = [max([len(row[i]) for row in rows]) for i in range(len(header))]
+        for row in rows:
+            print '  '.join([
+                value.ljust(width) for value, width in zip(row, widths)
+            ])
+
+        if summary['slowest']:
+            print
+            print 'slowest requests:'
+            for info in summary['slowest']:
+                line = '%.1f %s %s' % (info['wall_time'], info['view'], info['path'])
+                if info['dump']:
+                    line += ' ' + info['dump']
+                print line
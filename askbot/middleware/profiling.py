@@ -0,0 +1,133 @@
+"""
+Records the performance statistics of the requests,
+see :mod:`askbot.utils.profiling`
+
+Included here is the ProfilingMiddleware, it should be the first
+item in the ``MIDDLEWARE_CLASSES`` to measure the other middleware too.
+The middleware is not used unless ``ASKBOT_PROFILING_ENABLED``
+or ``ASKBOT_PROFILING_SAMPLE_RATE`` is set.
+"""
+import cProfile
+import os
+import random
+import time
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+from askbot.utils import profiling
+
+
+def get_cpu_time():
+    """returns user and system time of the process,
+    with the threaded servers it includes the time
+    spent by the concurrent requests"""
+    times = os.times()
+    return times[0] + times[1]
+
+def get_view_name(view_func):
+    name = getattr(view_func, '__name__', view_func.__class__.__name__)
+    module = getattr(view_func, '__module__', None)
+    if module:
+        return module + '.' + name
+    return name
+
+
+class ProfilingMiddleware(object):
+    """
+    ProfilingMiddleware measures all or the sampled requests,
+    and adds the measurements to the statistics of the process
+
+    """
+    def __init__(self, stats = None):
+        if not (profiling.PROFILING_ENABLED or profiling.PROFILING_SAMPLE_RATE):
+            raise MiddlewareNotUsed()
+        profiling.install_cache_counter()
+        self.stats = stats or profiling.PROCESS_STATS
+
+    def should_profile(self, request):
+        if profiling.PROFILING_ENABLED:
+            return True
+        return random.random() * 100 < profiling.PROFILING_SAMPLE_RATE
+
+    def process_request(self, request):
+        if not self.should_profile(request):
+            return None
+
+        state = {'view_name': 'unresolved', 'connections': list()}
+        for connection in connections.all():
+            state['connections'].append(
+                (connection, connection.use_debug_cursor, len(connection.queries))
+            )
+            connection.use_debug_cursor = True
+        request._profiling_state = state
+
+        profiling.start_sample()
+        if profiling.PROFILING_DUMP_DIR:
+            state['profiler'] = cProfile.Profile()
+            state['profiler'].enable()
+        state['cpu_time'] = get_cpu_time()
+        state['wall_time'] = time.time()
+        return None
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        state = getattr(request, '_profiling_state', None)
+        if state is not None:
+            state['view_name'] = get_view_name(view_func)
+
+    def process_response(self, request, response):
+        state = getattr(request, '_profiling_state', None)
+        if state is None:
+            return response
+        del request._profiling_state
+
+        wall_time = time.time() - state['wall_time']
+        cpu_time = get_cpu_time() - state['cpu_time']
+        profiler = state.get('profiler')
+        if profiler:
+            profiler.disable()
+
+        sample = profiling.stop_sample()
+        sample['wall_time'] = 1000 * wall_time
+        sample['cpu_time'] = 1000 * cpu_time
+        sample['template_time'] *= 1000
+        for connection, use_debug_cursor, query_count in state['connections']:
+            queries = connection.queries[query_count:]
+            sample['sql_count'] += len(queries)
+            sample['sql_time'] += 1000 * sum(
+                [float(query['time']) for query in queries]
+            )
+            connection.use_debug_cursor = use_debug_cursor
+
+        view_name = state['view_name']
+        self.stats.add(view_name, sample)
+
+        if self.stats.is_slowest(sample['wall_time']):
+            info = {
+                'view': view_name,
+                'path': request.path,
+                'wall_time': sample['wall_time'],
+                'timestamp': time.time(),
+                'dump': None
+            }
+            if profiler:
+                info['dump'] = self.dump_profile(profiler, view_name)
+            pushed_out = self.stats.add_slowest(sample['wall_time'], info)
+            if pushed_out and pushed_out['dump']:
+                try:
+                    os.remove(pushed_out['dump'])
+                except OSError:
+                    pass
+
+        profiling.maybe_publish(self.stats)
+        return response
+
+    def dump_profile(self, profiler, view_name):
+        """saves the profile into the dump directory,
+        returns the file path"""
+        file_name = '%s-%d-%d.prof' % (
+                                view_name,
+                                int(time.time() * 1000),
+                                os.getpid()
+                            )
+        path = os.path.join(profiling.PROFILING_DUMP_DIR, file_name)
+        profiler.dump_stats(path)
+        return path
@@ -23,6 +23,7 @@ from django.utils.translation import ungettext
 from django.utils.safestring import mark_safe
 from django.utils.html import escape
 from django.db import models
+from django.db.models import F
 from django.conf import settings as django_settings
 from django.contrib.contenttypes.models import ContentType
 from django.core import cache
@@ -37,30 +38,40 @@ from askbot.skins import utils as skin_utils
 from askbot.mail import messages
 from askbot.models.question import QuestionView, AnonymousQuestion
 from askbot.models.question import DraftQuestion
+from askbot.models.question import ThreadToGroup
+from askbot.models.question import bump_content_generation
 from askbot.models.question import FavoriteQuestion
-from askbot.models.tag import Tag, MarkedTag
+from askbot.models.tag import Tag, MarkedTag, WildcardTagPrefix
+from askbot.models.tag import TagCooccurrence
 from askbot.models.tag import get_global_group
 from askbot.models.tag import get_group_names
 from askbot.models.tag import get_groups
 from askbot.models.tag import format_personal_group_name
 from askbot.models.user import EmailFeedSetting, ActivityAuditStatus, Activity
 from askbot.models.user import GroupMembership
+from askbot.models.user import LAST_SEEN_BUFFER, LAST_SEEN_UPDATE_INTERVAL
+from askbot.models.user import RESPONSE_COUNT_ACTIVITY_TYPES
+from askbot.models.user import clear_email_schedule_cache
 from askbot.models.user import Group
 from askbot.models.post import Post, PostRevision
 from askbot.models.post import PostFlagReason, AnonymousAnswer
 from askbot.models.post import PostToGroup
 from askbot.models.post import DraftAnswer
+from askbot.models.permissions import get_post_permissions
 from askbot.models.reply_by_email import ReplyAddress
 from askbot.models import signals
+from askbot.models import badges
 from askbot.models.badges import award_badges_signal, get_badge, BadgeData
 from askbot.models.repute import Award, Repute, Vote
 from askbot.models.widgets import AskWidget, QuestionWidget
+from askbot.search import backends as search_backends
 from askbot import auth
 from askbot.utils.decorators import auto_now_timestamp
 from askbot.utils.slug import slugify
 from askbot.utils.html import sanitize_html
 from askbot.utils.diff import textDiff as htmldiff
 from askbot.utils.url_utils import strip_path
+from askbot.utils import response_cache
 from askbot import mail
 
 def get_model(model_name):
@@ -1327,6 +1338,8 @@ def user_mark_tags(
         else:
             if reason in ('good', 'bad'):#to maintain exclusivity of 'good' and 'bad'
                 marked_ts.update(reason=reason)
+                #update() does not send the signals
+                bump_content_generation()
             cleaned_tagnames = tagnames
 
     return cleaned_tagnames, cleaned_wildcards
@@ -1453,7 +1466,8 @@ def user_delete_question(
     question.deleted_at = timestamp
     question.save()
 
-    for tag in list(question.thread.tags.all()):
+    tags = list(question.thread.tags.all())
+    for tag in tags:
         if tag.used_count == 1:
             tag.deleted = True
             tag.deleted_by = self
@@ -1461,6 +1475,7 @@ def user_delete_question(
         else:
             tag.used_count = tag.used_count - 1
         tag.save()
+    TagCooccurrence.objects.update_counts([tag.id for tag in tags], [])
 
     signals.delete_question_or_answer.send(
         sender = question.__class__,
@@ -1533,12 +1548,15 @@ def user_restore_post(
             #todo: make sure that these tags actually exist
             #some may have since been deleted for good
             #or merged into others
-            for tag in list(post.thread.tags.all()):
+            tags = list(post.thread.tags.all())
+            for tag in tags:
                 if tag.used_count == 1 and tag.deleted:
                     tag.deleted = False
                     tag.deleted_by = None
                     tag.deleted_at = None
                     tag.save()
+            TagCooccurrence.objects.update_counts([], [tag.id for tag in tags])
+        search_backends.get_backend().update_thread(post.thread_id)
     else:
         raise NotImplementedError()
 
@@ -1891,22 +1909,22 @@ def user_visit_question(self, question = None, timestamp = None):
     #filter memo objects on response activities directed to the qurrent user
     #that refer to the children of the currently
     #viewed question and clear them for the current user
-    ACTIVITY_TYPES = const.RESPONSE_ACTIVITY_TYPES_FOR_DISPLAY
-    ACTIVITY_TYPES += (const.TYPE_ACTIVITY_MENTION,)
-
     audit_records = ActivityAuditStatus.objects.filter(
                         user = self,
                         status = ActivityAuditStatus.STATUS_NEW,
                         activity__question = question
                     )
 
-    cleared_record_count = audit_records.filter(
-                                activity__activity_type__in = ACTIVITY_TYPES
-                            ).update(
-                                status=ActivityAuditStatus.STATUS_SEEN
+    cleared_record_count = ActivityAuditStatus.objects.set_status(
+                                audit_records.filter(
+                                    activity__activity_type__in = \
+                                        RESPONSE_COUNT_ACTIVITY_TYPES
+                                ),
+                                ActivityAuditStatus.STATUS_SEEN
                             )
     if cleared_record_count > 0:
-        self.update_response_counts()
+        self.new_response_count -= cleared_record_count
+        self.seen_response_count += cleared_record_count
 
     #finally, mark admin memo objects if applicable
     #the admin response counts are not denormalized b/c they are easy to obtain
@@ -2573,23 +2591,45 @@ def user_get_flags_for_post(self, post):
     flags = self.get_flags()
     return flags.filter(content_type = post_content_type, object_id=post.id)
 
+def user_precache_post_permissions(self, posts):
+    """evaluates permissions of the user to act on the posts
+    in one batch, see :mod:`askbot.models.permissions`,
+    and keeps them for the :meth:`get_post_permissions` calls
+    - the user object of the request lives through one request,
+    so the posts shown on a page are evaluated once per request
+    """
+    permissions = get_post_permissions(self, posts)
+    if not hasattr(self, '_cached_post_permissions'):
+        self._cached_post_permissions = dict()
+    self._cached_post_permissions.update(permissions)
+    return permissions
+
+def user_get_post_permissions(self, post):
+    """returns set of the names of the actions which
+    the user can perform on the post, precached or
+    evaluated on the spot"""
+    cached = getattr(self, '_cached_post_permissions', {})
+    if post.id in cached:
+        return cached[post.id]
+    return get_post_permissions(self, [post])[post.id]
+
 def user_update_response_counts(user):
     """Recount number of responses to the user.
-    """
-    ACTIVITY_TYPES = const.RESPONSE_ACTIVITY_TYPES_FOR_DISPLAY
-    ACTIVITY_TYPES += (const.TYPE_ACTIVITY_MENTION,)
 
-    user.new_response_count = ActivityAuditStatus.objects.filter(
-                                    user = user,
-                                    status = ActivityAuditStatus.STATUS_NEW,
-                                    activity__activity_type__in = ACTIVITY_TYPES
-                                ).count()
-    user.seen_response_count = ActivityAuditStatus.objects.filter(
-                                    user = user,
-                                    status = ActivityAuditStatus.STATUS_SEEN,
-                                    activity__activity_type__in = ACTIVITY_TYPES
-                                ).count()
-    user.save()
+    The counts are maintained incrementally by the
+    ``ActivityAuditStatus.objects``, the recount is used
+    to fix the drift, see the ``fix_inbox_counts`` command
+    """
+    counts = ActivityAuditStatus.objects.get_response_counts(
+                    ActivityAuditStatus.objects.filter(user = user)
+                )
+    new_count, seen_count = counts.get(user.id, (0, 0))
+    user.new_response_count = new_count
+    user.seen_response_count = seen_count
+    User.objects.filter(id = user.id).update(
+        new_response_count = new_count,
+        seen_response_count = seen_count
+    )
 
 
 def user_receive_reputation(self, num_points):
@@ -2643,6 +2683,7 @@ def user_update_wildcard_tag_selections(
     self.ignored_tags = ' '.join(ignored)
     self.subscribed_tags = ' '.join(subscribed)
     self.save()
+    WildcardTagPrefix.objects.rebuild_for_user(self)
     return new_tags
 
 
@@ -2755,6 +2796,8 @@ User.add_to_class(
     user_get_flag_count_posted_today
 )
 User.add_to_class('get_flags_for_post', user_get_flags_for_post)
+User.add_to_class('precache_post_permissions', user_precache_post_permissions)
+User.add_to_class('get_post_permissions', user_get_post_permissions)
 User.add_to_class('get_profile_url', get_profile_url)
 User.add_to_class('get_profile_link', get_profile_link)
 User.add_to_class('get_tag_filtered_questions', user_get_tag_filtered_questions)
@@ -3032,11 +3075,15 @@ def send_instant_notifications_about_activity_in_post(
                                                 update_activity = None,
                                                 post = None,
                                                 recipients = None,
+                                                email_retries = 0
                                             ):
     """
     function called when posts are updated
     newly mentioned users are carried through to reduce
     database hits
+
+    ``email_retries`` - number of re-sends after the transient
+    email errors, must be 0 when called within a web request
     """
     if post.is_approved() is False:
         return
@@ -3068,7 +3115,9 @@ def send_instant_notifications_about_activity_in_post(
     else:
         log_id = None
 
-    #send email for all recipients
+    #build email for all recipients
+    template = get_template('instant_notification.html')
+    messages = list()
     for user in recipients:
 
         if user.is_blocked():
@@ -3083,26 +3132,31 @@ def send_instant_notifications_about_activity_in_post(
                             reply_address = reply_address,
                             alt_reply_address = alt_reply_address,
                             update_type = update_type,
-                            template = get_template('instant_notification.html')
+                            template = template
                         )
 
-        headers['Reply-To'] = reply_address
-        try:
-            mail.send_mail(
+        message_headers = dict(headers)
+        message_headers['Reply-To'] = reply_address
+        messages.append(
+            mail.build_message(
                 subject_line=subject_line,
                 body_text=body_text,
                 recipient_list=[user.email],
-                related_object=origin_post,
-                activity_type=const.TYPE_ACTIVITY_EMAIL_UPDATE_SENT,
-                headers=headers,
-                raise_on_failure=True
-            )
-        except askbot_exceptions.EmailNotSent, error:
-            logger.debug(
-                '%s, error=%s, logId=%s' % (user.email, error, log_id)
+                headers=message_headers
             )
-        else:
-            logger.debug('success %s, logId=%s' % (user.email, log_id))
+        )
+
+    #and send them in batches over the shared connections
+    failures = mail.send_messages(messages, retries = email_retries)
+    failed_messages = set()
+    for message, error in failures:
+        failed_messages.add(message)
+        logger.debug(
+            '%s, error=%s, logId=%s' % (message.to[0], error, log_id)
+        )
+    for message in messages:
+        if message not in failed_messages:
+            logger.debug('success %s, logId=%s' % (message.to[0], log_id))
 
 
 def notify_author_of_published_revision(
@@ -3181,8 +3235,12 @@ def record_award_event(instance, created, **kwargs):
         activity.save()
         activity.add_recipients([instance.user])
 
-        instance.badge.awarded_count += 1
-        instance.badge.save()
+        #the counter is incremented by Badge.award() in the same
+        #way for the awards made through the badges module
+        if not getattr(instance, 'awarded_count_updated', False):
+            BadgeData.objects.filter(id = instance.badge_id).update(
+                                awarded_count = F('awarded_count') + 1
+                            )
 
         badge = get_badge(instance.badge.slug)
 
@@ -3194,6 +3252,22 @@ def record_award_event(instance, created, **kwargs):
             instance.user.bronze += 1
         instance.user.save()
 
+def clear_held_badges_cache(instance, **kwargs):
+    """drops the cached set of badges of the user
+    when the award is saved or deleted"""
+    badges.clear_held_badges_cache(instance.user_id)
+
+def clear_email_schedule_cache_of_subscriber(instance, **kwargs):
+    """drops the cached email subscriptions of the user
+    when the subscription is saved or deleted"""
+    clear_email_schedule_cache(instance.subscriber_id)
+
+def clear_held_badges_cache_of_new_user(instance, created, **kwargs):
+    """user ids may be reused (e.g. after a rolled back
+    transaction), so the cached badges of a new user are dropped"""
+    if created:
+        badges.clear_held_badges_cache(instance.id)
+
 def notify_award_message(instance, created, **kwargs):
     """
     Notify users when they have been awarded badges by using Django message.
@@ -3242,19 +3316,42 @@ def record_user_visit(user, timestamp, **kwargs):
     """
     when user visits any pages, we update the last_seen and
     consecutive_days_visit_count
+
+    last_seen is buffered in the cache and saved in bulk by the
+    periodic task or the ``flush_last_seen`` management command,
+    only the first visit of a day is saved right away,
+    with the count of the days
     """
-    prev_last_seen = user.last_seen or datetime.datetime.now()
+    buffered = LAST_SEEN_UPDATE_INTERVAL and LAST_SEEN_BUFFER.is_enabled()
+    prev_last_seen = None
+    if buffered:
+        prev_last_seen = LAST_SEEN_BUFFER.get_pending(user.id)
+    prev_last_seen = prev_last_seen or user.last_seen or timestamp
     user.last_seen = timestamp
-    if (user.last_seen - prev_last_seen).days == 1:
-        user.consecutive_days_visit_count += 1
-        award_badges_signal.send(None,
-            event = 'site_visit',
-            actor = user,
-            context_object = user,
-            timestamp = timestamp
+
+    days = (timestamp.date() - prev_last_seen.date()).days
+    if days > 0 or not buffered:
+        if days == 1:
+            user.consecutive_days_visit_count += 1
+        elif days > 1:
+            user.consecutive_days_visit_count = 0
+        #somehow it saves on the query as compared to user.save()
+        User.objects.filter(id = user.id).update(
+            last_seen = timestamp,
+            consecutive_days_visit_count = user.consecutive_days_visit_count
         )
-    #somehow it saves on the query as compared to user.save()
-    User.objects.filter(id = user.id).update(last_seen = timestamp)
+        if days == 1:
+            award_badges_signal.send(None,
+                event = 'site_visit',
+                actor = user,
+                context_object = user,
+                timestamp = timestamp
+            )
+
+    if buffered:
+        #buffered value is saved even if it is already in the database,
+        #so that an older pending value does not overwrite it
+        LAST_SEEN_BUFFER.set(user.id, timestamp)
 
 
 def record_vote(instance, created, **kwargs):
@@ -3367,6 +3464,56 @@ def record_update_tags(thread, tags, user, timestamp, **kwargs):
                 )
     activity.save()
 
+def update_search_index_of_post(post, **kwargs):
+    """called upon signals post_updated
+    and delete_question_or_answer"""
+    if post.thread_id:
+        search_backends.get_backend().update_thread(post.thread_id)
+
+def update_search_index_of_deleted_post(instance, **kwargs):
+    """comments are deleted from the database,
+    so the index is updated on post_delete"""
+    if instance.post_type == 'comment' and instance.thread_id:
+        search_backends.get_backend().update_thread(instance.thread_id)
+
+def update_search_index_of_deleted_question_or_answer(instance, **kwargs):
+    update_search_index_of_post(instance)
+
+def update_search_index_of_thread(thread, **kwargs):
+    """called upon signal tags_updated"""
+    search_backends.get_backend().update_thread(thread.id)
+
+def remove_thread_from_search_index(instance, **kwargs):
+    search_backends.get_backend().remove_thread(instance.id)
+
+def remember_tags_of_deleted_thread(instance, **kwargs):
+    """tags are unlinked from the thread before post_delete,
+    the tags of the deleted questions are already not counted"""
+    question_deleted = Post.objects.filter(
+                                thread = instance,
+                                post_type = 'question',
+                                deleted = True
+                            ).exists()
+    if question_deleted:
+        instance._counted_tag_ids = list()
+    else:
+        instance._counted_tag_ids = list(
+                        instance.tags.values_list('id', flat = True)
+                    )
+
+def update_tag_cooccurrence_of_deleted_thread(instance, **kwargs):
+    tag_ids = getattr(instance, '_counted_tag_ids', None)
+    if tag_ids:
+        TagCooccurrence.objects.update_counts(tag_ids, [])
+
+def bump_thread_version_of_post(instance, **kwargs):
+    """makes the cached pages of the thread of the post stale"""
+    if instance.thread_id:
+        response_cache.bump_thread_version(instance.thread_id)
+
+def bump_thread_version(instance, **kwargs):
+    response_cache.bump_thread_version(instance.id)
+
 def record_favorite_question(instance, created, **kwargs):
     """
     when user add the question in him favorite questions list.
@@ -3562,7 +3709,15 @@ django_signals.post_save.connect(add_missing_subscriptions, sender=User)
 django_signals.post_save.connect(add_user_to_global_group, sender=User)
 django_signals.post_save.connect(add_user_to_personal_group, sender=User)
 django_signals.post_save.connect(record_award_event, sender=Award)
+django_signals.post_save.connect(clear_held_badges_cache, sender=Award)
+django_signals.post_delete.connect(clear_held_badges_cache, sender=Award)
+django_signals.post_save.connect(
+    clear_held_badges_cache_of_new_user,
+    sender=User
+)
 django_signals.post_save.connect(notify_award_message, sender=Award)
+django_signals.post_save.connect(clear_email_schedule_cache_of_subscriber, sender=EmailFeedSetting)
+django_signals.post_delete.connect(clear_email_schedule_cache_of_subscriber, sender=EmailFeedSetting)
 django_signals.post_save.connect(record_answer_accepted, sender=Post)
 django_signals.post_save.connect(record_vote, sender=Vote)
 django_signals.post_save.connect(record_favorite_question, sender=FavoriteQuestion)
@@ -3574,17 +3729,41 @@ if 'avatar' in django_settings.INSTALLED_APPS:
     django_signals.post_delete.connect(update_user_avatar_type_flag, sender=Avatar)
 
 django_signals.post_delete.connect(record_cancel_vote, sender=Vote)
+django_signals.post_delete.connect(update_search_index_of_deleted_post, sender=Post)
+django_signals.post_delete.connect(remove_thread_from_search_index, sender=Thread)
+django_signals.pre_delete.connect(remember_tags_of_deleted_thread, sender=Thread)
+django_signals.post_delete.connect(update_tag_cooccurrence_of_deleted_thread, sender=Thread)
+#cached search results go stale with any change of the content
+#or of the visibility of the threads
+django_signals.post_save.connect(bump_content_generation, sender=Post)
+django_signals.post_delete.connect(bump_content_generation, sender=Post)
+django_signals.post_save.connect(bump_content_generation, sender=Thread)
+django_signals.post_delete.connect(bump_content_generation, sender=Thread)
+django_signals.post_save.connect(bump_content_generation, sender=ThreadToGroup)
+django_signals.post_delete.connect(bump_content_generation, sender=ThreadToGroup)
+django_signals.post_save.connect(bump_content_generation, sender=MarkedTag)
+django_signals.post_delete.connect(bump_content_generation, sender=MarkedTag)
+django_signals.post_save.connect(bump_content_generation, sender=GroupMembership)
+django_signals.post_delete.connect(bump_content_generation, sender=GroupMembership)
+django_signals.post_save.connect(bump_thread_version_of_post, sender=Post)
+django_signals.post_delete.connect(bump_thread_version_of_post, sender=Post)
+django_signals.post_save.connect(bump_thread_version, sender=Thread)
 
 #change this to real m2m_changed with Django1.2
 signals.delete_question_or_answer.connect(record_delete_question, sender=Post)
+signals.delete_question_or_answer.connect(
+    update_search_index_of_deleted_question_or_answer, sender=Post
+)
 signals.flag_offensive.connect(record_flag_offensive, sender=Post)
 signals.remove_flag_offensive.connect(remove_flag_offensive, sender=Post)
 signals.tags_updated.connect(record_update_tags)
+signals.tags_updated.connect(update_search_index_of_thread)
 signals.user_registered.connect(greet_new_user)
 signals.user_updated.connect(record_user_full_updated, sender=User)
 signals.user_logged_in.connect(complete_pending_tag_subscriptions)#todo: add this to fake onlogin middleware
 signals.user_logged_in.connect(post_anonymous_askbot_content)
 signals.post_updated.connect(record_post_update_activity)
+signals.post_updated.connect(update_search_index_of_post)
 
 #probably we cannot use post-save here the point of this is
 #to tell when the revision becomes publicly visible, not when it is saved
@@ -3612,6 +3791,8 @@ __all__ = [
         'Vote',
         'PostFlagReason',
         'MarkedTag',
+        'WildcardTagPrefix',
+        'TagCooccurrence',
 
         'BadgeData',
         'Award',
@@ -16,8 +16,21 @@ adde it to BADGES dictionary, register with event in EVENTS_TO_BADGES
 and make sure that a signal `award_badges_signal` is sent with the
 corresponding event name, actor (user object), context_object and optionally
 - timestamp
+
+Badges are evaluated by instances kept in a process-wide registry,
+which is rebuilt when the live settings change, because the thresholds
+of the badges are read from the settings. The ``BadgeData`` records are
+cached by slug in the process as well, and a set of slugs of the badges
+held by each user is cached, so that badges that can be awarded
+only once are skipped without database queries.
+
+With ``ASKBOT_AWARD_BADGES_ASYNC = True`` in the django settings
+the badges are evaluated in a celery task.
 """
 import datetime
+from django.conf import settings as django_settings
+from django.core import cache  # import cache, not from cache import cache, to be able to monkey-patch cache.cache in test cases
+from django.db.models import F
 from django.template.defaultfilters import slugify
 from django.contrib.contenttypes.models import ContentType
 from django.utils.translation import ugettext as _
@@ -60,6 +73,45 @@ class Badge(object):
         data, created = BadgeData.objects.get_or_create(slug = self.key)
         return data
 
+    def get_cached_stored_data(self):
+        """returns ``BadgeData`` record of the badge
+        from the process-wide cache, the record
+        may be stale, so the caller must verify it"""
+        data = _badge_data.get(self.key)
+        if data is None:
+            load_badge_data()
+            data = _badge_data.get(self.key)
+            if data is None:
+                data = self.get_stored_data()
+                _badge_data[self.key] = data
+        return data
+
+    def increment_awarded_count(self):
+        """increments the award counter and returns
+        the ``BadgeData`` record of the badge,
+        the cached record is reloaded if it is not
+        in the database anymore"""
+        data = self.get_cached_stored_data()
+        count = BadgeData.objects.filter(
+                                id = data.id, slug = self.key
+                            ).update(
+                                awarded_count = F('awarded_count') + 1
+                            )
+        if count == 0:
+            _badge_data.pop(self.key, None)
+            data = self.get_cached_stored_data()
+            BadgeData.objects.filter(id = data.id).update(
+                                awarded_count = F('awarded_count') + 1
+                            )
+        return data
+
+    def is_held_by(self, user):
+        """``True`` if the badge can be awarded only once
+        and the user already has it"""
+        if self.multiple:
+            return False
+        return self.key in get_held_badge_slugs(user)
+
     @property
     def awarded_count(self):
         return self.get_stored_data().awarded_count
@@ -88,6 +140,9 @@ class Badge(object):
         """do award, the recipient was proven to deserve"""
 
         if self.multiple == False:
+            if self.is_held_by(recipient):
+                return False
+            #the cached set may miss an award made by another process
             if recipient.badges.filter(slug = self.key).count() != 0:
                 return False
         else:
@@ -102,13 +157,15 @@ class Badge(object):
             if Award.objects.filter(**filters).count() != 0:
                 return False
 
-        badge = self.get_stored_data()
+        badge = self.increment_awarded_count()
         award = Award(
                     user = recipient,
                     badge = badge,
                     awarded_at = timestamp,
                     content_object = context_object
                 )
+        #tells the signal handler that the counter is already updated
+        award.awarded_count_updated = True
         award.save()#note: there are signals that listen to saving the Award
         return True
 
@@ -244,6 +301,8 @@ class CivicDuty(Badge):
             context_object = None, timestamp = None):
         if context_object.post_type not in ('question', 'answer'):
             return False
+        if self.is_held_by(actor):
+            return False
         if actor.votes.count() == askbot_settings.CIVIC_DUTY_BADGE_MIN_VOTES:
             return self.award(actor, context_object, timestamp)
 
@@ -596,6 +655,8 @@ class EditorTypeBadge(Badge):
 
     def consider_award(self, actor = None,
             context_object = None, timestamp = None):
+        if self.is_held_by(actor):
+            return False
 
         atypes = (
             const.TYPE_ACTIVITY_UPDATE_QUESTION,
@@ -739,6 +800,8 @@ class Commentator(Badge):
 
     def consider_award(self, actor = None,
             context_object = None, timestamp = None):
+        if self.is_held_by(actor):
+            return False
         num_comments = Post.objects.get_comments().filter(author=actor).count()
         if num_comments >= askbot_settings.COMMENTATOR_BADGE_MIN_COMMENTS:
             return self.award(actor, context_object, timestamp)
@@ -868,6 +931,62 @@ def get_badge(name = None):
     key = slugify(name)
     return BADGES[key]()
 
+#cache of the BadgeData records by slug
+_badge_data = dict()
+#instances of the badge classes used to evaluate the awards,
+#valid for the given version of the live settings
+_badge_registry = {'version': None, 'badges': dict()}
+
+def load_badge_data():
+    """loads all ``BadgeData`` records into the
+    process-wide cache with a single query"""
+    for data in BadgeData.objects.all():
+        _badge_data[data.slug] = data
+
+def get_badge_instance(badge_class):
+    """returns instance of the badge class from the registry,
+    instances are created once per version of the live settings,
+    which determine the badge thresholds
+
+    the instances are to be used for evaluation of the awards only,
+    to display the badges use :func:`get_badge`, because
+    names and descriptions of the badges are translated
+    """
+    version = askbot_settings.get_snapshot_version()
+    if version is None:
+        #settings are not available yet
+        return badge_class()
+    if version != _badge_registry['version']:
+        _badge_registry['badges'] = dict()
+        _badge_registry['version'] = version
+    badges = _badge_registry['badges']
+    badge = badges.get(badge_class)
+    if badge is None:
+        badge = badge_class()
+        badges[badge_class] = badge
+    return badge
+
+def get_held_badges_cache_key(user_id):
+    return 'askbot-user-badges-%d' % user_id
+
+def get_held_badge_slugs(user):
+    """returns frozenset of slugs of the badges held by the user
+
+    the value is cached along with the badge counters of the user,
+    so that the entry is ignored when the counters do not match
+    """
+    counters = (user.gold, user.silver, user.bronze)
+    key = get_held_badges_cache_key(user.id)
+    cached = cache.cache.get(key)
+    if cached is not None and cached[0] == counters:
+        return cached[1]
+    slugs = frozenset(user.badges.values_list('slug', flat = True))
+    cache.cache.set(key, (counters, slugs), const.LONG_TIME)
+    return slugs
+
+def clear_held_badges_cache(user_id):
+    cache.cache.delete(get_held_badges_cache_key(user_id))
+
 def init_badges():
     """Calling this function will set up badge record
     int the database for each badge enumerated in the
@@ -893,18 +1012,44 @@ award_badges_signal = Signal(
 #event - string name of the event, e.g 'downvote'
 #context_object - database object related to the event, e.g. question
 
-@auto_now_timestamp
-def award_badges(event = None, actor = None, 
-                context_object = None, timestamp = None, **kwargs):
-    """function that is called when signal `award_badges_signal` is sent
-    """
+#events evaluated synchronously even when badges are awarded
+#in the celery task, because the badges depend on the
+#state of the actor that is not saved to the database yet
+SYNCHRONOUS_EVENTS = ('site_visit',)
+
+def evaluate_badges(event = None, actor = None,
+                context_object = None, timestamp = None):
+    """tries to award all badges registered for the event"""
     try:
         consider_badges = EVENTS_TO_BADGES[event]
     except KeyError:
         raise NotImplementedError('event "%s" is not implemented' % event)
 
     for badge in consider_badges:
-        badge_instance = badge()
+        badge_instance = get_badge_instance(badge)
         badge_instance.consider_award(actor, context_object, timestamp)
 
+@auto_now_timestamp
+def award_badges(event = None, actor = None, 
+                context_object = None, timestamp = None, **kwargs):
+    """function that is called when signal `award_badges_signal` is sent
+    """
+    if event not in EVENTS_TO_BADGES:
+        raise NotImplementedError('event "%s" is not implemented' % event)
+
+    if getattr(django_settings, 'ASKBOT_AWARD_BADGES_ASYNC', False) \
+        and event not in SYNCHRONOUS_EVENTS:
+        from askbot import tasks#tasks module imports models
+        content_type = ContentType.objects.get_for_model(context_object)
+        tasks.award_badges_celery_task.delay(
+                                event = event,
+                                actor_id = actor.id,
+                                content_type_id = content_type.id,
+                                object_id = context_object.id,
+                                timestamp = timestamp
+                            )
+        return
+
+    evaluate_badges(event, actor, context_object, timestamp)
+
 award_badges_signal.connect(award_badges)
@@ -1,7 +1,47 @@
 import datetime
-from django.db import models
+from django.db import connection, models, transaction
 from django.contrib.auth.models import User
 
+#max number of rows inserted with one query
+BULK_INSERT_BATCH_SIZE = 500
+
+def bulk_insert(model, field_names, rows, batch_size = BULK_INSERT_BATCH_SIZE):
+    """inserts ``rows`` - tuples of values of the fields
+    of the model given by ``field_names``, with one query
+    per batch of rows, model signals are not sent
+
+    todo: change to bulk_create when django 1.3 goes out of use
+    """
+    opts = model._meta
+    fields = [opts.get_field(name) for name in field_names]
+    query = 'INSERT INTO %s (%s) VALUES (%s)' % (
+                connection.ops.quote_name(opts.db_table),
+                ', '.join([connection.ops.quote_name(f.column) for f in fields]),
+                ', '.join(['%s'] * len(fields))
+            )
+    cursor = connection.cursor()
+    for start in range(0, len(rows), batch_size):
+        params = list()
+        for row in rows[start:start + batch_size]:
+            params.append([
+                field.get_db_prep_save(value, connection = connection)
+                for field, value in zip(fields, row)
+            ])
+        cursor.executemany(query, params)
+    transaction.commit_unless_managed()
+
+def bulk_insert_objects(objects, batch_size = BULK_INSERT_BATCH_SIZE):
+    """inserts unsaved instances of one model with :func:`bulk_insert`,
+    the primary keys must be assigned by the caller,
+    values of the fields of the parent models are not inserted
+    """
+    if len(objects) == 0:
+        return
+    model = objects[0].__class__
+    fields = model._meta.local_fields
+    rows = [[field.pre_save(obj, True) for field in fields] for obj in objects]
+    bulk_insert(model, [field.name for field in fields], rows, batch_size)
+
 class BaseQuerySetManager(models.Manager):
     """a base class that allows chainable qustom filters
     on the query sets
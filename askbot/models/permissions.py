@@ -0,0 +1,389 @@
+"""Permissions of the user to act on many posts at once.
+
+Each ``User.assert_can_<action>()`` call checks one action on one
+post and raises ``PermissionDenied`` with the translated reason.
+That is right for the views which perform the actions, but not
+for the pages which show the controls of many posts.
+
+:func:`get_post_permissions` evaluates the same rules for a batch
+of posts: the live settings are read once, and the data needed by
+the rules (flags, authors of the questions, upvoted answers and
+the latest comments) is loaded with a few queries for all posts.
+The result is a matrix post id -> set of the allowed actions,
+the names of the actions are listed in :data:`POST_ACTIONS`.
+
+The rules must be kept in sync with the ``user_assert_can_*``
+functions in :mod:`askbot.models`.
+"""
+import datetime
+from django.contrib.contenttypes.models import ContentType
+from django.db.models import Max
+from askbot import const
+from askbot.conf import settings as askbot_settings
+from askbot.models.post import Post
+from askbot.models.user import Activity
+
+POST_ACTIONS = (
+    'accept_best_answer',
+    'close_question',
+    'delete_comment',
+    'delete_post',
+    'edit_comment',
+    'edit_post',
+    'flag_offensive',
+    'post_comment',
+    'remove_all_flags_offensive',
+    'remove_flag_offensive',
+    'reopen_question',
+    'retag_question',
+)
+
+
+def is_allowed(
+            user,
+            is_owner = False,
+            owner_can = False,
+            suspended_owner_cannot = False,
+            owner_min_rep = None,
+            check_blocked = True,
+            check_suspended = True,
+            min_rep = None,
+            admin_or_moderator_required = False
+        ):
+    """boolean counterpart of the ``_assert_user_can``
+    in :mod:`askbot.models`"""
+    if check_blocked and user.is_blocked():
+        return False
+    if owner_can and is_owner:
+        if owner_min_rep and user.reputation < owner_min_rep:
+            return user.is_administrator_or_moderator()
+        return not (suspended_owner_cannot and user.is_suspended())
+    if check_suspended and user.is_suspended():
+        return False
+    if user.is_administrator_or_moderator():
+        return True
+    if min_rep is not None and user.reputation < min_rep:
+        return False
+    return admin_or_moderator_required == False
+
+
+class PostPermissionEvaluator(object):
+    """evaluates permissions of one user for a batch of posts,
+    the data shared by the posts is loaded in the constructor"""
+
+    def __init__(self, user, posts):
+        self.user = user
+        self.is_staff = user.is_administrator_or_moderator()
+        self.now = datetime.datetime.now()
+        self.flags_posted_today = None
+
+        settings = dict()
+        for name in (
+            'MIN_REP_TO_ACCEPT_OWN_ANSWER',
+            'MIN_DAYS_FOR_STAFF_TO_ACCEPT_ANSWER',
+            'MIN_REP_TO_LEAVE_COMMENTS',
+            'MIN_REP_TO_EDIT_WIKI',
+            'MIN_REP_TO_EDIT_OTHERS_POSTS',
+            'MIN_REP_TO_DELETE_OTHERS_POSTS',
+            'MIN_REP_TO_DELETE_OTHERS_COMMENTS',
+            'MIN_REP_TO_CLOSE_OTHERS_QUESTIONS',
+            'MIN_REP_TO_CLOSE_OWN_QUESTIONS',
+            'MIN_REP_TO_REOPEN_OWN_QUESTIONS',
+            'MIN_REP_TO_RETAG_OTHERS_QUESTIONS',
+            'MIN_REP_TO_FLAG_OFFENSIVE',
+            'MAX_FLAGS_PER_USER_PER_DAY',
+            'USE_TIME_LIMIT_TO_EDIT_COMMENT',
+            'MINUTES_TO_EDIT_COMMENT',
+        ):
+            settings[name] = getattr(askbot_settings, name)
+        self.settings = settings
+
+        post_ids = [post.id for post in posts]
+        flags = Activity.objects.filter(
+                        activity_type = const.TYPE_ACTIVITY_MARK_OFFENSIVE,
+                        content_type = ContentType.objects.get_for_model(Post),
+                        object_id__in = post_ids
+                    ).values_list('object_id', 'user')
+        self.flagged_post_ids = set()
+        self.own_flagged_post_ids = set()
+        for post_id, user_id in flags:
+            self.flagged_post_ids.add(post_id)
+            if user_id == user.id:
+                self.own_flagged_post_ids.add(post_id)
+
+        self.question_author_ids = self.get_question_author_ids(posts)
+        self.threads_with_upvoted_answers = \
+                            self.get_threads_with_upvoted_answers(posts)
+        self.last_comment_times = self.get_last_comment_times(posts)
+
+    def get_question_author_ids(self, posts):
+        """returns dictionary thread id -> id of the author
+        of the question, for the threads of the answers"""
+        author_ids = dict()
+        thread_ids = set()
+        for post in posts:
+            if post.post_type == 'question':
+                author_ids[post.thread_id] = post.author_id
+            elif post.post_type == 'answer':
+                thread_ids.add(post.thread_id)
+        thread_ids -= set(author_ids.keys())
+        if thread_ids:
+            author_ids.update(
+                Post.objects.get_questions().filter(
+                    thread__in = thread_ids
+                ).values_list('thread', 'author')
+            )
+        return author_ids
+
+    def get_threads_with_upvoted_answers(self, posts):
+        """returns ids of the threads of the own questions
+        which have upvoted answers by other users,
+        such questions can be deleted only by the staff"""
+        if self.is_staff:
+            return set()
+        thread_ids = [
+            post.thread_id for post in posts
+            if post.post_type == 'question' and post.author_id == self.user.id
+        ]
+        if len(thread_ids) == 0:
+            return set()
+        return set(
+            Post.objects.get_answers().filter(
+                thread__in = thread_ids
+            ).exclude(
+                author = self.user
+            ).exclude(
+                score__lte = 0
+            ).values_list('thread', flat = True)
+        )
+
+    def get_last_comment_times(self, posts):
+        """returns dictionary parent post id -> time of the
+        latest comment, for the parents of own comments which
+        can no longer be edited by the time limit, unless
+        they are the last ones"""
+        if self.is_staff or not self.settings['USE_TIME_LIMIT_TO_EDIT_COMMENT']:
+            return dict()
+        parent_ids = set([
+            post.parent_id for post in posts
+            if post.post_type == 'comment' \
+                and post.author_id == self.user.id \
+                and self.is_comment_edit_time_over(post)
+        ])
+        if len(parent_ids) == 0:
+            return dict()
+        return dict(
+            Post.objects.get_comments().filter(
+                parent__in = parent_ids
+            ).values_list('parent').annotate(Max('added_at'))
+        )
+
+    def is_comment_edit_time_over(self, comment):
+        minutes = self.settings['MINUTES_TO_EDIT_COMMENT']
+        return self.now - comment.added_at > datetime.timedelta(0, 60 * minutes)
+
+    def get_flags_posted_today(self):
+        if self.flags_posted_today is None:
+            self.flags_posted_today = self.user.get_flag_count_posted_today()
+        return self.flags_posted_today
+
+    def can_see_deleted_post(self, post):
+        return is_allowed(
+                    self.user,
+                    is_owner = post.author_id == self.user.id,
+                    owner_can = True,
+                    check_blocked = False,
+                    check_suspended = False,
+                    admin_or_moderator_required = True
+                )
+
+    def can_edit_post(self, post):
+        if post.deleted:
+            return self.can_see_deleted_post(post)
+        if post.wiki:
+            min_rep = self.settings['MIN_REP_TO_EDIT_WIKI']
+        else:
+            min_rep = self.settings['MIN_REP_TO_EDIT_OTHERS_POSTS']
+        return is_allowed(
+                    self.user,
+                    is_owner = post.author_id == self.user.id,
+                    owner_can = True,
+                    min_rep = min_rep
+                )
+
+    def can_delete_answer(self, post):
+        return is_allowed(
+                    self.user,
+                    is_owner = post.author_id == self.user.id,
+                    owner_can = True,
+                    min_rep = self.settings['MIN_REP_TO_DELETE_OTHERS_POSTS']
+                )
+
+    def can_delete_question(self, post):
+        if not self.can_delete_answer(post):
+            return False
+        return post.thread_id not in self.threads_with_upvoted_answers
+
+    def can_delete_comment(self, post):
+        return is_allowed(
+                    self.user,
+                    is_owner = post.author_id == self.user.id,
+                    owner_can = True,
+                    min_rep = self.settings['MIN_REP_TO_DELETE_OTHERS_COMMENTS']
+                )
+
+    def can_delete_post(self, post):
+        if post.post_type == 'question':
+            return self.can_delete_question(post)
+        elif post.post_type == 'answer':
+            return self.can_delete_answer(post)
+        elif post.post_type == 'comment':
+            return self.can_delete_comment(post)
+        return False
+
+    def can_edit_comment(self, post):
+        if self.is_staff:
+            return True
+        if post.author_id != self.user.id:
+            return False
+        if post.parent_id in self.last_comment_times:
+            return post.added_at >= self.last_comment_times[post.parent_id]
+        return True
+
+    def can_post_comment(self, post):
+        allowed = is_allowed(
+                    self.user,
+                    is_owner = post.author_id == self.user.id,
+                    owner_can = True,
+                    min_rep = self.settings['MIN_REP_TO_LEAVE_COMMENTS']
+                )
+        if allowed:
+            return True
+        #answers can be commented by the author of the question
+        #regardless of the reputation
+        user = self.user
+        if user.is_blocked() or user.is_suspended() \
+                or post.post_type != 'answer':
+            return False
+        return self.question_author_ids.get(post.thread_id) == user.id
+
+    def can_close_question(self, post):
+        return is_allowed(
+                    self.user,
+                    is_owner = post.author_id == self.user.id,
+                    owner_can = True,
+                    suspended_owner_cannot = True,
+                    owner_min_rep = self.settings['MIN_REP_TO_CLOSE_OWN_QUESTIONS'],
+                    min_rep = self.settings['MIN_REP_TO_CLOSE_OTHERS_QUESTIONS']
+                )
+
+    def can_reopen_question(self, post):
+        return is_allowed(
+                    self.user,
+                    is_owner = post.author_id == self.user.id,
+                    owner_can = True,
+                    suspended_owner_cannot = True,
+                    owner_min_rep = self.settings['MIN_REP_TO_REOPEN_OWN_QUESTIONS']
+                )
+
+    def can_retag_question(self, post):
+        if post.deleted and not self.can_see_deleted_post(post):
+            return False
+        return is_allowed(
+                    self.user,
+                    is_owner = post.author_id == self.user.id,
+                    owner_can = True,
+                    min_rep = self.settings['MIN_REP_TO_RETAG_OTHERS_QUESTIONS']
+                )
+
+    def can_accept_best_answer(self, post):
+        user = self.user
+        if user.is_blocked() or user.is_suspended():
+            return False
+        if self.question_author_ids.get(post.thread_id) == user.id:
+            if post.author_id == user.id and not user.is_administrator():
+                return is_allowed(
+                    user,
+                    min_rep = self.settings['MIN_REP_TO_ACCEPT_OWN_ANSWER']
+                )
+            return True
+        if self.is_staff:
+            days = self.settings['MIN_DAYS_FOR_STAFF_TO_ACCEPT_ANSWER']
+            return self.now >= post.added_at + datetime.timedelta(days = days)
+        return False
+
+    def can_flag_offensive(self, post):
+        """flagging twice is not allowed, but the control
+        is shown on the flagged posts anyway"""
+        if post.id in self.own_flagged_post_ids:
+            return True
+        allowed = is_allowed(
+                    self.user,
+                    min_rep = self.settings['MIN_REP_TO_FLAG_OFFENSIVE']
+                )
+        if not allowed:
+            return False
+        if self.is_staff:
+            return True
+        max_flags = self.settings['MAX_FLAGS_PER_USER_PER_DAY']
+        return self.get_flags_posted_today() < max_flags
+
+    def can_remove_flag_offensive(self, post):
+        if post.id not in self.own_flagged_post_ids:
+            return False
+        return is_allowed(
+                    self.user,
+                    min_rep = self.settings['MIN_REP_TO_FLAG_OFFENSIVE']
+                )
+
+    def can_remove_all_flags_offensive(self, post):
+        return self.is_staff and post.id in self.flagged_post_ids
+
+    def get_actions(self, post):
+        """returns set of the names of the actions
+        which the user can perform on the post"""
+        if post.post_type == 'question':
+            actions = (
+                'close_question', 'delete_post', 'edit_post',
+                'flag_offensive', 'post_comment', 'remove_all_flags_offensive',
+                'remove_flag_offensive', 'reopen_question', 'retag_question',
+            )
+        elif post.post_type == 'answer':
+            actions = (
+                'accept_best_answer', 'delete_post', 'edit_post',
+                'flag_offensive', 'post_comment', 'remove_all_flags_offensive',
+                'remove_flag_offensive',
+            )
+        elif post.post_type == 'comment':
+            actions = (
+                'delete_comment', 'delete_post', 'edit_comment', 'edit_post',
+                'flag_offensive', 'remove_all_flags_offensive',
+                'remove_flag_offensive',
+            )
+        else:
+            actions = ('edit_post',)
+
+        allowed = set()
+        for action in actions:
+            if getattr(self, 'can_' + action)(post):
+                allowed.add(action)
+        return allowed
+
+
+def get_post_permissions(user, posts):
+    """returns dictionary post id -> set of the names
+    of the actions that the user can perform on the post,
+    anonymous users cannot perform any actions"""
+    posts = list(posts)
+    if user.is_anonymous() or len(posts) == 0:
+        return dict([(post.id, set()) for post in posts])
+    evaluator = PostPermissionEvaluator(user, posts)
+    return dict([(post.id, evaluator.get_actions(post)) for post in posts])
+
+def format_post_permissions(permissions):
+    """returns the permissions matrix in the form which
+    can be serialized to json: post id -> sorted list of the actions"""
+    return dict([
+        (post_id, sorted(actions))
+        for post_id, actions in permissions.items()
+    ])
@@ -25,26 +25,64 @@ import askbot
 from askbot.utils.slug import slugify
 from askbot import const
 from askbot.models.user import Activity
-from askbot.models.user import EmailFeedSetting
+from askbot.models.user import EmailFeedSetting, SUBSCRIBER_BATCH_SIZE
 from askbot.models.user import Group
 from askbot.models.user import GroupMembership
-from askbot.models.tag import Tag, MarkedTag
-from askbot.models.tag import get_groups, tags_match_some_wildcard
+from askbot.models.tag import Tag, MarkedTag, WildcardTagPrefix
+from askbot.models.tag import get_groups
 from askbot.models.tag import get_global_group
 from askbot.conf import settings as askbot_settings
 from askbot import exceptions
 from askbot.utils import markup
 from askbot.utils.html import sanitize_html
 from askbot.models.base import BaseQuerySetManager, DraftContent
+from askbot.models.base import bulk_insert
 
 #todo: maybe merge askbot.utils.markup and forum.utils.html
 from askbot.utils.diff import textDiff as htmldiff
 from askbot.utils import mysql
 
+class PostToGroupManager(models.Manager):
+    """adds and removes group memberships of many posts
+    at once, with the number of queries independent
+    of the number of posts"""
+
+    def add_posts_to_groups(self, posts, groups):
+        """adds posts given by the query set to the groups,
+        only missing memberships are inserted, with one query,
+        returns number of the added memberships
+        """
+        group_ids = set([group.id for group in groups])
+        if len(group_ids) == 0:
+            return 0
+        existing = set(
+            self.filter(
+                post__in=posts, group__id__in=group_ids
+            ).values_list('post', 'group')
+        )
+        missing = list()
+        for post_id in posts.values_list('id', flat=True):
+            for group_id in group_ids:
+                if (post_id, group_id) not in existing:
+                    missing.append((post_id, group_id))
+        if len(missing) == 0:
+            return 0
+
+        bulk_insert(self.model, ('post', 'group'), missing)
+        return len(missing)
+
+    def remove_posts_from_groups(self, posts, groups):
+        """removes posts given by the query set from the groups"""
+        group_ids = [group.id for group in groups]
+        self.filter(post__in=posts, group__id__in=group_ids).delete()
+
+
 class PostToGroup(models.Model):
     post = models.ForeignKey('Post')
     group = models.ForeignKey(Group)
 
+    objects = PostToGroupManager()
+
     class Meta:
         unique_together = ('post', 'group')
         app_label = 'askbot'
@@ -414,7 +452,7 @@ class Post(models.Model):
             text = html.urlize(text)
 
         if _use_markdown:
-            text = sanitize_html(markup.get_parser().convert(text))
+            text = markup.markdown_to_html(text)
 
         #todo, add markdown parser call conditional on
         #self.use_markdown flag
@@ -431,10 +469,15 @@ class Post(models.Model):
             extra_name_seeds = markup.extract_mentioned_name_seeds(text)
 
             extra_authors = set()
-            for name_seed in extra_name_seeds:
-                extra_authors.update(
-                    User.objects.filter(username__istartswith = name_seed)
+            if extra_name_seeds:
+                name_filter = reduce(
+                    operator.or_,
+                    [
+                        models.Q(username__istartswith = name_seed)
+                        for name_seed in extra_name_seeds
+                    ]
                 )
+                extra_authors.update(User.objects.filter(name_filter))
 
             #it is important to preserve order here so that authors of post
             #get mentioned first
@@ -576,24 +619,33 @@ class Post(models.Model):
         """true if post belongs to the group"""
         return self.groups.filter(id=group.id).exists()
 
-    def add_to_groups(self, groups):
-        #todo: use bulk-creation
-        for group in groups:
-            PostToGroup.objects.get_or_create(post=self, group=group)
+    def get_self_and_comments(self):
+        """returns query set with the post and, for questions
+        and answers, their comments"""
         if self.is_answer() or self.is_question():
-            comments = self.comments.all()
-            for group in groups:
-                for comment in comments:
-                    PostToGroup.objects.get_or_create(post=comment, group=group)
+            post_filter = models.Q(id=self.id) | models.Q(parent=self)
+        else:
+            post_filter = models.Q(id=self.id)
+        return Post.objects.filter(post_filter)
+
+    def add_to_groups(self, groups):
+        PostToGroup.objects.add_posts_to_groups(
+                                self.get_self_and_comments(), groups
+                            )
+        if self.thread_id:
+            self.thread.invalidate_cached_post_data()
+        if self.is_answer():
+            #answer visibility affects the cached thread summaries
+            self.thread.invalidate_cached_thread_content_fragment()
 
     def remove_from_groups(self, groups):
-        PostToGroup.objects.filter(post=self, group__in=groups).delete()
-        if self.is_answer() or self.is_question():
-            comment_ids = self.comments.all().values_list('id', flat=True)
-            PostToGroup.objects.filter(
-                        post__id__in=comment_ids,
-                        group__in=groups
-                    ).delete()
+        PostToGroup.objects.remove_posts_from_groups(
+                                self.get_self_and_comments(), groups
+                            )
+        if self.thread_id:
+            self.thread.invalidate_cached_post_data()
+        if self.is_answer():
+            self.thread.invalidate_cached_thread_content_fragment()
 
 
     def issue_update_notifications(
@@ -602,11 +654,14 @@ class Post(models.Model):
                                 notify_sets=None,
                                 activity_type=None,
                                 timestamp=None,
-                                diff=None
+                                diff=None,
+                                email_retries=0
                             ):
         """Called when a post is updated. Arguments:
 
         * ``notify_sets`` - result of ``Post.get_notify_sets()`` method
+        * ``email_retries`` - number of re-sends of the email alerts
+          after the transient errors, used outside of the web requests
 
         The method does two things:
 
@@ -632,16 +687,12 @@ class Post(models.Model):
         update_activity.add_recipients(notify_sets['for_inbox'])
 
         #create new mentions (barring the double-adds)
-        for u in notify_sets['for_mentions'] - notify_sets['for_inbox']:
-            Activity.objects.create_new_mention(
-                                    mentioned_whom = u,
-                                    mentioned_in = self,
-                                    mentioned_by = updated_by,
-                                    mentioned_at = timestamp
-                                )
-
-        for user in (notify_sets['for_inbox'] | notify_sets['for_mentions']):
-            user.update_response_counts()
+        Activity.objects.create_new_mentions(
+                mentioned_whom = notify_sets['for_mentions'] - notify_sets['for_inbox'],
+                mentioned_in = self,
+                mentioned_by = updated_by,
+                mentioned_at = timestamp
+            )
 
         #shortcircuit if the email alerts are disabled
         if askbot_settings.ENABLE_EMAIL_ALERTS == False:
@@ -658,6 +709,7 @@ class Post(models.Model):
                                 update_activity=update_activity,
                                 post=self,
                                 recipients=notify_sets['for_email'],
+                                email_retries=email_retries
                             )
 
     def make_private(self, user, group_id=None):
@@ -754,7 +806,7 @@ class Post(models.Model):
             #activity_types += (const.TYPE_ACTIVITY_MENTION,)
             #todo: not very good import in models of other models
             #todo: potentially a circular import
-            from askbot.models.user import Activity
+            from askbot.models.user import Activity, ActivityAuditStatus
             comment_content_type = ContentType.objects.get_for_model(self)
             activities = Activity.objects.filter(
                                 content_type = comment_content_type,
@@ -762,18 +814,12 @@ class Post(models.Model):
                                 #activity_type__in = activity_types
                             )
 
-            recipients = set()
-            for activity in activities:
-                for user in activity.recipients.all():
-                    recipients.add(user)
-
-            #activities need to be deleted before the response
-            #counts are updated
+            #audit statuses are deleted first, to update the response counts
+            ActivityAuditStatus.objects.delete_responses(
+                ActivityAuditStatus.objects.filter(activity__in = activities)
+            )
             activities.delete()
 
-            for user in recipients:
-                user.update_response_counts()
-
         super(Post, self).delete(**kwargs)
 
     def __unicode__(self):
@@ -947,12 +993,12 @@ class Post(models.Model):
 
         return comment_post
 
-    def get_global_tag_based_subscribers(
+    def get_global_tag_based_subscriber_ids(
             self,
             tag_mark_reason = None,
             subscription_records = None
     ):
-        """returns a list of users who either follow or "do not ignore"
+        """returns a set of ids of users who either follow or "do not ignore"
         the given set of tags, depending on the tag_mark_reason
 
         ``subscription_records`` - query set of ``~askbot.models.EmailFeedSetting``
@@ -973,97 +1019,94 @@ class Post(models.Model):
             tag__name__in = tag_names,
             reason = tag_mark_reason
         )
-        subscribers = set(
+        subscriber_ids = set(
             user_set_getter(
                 tag_selections__in = tag_selections
             ).filter(
                 email_tag_filter_strategy = email_tag_filter_strategy,
                 notification_subscriptions__in = subscription_records
-            )
+            ).values_list('id', flat = True)
         )
 
         #part 2 - find users who follow or not ignore tags via wildcard selections
-        #inside there is a potentially time consuming loop
+        #the wildcards are looked up in the prefix index
+        #so that the cost does not depend on the number of users
         if askbot_settings.USE_WILDCARD_TAGS:
-            #todo: fix this
-            #this branch will not scale well
-            #because we have to loop through the list of users
-            #in python
-            if tag_mark_reason == 'good':
-                empty_wildcard_filter = {'interesting_tags__exact': ''}
-                wildcard_tags_attribute = 'interesting_tags'
-                update_subscribers = lambda the_set, item: the_set.add(item)
-            elif tag_mark_reason == 'bad':
-                empty_wildcard_filter = {'ignored_tags__exact': ''}
-                wildcard_tags_attribute = 'ignored_tags'
-                update_subscribers = lambda the_set, item: the_set.discard(item)
-
-            potential_wildcard_subscribers = User.objects.filter(
+            wildcard_subscriber_ids = WildcardTagPrefix.objects.get_subscriber_ids(
+                tag_names, reason = tag_mark_reason
+            )
+            wildcard_subscriber_ids = User.objects.filter(
+                id__in = wildcard_subscriber_ids,
                 notification_subscriptions__in = subscription_records
             ).filter(
                 email_tag_filter_strategy = email_tag_filter_strategy
-            ).exclude(
-                **empty_wildcard_filter #need this to limit size of the loop
-            )
-            for potential_subscriber in potential_wildcard_subscribers:
-                wildcard_tags = getattr(
-                    potential_subscriber,
-                    wildcard_tags_attribute
-                ).split(' ')
+            ).values_list('id', flat = True)
+            if tag_mark_reason == 'good':
+                subscriber_ids.update(wildcard_subscriber_ids)
+            elif tag_mark_reason == 'bad':
+                subscriber_ids.difference_update(wildcard_subscriber_ids)
 
-                if tags_match_some_wildcard(tag_names, wildcard_tags):
-                    update_subscribers(subscribers, potential_subscriber)
+        return subscriber_ids
 
-        return subscribers
+    def get_global_tag_based_subscribers(
+            self,
+            tag_mark_reason = None,
+            subscription_records = None
+    ):
+        """same as :meth:`get_global_tag_based_subscriber_ids`,
+        but returns a set of users"""
+        subscriber_ids = self.get_global_tag_based_subscriber_ids(
+                                        tag_mark_reason = tag_mark_reason,
+                                        subscription_records = subscription_records
+                                    )
+        return set(User.objects.filter(id__in = subscriber_ids))
 
-    def get_global_instant_notification_subscribers(self):
-        """returns a set of subscribers to post according to tag filters
+    def get_global_instant_notification_subscriber_ids(self):
+        """returns a set of ids of subscribers to post according to tag filters
         both - subscribers who ignore tags or who follow only
         specific tags
 
         this method in turn calls several more specialized
         subscriber retrieval functions
-        todo: retrieval of wildcard tag followers ignorers
-              won't scale at all
         """
-        subscriber_set = set()
-
         global_subscriptions = EmailFeedSetting.objects.filter(
             feed_type = 'q_all',
             frequency = 'i'
         )
 
         #segment of users who have tag filter turned off
-        global_subscribers = User.objects.filter(
-            email_tag_filter_strategy = const.INCLUDE_ALL
+        subscriber_ids = set(
+            User.objects.filter(
+                email_tag_filter_strategy = const.INCLUDE_ALL,
+                notification_subscriptions__in = global_subscriptions
+            ).values_list('id', flat = True)
         )
-        subscriber_set.update(global_subscribers)
 
         #segment of users who want emails on selected questions only
-        subscriber_set.update(
-            self.get_global_tag_based_subscribers(
+        subscriber_ids.update(
+            self.get_global_tag_based_subscriber_ids(
                 subscription_records = global_subscriptions,
                 tag_mark_reason = 'good'
             )
         )
 
         #segment of users who want to exclude ignored tags
-        subscriber_set.update(
-            self.get_global_tag_based_subscribers(
+        subscriber_ids.update(
+            self.get_global_tag_based_subscriber_ids(
                 subscription_records = global_subscriptions,
                 tag_mark_reason = 'bad'
             )
         )
-        return subscriber_set
+        return subscriber_ids
 
 
-    def _qa__get_instant_notification_subscribers(
+    def _qa__get_instant_notification_subscriber_ids(
             self,
             potential_subscribers = None,
             mentioned_users = None,
             exclude_list = None,
             ):
-        """get list of users who have subscribed to
+        """get set of ids of users who have subscribed to
         receive instant notifications for a given post
 
         this method works for questions and answers
@@ -1091,78 +1134,62 @@ class Post(models.Model):
         * authors or any answers who subsribe to instant updates
           on the questions which they answered
         """
-        #print '------------------'
-        #print 'in content function'
-        subscriber_set = set()
-        #print 'potential subscribers: ', potential_subscribers
+        origin_post = self.get_origin_post()
 
-        #1) mention subscribers - common to questions and answers
-        if mentioned_users:
-            mention_subscribers = EmailFeedSetting.objects.filter_subscribers(
-                potential_subscribers = mentioned_users,
-                feed_type = 'm_and_c',
-                frequency = 'i'
-            )
-            subscriber_set.update(mention_subscribers)
+        mentioned_ids = set([user.id for user in mentioned_users or ()])
+        # TODO: The line below works only if origin_post is Question !
+        follower_ids = set(
+            origin_post.thread.followed_by.values_list('id', flat = True)
+        )
+        #authors of all revisions of the answers
+        answer_author_ids = set(
+            PostRevision.objects.filter(
+                post__thread = origin_post.thread,
+                post__post_type = 'answer'
+            ).values_list('author', flat = True)
+        )
+        question_author_ids = set([origin_post.author_id])
 
-        origin_post = self.get_origin_post()
+        #subscriptions of all candidates are read at once
+        schedules = EmailFeedSetting.objects.get_schedules(
+            mentioned_ids | follower_ids | answer_author_ids | question_author_ids
+        )
+        def filter_subscriber_ids(user_ids, feed_type):
+            return EmailFeedSetting.objects.filter_subscriber_ids(
+                user_ids,
+                feed_type = feed_type,
+                frequency = 'i',
+                schedules = schedules
+            )
 
-        #print origin_post
+        #1) mention subscribers - common to questions and answers
+        subscriber_ids = filter_subscriber_ids(mentioned_ids, 'm_and_c')
 
         #2) individually selected - make sure that users
         #are individual subscribers to this question
-        # TODO: The line below works only if origin_post is Question !
-        selective_subscribers = origin_post.thread.followed_by.all()
-        #print 'question followers are ', [s for s in selective_subscribers]
-        if selective_subscribers:
-            selective_subscribers = EmailFeedSetting.objects.filter_subscribers(
-                potential_subscribers = selective_subscribers,
-                feed_type = 'q_sel',
-                frequency = 'i'
-            )
-            subscriber_set.update(selective_subscribers)
-            #print 'selective subscribers: ', selective_subscribers
+        subscriber_ids.update(filter_subscriber_ids(follower_ids, 'q_sel'))
 
         #3) whole forum subscribers
-        global_subscribers = origin_post.get_global_instant_notification_subscribers()
-        subscriber_set.update(global_subscribers)
+        subscriber_ids.update(
+            origin_post.get_global_instant_notification_subscriber_ids()
+        )
 
         #4) question asked by me (todo: not "edited_by_me" ???)
-        question_author = origin_post.author
-        if EmailFeedSetting.objects.filter(
-            subscriber = question_author,
-            frequency = 'i',
-            feed_type = 'q_ask'
-        ).exists():
-            subscriber_set.add(question_author)
+        subscriber_ids.update(filter_subscriber_ids(question_author_ids, 'q_ask'))
 
         #4) questions answered by me -make sure is that people
         #are authors of the answers to this question
-        #todo: replace this with a query set method
-        answer_authors = set()
-        for answer in origin_post.thread.posts.get_answers().all():
-            authors = answer.get_author_list()
-            answer_authors.update(authors)
-
-        if answer_authors:
-            answer_subscribers = EmailFeedSetting.objects.filter_subscribers(
-                potential_subscribers = answer_authors,
-                frequency = 'i',
-                feed_type = 'q_ans',
-            )
-            subscriber_set.update(answer_subscribers)
-            #print 'answer subscribers: ', answer_subscribers
+        subscriber_ids.update(filter_subscriber_ids(answer_author_ids, 'q_ans'))
 
-        #print 'exclude_list is ', exclude_list
-        return subscriber_set - set(exclude_list)
+        return subscriber_ids - set([user.id for user in exclude_list])
 
-    def _comment__get_instant_notification_subscribers(
+    def _comment__get_instant_notification_subscriber_ids(
                                     self,
                                     potential_subscribers = None,
                                     mentioned_users = None,
                                     exclude_list = None
                                 ):
-        """get list of users who want instant notifications about comments
+        """get set of ids of users who want instant notifications about comments
 
         argument potential_subscribers is required as it saves on db hits
 
@@ -1177,63 +1204,55 @@ class Post(models.Model):
         * all global subscribers
           (tag filtered, and subject to personalized settings)
         """
-        #print 'in meta function'
-        #print 'potential subscribers: ', potential_subscribers
-
-        subscriber_set = set()
-
-        if potential_subscribers:
-            potential_subscribers = set(potential_subscribers)
-        else:
-            potential_subscribers = set()
-
-        if mentioned_users:
-            potential_subscribers.update(mentioned_users)
-
-        if potential_subscribers:
-            comment_subscribers = EmailFeedSetting.objects.filter_subscribers(
-                                        potential_subscribers = potential_subscribers,
-                                        feed_type = 'm_and_c',
-                                        frequency = 'i'
-                                    )
-            subscriber_set.update(comment_subscribers)
-            #print 'comment subscribers: ', comment_subscribers
+        potential_ids = set([user.id for user in potential_subscribers or ()])
+        potential_ids.update([user.id for user in mentioned_users or ()])
 
         origin_post = self.get_origin_post()
         # TODO: The line below works only if origin_post is Question !
-        selective_subscribers = origin_post.thread.followed_by.all()
-        if selective_subscribers:
-            selective_subscribers = EmailFeedSetting.objects.filter_subscribers(
-                                    potential_subscribers = selective_subscribers,
+        follower_ids = set(
+            origin_post.thread.followed_by.values_list('id', flat = True)
+        )
+
+        schedules = EmailFeedSetting.objects.get_schedules(
+                                            potential_ids | follower_ids
+                                        )
+        subscriber_ids = EmailFeedSetting.objects.filter_subscriber_ids(
+                                    potential_ids,
+                                    feed_type = 'm_and_c',
+                                    frequency = 'i',
+                                    schedules = schedules
+                                )
+        subscriber_ids.update(
+            EmailFeedSetting.objects.filter_subscriber_ids(
+                                    follower_ids,
                                     feed_type = 'q_sel',
-                                    frequency = 'i'
+                                    frequency = 'i',
+                                    schedules = schedules
                                 )
-            for subscriber in selective_subscribers:
-                if origin_post.passes_tag_filter_for_user(subscriber):
-                    subscriber_set.add(subscriber)
-
-            subscriber_set.update(selective_subscribers)
-            #print 'selective subscribers: ', selective_subscribers
-
-        global_subscribers = origin_post.get_global_instant_notification_subscribers()
-        #print 'global subscribers: ', global_subscribers
+        )
 
-        subscriber_set.update(global_subscribers)
+        subscriber_ids.update(
+            origin_post.get_global_instant_notification_subscriber_ids()
+        )
 
-        return subscriber_set - set(exclude_list)
+        return subscriber_ids - set([user.id for user in exclude_list])
 
     def get_instant_notification_subscribers(
         self, potential_subscribers = None,
         mentioned_users = None, exclude_list = None
     ):
+        """returns users who receive the instant email
+        notifications about the post, the subscriptions are
+        resolved on the user ids and only the recipients are loaded
+        """
         if self.is_question() or self.is_answer():
-            subscribers = self._qa__get_instant_notification_subscribers(
+            subscriber_ids = self._qa__get_instant_notification_subscriber_ids(
                 potential_subscribers=potential_subscribers,
                 mentioned_users=mentioned_users,
                 exclude_list=exclude_list
             )
         elif self.is_comment():
-            subscribers = self._comment__get_instant_notification_subscribers(
+            subscriber_ids = self._comment__get_instant_notification_subscriber_ids(
                 potential_subscribers=potential_subscribers,
                 mentioned_users=mentioned_users,
                 exclude_list=exclude_list
@@ -1243,6 +1262,15 @@ class Post(models.Model):
         else:
             raise NotImplementedError
 
+        subscriber_ids = list(subscriber_ids)
+        subscribers = set()
+        for start in range(0, len(subscriber_ids), SUBSCRIBER_BATCH_SIZE):
+            subscribers.update(
+                User.objects.filter(
+                    id__in = subscriber_ids[start:start + SUBSCRIBER_BATCH_SIZE]
+                )
+            )
+
         #if askbot_settings.GROUPS_ENABLED and self.is_effectively_private():
         #    for subscriber in subscribers:
         return self.filter_authorized_users(subscribers)
@@ -1965,6 +1993,10 @@ class PostRevision(models.Model):
     tagnames   = models.CharField(max_length=125, blank=True, default='')
     is_anonymous = models.BooleanField(default=False)
 
+    #html diff with the previous revision, for the first
+    #revision - its html, computed when the revision is saved
+    diff = models.TextField(null = True, blank = True)
+
     objects = PostRevisionManager()
 
     class Meta:
@@ -2109,8 +2141,40 @@ class PostRevision(models.Model):
 
         self.full_clean()
 
+        #only the questions and answers have the html of the revisions
+        if self.diff is None and self.post.post_type in ('question', 'answer'):
+            self.diff = self.get_diff()
+
         super(PostRevision, self).save(**kwargs)
 
+    def get_previous_revision(self):
+        """returns the preceding revision of the post or ``None``"""
+        revisions = self.post.revisions.filter(
+                                revision__lt = self.revision
+                            ).order_by('-revision')[:1]
+        if len(revisions) == 0:
+            return None
+        return revisions[0]
+
+    def get_diff(self, previous_revision = None):
+        """returns html diff with the previous revision,
+        which is looked up, if not given, or the html
+        of the revision if it is the first one"""
+        if previous_revision is None:
+            previous_revision = self.get_previous_revision()
+        if previous_revision is None:
+            return sanitize_html(self.html)
+        return htmldiff(
+            sanitize_html(previous_revision.html),
+            sanitize_html(self.html)
+        )
+
+    def update_diff(self, previous_revision = None):
+        """computes and saves the diff of the revision
+        saved before the diffs were stored"""
+        self.diff = self.get_diff(previous_revision)
+        PostRevision.objects.filter(id = self.id).update(diff = self.diff)
+
     def get_absolute_url(self):
         if self.post.is_question():
             return reverse('question_revisions', args = (self.post.id,))
@@ -2129,8 +2193,7 @@ class PostRevision(models.Model):
 
     @property
     def html(self, **kwargs):
-        markdowner = markup.get_parser()
-        sanitized_html = sanitize_html(markdowner.convert(self.text))
+        sanitized_html = markup.markdown_to_html(self.text)
 
         if self.post.is_question():
             return self.QUESTION_REVISION_TEMPLATE_NO_TAGS % {
@@ -1,21 +1,24 @@
 import datetime
 import operator
 import re
+import time
+import uuid
 
 from django.conf import settings
+from django.core.paginator import Paginator, Page
 from django.db import models
 from django.contrib.auth.models import User
 from django.core import cache  # import cache, not from cache import cache, to be able to monkey-patch cache.cache in test cases
 from django.core.urlresolvers import reverse
+from django.utils.encoding import smart_str
 from django.utils.hashcompat import md5_constructor
 from django.utils.translation import ugettext as _
 from django.utils.translation import ungettext
 
-import askbot
 from askbot.conf import settings as askbot_settings
 from askbot import mail
 from askbot.mail import messages
-from askbot.models.tag import Tag
+from askbot.models.tag import Tag, TagCooccurrence
 from askbot.models.tag import get_groups
 from askbot.models.tag import get_global_group
 from askbot.models.tag import get_tags_by_names
@@ -27,13 +30,255 @@ from askbot.models.post import Post, PostRevision
 from askbot.models.post import PostToGroup
 from askbot.models.user import Group, PERSONAL_GROUP_NAME_PREFIX
 from askbot.models import signals
+from askbot.search import backends as search_backends
+from askbot.search import similarity
 from askbot import const
+from askbot.utils.counters import CachedCounterBuffer
 from askbot.utils.lists import LazyList
-from askbot.utils import mysql
+from askbot.utils import response_cache
 from askbot.utils.slug import slugify
 from askbot.skins.loaders import get_template #jinja2 template loading enviroment
 from askbot.search.state_manager import DummySearchState
 
+#views are accumulated in the cache and written to the database
+#by the ThreadManager.flush_view_counts() - from the periodic celery task,
+#run once per interval (seconds), or from the flush_view_counts command,
+#when interval is 0 - view counts are updated immediately
+VIEW_COUNT_FLUSH_INTERVAL = getattr(settings, 'ASKBOT_VIEW_COUNT_FLUSH_INTERVAL', 60)
+VIEW_COUNT_BUFFER = CachedCounterBuffer('thread-view-count')
+
+#orderings of the question list by the search state sort methods
+QUESTION_ORDER_BY_MAP = {
+    'age-desc': '-added_at',
+    'age-asc': 'added_at',
+    'activity-desc': '-last_activity_at',
+    'activity-asc': 'last_activity_at',
+    'answers-desc': '-answer_count',
+    'answers-asc': 'answer_count',
+    'votes-desc': '-score',
+    'votes-asc': 'score',
+
+    'relevance-desc': '-relevance', # special Postgresql-specific ordering, 'relevance' quaso-column is added by get_for_query()
+}
+#sort methods supported by the keyset pagination,
+#relevance is computed per query and cannot be used in a cursor
+KEYSET_SORT_METHODS = [
+    sort for sort in QUESTION_ORDER_BY_MAP if sort != 'relevance-desc'
+]
+CURSOR_DATETIME_FORMAT = '%Y%m%d%H%M%S'
+#cached question counts of the searches are refreshed
+#in the background when older than the interval (seconds)
+QUESTION_COUNT_REFRESH_INTERVAL = getattr(
+                            settings,
+                            'ASKBOT_QUESTION_COUNT_REFRESH_INTERVAL',
+                            60
+                        )
+
+#pages of the search results are cached for at most this many seconds,
+#0 disables the cache, see ThreadManager.get_search_page()
+SEARCH_RESULT_CACHE_TIMEOUT = getattr(
+                            settings,
+                            'ASKBOT_SEARCH_RESULT_CACHE_TIMEOUT',
+                            300
+                        )
+CONTENT_GENERATION_CACHE_KEY = 'askbot-content-generation'
+#fields of the threads loaded for the question list
+QUESTION_LIST_FIELDS = (
+    'id', 'title', 'view_count', 'answer_count', 'last_activity_at',
+    'last_activity_by', 'closed', 'tagnames', 'accepted_answer',
+    'added_at', 'score'
+)
+
+def format_thread_cursor(thread, field_name, direction):
+    """returns cursor string pointing to the position of the thread
+    in the list ordered by the field, direction is
+    'a' (threads after the thread) or 'b' (threads before it)
+    """
+    value = getattr(thread, field_name)
+    if isinstance(value, datetime.datetime):
+        value = value.strftime(CURSOR_DATETIME_FORMAT) + '%06d' % value.microsecond
+    return '%s.%s.%d' % (direction, value, thread.id)
+
+def parse_thread_cursor(cursor, field_name):
+    """returns tuple (direction, value, thread id)
+    or ``None`` if the cursor is not valid"""
+    try:
+        direction, value, thread_id = cursor.split('.')
+        if direction not in ('a', 'b'):
+            return None
+        field = Thread._meta.get_field(field_name)
+        if isinstance(field, models.DateTimeField):
+            value = datetime.datetime.strptime(
+                                value[:-6], CURSOR_DATETIME_FORMAT
+                            ).replace(microsecond = int(value[-6:]))
+        else:
+            value = int(value)
+        return direction, value, int(thread_id)
+    except (AttributeError, ValueError):
+        return None
+
+def get_question_count_cache_key(search_state, user):
+    """the count does not depend on the sort order and the page,
+    it depends on the tag selections and groups of the user"""
+    if user is not None and user.is_authenticated():
+        user_id = user.id
+    else:
+        user_id = 0
+    key = '%s:%s:%s:%s:%d' % (
+                search_state.scope,
+                search_state.query or '',
+                const.TAG_SEP.join(search_state.tags),
+                search_state.author or '',
+                user_id
+            )
+    return 'question-count-' + md5_constructor(smart_str(key)).hexdigest()
+
+def get_content_generation():
+    """returns number of the current generation of the content,
+    the number changes with every write to the posts and threads,
+    so that the cached search results keyed by it go stale
+    without the need to find and delete them
+
+    the counter starts from the current time, so that
+    the generations used before the counter was evicted
+    from the cache are not reused
+    """
+    generation = cache.cache.get(CONTENT_GENERATION_CACHE_KEY)
+    if generation is None:
+        cache.cache.add(
+            CONTENT_GENERATION_CACHE_KEY,
+            int(time.time() * 1000),
+            const.LONG_TIME
+        )
+        generation = cache.cache.get(CONTENT_GENERATION_CACHE_KEY)
+    return generation
+
+def bump_content_generation(**kwargs):
+    """starts new generation of the content,
+    used as a handler of the post_save and post_delete signals"""
+    try:
+        cache.cache.incr(CONTENT_GENERATION_CACHE_KEY)
+    except ValueError:
+        #counter is not in the cache, it will be started anew
+        pass
+
+def get_search_visibility_class(user):
+    """returns name of the class of the visitors who see
+    the same results of the search: all anonymous visitors
+    see the same results, results of the registered users
+    depend on their groups and tag selections
+    """
+    if user is None or user.is_anonymous():
+        return 'anonymous'
+    return 'user:%d:%s:%s:%s' % (
+                user.id,
+                user.display_tag_filter_strategy,
+                user.interesting_tags,
+                user.ignored_tags
+            )
+
+def get_search_result_cache_key(search_state, user, page_size):
+    """returns the cache key of the page of the search results,
+    or ``None`` if the results should not be cached"""
+    if SEARCH_RESULT_CACHE_TIMEOUT == 0 or search_state.scope == 'favorite':
+        #favorite threads depend on too many things
+        return None
+    key = '%s:%s:%s:%s:%s:%d:%d:%s' % (
+                search_state.scope,
+                search_state.sort,
+                search_state.query or '',
+                const.TAG_SEP.join(sorted(search_state.tags)),
+                search_state.author or '',
+                search_state.page,
+                page_size,
+                get_search_visibility_class(user)
+            )
+    return 'search-result-%s-%s-%s' % (
+                get_content_generation(),
+                askbot_settings.get_snapshot_version(),
+                md5_constructor(smart_str(key)).hexdigest()
+            )
+
+# tag urls in the cached thread summaries are replaced with placeholders,
+# filled for the search state of each request.
+# use `<<<` and `>>>` because they cannot be confused with user input
+# - if user accidentialy types <<<tag-name>>> into question title or body,
+# then in html it'll become escaped like this: &lt;&lt;&lt;tag-name&gt;&gt;&gt;
+SUMMARY_TAG_PLACEHOLDER_RE = re.compile(
+    r'<<<(%s)>>>' % const.TAG_REGEX_BARE,
+    re.UNICODE
+)
+
+def split_summary_html(html):
+    """returns list of segments of the summary html:
+    literal chunks at the even positions and
+    names of the tags of the url placeholders at the odd ones"""
+    return SUMMARY_TAG_PLACEHOLDER_RE.split(html)
+
+def join_summary_segments(segments, get_tag_url):
+    """returns html of the split summary, with the urls
+    of the tags given by the function ``get_tag_url``"""
+    chunks = segments[:]
+    for position in range(1, len(chunks), 2):
+        chunks[position] = get_tag_url(chunks[position])
+    return ''.join(chunks)
+
+def get_tag_placeholder(tag):
+    return '<<<%s>>>' % tag
+
+
+class CachedSearchPaginator(Paginator):
+    """paginator of one cached page of the search
+    results, with the known total number of results"""
+
+    def __init__(self, threads, count, per_page):
+        super(CachedSearchPaginator, self).__init__(threads, per_page)
+        self._count = count
+
+    def page(self, number):
+        number = self.validate_number(number)
+        return Page(self.object_list, number, self)
+
+
+class KeysetPage(object):
+    """page of threads selected by the keyset
+    (a.k.a. seek) pagination, with cursors of the
+    adjacent pages"""
+
+    def __init__(self, object_list, field_name,
+                has_previous = False, has_next = False):
+        self.object_list = object_list
+        self.has_previous = has_previous and len(object_list) > 0
+        self.has_next = has_next and len(object_list) > 0
+        if self.has_previous:
+            self.previous_cursor = format_thread_cursor(
+                                        object_list[0], field_name, 'b'
+                                    )
+        else:
+            self.previous_cursor = None
+        if self.has_next:
+            self.next_cursor = format_thread_cursor(
+                                        object_list[-1], field_name, 'a'
+                                    )
+        else:
+            self.next_cursor = None
+
+
+def get_visitor_group_ids(visitor):
+    """returns ids of groups to which the visitor belongs,
+    the value is memoized on the user object, so that
+    the groups are looked up once per request"""
+    if visitor is None:
+        return (get_global_group().id,)
+    group_ids = getattr(visitor, '_askbot_group_ids', None)
+    if group_ids is None:
+        if visitor.is_anonymous():
+            group_ids = (get_global_group().id,)
+        else:
+            group_ids = tuple(visitor.get_groups().values_list('id', flat=True))
+        visitor._askbot_group_ids = group_ids
+    return group_ids
+
 class ThreadQuerySet(models.query.QuerySet):
     def get_visible(self, user):
         """filters out threads not belonging to the user groups"""
@@ -161,30 +406,12 @@ class ThreadManager(BaseQuerySetManager):
 
     def get_for_query(self, search_query, qs=None):
         """returns a query set of questions,
-        matching the full text query
+        matching the full text query, as found
+        by the search backend selected in the settings
         """
         if not qs:
             qs = self.all()
-#        if getattr(settings, 'USE_SPHINX_SEARCH', False):
-#            matching_questions = Question.sphinx_search.query(search_query)
-#            question_ids = [q.id for q in matching_questions]
-#            return qs.filter(posts__post_type='question', posts__deleted=False, posts__self_question_id__in=question_ids)
-        if askbot.get_database_engine_name().endswith('mysql') \
-            and mysql.supports_full_text_search():
-            return qs.filter(
-                models.Q(title__search = search_query) |
-                models.Q(tagnames__search = search_query) |
-                models.Q(posts__deleted=False, posts__text__search = search_query)
-            )
-        elif 'postgresql_psycopg2' in askbot.get_database_engine_name():
-            from askbot.search import postgresql
-            return postgresql.run_full_text_search(qs, search_query)
-        else:
-            return qs.filter(
-                models.Q(title__icontains=search_query) |
-                models.Q(tagnames__icontains=search_query) |
-                models.Q(posts__deleted=False, posts__text__icontains = search_query)
-            )
+        return search_backends.get_backend().filter_threads(qs, search_query)
 
 
     def run_advanced_search(self, request_user, search_state):  # TODO: !! review, fix, and write tests for this
@@ -347,18 +574,6 @@ class ThreadManager(BaseQuerySetManager):
                 meta_data['interesting_tag_names'].extend(request_user.interesting_tags.split())
                 meta_data['ignored_tag_names'].extend(request_user.ignored_tags.split())
 
-        QUESTION_ORDER_BY_MAP = {
-            'age-desc': '-added_at',
-            'age-asc': 'added_at',
-            'activity-desc': '-last_activity_at',
-            'activity-asc': 'last_activity_at',
-            'answers-desc': '-answer_count',
-            'answers-asc': 'answer_count',
-            'votes-desc': '-score',
-            'votes-asc': 'score',
-
-            'relevance-desc': '-relevance', # special Postgresql-specific ordering, 'relevance' quaso-column is added by get_for_query()
-        }
         orderby = QUESTION_ORDER_BY_MAP[search_state.sort]
         qs = qs.extra(order_by=[orderby])
 
@@ -369,12 +584,147 @@ class ThreadManager(BaseQuerySetManager):
         # qs = qs.extra(select={'ordering_key': orderby.lstrip('-')}, order_by=['-ordering_key' if orderby.startswith('-') else 'ordering_key'])
         # qs = qs.distinct()
 
-        qs = qs.only('id', 'title', 'view_count', 'answer_count', 'last_activity_at', 'last_activity_by', 'closed', 'tagnames', 'accepted_answer')
+        qs = qs.only(*QUESTION_LIST_FIELDS)
 
         #print qs.query
 
         return qs.distinct(), meta_data
 
+    def get_search_page(self, request_user = None,
+                        search_state = None, page_size = None):
+        """returns tuple (paginator, page, meta data) with
+        the page of the threads found by :meth:`run_advanced_search`
+
+        ids of the threads of the page, the total number of results
+        and the meta data are cached for the search state and the
+        visibility class of the user, until the next change of the content
+        """
+        key = get_search_result_cache_key(
+                                search_state, request_user, page_size
+                            )
+        cached = key and cache.cache.get(key)
+        if cached:
+            thread_ids, count, number, meta_data = cached
+            threads = self.filter(id__in = thread_ids).only(*QUESTION_LIST_FIELDS)
+            threads = dict([(thread.id, thread) for thread in threads])
+            object_list = [
+                threads[thread_id] for thread_id in thread_ids
+                if thread_id in threads
+            ]
+            paginator = CachedSearchPaginator(object_list, count, page_size)
+            return paginator, paginator.page(number), meta_data
+
+        threads, meta_data = self.run_advanced_search(
+                                    request_user = request_user,
+                                    search_state = search_state
+                                )
+        paginator = Paginator(threads, page_size)
+        number = search_state.page
+        if paginator.num_pages < number:
+            number = 1
+        page = paginator.page(number)
+        page.object_list = list(page.object_list) # evaluate the queryset
+        if key:
+            thread_ids = [thread.id for thread in page.object_list]
+            cache.cache.set(
+                key,
+                (thread_ids, paginator.count, number, meta_data),
+                SEARCH_RESULT_CACHE_TIMEOUT
+            )
+        return paginator, page, meta_data
+
+    def get_keyset_page(self, threads, sort = None,
+                        cursor = None, page_size = None):
+        """returns :class:`KeysetPage` of the threads from the
+        result of :meth:`run_advanced_search`, ordered by the
+        sort column and the thread id, located by the cursor
+        instead of the offset, so that deep pages are as fast
+        as the first one
+        """
+        orderby = QUESTION_ORDER_BY_MAP[sort]
+        field_name = orderby.lstrip('-')
+        descending = orderby.startswith('-')
+
+        position = None
+        if cursor:
+            position = parse_thread_cursor(cursor, field_name)
+        backwards = position is not None and position[0] == 'b'
+        if backwards:
+            #walk in the reverse order from the cursor
+            descending = not descending
+
+        if position:
+            direction, value, thread_id = position
+            lookup = descending and 'lt' or 'gt'
+            threads = threads.filter(
+                models.Q(**{field_name + '__' + lookup: value}) |
+                models.Q(**{field_name: value, 'id__' + lookup: thread_id})
+            )
+
+        prefix = descending and '-' or ''
+        threads = threads.extra(
+                    order_by = [prefix + field_name, prefix + 'id']
+                )
+        object_list = list(threads[:page_size + 1])
+        has_more = len(object_list) > page_size
+        object_list = object_list[:page_size]
+
+        if backwards:
+            object_list.reverse()
+            return KeysetPage(
+                        object_list, field_name,
+                        has_previous = has_more, has_next = True
+                    )
+        return KeysetPage(
+                    object_list, field_name,
+                    has_previous = position is not None, has_next = has_more
+                )
+
+    def get_cached_count(self, threads, search_state = None,
+                                        request_user = None):
+        """returns the number of the threads from the result
+        of :meth:`run_advanced_search`, the number is cached and
+        recounted in the celery task when it gets older than
+        ``QUESTION_COUNT_REFRESH_INTERVAL`` seconds, so
+        the value may be slightly out of date
+        """
+        key = get_question_count_cache_key(search_state, request_user)
+        cached = cache.cache.get(key)
+        if cached is None:
+            count = threads.count()
+            cache.cache.set(key, (count, time.time()), const.LONG_TIME)
+            return count
+
+        count, counted_at = cached
+        if time.time() - counted_at > QUESTION_COUNT_REFRESH_INTERVAL:
+            lock_key = key + '-refresh'
+            if cache.cache.add(lock_key, True, QUESTION_COUNT_REFRESH_INTERVAL):
+                from askbot import tasks
+                if request_user is not None and request_user.is_authenticated():
+                    user_id = request_user.id
+                else:
+                    user_id = None
+                tasks.refresh_question_count_celery_task.delay(
+                                scope = search_state.scope,
+                                query = search_state.query,
+                                tags = const.TAG_SEP.join(search_state.tags),
+                                author = search_state.author,
+                                user_id = user_id
+                            )
+        return count
+
+    def refresh_cached_count(self, search_state = None, request_user = None):
+        """recounts the threads of the search and caches the number"""
+        threads, meta_data = self.run_advanced_search(
+                                        request_user = request_user,
+                                        search_state = search_state
+                                    )
+        count = threads.count()
+        key = get_question_count_cache_key(search_state, request_user)
+        cache.cache.set(key, (count, time.time()), const.LONG_TIME)
+        cache.cache.delete(key + '-refresh')
+        return count
+
     def precache_view_data_hack(self, threads):
         # TODO: Re-enable this when we have a good test cases to verify that it works properly.
         #
@@ -435,6 +785,32 @@ class ThreadManager(BaseQuerySetManager):
                                     ).distinct()
         return self.filter(id__in = thread_ids)
 
+    def flush_view_counts(self, batch_size=100):
+        """applies view counts accumulated by the
+        :meth:`Thread.increase_view_count` to the database
+        and regenerates summaries of the affected threads,
+        returns number of updated threads
+
+        threads within a batch are updated with one
+        query per distinct value of the increment
+        """
+        view_counts = VIEW_COUNT_BUFFER.pop_all()
+        thread_ids = view_counts.keys()
+        for start in range(0, len(thread_ids), batch_size):
+            batch = thread_ids[start:start + batch_size]
+            ids_by_increment = dict()
+            for thread_id in batch:
+                increment = view_counts[thread_id]
+                ids_by_increment.setdefault(increment, []).append(thread_id)
+
+            for increment, ids in ids_by_increment.items():
+                self.filter(id__in=ids).update(
+                    view_count=models.F('view_count') + increment
+                )
+            for thread in self.filter(id__in=batch):
+                thread.update_summary_html()
+        return len(thread_ids)
+
 
 class ThreadToGroup(models.Model):
     """the "through" many-to-many relation between
@@ -462,6 +838,10 @@ class ThreadToGroup(models.Model):
 
 class Thread(models.Model):
     SUMMARY_CACHE_KEY_TPL = 'thread-question-summary-%d'
+    #used when groups are enabled, stores the token of the summaries
+    #cached per visibility fingerprint - see method
+    #get_summary_visibility_fingerprint()
+    GROUPS_SUMMARY_CACHE_KEY_TPL = 'thread-question-summary-groups-%d'
     ANSWER_LIST_KEY_TPL = 'thread-answer-list-%d'
 
     title = models.CharField(max_length=300)
@@ -499,6 +879,11 @@ class Thread(models.Model):
     added_at = models.DateTimeField(default = datetime.datetime.now)
 
     score = models.IntegerField(default = 0)
+    #ids of the most similar threads, see askbot.search.similarity
+    #``None`` until computed
+    similar_thread_ids = models.CommaSeparatedIntegerField(
+                                max_length = 255, null = True, blank = True
+                            )
 
     objects = ThreadManager()
     
@@ -607,6 +992,18 @@ class Thread(models.Model):
         self.save()
 
     def increase_view_count(self, increment=1):
+        """adds views to the write-behind buffer, the buffered
+        views are saved by the :meth:`ThreadManager.flush_view_counts`.
+        The ``view_count`` attribute is set to the value
+        including the views not yet saved in the database.
+        """
+        if VIEW_COUNT_FLUSH_INTERVAL:
+            pending = VIEW_COUNT_BUFFER.increment(self.id, increment)
+            prev_pending = getattr(self, '_pending_view_count', 0)
+            self.view_count += pending - prev_pending
+            self._pending_view_count = pending
+            return
+
         qset = Thread.objects.filter(id=self.id)
         qset.update(view_count=models.F('view_count') + increment)
         self.view_count = qset.values('view_count')[0]['view_count'] # get the new view_count back because other pieces of code relies on such behaviour
@@ -730,10 +1127,39 @@ class Thread(models.Model):
 
     def invalidate_cached_thread_content_fragment(self):
         cache.cache.delete(self.SUMMARY_CACHE_KEY_TPL % self.id)
+        cache.cache.delete(self.GROUPS_SUMMARY_CACHE_KEY_TPL % self.id)
 
     def get_post_data_cache_key(self, sort_method = None):
         return 'thread-data-%s-%s' % (self.id, sort_method)
 
+    def get_post_data_base_cache_key(self, sort_method):
+        return 'thread-data-base-%s-%s' % (self.id, sort_method)
+
+    def get_post_data_meta_cache_key(self):
+        return 'thread-data-meta-%s' % self.id
+
+    def get_post_data_visibility_cache_key(self, sort_method, meta, user):
+        """key of the post data for users who see the same
+        posts of the thread as the given user"""
+        fingerprint = self.get_post_data_visibility_fingerprint(meta, user)
+        fingerprint_hash = md5_constructor(fingerprint).hexdigest()
+        return 'thread-data-%s-%s-%s-%s' % (
+                            self.id, sort_method, meta['token'], fingerprint_hash
+                        )
+
+    def get_post_data_visibility_fingerprint(self, meta, user):
+        """returns string, same for all users who
+        see the same posts in the thread:
+        groups of the user in which there are posts of the thread
+        and whether user is the author of the moderated question
+        """
+        group_ids = set(get_visitor_group_ids(user)) & set(meta['group_ids'])
+        fingerprint = ','.join([str(group_id) for group_id in sorted(group_ids)])
+        if meta['is_moderated'] and \
+            getattr(user, 'id', None) == meta['question_author_id']:
+            fingerprint += ':author'
+        return fingerprint
+
     def invalidate_cached_post_data(self):
         """needs to be called when anything notable 
         changes in the post data - on votes, adding,
@@ -741,9 +1167,13 @@ class Thread(models.Model):
         #we can call delete_many() here if using Django > 1.2
         for sort_method in const.ANSWER_SORT_METHODS:
             cache.cache.delete(self.get_post_data_cache_key(sort_method))
+            cache.cache.delete(self.get_post_data_base_cache_key(sort_method))
+        #per visibility data expires with the token stored in meta
+        cache.cache.delete(self.get_post_data_meta_cache_key())
 
     def invalidate_cached_data(self):
         self.invalidate_cached_post_data()
+        response_cache.bump_thread_version(self.id)
         #self.invalidate_cached_thread_content_fragment()
         self.update_summary_html()
 
@@ -751,8 +1181,9 @@ class Thread(models.Model):
         """returns cached post data, as calculated by
         the method get_post_data()"""
         if askbot_settings.GROUPS_ENABLED:
-            #temporary plug: bypass cache where groups are enabled
-            return self.get_post_data(sort_method=sort_method, user=user)
+            return self.get_cached_group_post_data(
+                                user=user, sort_method=sort_method
+                            )
         key = self.get_post_data_cache_key(sort_method)
         post_data = cache.cache.get(key)
         if not post_data:
@@ -760,6 +1191,90 @@ class Thread(models.Model):
             cache.cache.set(key, post_data, const.LONG_TIME)
         return post_data
 
+    def get_cached_group_post_data(self, user = None, sort_method = 'votes'):
+        """returns cached post data, when groups are enabled.
+
+        Post data is cached per visibility of posts to the user.
+        Structure with all the posts of the thread is cached
+        separately and filtered for each visibility in memory,
+        so that the database is queried once per thread change,
+        regardless of the number of combinations of groups.
+        """
+        meta_key = self.get_post_data_meta_cache_key()
+        meta = cache.cache.get(meta_key)
+        if meta:
+            key = self.get_post_data_visibility_cache_key(sort_method, meta, user)
+            post_data = cache.cache.get(key)
+            if post_data:
+                return post_data
+
+        base_key = self.get_post_data_base_cache_key(sort_method)
+        base = None
+        if meta:
+            base = cache.cache.get(base_key)
+        if base is None:
+            base = self.get_post_data_base(sort_method)
+            cache.cache.set(base_key, base, const.LONG_TIME)
+
+        if meta is None:
+            meta = {
+                'token': uuid.uuid4().hex[:12],
+                'group_ids': base['group_ids'],
+                'is_moderated': base['is_moderated'],
+                'question_author_id': base['question_author_id'],
+            }
+            cache.cache.set(meta_key, meta, const.LONG_TIME)
+
+        post_data = self.filter_post_data(base, sort_method=sort_method, user=user)
+        key = self.get_post_data_visibility_cache_key(sort_method, meta, user)
+        cache.cache.set(key, post_data, const.LONG_TIME)
+        return post_data
+
+    def get_post_data_base(self, sort_method='votes'):
+        """returns dictionary with all posts of the thread,
+        used by the :meth:`filter_post_data` to build
+        post data visible to the given user:
+
+        * posts - list of all posts in the sort order
+        * post_groups - post id -> set of group ids
+        * group_ids - set of all groups of the posts
+        * is_moderated - ``True`` if thread is moderated
+        * question_author_id - id of author of the question
+        """
+        thread_posts = self.posts.all().order_by(
+                    {
+                        'latest':'-added_at',
+                        'oldest':'added_at',
+                        'votes':'-score'
+                    }[sort_method]
+                )
+        posts = list(thread_posts)
+
+        post_groups = dict()
+        group_ids = set()
+        is_moderated = False
+        if askbot_settings.GROUPS_ENABLED:
+            post_group_ids = PostToGroup.objects.filter(
+                                        post__thread=self
+                                    ).values_list('post_id', 'group_id')
+            for post_id, group_id in post_group_ids:
+                post_groups.setdefault(post_id, set()).add(group_id)
+                group_ids.add(group_id)
+            is_moderated = bool(self.is_moderated())
+
+        question_author_id = None
+        for post in posts:
+            if post.post_type == 'question':
+                question_author_id = post.author_id
+
+        return {
+            'posts': posts,
+            'post_groups': post_groups,
+            'group_ids': group_ids,
+            'is_moderated': is_moderated,
+            'question_author_id': question_author_id
+        }
+
     def get_post_data(self, sort_method='votes', user=None):
         """returns question, answers as list and a list of post ids
         for the given thread, and the list of published post ids
@@ -768,30 +1283,30 @@ class Thread(models.Model):
         all (both posts and the comments sorted in the correct
         order)
         """
-        thread_posts = self.posts.all()
+        base = self.get_post_data_base(sort_method)
+        return self.filter_post_data(base, sort_method=sort_method, user=user)
+
+    def filter_post_data(self, base, sort_method='votes', user=None):
+        """returns the post data as in :meth:`get_post_data`,
+        using the posts from the structure returned by
+        :meth:`get_post_data_base`, filtered in memory
+        for the given user
+        """
+        group_ids = None
         if askbot_settings.GROUPS_ENABLED:
-            if user is None or user.is_anonymous():
-                groups = (get_global_group(),)
-            else:
-                groups = user.get_groups()
+            group_ids = set(get_visitor_group_ids(user))
+        post_groups = base['post_groups']
 
-            thread_posts = thread_posts.filter(groups__in=groups)
-            thread_posts = thread_posts.distinct()#important for >1 group
-
-        thread_posts = thread_posts.order_by(
-                    {
-                        'latest':'-added_at',
-                        'oldest':'added_at',
-                        'votes':'-score'
-                    }[sort_method]
-                )
         #1) collect question, answer and comment posts and list of post id's
         answers = list()
         post_map = dict()
         comment_map = dict()
         post_to_author = dict()
         question_post = None
-        for post in thread_posts:
+        for post in base['posts']:
+            if group_ids is not None:
+                if not (group_ids & post_groups.get(post.id, set())):
+                    continue
             #pass through only deleted question posts
             if post.deleted and post.post_type != 'question':
                 continue
@@ -823,32 +1338,30 @@ class Thread(models.Model):
             except KeyError:
                 pass#comment to deleted answer - don't want it
 
-        if self.has_accepted_answer() and self.accepted_answer.deleted == False:
+        #deleted answers are not in the post_map
+        if self.accepted_answer_id in post_map:
             #Put the accepted answer to front
-            #the second check is for the case when accepted answer is deleted
-            if self.accepted_answer_id in post_map:
-                accepted_answer = post_map[self.accepted_answer_id]
-                answers.remove(accepted_answer)
-                answers.insert(0, accepted_answer)
+            accepted_answer = post_map[self.accepted_answer_id]
+            answers.remove(accepted_answer)
+            answers.insert(0, accepted_answer)
 
         #if user is not an inquirer, and thread is moderated,
         #put published answers first
         #todo: there may be > 1 enquirers
         published_answer_ids = list()
-        if self.is_moderated() and user != question_post.author:
+        if base['is_moderated'] and \
+            getattr(user, 'id', None) != base['question_author_id']:
             #if moderated - then author is guaranteed to be the 
             #limited visibility enquirer
-            published_answers = self.posts.get_answers(
-                                        user=question_post.author#todo: may be > 1
-                                    ).filter(
-                                        deleted=False
-                                    ).order_by(
-                                        {
-                                            'latest':'-added_at',
-                                            'oldest':'added_at',
-                                            'votes':'-score'
-                                        }[sort_method]
-                                    )
+            author_group_ids = set(
+                get_visitor_group_ids(question_post.author)#todo: may be > 1
+            )
+            published_answers = list()
+            for post in base['posts']:
+                if post.post_type == 'answer' and post.deleted == False \
+                    and post.id in post_map \
+                    and author_group_ids & post_groups.get(post.id, set()):
+                    published_answers.append(post_map[post.id])
             #now put those answers first
             for answer in reversed(published_answers):
                 answers.remove(answer)
@@ -868,67 +1381,50 @@ class Thread(models.Model):
         others_tags = set(other_thread.get_tag_names())
         return len(my_tags & others_tags)
 
+    def get_similar_thread_ids(self):
+        """returns list of ids of the precomputed similar threads,
+        computes them if that was not done yet"""
+        if self.similar_thread_ids is None:
+            #neighbours are reset only on retag, otherwise views
+            #of the neighbouring threads would reset each other
+            similarity.update_similar_threads(self)
+        return similarity.parse_thread_ids(self.similar_thread_ids)
+
     def get_similar_threads(self):
         """
         Get 10 similar threads for given one.
-        Threads with the individual tags will be added to list if above questions are not full.
 
-        This function has a limitation that it will
-        retrieve only 100 records then select 10 most similar
-        from that list as querying entire database may
-        be very expensive - this function will benefit from
-        some sort of optimization
+        The similar threads are precomputed by the engine in
+        :mod:`askbot.search.similarity`, the list is recomputed
+        when the thread is retagged
         """
 
         def get_data():
+            similar_ids = self.get_similar_thread_ids()
             # todo: code in this function would be simpler if
             # we had question post id denormalized on the thread
-            tags_list = self.get_tag_names()
-            similar_threads = Thread.objects.filter(
-                                        tags__name__in=tags_list
-                                    ).exclude(
-                                        id = self.id
-                                    ).exclude(
-                                        posts__post_type='question',
-                                        posts__deleted = True
-                                    ).distinct()[:100]
-            similar_threads = list(similar_threads)
-
-            for thread in similar_threads:
-                thread.similarity = self.get_similarity(other_thread=thread)
-
-            similar_threads.sort(key=operator.attrgetter('similarity'), reverse=True)
-            similar_threads = similar_threads[:10]
-
-            # Denormalize questions to speed up template rendering
-            # todo: just denormalize question_post_id on the thread!
-            thread_map = dict([(thread.id, thread) for thread in similar_threads])
-            questions = Post.objects.get_questions()
-            questions = questions.select_related('thread').filter(thread__in=similar_threads)
-            for q in questions:
-                thread_map[q.thread_id].question_denorm = q
+            questions = Post.objects.get_questions().filter(
+                                            thread__id__in = similar_ids,
+                                            deleted = False
+                                        ).select_related('thread')
+            question_map = dict([(q.thread_id, q) for q in questions])
 
             # Postprocess data for the final output
             result = list()
-            for thread in similar_threads:
-                question_post = getattr(thread, 'question_denorm', None)
-                # unfortunately the if statement below is necessary due to
-                # a possible bug
-                # all this proves that it's wrong to reference threads by
-                # the question post id in the question page urls!!!
-                # this is a "legacy" problem inherited from the old models
+            for thread_id in similar_ids:
+                question_post = question_map.get(thread_id)
                 if question_post:
                     url = question_post.get_absolute_url()
-                    title = thread.get_title(question_post)
+                    title = question_post.thread.get_title(question_post)
                     result.append({'url': url, 'title': title})
-                
+
             return result 
 
         def get_cached_data():
             """similar thread data will expire
             with the default expiration delay
             """
-            key = 'similar-threads-%s' % self.id
+            key = similarity.get_similar_threads_cache_key(self.id)
             data = cache.cache.get(key)
             if data is None:
                 data = get_data()
@@ -967,23 +1463,14 @@ class Thread(models.Model):
         return False
 
     def add_child_posts_to_groups(self, groups):
-        """adds questions and answers of the thread to 
-        given groups, comments are taken care of implicitly
-        by the underlying ``Post`` methods
+        """adds questions, answers and comments of the thread
+        to given groups, with a fixed number of queries
         """
-        post_types = ('question', 'answer')
-        posts = self.posts.filter(post_type__in=post_types)
-        for post in posts:
-            post.add_to_groups(groups)
+        PostToGroup.objects.add_posts_to_groups(self.posts.all(), groups)
 
     def remove_child_posts_from_groups(self, groups):
         """removes child posts from given groups"""
-        post_ids = self.posts.all().values_list('id', flat=True)
-        group_ids = [group.id for group in groups]
-        PostToGroup.objects.filter(
-                        post__id__in=post_ids,
-                        tag__id__in=group_ids
-                    ).delete()
+        PostToGroup.objects.remove_posts_from_groups(self.posts.all(), groups)
 
     def add_to_groups(
         self, groups, visibility=ThreadToGroup.SHOW_ALL_RESPONSES, recursive=False
@@ -1003,8 +1490,9 @@ class Thread(models.Model):
                 thread_group.save()
 
         if recursive == True:
-            #comments are taken care of automatically
             self.add_child_posts_to_groups(groups)
+        self.invalidate_cached_thread_content_fragment()
+        self.invalidate_cached_post_data()
 
     def remove_from_groups(self, groups, recursive=False):
         thread_groups =  ThreadToGroup.objects.filter(
@@ -1013,6 +1501,8 @@ class Thread(models.Model):
         thread_groups.delete()
         if recursive == True:
             self.remove_child_posts_from_groups(groups)
+        self.invalidate_cached_thread_content_fragment()
+        self.invalidate_cached_post_data()
 
     def make_public(self, recursive=False):
         """adds the global group to the thread"""
@@ -1084,6 +1574,7 @@ class Thread(models.Model):
         if tagnames.strip() == '':
             return
 
+        previous_tag_ids = list(self.tags.values_list('id', flat = True))
         previous_tags = list(self.tags.filter(status = Tag.STATUS_ACCEPTED))
 
         ordered_updated_tagnames = [t for t in tagnames.strip().split(' ')]
@@ -1136,6 +1627,14 @@ class Thread(models.Model):
         self.tagnames = ' '.join(ordered_final_tagnames)
         self.save()#need to save here?
 
+        #tags of the deleted questions are not counted
+        if not self._question_post().deleted:
+            TagCooccurrence.objects.update_counts(
+                        previous_tag_ids,
+                        self.tags.values_list('id', flat = True)
+                    )
+        similarity.update_similar_threads(self, reset_neighbors = True)
+
         #todo: factor out - tell author about suggested tags
         suggested_tags = filter_suggested_tags(added_tags)
         if len(suggested_tags) > 0:
@@ -1240,40 +1739,138 @@ class Thread(models.Model):
         return last_updated_at, last_updated_by
 
     def get_summary_html(self, search_state, visitor = None):
-        html = self.get_cached_summary_html(visitor)
-        if not html:
-            html = self.update_summary_html(visitor)
+        segments = self.get_cached_summary_segments(visitor)
+        if segments is None:
+            if askbot_settings.GROUPS_ENABLED:
+                html = self.update_group_summary_html(visitor)
+            else:
+                html = self.update_summary_html(visitor)
+            segments = split_summary_html(html)
 
         # todo: this work may be pushed onto javascript we post-process tag names
         # in the snippet so that tag urls match the search state
-        # use `<<<` and `>>>` because they cannot be confused with user input
-        # - if user accidentialy types <<<tag-name>>> into question title or body,
-        # then in html it'll become escaped like this: &lt;&lt;&lt;tag-name&gt;&gt;&gt;
-        regex = re.compile(
-            r'<<<(%s)>>>' % const.TAG_REGEX_BARE,
-            re.UNICODE
+        return join_summary_segments(segments, search_state.get_tag_url)
+
+    def get_summary_answer_group_ids(self):
+        """returns ids of groups to which answers
+        of the thread are shared"""
+        return list(
+            PostToGroup.objects.filter(
+                post__thread=self, post__post_type='answer'
+            ).values_list('group_id', flat=True).distinct()
         )
 
-        while True:
-            match = regex.search(html)
-            if not match:
-                break
-            seq = match.group(0)  # e.g "<<<my-tag>>>"
-            tag = match.group(1)  # e.g "my-tag"
-            full_url = search_state.add_tag(tag).full_url()
-            html = html.replace(seq, full_url)
-
-        return html
+    def get_summary_visibility_fingerprint(self, visitor, answer_group_ids):
+        """returns a string, identical for all visitors
+        who see the same version of the thread summary:
+        groups of the visitor that can see any answers in the thread,
+        plus a flag for the moderators who also see deleted answers
+        """
+        group_ids = set(get_visitor_group_ids(visitor)) & set(answer_group_ids)
+        fingerprint = ','.join([str(group_id) for group_id in sorted(group_ids)])
+        if visitor and visitor.is_authenticated() \
+            and visitor.is_administrator_or_moderator():
+            fingerprint += ':m'
+        return fingerprint
+
+    def get_summary_answer_count(self, visitor, answer_group_ids):
+        """answer count shown in the summary, which is
+        the same for all visitors with the same
+        visibility fingerprint"""
+        group_ids = set(get_visitor_group_ids(visitor)) & set(answer_group_ids)
+        answers = self.posts.filter(
+                            post_type='answer', groups__id__in=group_ids
+                        )
+        if not (visitor and visitor.is_authenticated() \
+            and visitor.is_administrator_or_moderator()):
+            answers = answers.filter(deleted=False)
+        return answers.distinct().count()
+
+    def get_cached_summary_segments(self, visitor = None):
+        """returns cached summary html, split by
+        :func:`split_summary_html`, or ``None``"""
+        #when groups are enabled summaries are cached
+        #per visibility fingerprint of the visitor
+        if askbot_settings.GROUPS_ENABLED:
+            meta = cache.cache.get(self.GROUPS_SUMMARY_CACHE_KEY_TPL % self.id)
+            if meta is None:
+                return None
+            key = self.get_group_summary_cache_key(meta, visitor)
+            return cache.cache.get(key)
+        segments = cache.cache.get(self.SUMMARY_CACHE_KEY_TPL % self.id)
+        if isinstance(segments, basestring):
+            #summary cached as html string
+            return split_summary_html(segments)
+        return segments
 
     def get_cached_summary_html(self, visitor = None):
-        #todo: remove this plug by adding cached foreign user group
-        #parameter to the key. Now with groups on caching is turned off
-        #parameter visitor is there to get summary out by the user groups
-        if askbot_settings.GROUPS_ENABLED:
+        """returns cached summary html, with
+        the tag url placeholders, or ``None``"""
+        segments = self.get_cached_summary_segments(visitor)
+        if segments is None:
             return None
-        return cache.cache.get(self.SUMMARY_CACHE_KEY_TPL % self.id)
+        return join_summary_segments(segments, get_tag_placeholder)
+
+    def get_group_summary_meta(self):
+        """returns dictionary with the token of the summaries
+        cached per visibility fingerprint and the ids of the groups
+        of the answers, the token is new after each change of the thread
+        """
+        key = self.GROUPS_SUMMARY_CACHE_KEY_TPL % self.id
+        meta = cache.cache.get(key)
+        if meta is None:
+            meta = {
+                'token': uuid.uuid4().hex[:12],
+                'answer_group_ids': self.get_summary_answer_group_ids()
+            }
+            cache.cache.set(key, meta, timeout=const.LONG_TIME)
+        return meta
+
+    def get_group_summary_cache_key(self, meta, visitor):
+        """key of the summary for visitors who see
+        the same version of it as the given visitor"""
+        fingerprint = self.get_summary_visibility_fingerprint(
+                                            visitor, meta['answer_group_ids']
+                                        )
+        fingerprint_hash = md5_constructor(fingerprint).hexdigest()
+        return 'thread-question-summary-groups-%s-%s-%s' % (
+                                    self.id, meta['token'], fingerprint_hash
+                                )
+
+    def update_group_summary_html(self, visitor):
+        """renders summary for the visitor and caches it
+        for the visibility fingerprint of the visitor, summaries
+        rendered before the thread changed are cached with the old token,
+        so they never overwrite the fresh ones"""
+        meta = self.get_group_summary_meta()
+        answer_group_ids = meta['answer_group_ids']
+        context = {
+            'thread': self,
+            'question': self._question_post(refresh=True),
+            'search_state': DummySearchState(),
+            'visitor': visitor,
+            'summary_answer_count': self.get_summary_answer_count(
+                                                visitor, answer_group_ids
+                                            )
+        }
+        html = get_template('widgets/question_summary.html').render(context)
+        cache.cache.set(
+            self.get_group_summary_cache_key(meta, visitor),
+            split_summary_html(html),
+            timeout=const.LONG_TIME
+        )
+        return html
 
     def update_summary_html(self, visitor = None):
+        #the thread has changed, summaries for
+        #all visibility fingerprints are stale
+        cache.cache.delete(self.GROUPS_SUMMARY_CACHE_KEY_TPL % self.id)
+        if askbot_settings.GROUPS_ENABLED:
+            if visitor is None:
+                #will be rendered per fingerprint on demand
+                return None
+            return self.update_group_summary_html(visitor)
+
         context = {
             'thread': self,
             #fetch new question post to make sure we're up-to-date
@@ -1289,7 +1886,7 @@ class Thread(models.Model):
         #   which probably doesn't break anything but if we can stick to 30 days then let's stick to it
         cache.cache.set(
             self.SUMMARY_CACHE_KEY_TPL % self.id,
-            html,
+            split_summary_html(html),
             timeout=const.LONG_TIME
         )
         return html
@@ -1,5 +1,8 @@
-import re
+import collections
+import itertools
 import logging
+import operator
+import re
 from django.db import models
 from django.contrib.auth.models import User
 from django.utils.translation import ugettext as _
@@ -179,6 +182,34 @@ class TagQuerySet(models.query.QuerySet):
         tags = tags.exclude(deleted = True)
         return list(tags[:50])
 
+    def get_related_to_tags(self, tag_names, ignored_tag_names, limit = 50):
+        """Returns tags most often used together with
+        the given tags, with use counts in ``local_used_count``,
+        summed from the precomputed co-occurrence counts
+        """
+        related = TagCooccurrence.objects.filter(
+                                tag__name__in = tag_names,
+                                count__gt = 0,
+                                related_tag__deleted = False
+                            )
+        if ignored_tag_names:
+            related = related.exclude(related_tag__name__in = ignored_tag_names)
+        related = related.values(
+                                'related_tag', 'related_tag__name'
+                            ).annotate(
+                                local_used_count = models.Sum('count')
+                            ).order_by(
+                                '-local_used_count', 'related_tag__name'
+                            )
+        counts = list(related[:limit])
+        tags = self.in_bulk([item['related_tag'] for item in counts])
+        result = list()
+        for item in counts:
+            tag = tags[item['related_tag']]
+            tag.local_used_count = item['local_used_count']
+            result.append(tag)
+        return result
+
 
 class TagManager(BaseQuerySetManager):
     """chainable custom filter query set manager
@@ -191,6 +222,25 @@ class TagManager(BaseQuerySetManager):
         """temporary function that filters out the group tags"""
         return self.all()
 
+    def get_related_to_search_state(
+        self, search_state = None, threads = None, ignored_tag_names = None
+    ):
+        """Returns tags related to the search for the sidebar.
+        When the search is defined by the selected tags only,
+        the tags are taken from the co-occurrence counts,
+        otherwise - counted over the given threads.
+        The co-occurrence counts include the threads of all groups,
+        so they are not used when the groups are enabled
+        """
+        if search_state.tags and not search_state.query \
+            and not askbot_settings.GROUPS_ENABLED \
+            and not search_state.author and search_state.scope != 'favorite' \
+            and not [name for name in search_state.tags if name.endswith('*')]:
+            return self.get_query_set().get_related_to_tags(
+                                    search_state.tags, ignored_tag_names
+                                )
+        return self.get_related_to_search(threads, ignored_tag_names)
+
     def create(self, name = None, created_by = None, **kwargs):
         """Creates a new tag"""
         if created_by.can_create_tags() or is_preapproved_tag_name(name):
@@ -332,6 +382,136 @@ class MarkedTag(models.Model):
     class Meta:
         app_label = 'askbot'
 
+def get_tag_name_prefixes(tag_names):
+    """returns set of all prefixes of the given tag names,
+    including the empty one, which is matched by the
+    bare "*" wildcard
+    """
+    prefixes = set([''])
+    for tag_name in tag_names:
+        for length in range(1, len(tag_name) + 1):
+            prefixes.add(tag_name[:length])
+    return prefixes
+
+class WildcardTagPrefixManager(models.Manager):
+    """manager of the wildcard tag prefix index"""
+
+    def rebuild_for_user(self, user):
+        """replaces the indexed prefixes of the user
+        with the prefixes of the "interesting" and "ignored"
+        wildcards stored on the user object
+        """
+        self.filter(user = user).delete()
+        wildcards = (
+            ('good', user.interesting_tags),
+            ('bad', user.ignored_tags),
+        )
+        for reason, wildcard_string in wildcards:
+            #same matching rule as in the tags_match_some_wildcard()
+            prefixes = set([
+                wildcard[:-1] for wildcard in wildcard_string.split()
+            ])
+            for prefix in prefixes:
+                self.create(user = user, prefix = prefix, reason = reason)
+
+    def get_subscriber_ids(self, tag_names, reason = None):
+        """returns query set of ids of users whose
+        wildcards of the given reason match any of the tag names;
+        cost of the lookup depends on the length of tag names,
+        not on the number of users with wildcard selections
+        """
+        return self.filter(
+            prefix__in = get_tag_name_prefixes(tag_names),
+            reason = reason
+        ).values_list('user', flat = True)
+
+
+class WildcardTagPrefix(models.Model):
+    """index of wildcard tag selections of the users,
+    one record per prefix (wildcard without the trailing "*"),
+    denormalized from ``User.interesting_tags``
+    and ``User.ignored_tags``
+    """
+    user = models.ForeignKey(User, related_name='wildcard_tag_prefixes')
+    prefix = models.CharField(max_length=255, db_index=True)
+    reason = models.CharField(max_length=16, choices=MarkedTag.TAG_MARK_REASONS)
+
+    objects = WildcardTagPrefixManager()
+
+    class Meta:
+        app_label = 'askbot'
+
+class TagCooccurrenceManager(models.Manager):
+    """manager of the tag co-occurrence counts"""
+
+    def update_counts(self, previous_tag_ids, current_tag_ids):
+        """adjusts the counts for a thread whose tags changed
+        from ``previous_tag_ids`` to ``current_tag_ids``
+        """
+        previous_pairs = get_tag_id_pairs(previous_tag_ids)
+        current_pairs = get_tag_id_pairs(current_tag_ids)
+        for tag_id, related_tag_id in previous_pairs - current_pairs:
+            #the count cannot go below zero even if
+            #the decrement was already applied
+            self.filter(
+                tag = tag_id, related_tag = related_tag_id, count__gt = 0
+            ).update(count = models.F('count') - 1)
+        for tag_id, related_tag_id in current_pairs - previous_pairs:
+            updated = self.filter(
+                tag = tag_id, related_tag = related_tag_id
+            ).update(count = models.F('count') + 1)
+            if updated == 0:
+                self.create(
+                    tag_id = tag_id, related_tag_id = related_tag_id, count = 1
+                )
+
+    def rebuild(self, thread_tag_ids):
+        """replaces all counts with the ones computed from the
+        iterable of ``(thread_id, tag_id)`` tuples,
+        ordered by the thread id
+        """
+        counts = collections.defaultdict(int)
+        for thread_id, tags in itertools.groupby(
+                                        thread_tag_ids,
+                                        operator.itemgetter(0)
+                                    ):
+            tag_ids = [tag_id for thread_id, tag_id in tags]
+            for pair in get_tag_id_pairs(tag_ids):
+                counts[pair] += 1
+        self.all().delete()
+        for (tag_id, related_tag_id), count in counts.items():
+            self.create(
+                tag_id = tag_id, related_tag_id = related_tag_id, count = count
+            )
+        return len(counts)
+
+
+class TagCooccurrence(models.Model):
+    """number of threads tagged with both tags,
+    stored for both orders of the tags; the record of a tag
+    with itself holds the number of threads with the tag
+    """
+    tag = models.ForeignKey(Tag, related_name = 'cooccurrences')
+    related_tag = models.ForeignKey(
+                        Tag, related_name = 'related_cooccurrences'
+                    )
+    count = models.PositiveIntegerField(default = 0)
+
+    objects = TagCooccurrenceManager()
+
+    class Meta:
+        app_label = 'askbot'
+        unique_together = ('tag', 'related_tag')
+
+def get_tag_id_pairs(tag_ids):
+    """returns set of all ordered pairs of the tag ids,
+    including the pairs of each tag with itself"""
+    tag_ids = set(tag_ids)
+    return set([
+        (tag_id, related_tag_id)
+        for tag_id in tag_ids for related_tag_id in tag_ids
+    ])
+
 def get_groups():
     from askbot.models import Group
     return Group.objects.all()
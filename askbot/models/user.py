@@ -1,7 +1,9 @@
 import datetime
 import logging
 import re
-from django.db import models
+from django.conf import settings as django_settings
+from django.core import cache  # import cache, not from cache import cache, to be able to monkey-patch cache.cache in test cases
+from django.db import connection, models, transaction
 from django.db.backends.dummy.base import IntegrityError
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.contenttypes import generic
@@ -14,13 +16,46 @@ from django.utils.html import strip_tags
 from askbot import const
 from askbot.conf import settings as askbot_settings
 from askbot.utils import functions
-from askbot.models.base import BaseQuerySetManager
+from askbot.utils.counters import CachedValueBuffer
+from askbot.models.base import BaseQuerySetManager, bulk_insert
 from askbot.models.tag import Tag, get_global_group
 from askbot.models.tag import clean_group_name#todo - delete this
 from askbot.forms import DomainNameField
 from askbot.utils.forms import email_is_allowed
 
 PERSONAL_GROUP_NAME_PREFIX = '_personal_'
+#max number of users whose data is loaded with one query
+SUBSCRIBER_BATCH_SIZE = 500
+
+#times of the last visits of the users are accumulated in the cache
+#and saved by the flush_last_seen() - from the periodic celery task,
+#run once per interval (seconds), or from the flush_last_seen command,
+#when interval is 0 - last_seen is updated on every visit
+LAST_SEEN_UPDATE_INTERVAL = getattr(
+                            django_settings,
+                            'ASKBOT_LAST_SEEN_UPDATE_INTERVAL',
+                            300
+                        )
+LAST_SEEN_BUFFER = CachedValueBuffer('user-last-seen')
+
+def flush_last_seen(batch_size = 100):
+    """saves the times of the last visits of the users
+    buffered in the cache, returns number of updated users"""
+    last_seen = LAST_SEEN_BUFFER.pop_all()
+    user_ids = last_seen.keys()
+    query = 'UPDATE %s SET last_seen = %%s WHERE id = %%s' % \
+            connection.ops.quote_name(User._meta.db_table)
+    cursor = connection.cursor()
+    for start in range(0, len(user_ids), batch_size):
+        batch = user_ids[start:start + batch_size]
+        cursor.executemany(
+            query, [
+                (connection.ops.value_to_db_datetime(last_seen[user_id]), user_id)
+                for user_id in batch
+            ]
+        )
+        transaction.commit_unless_managed()
+    return len(user_ids)
 
 class ResponseAndMentionActivityManager(models.Manager):
     def get_query_set(self):
@@ -89,10 +124,59 @@ class ActivityManager(models.Manager):
         if mentioned_whom:
             assert(isinstance(mentioned_whom, User))
             mention_activity.add_recipients([mentioned_whom])
-            mentioned_whom.update_response_counts()
 
         return mention_activity
 
+    def create_new_mentions(
+                self,
+                mentioned_by = None,
+                mentioned_whom = None,
+                mentioned_at = None,
+                mentioned_in = None
+            ):
+        """creates mention activities of many users in the
+        same post at once, one activity per mentioned user,
+        with a number of queries independent of the number of users,
+        returns list of the created activities
+        """
+        mentioned_whom = list(mentioned_whom)
+        if len(mentioned_whom) == 0:
+            return list()
+        if mentioned_at is None:
+            mentioned_at = datetime.datetime.now()
+
+        post_content_type = ContentType.objects.get_for_model(mentioned_in)
+        question = mentioned_in.get_origin_post()
+        fields = (
+            'user', 'activity_type', 'active_at', 'content_type',
+            'object_id', 'question', 'is_auditted', 'summary'
+        )
+        row = (
+            mentioned_by.id, const.TYPE_ACTIVITY_MENTION, mentioned_at,
+            post_content_type.id, mentioned_in.id, question.id, False, ''
+        )
+        bulk_insert(self.model, fields, [row] * len(mentioned_whom))
+
+        #the new activities are identical, so any of them
+        #can be given to any of the mentioned users
+        activities = list(
+            self.filter(
+                user = mentioned_by,
+                activity_type = const.TYPE_ACTIVITY_MENTION,
+                active_at = mentioned_at,
+                content_type = post_content_type,
+                object_id = mentioned_in.id,
+                activityauditstatus = None
+            ).order_by('id')[:len(mentioned_whom)]
+        )
+        ActivityAuditStatus.objects.add_recipients(
+            [
+                (activity, user)
+                for activity, user in zip(activities, mentioned_whom)
+            ]
+        )
+        return activities
+
     def get_mentions(
                 self, 
                 mentioned_by = None,
@@ -142,6 +226,110 @@ class ActivityManager(models.Manager):
         return self.filter(**kwargs)
 
 
+#types of activity counted in the new_response_count
+#and seen_response_count fields of the users
+RESPONSE_COUNT_ACTIVITY_TYPES = const.RESPONSE_ACTIVITY_TYPES_FOR_DISPLAY \
+                                + (const.TYPE_ACTIVITY_MENTION,)
+
+class ActivityAuditStatusManager(models.Manager):
+    """maintains the response counts of the users with the atomic
+    increments, when the audit statuses are added, changed or deleted,
+    the counts can be recounted with ``User.update_response_counts()``
+    """
+
+    def get_response_counts(self, audit_statuses):
+        """returns dictionary user id -> (new count, seen count)
+        of the responses among the given audit statuses"""
+        rows = audit_statuses.filter(
+                        activity__activity_type__in = RESPONSE_COUNT_ACTIVITY_TYPES
+                    ).values('user', 'status').annotate(
+                        count = models.Count('id')
+                    ).order_by()
+        counts = dict()
+        for row in rows:
+            new_count, seen_count = counts.get(row['user'], (0, 0))
+            if row['status'] == ActivityAuditStatus.STATUS_NEW:
+                new_count += row['count']
+            else:
+                seen_count += row['count']
+            counts[row['user']] = (new_count, seen_count)
+        return counts
+
+    def add_response_counts(self, counts, sign = 1):
+        """adds counts returned by the :meth:`get_response_counts`
+        to the users, or subtracts them if ``sign`` is -1,
+        users with the same changes are updated with one query"""
+        user_ids = dict()
+        for user_id, (new_count, seen_count) in counts.items():
+            delta = (sign * new_count, sign * seen_count)
+            user_ids.setdefault(delta, list()).append(user_id)
+        for (new_delta, seen_delta), ids in user_ids.items():
+            User.objects.filter(id__in = ids).update(
+                new_response_count = models.F('new_response_count') + new_delta,
+                seen_response_count = models.F('seen_response_count') + seen_delta
+            )
+
+    def set_status(self, audit_statuses, status):
+        """sets status of the audit statuses and moves
+        the responses between the new and the seen counts,
+        returns number of the changed audit statuses
+
+        responses are updated per user and the counts are moved
+        by the numbers of rows changed by the updates, so that
+        the concurrent calls don't move the same responses twice
+        """
+        audit_statuses = audit_statuses.exclude(status = status)
+        responses = audit_statuses.filter(
+                        activity__activity_type__in = RESPONSE_COUNT_ACTIVITY_TYPES
+                    )
+        user_ids = responses.values_list('user', flat = True).distinct()
+        changed_count = 0
+        moved = dict()
+        for user_id in list(user_ids.order_by()):
+            count = responses.filter(user = user_id).update(status = status)
+            if count == 0:
+                continue
+            changed_count += count
+            if status == ActivityAuditStatus.STATUS_NEW:
+                moved[user_id] = (count, -count)
+            else:
+                moved[user_id] = (-count, count)
+        #the other activities do not change the counts
+        changed_count += audit_statuses.update(status = status)
+        self.add_response_counts(moved)
+        return changed_count
+
+    def add_recipients(self, activities_and_users):
+        """adds audit statuses for the pairs (activity, user)
+        and increments the new response counts of the users
+        with a number of queries independent of the number of pairs
+        """
+        rows = [
+            (activity.id, user.id, ActivityAuditStatus.STATUS_NEW)
+            for activity, user in activities_and_users
+        ]
+        bulk_insert(self.model, ('activity', 'user', 'status'), rows)
+
+        response_counts = dict()
+        for activity, user in activities_and_users:
+            if activity.activity_type in RESPONSE_COUNT_ACTIVITY_TYPES:
+                response_counts[user.id] = response_counts.get(user.id, 0) + 1
+                user.new_response_count += 1
+        self.add_response_counts(
+            dict([
+                (user_id, (count, 0))
+                for user_id, count in response_counts.items()
+            ])
+        )
+
+    def delete_responses(self, audit_statuses):
+        """deletes the audit statuses and subtracts
+        them from the response counts of the users"""
+        counts = self.get_response_counts(audit_statuses)
+        audit_statuses.delete()
+        self.add_response_counts(counts, sign = -1)
+
+
 class ActivityAuditStatus(models.Model):
     """bridge "through" relation between activity and users"""
     STATUS_NEW = 0
@@ -154,6 +342,8 @@ class ActivityAuditStatus(models.Model):
     activity = models.ForeignKey('Activity')
     status = models.SmallIntegerField(choices=STATUS_CHOICES, default=STATUS_NEW)
 
+    objects = ActivityAuditStatusManager()
+
     class Meta:
         unique_together = ('user', 'activity')
         app_label = 'askbot'
@@ -197,10 +387,9 @@ class Activity(models.Model):
         """have to use a special method, because django does not allow
         auto-adding to M2M with "through" model
         """
-        for recipient in recipients:
-            #todo: may optimize for bulk addition
-            aas = ActivityAuditStatus(user = recipient, activity = self)
-            aas.save()
+        ActivityAuditStatus.objects.add_recipients(
+            [(self, recipient) for recipient in recipients]
+        )
 
     def get_mentioned_user(self):
         assert(self.activity_type == const.TYPE_ACTIVITY_MENTION)
@@ -217,7 +406,72 @@ class Activity(models.Model):
     def get_absolute_url(self):
         return self.content_object.get_absolute_url()
 
+def get_email_schedule_cache_key(user_id):
+    return 'email-feed-schedule-%d' % user_id
+
+def clear_email_schedule_cache(user_id):
+    cache.cache.delete(get_email_schedule_cache_key(user_id))
+
+
 class EmailFeedSettingManager(models.Manager):
+    def get_schedules(self, user_ids):
+        """returns dictionary user id -> dictionary
+        feed type -> frequency of the email subscriptions
+        of the given users
+
+        schedules are cached per user, the missing ones are
+        loaded with one query per batch of users, the cache
+        is cleared when the subscriptions are saved or deleted
+        """
+        keys = dict([
+            (get_email_schedule_cache_key(user_id), user_id)
+            for user_id in set(user_ids)
+        ])
+        schedules = dict([
+            (keys[key], schedule)
+            for key, schedule in cache.cache.get_many(keys.keys()).items()
+        ])
+        missing_ids = list(set(keys.values()) - set(schedules.keys()))
+        if len(missing_ids) == 0:
+            return schedules
+
+        loaded = dict([(user_id, dict()) for user_id in missing_ids])
+        for start in range(0, len(missing_ids), SUBSCRIBER_BATCH_SIZE):
+            feeds = self.filter(
+                    subscriber__in = missing_ids[start:start + SUBSCRIBER_BATCH_SIZE]
+                ).values_list('subscriber', 'feed_type', 'frequency')
+            for user_id, feed_type, frequency in feeds:
+                loaded[user_id][feed_type] = frequency
+        cache.cache.set_many(
+            dict([
+                (get_email_schedule_cache_key(user_id), schedule)
+                for user_id, schedule in loaded.items()
+            ]),
+            const.LONG_TIME
+        )
+        schedules.update(loaded)
+        return schedules
+
+    def filter_subscriber_ids(
+                        self,
+                        user_ids,
+                        feed_type = None,
+                        frequency = None,
+                        schedules = None
+                    ):
+        """returns set of ids of the given users who have
+        matching subscriptions, ``schedules`` - the result of
+        :meth:`get_schedules` for these users, is loaded if not given
+        """
+        if schedules is None:
+            schedules = self.get_schedules(user_ids)
+        subscriber_ids = set()
+        for user_id in user_ids:
+            schedule = schedules.get(user_id, {})
+            if schedule.get(feed_type) == frequency:
+                subscriber_ids.add(user_id)
+        return subscriber_ids
+
     def filter_subscribers(
                         self,
                         potential_subscribers = None,
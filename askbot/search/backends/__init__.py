@@ -0,0 +1,88 @@
+"""Pluggable backends of the full text search of the threads.
+
+The backend is selected with the ``ASKBOT_SEARCH_BACKEND`` django setting,
+a dotted path to the backend class, by default
+``askbot.search.backends.database.DatabaseSearchBackend`` -
+search with the means of the database.
+
+Available backends:
+
+* :class:`~askbot.search.backends.database.DatabaseSearchBackend`
+* :class:`~askbot.search.backends.inverted_index.InvertedIndexBackend` -
+  built-in on-disk inverted index with BM25 ranking
+
+The backends that keep own index are notified about
+the changes in the threads via :meth:`SearchBackend.update_thread`
+and :meth:`SearchBackend.remove_thread`.
+"""
+from django.conf import settings as django_settings
+from askbot.utils.loading import load_module
+
+DEFAULT_BACKEND = 'askbot.search.backends.database.DatabaseSearchBackend'
+#max number of the ranked threads returned by the search
+MAX_RESULTS = getattr(django_settings, 'ASKBOT_SEARCH_MAX_RESULTS', 1000)
+
+_backend = {'path': None, 'instance': None}
+
+
+class SearchBackend(object):
+    """interface of the search backends,
+    subclasses must implement either :meth:`search`,
+    returning ranked thread ids, or :meth:`filter_threads`
+    """
+
+    def supports_relevance(self):
+        """``True`` if results can be sorted by relevance,
+        the result of :meth:`filter_threads` must then have
+        the ``relevance`` column"""
+        return True
+
+    def search(self, query, limit = MAX_RESULTS):
+        """returns list of ids of the threads matching
+        the query, the most relevant first"""
+        raise NotImplementedError()
+
+    def filter_threads(self, threads, query):
+        """returns the query set of threads filtered
+        by the search query, with the ``relevance`` column
+        equal to the rank of the thread in the search results
+        """
+        thread_ids = self.search(query)
+        if len(thread_ids) == 0:
+            return threads.none()
+        table = threads.model._meta.db_table
+        rank_clause = 'CASE %s.id %s ELSE 0 END' % (
+                        table, ' '.join(['WHEN %s THEN %s'] * len(thread_ids))
+                    )
+        rank_params = list()
+        for position, thread_id in enumerate(thread_ids):
+            rank_params.extend((thread_id, len(thread_ids) - position))
+        return threads.filter(id__in = thread_ids).extra(
+                                select = {'relevance': rank_clause},
+                                select_params = rank_params
+                            )
+
+    def update_thread(self, thread_id):
+        """updates the indexed content of the thread,
+        called when posts of the thread are added, edited,
+        deleted or restored, and when the thread is retagged"""
+        pass
+
+    def remove_thread(self, thread_id):
+        """removes the thread from the index"""
+        pass
+
+    def rebuild(self, thread_id_batches):
+        """replaces the index with the one built from
+        the threads, given as an iterable of lists of ids"""
+        pass
+
+
+def get_backend():
+    """returns instance of the search backend
+    selected in the django settings"""
+    path = getattr(django_settings, 'ASKBOT_SEARCH_BACKEND', DEFAULT_BACKEND)
+    if _backend['path'] != path:
+        _backend['instance'] = load_module(path)()
+        _backend['path'] = path
+    return _backend['instance']
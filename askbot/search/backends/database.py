@@ -0,0 +1,38 @@
+"""Search with the means of the database:
+full text search on PostgreSQL and MySQL MyISAM tables,
+otherwise - case-insensitive substring match
+"""
+from django.db import models
+import askbot
+from askbot.search.backends import SearchBackend
+from askbot.utils import mysql
+
+
+class DatabaseSearchBackend(SearchBackend):
+    """searches threads with the database queries,
+    does not keep own index"""
+
+    def supports_relevance(self):
+        return 'postgresql_psycopg2' in askbot.get_database_engine_name()
+
+    def filter_threads(self, threads, query):
+        engine_name = askbot.get_database_engine_name()
+#        if getattr(settings, 'USE_SPHINX_SEARCH', False):
+#            matching_questions = Question.sphinx_search.query(search_query)
+#            question_ids = [q.id for q in matching_questions]
+#            return qs.filter(posts__post_type='question', posts__deleted=False, posts__self_question_id__in=question_ids)
+        if engine_name.endswith('mysql') and mysql.supports_full_text_search():
+            return threads.filter(
+                models.Q(title__search = query) |
+                models.Q(tagnames__search = query) |
+                models.Q(posts__deleted=False, posts__text__search = query)
+            )
+        elif 'postgresql_psycopg2' in engine_name:
+            from askbot.search import postgresql
+            return postgresql.run_full_text_search(threads, query)
+        else:
+            return threads.filter(
+                models.Q(title__icontains=query) |
+                models.Q(tagnames__icontains=query) |
+                models.Q(posts__deleted=False, posts__text__icontains = query)
+            )
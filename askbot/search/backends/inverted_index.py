@@ -0,0 +1,330 @@
+"""Built-in search backend - inverted index of the threads
+stored on disk, with the BM25 ranking of the results.
+
+The index is kept in an SQLite file (python standard library),
+at the path given by the ``ASKBOT_SEARCH_INDEX_PATH`` django setting,
+so that all processes of the site share it. Ranking is done in python.
+
+Each thread is indexed as one document made of the title,
+the tag names and the texts of all its posts that are not deleted.
+Threads with deleted questions are not indexed.
+All words of the query must be present in the matching documents.
+
+The index is updated incrementally when posts are saved, deleted and
+restored and when threads are retagged, and is built from scratch
+by the ``rebuild_search_index`` management command. Ids of the threads
+updated while the index is rebuilt are recorded in a separate file
+and the threads are indexed again once the new index is in place.
+"""
+import collections
+import math
+import os
+import re
+import sqlite3
+from django.conf import settings as django_settings
+from django.core.exceptions import ImproperlyConfigured
+from askbot.search.backends import SearchBackend, MAX_RESULTS
+
+#BM25 parameters
+K1 = 1.2
+B = 0.75
+TERM_RE = re.compile(r'\w+', re.UNICODE)
+#seconds to wait for the lock of the index file
+LOCK_TIMEOUT = 30
+#max number of parameters in one sqlite query
+IN_CLAUSE_SIZE = 500
+#suffixes of the index being rebuilt and of the file
+#with ids of the threads updated during the rebuild
+NEW_INDEX_SUFFIX = '.new'
+CHANGES_SUFFIX = '.changes'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS documents (
+    thread_id INTEGER PRIMARY KEY,
+    length INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS postings (
+    term TEXT NOT NULL,
+    thread_id INTEGER NOT NULL,
+    frequency INTEGER NOT NULL,
+    PRIMARY KEY (term, thread_id)
+);
+CREATE INDEX IF NOT EXISTS postings_thread_id ON postings (thread_id);
+CREATE TABLE IF NOT EXISTS stats (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+"""
+
+
+def tokenize(text):
+    """returns list of the lowercased words of the text"""
+    return TERM_RE.findall(text.lower())
+
+def iter_chunks(items, size = IN_CLAUSE_SIZE):
+    items = list(items)
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+def get_index_path():
+    path = getattr(django_settings, 'ASKBOT_SEARCH_INDEX_PATH', None)
+    if not path:
+        raise ImproperlyConfigured(
+            'ASKBOT_SEARCH_INDEX_PATH must be set to use the inverted index'
+        )
+    return path
+
+def load_documents(thread_ids):
+    """returns dictionary of thread id -> term frequencies
+    of the threads with the given ids, threads with
+    deleted questions and missing threads are left out
+    """
+    from askbot.models import Post, Thread
+    documents = dict()
+    deleted_ids = set(
+        Post.objects.get_questions().filter(
+            thread__in = thread_ids, deleted = True
+        ).values_list('thread', flat = True)
+    )
+    threads = Thread.objects.filter(
+                            id__in = thread_ids
+                        ).values_list('id', 'title', 'tagnames')
+    for thread_id, title, tagnames in threads:
+        if thread_id not in deleted_ids:
+            terms = tokenize(title) + tokenize(tagnames)
+            documents[thread_id] = collections.defaultdict(int)
+            for term in terms:
+                documents[thread_id][term] += 1
+
+    texts = Post.objects.filter(
+                            thread__in = documents.keys(), deleted = False
+                        ).values_list('thread', 'text')
+    for thread_id, text in texts.iterator():
+        frequencies = documents[thread_id]
+        for term in tokenize(text or ''):
+            frequencies[term] += 1
+    return documents
+
+
+class InvertedIndexBackend(SearchBackend):
+    """on-disk inverted index with BM25 ranking"""
+
+    def __init__(self, path = None):
+        self._path = path
+
+    @property
+    def path(self):
+        return self._path or get_index_path()
+
+    def connect(self, path = None):
+        connection = sqlite3.connect(path or self.path, timeout = LOCK_TIMEOUT)
+        connection.executescript(SCHEMA)
+        return connection
+
+    def get_stats(self, connection):
+        """returns tuple (number of documents, total length)"""
+        stats = dict(connection.execute('SELECT name, value FROM stats'))
+        return stats.get('document_count', 0), stats.get('total_length', 0)
+
+    def add_stats(self, connection, document_count, total_length):
+        count, length = self.get_stats(connection)
+        connection.executemany(
+            'INSERT OR REPLACE INTO stats (name, value) VALUES (?, ?)',
+            (
+                ('document_count', count + document_count),
+                ('total_length', length + total_length),
+            )
+        )
+
+    def delete_documents(self, connection, thread_ids):
+        for chunk in iter_chunks(thread_ids):
+            placeholders = ','.join(['?'] * len(chunk))
+            rows = connection.execute(
+                'SELECT COUNT(*), SUM(length) FROM documents '
+                'WHERE thread_id IN (%s)' % placeholders, chunk
+            ).fetchone()
+            if rows[0]:
+                self.add_stats(connection, -rows[0], -rows[1])
+            connection.execute(
+                'DELETE FROM documents WHERE thread_id IN (%s)' % placeholders,
+                chunk
+            )
+            connection.execute(
+                'DELETE FROM postings WHERE thread_id IN (%s)' % placeholders,
+                chunk
+            )
+
+    def write_documents(self, connection, documents):
+        total_length = 0
+        for thread_id, frequencies in documents.items():
+            length = sum(frequencies.values())
+            total_length += length
+            connection.execute(
+                'INSERT INTO documents (thread_id, length) VALUES (?, ?)',
+                (thread_id, length)
+            )
+            connection.executemany(
+                'INSERT INTO postings (term, thread_id, frequency) '
+                'VALUES (?, ?, ?)',
+                [
+                    (term, thread_id, frequency)
+                    for term, frequency in frequencies.items()
+                ]
+            )
+        self.add_stats(connection, len(documents), total_length)
+
+    def connect_changes(self):
+        connection = sqlite3.connect(
+                            self.path + CHANGES_SUFFIX,
+                            timeout = LOCK_TIMEOUT
+                        )
+        connection.execute(
+            'CREATE TABLE IF NOT EXISTS changes '
+            '(thread_id INTEGER PRIMARY KEY)'
+        )
+        return connection
+
+    def record_change(self, thread_id):
+        """if the index is being rebuilt - records id of the thread,
+        must be called before the thread is updated in the index,
+        so that the update is not lost with the replaced index file"""
+        if not os.path.exists(self.path + NEW_INDEX_SUFFIX):
+            return
+        connection = self.connect_changes()
+        try:
+            connection.execute(
+                'INSERT OR IGNORE INTO changes (thread_id) VALUES (?)',
+                (thread_id,)
+            )
+            connection.commit()
+        finally:
+            connection.close()
+
+    def pop_changes(self):
+        """returns ids of the threads recorded by :meth:`record_change`
+        and deletes the record"""
+        if not os.path.exists(self.path + CHANGES_SUFFIX):
+            return list()
+        connection = self.connect_changes()
+        try:
+            thread_ids = [
+                row[0] for row in connection.execute(
+                    'SELECT thread_id FROM changes'
+                )
+            ]
+            connection.execute('DELETE FROM changes')
+            connection.commit()
+        finally:
+            connection.close()
+        return thread_ids
+
+    def update_threads(self, connection, thread_ids):
+        for chunk in iter_chunks(thread_ids):
+            documents = load_documents(chunk)
+            self.delete_documents(connection, chunk)
+            self.write_documents(connection, documents)
+
+    def update_thread(self, thread_id):
+        self.record_change(thread_id)
+        connection = self.connect()
+        try:
+            self.update_threads(connection, [thread_id])
+            connection.commit()
+        finally:
+            connection.close()
+
+    def remove_thread(self, thread_id):
+        self.record_change(thread_id)
+        connection = self.connect()
+        try:
+            self.delete_documents(connection, [thread_id])
+            connection.commit()
+        finally:
+            connection.close()
+
+    def rebuild(self, thread_id_batches):
+        """builds the index in a new file, batch by batch,
+        and replaces the old index with it, so that
+        the search works while the index is rebuilt,
+        then indexes again the threads updated meanwhile"""
+        new_path = self.path + NEW_INDEX_SUFFIX
+        changes_path = self.path + CHANGES_SUFFIX
+        for path in (new_path, changes_path):
+            if os.path.exists(path):
+                os.remove(path)
+        connection = self.connect(new_path)
+        try:
+            for thread_ids in thread_id_batches:
+                self.write_documents(connection, load_documents(thread_ids))
+                connection.commit()
+        finally:
+            connection.close()
+        os.rename(new_path, self.path)
+
+        #changes recorded after this point are applied
+        #by the updates to the new index
+        connection = self.connect()
+        try:
+            self.update_threads(connection, self.pop_changes())
+            connection.commit()
+        finally:
+            connection.close()
+        if os.path.exists(changes_path):
+            os.remove(changes_path)
+
+    def search(self, query, limit = MAX_RESULTS):
+        terms = set(tokenize(query))
+        if len(terms) == 0:
+            return list()
+
+        connection = self.connect()
+        try:
+            document_count, total_length = self.get_stats(connection)
+            if document_count == 0:
+                return list()
+
+            postings = dict()
+            for term in terms:
+                postings[term] = connection.execute(
+                    'SELECT thread_id, frequency FROM postings WHERE term = ?',
+                    (term,)
+                ).fetchall()
+                if len(postings[term]) == 0:
+                    return list()
+
+            #all terms must match
+            thread_ids = None
+            for rows in sorted(postings.values(), key = len):
+                ids = set([row[0] for row in rows])
+                if thread_ids is None:
+                    thread_ids = ids
+                else:
+                    thread_ids &= ids
+
+            lengths = dict()
+            for chunk in iter_chunks(thread_ids):
+                placeholders = ','.join(['?'] * len(chunk))
+                lengths.update(connection.execute(
+                    'SELECT thread_id, length FROM documents '
+                    'WHERE thread_id IN (%s)' % placeholders, chunk
+                ))
+        finally:
+            connection.close()
+
+        average_length = float(total_length) / document_count
+        scores = dict.fromkeys(thread_ids, 0.0)
+        for rows in postings.values():
+            df = len(rows)
+            idf = math.log(1.0 + (document_count - df + 0.5) / (df + 0.5))
+            for thread_id, frequency in rows:
+                if thread_id in scores:
+                    norm = 1 - B + B * lengths[thread_id] / average_length
+                    scores[thread_id] += idf * frequency * (K1 + 1) \
+                                        / (frequency + K1 * norm)
+
+        ranked = sorted(
+                    thread_ids,
+                    key = lambda thread_id: (scores[thread_id], thread_id),
+                    reverse = True
+                )
+        return ranked[:limit]
@@ -0,0 +1,252 @@
+"""Engine of the similar threads, shown on the question page.
+
+Threads are compared by the tags they share, each tag weighted
+by its inverse document frequency (so that rare tags count more),
+and by the number of terms shared in their titles.
+
+Top neighbours of each thread are precomputed and stored
+as a comma-separated list of ids in ``Thread.similar_thread_ids``:
+
+* for all threads - by the ``rebuild_similar_threads`` management command
+* for one thread - by :func:`update_similar_threads` when the thread
+  is retagged, or when the neighbours are requested for the first time;
+  only on retag the lists of the neighbours are reset, to be recomputed
+  when they are requested
+
+For one thread the candidates are collected from the threads sharing
+the rarest tags of the thread first, at most
+``ASKBOT_SIMILAR_THREADS_MAX_CANDIDATES`` of them, so that the cost
+of the computation does not grow with the popularity of the tags.
+The management command ranks all threads sharing tags with the thread.
+"""
+import math
+import re
+from django.conf import settings as django_settings
+from django.core import cache  # import cache, not from cache import cache, to be able to monkey-patch cache.cache in test cases
+
+NEIGHBOR_COUNT = 10
+MAX_CANDIDATES = getattr(
+                    django_settings,
+                    'ASKBOT_SIMILAR_THREADS_MAX_CANDIDATES',
+                    500
+                )
+#weight of one shared title term relative to the tag weights
+TITLE_TERM_WEIGHT = 0.5
+MIN_TERM_LENGTH = 3
+STOP_WORDS = frozenset((
+    'and', 'are', 'can', 'does', 'for', 'from', 'get', 'have',
+    'how', 'into', 'not', 'that', 'the', 'there', 'this', 'use',
+    'using', 'what', 'when', 'which', 'why', 'with', 'you', 'your',
+))
+TERM_RE = re.compile(r'\w+', re.UNICODE)
+#max number of ids in one "in" clause
+IN_CLAUSE_SIZE = 500
+
+
+def get_title_terms(title):
+    """returns frozenset of the significant words of the title"""
+    return frozenset([
+        term for term in TERM_RE.findall(title.lower())
+        if len(term) >= MIN_TERM_LENGTH and term not in STOP_WORDS
+    ])
+
+def get_tag_weight(tag_thread_count, thread_count):
+    """inverse document frequency of the tag"""
+    return math.log(1.0 + float(thread_count) / max(tag_thread_count, 1))
+
+def get_similar_threads_cache_key(thread_id):
+    return 'similar-threads-%s' % thread_id
+
+def format_thread_ids(thread_ids):
+    return ','.join([str(thread_id) for thread_id in thread_ids])
+
+def parse_thread_ids(value):
+    return [int(thread_id) for thread_id in value.split(',') if thread_id]
+
+def iter_chunks(items, size = IN_CLAUSE_SIZE):
+    items = list(items)
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+class SimilarityIndex(object):
+    """in-memory inverted index of the thread tags,
+    with the title terms of the threads
+    """
+
+    def __init__(self, thread_count = 0, tag_thread_counts = None):
+        self.thread_count = thread_count
+        self.tag_weights = dict()
+        for tag_id, count in (tag_thread_counts or dict()).items():
+            self.tag_weights[tag_id] = get_tag_weight(count, thread_count)
+        self.thread_tags = dict()
+        self.title_terms = dict()
+        #tag id -> list of thread ids, newest threads first
+        self.postings = dict()
+
+    def add_thread(self, thread_id, title, tag_ids):
+        self.thread_tags[thread_id] = frozenset(tag_ids)
+        self.title_terms[thread_id] = get_title_terms(title)
+        for tag_id in tag_ids:
+            self.postings.setdefault(tag_id, list()).append(thread_id)
+
+    def sort_postings(self):
+        for thread_ids in self.postings.values():
+            thread_ids.sort(reverse = True)
+
+    def get_thread_ids(self):
+        return self.thread_tags.keys()
+
+    def get_tag_weight(self, tag_id):
+        return self.tag_weights.get(tag_id, 0)
+
+    def get_candidates(self, thread_id, max_candidates = MAX_CANDIDATES):
+        """returns set of ids of the threads sharing
+        tags with the given one, taken from the rarest tags first,
+        with ``max_candidates = None`` all such threads are returned"""
+        tag_ids = sorted(
+                    self.thread_tags.get(thread_id, ()),
+                    key = self.get_tag_weight,
+                    reverse = True
+                )
+        candidates = set()
+        for tag_id in tag_ids:
+            for other_id in self.postings.get(tag_id, ()):
+                if max_candidates is not None \
+                    and len(candidates) >= max_candidates:
+                    return candidates
+                if other_id != thread_id:
+                    candidates.add(other_id)
+        return candidates
+
+    def get_score(self, thread_id, other_id):
+        shared_tags = self.thread_tags[thread_id] & self.thread_tags[other_id]
+        shared_terms = self.title_terms[thread_id] & self.title_terms[other_id]
+        score = sum([self.get_tag_weight(tag_id) for tag_id in shared_tags])
+        return score + TITLE_TERM_WEIGHT * len(shared_terms)
+
+    def get_neighbors(self, thread_id, candidates = None,
+                                        count = NEIGHBOR_COUNT,
+                                        max_candidates = MAX_CANDIDATES):
+        """returns list of ids of the threads most similar
+        to the given one, ties are resolved in favor of newer threads"""
+        if candidates is None:
+            candidates = self.get_candidates(thread_id, max_candidates)
+        scored = list()
+        for other_id in candidates:
+            if other_id in self.thread_tags:
+                score = self.get_score(thread_id, other_id)
+                if score > 0:
+                    scored.append((score, other_id))
+        scored.sort(reverse = True)
+        return [other_id for score, other_id in scored[:count]]
+
+
+def get_deleted_thread_ids():
+    from askbot.models import Post
+    return set(
+        Post.objects.get_questions().filter(
+            deleted = True
+        ).values_list('thread', flat = True)
+    )
+
+def build_index():
+    """returns index of all threads,
+    except those with deleted questions"""
+    from askbot.models import Tag, Thread
+    deleted_ids = get_deleted_thread_ids()
+    index = SimilarityIndex(
+                thread_count = Thread.objects.count(),
+                tag_thread_counts = dict(
+                    Tag.objects.values_list('id', 'used_count')
+                )
+            )
+    thread_tags = dict()
+    thread_tag_ids = Thread.tags.through.objects.values_list('thread', 'tag')
+    for thread_id, tag_id in thread_tag_ids.iterator():
+        thread_tags.setdefault(thread_id, list()).append(tag_id)
+
+    titles = Thread.objects.values_list('id', 'title')
+    for thread_id, title in titles.iterator():
+        if thread_id not in deleted_ids:
+            index.add_thread(thread_id, title, thread_tags.get(thread_id, ()))
+    index.sort_postings()
+    return index
+
+def save_similar_threads(thread_id, similar_thread_ids):
+    from askbot.models import Thread
+    value = format_thread_ids(similar_thread_ids)
+    Thread.objects.filter(id = thread_id).update(similar_thread_ids = value)
+    cache.cache.delete(get_similar_threads_cache_key(thread_id))
+    return value
+
+def reset_similar_threads(thread_ids):
+    """marks lists of similar threads for recomputation"""
+    from askbot.models import Thread
+    Thread.objects.filter(id__in = thread_ids).update(similar_thread_ids = None)
+    for thread_id in thread_ids:
+        cache.cache.delete(get_similar_threads_cache_key(thread_id))
+
+def update_similar_threads(thread, reset_neighbors = False):
+    """recomputes the neighbours of one thread,
+    the candidates are read from the database,
+    newest first, for the rarest tags of the thread first
+
+    with ``reset_neighbors = True`` the lists of the previous
+    and the new neighbours are marked for recomputation,
+    because the thread may enter or leave those lists
+    """
+    from askbot.models import Post, Tag, Thread
+    through = Thread.tags.through
+    tags = Tag.objects.filter(threads = thread).order_by('used_count')
+    tag_counts = list(tags.values_list('id', 'used_count'))
+
+    candidates = set()
+    for tag_id, used_count in tag_counts:
+        limit = MAX_CANDIDATES - len(candidates)
+        if limit <= 0:
+            break
+        thread_ids = through.objects.filter(
+                                tag = tag_id
+                            ).exclude(
+                                thread = thread.id
+                            ).order_by(
+                                '-thread'
+                            ).values_list('thread', flat = True)
+        candidates.update(thread_ids[:limit])
+
+    index = SimilarityIndex(
+                thread_count = Thread.objects.count(),
+                tag_thread_counts = dict(tag_counts)
+            )
+    index.add_thread(thread.id, thread.title, [t[0] for t in tag_counts])
+
+    thread_tags = dict()
+    titles = dict()
+    deleted_ids = set()
+    for chunk in iter_chunks(candidates):
+        #threads with deleted questions are not candidates
+        deleted_ids.update(
+            Post.objects.get_questions().filter(
+                thread__in = chunk, deleted = True
+            ).values_list('thread', flat = True)
+        )
+        chunk = [thread_id for thread_id in chunk if thread_id not in deleted_ids]
+        thread_tag_ids = through.objects.filter(
+                                thread__in = chunk
+                            ).values_list('thread', 'tag')
+        for thread_id, tag_id in thread_tag_ids:
+            thread_tags.setdefault(thread_id, list()).append(tag_id)
+        titles.update(
+            Thread.objects.filter(id__in = chunk).values_list('id', 'title')
+        )
+    candidates -= deleted_ids
+    for thread_id, title in titles.items():
+        index.add_thread(thread_id, title, thread_tags.get(thread_id, ()))
+
+    neighbors = index.get_neighbors(thread.id, candidates = candidates)
+    if reset_neighbors:
+        previous = parse_thread_ids(thread.similar_thread_ids or '')
+        reset_similar_threads(set(previous) | set(neighbors))
+    thread.similar_thread_ids = save_similar_threads(thread.id, neighbors)
+    return neighbors
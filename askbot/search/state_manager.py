@@ -87,7 +87,7 @@ class SearchState(object):
     def get_empty(cls):
         return cls(scope=None, sort=None, query=None, tags=None, author=None, page=None, user_logged_in=None)
 
-    def __init__(self, scope, sort, query, tags, author, page, user_logged_in):
+    def __init__(self, scope, sort, query, tags, author, page, user_logged_in, cursor=None):
         # INFO: zip(*[('a', 1), ('b', 2)])[0] == ('a', 'b')
 
         if (scope not in zip(*const.POST_SCOPE_LIST)[0]) or (scope == 'favorite' and not user_logged_in):
@@ -133,7 +133,13 @@ class SearchState(object):
         if self.page == 0:  # in case someone likes jokes :)
             self.page = 1
 
+        #position in the list for the keyset pagination,
+        #see ThreadManager.get_keyset_page()
+        self.cursor = cursor or None
+
         self._questions_url = urlresolvers.reverse('questions')
+        #urls of the states with the tags added, see get_tag_url()
+        self._tag_urls = dict()
 
     def __str__(self):
         return self.query_string()
@@ -182,6 +188,8 @@ class SearchState(object):
             lst.append('author:' + str(self.author))
         if self.page:
             lst.append('page:' + str(self.page))
+        if self.cursor:
+            lst.append('cursor:' + self.cursor)
         return '/'.join(lst) + '/'
 
     def deepcopy(self): # TODO: test me
@@ -201,23 +209,36 @@ class SearchState(object):
             ss.query_tags = ss.query_tags[:]
         if ss.query_users:
             ss.query_users = ss.query_users[:]
+        ss._tag_urls = dict()
         #ss.query_title = self.query_title
 
         #ss._questions_url = self._questions_url
 
         return ss
 
+    def get_tag_url(self, tag):
+        """returns url of the state with the tag added,
+        urls are memoized, as the same tags are repeated
+        in the thread summaries of the question list"""
+        url = self._tag_urls.get(tag)
+        if url is None:
+            url = self.add_tag(tag).full_url()
+            self._tag_urls[tag] = url
+        return url
+
     def add_tag(self, tag):
         ss = self.deepcopy()
         if tag not in ss.tags:
             ss.tags.append(tag)
             ss.page = 1 # state change causes page reset
+            ss.cursor = None
         return ss
 
     def remove_author(self):
         ss = self.deepcopy()
         ss.author = None
         ss.page = 1
+        ss.cursor = None
         return ss
 
     def remove_tags(self, tags = None):
@@ -229,23 +250,33 @@ class SearchState(object):
         else:
             ss.tags = []
         ss.page = 1
+        ss.cursor = None
         return ss
 
     def change_scope(self, new_scope):
         ss = self.deepcopy()
         ss.scope = new_scope
         ss.page = 1
+        ss.cursor = None
         return ss
 
     def change_sort(self, new_sort):
         ss = self.deepcopy()
         ss.sort = new_sort
         ss.page = 1
+        ss.cursor = None
         return ss
 
     def change_page(self, new_page):
         ss = self.deepcopy()
         ss.page = new_page
+        ss.cursor = None
+        return ss
+
+    def change_cursor(self, new_cursor):
+        ss = self.deepcopy()
+        ss.page = 1
+        ss.cursor = new_cursor
         return ss
 
 
@@ -97,6 +97,8 @@ TEMPLATE_LOADERS = (
 
 
 MIDDLEWARE_CLASSES = (
+    #enabled by ASKBOT_PROFILING_ENABLED or ASKBOT_PROFILING_SAMPLE_RATE
+    'askbot.middleware.profiling.ProfilingMiddleware',
     #'django.middleware.gzip.GZipMiddleware',
     #'askbot.middleware.locale.LocaleMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
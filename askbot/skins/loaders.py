@@ -1,4 +1,5 @@
 import os.path
+import time
 from django.template.loaders import filesystem
 from django.template import RequestContext
 from django.http import HttpResponse
@@ -10,6 +11,7 @@ from jinja2.exceptions import TemplateNotFound
 from jinja2.utils import open_if_exists
 from askbot.conf import settings as askbot_settings
 from askbot.skins import utils
+from askbot.utils import profiling
 
 from coffin import template
 template.add_to_builtins('askbot.templatetags.extra_filters_jinja')
@@ -115,10 +117,19 @@ def get_template(template, request = None):
         skin.set_language(request.LANGUAGE_CODE)
     return skin.get_template(template)
 
+def render_template(template, context):
+    """renders template, time of the rendering
+    is added to the statistics of the profiled requests"""
+    started_at = time.time()
+    try:
+        return template.render(context)
+    finally:
+        profiling.add_to_sample('template_time', time.time() - started_at)
+
 def render_into_skin_as_string(template, data, request):
     context = RequestContext(request, data)
     template = get_template(template, request)
-    return template.render(context)
+    return render_template(template, context)
 
 def render_into_skin(template, data, request, mimetype = 'text/html'):
     """in the future this function will be able to
@@ -134,4 +145,4 @@ def render_text_into_skin(text, data, request):
     context = RequestContext(request, data)
     skin = get_skin(request)
     template = skin.from_string(text)
-    return template.render(context)
+    return render_template(template, context)
@@ -17,18 +17,25 @@ That is the reason for having two types of methods here:
 * celery tasks - shells that reconstitute the necessary ORM
   objects and call the base methods
 """
+import datetime
 import sys
 import traceback
 
+from django.contrib.auth.models import AnonymousUser
 from django.contrib.contenttypes.models import ContentType
+from django.core.exceptions import ObjectDoesNotExist
 from django.template import Context
 from django.utils.translation import ugettext as _
-from celery.decorators import task
+from celery.decorators import periodic_task, task
 from askbot.conf import settings as askbot_settings
 from askbot import const
 from askbot import mail
 from askbot.models import Post, Thread, User, ReplyAddress
+from askbot.models import badges
 from askbot.models.badges import award_badges_signal
+from askbot.models.question import VIEW_COUNT_FLUSH_INTERVAL
+from askbot.models.user import LAST_SEEN_UPDATE_INTERVAL, flush_last_seen
+from askbot.search.state_manager import SearchState
 
 # TODO: Make exceptions raised inside record_post_update_celery_task() ...
 #       ... propagate upwards to test runner, if only CELERY_ALWAYS_EAGER = True
@@ -116,12 +123,20 @@ def record_post_update_celery_task(
         #update_object is not used
         (activity_type, update_object) = post.get_updated_activity_data(created)
 
+        #retry sending the alerts only in the worker,
+        #an eager task runs within the web request
+        if record_post_update_celery_task.request.is_eager:
+            email_retries = 0
+        else:
+            email_retries = mail.SEND_RETRIES
+
         post.issue_update_notifications(
             updated_by=updated_by,
             notify_sets=notify_sets,
             activity_type=activity_type,
             timestamp=timestamp,
-            diff=diff
+            diff=diff,
+            email_retries=email_retries
         )
 
     except Exception:
@@ -164,3 +179,82 @@ def record_question_visit(
                     actor = user,
                     context_object = question_post,
                 )
+
+@task(ignore_result = True)
+def award_badges_celery_task(
+    event = None,
+    actor_id = None,
+    content_type_id = None,
+    object_id = None,
+    timestamp = None):
+    """evaluates the badges for the event,
+    used when ``ASKBOT_AWARD_BADGES_ASYNC`` is enabled
+    """
+    try:
+        actor = User.objects.get(id = actor_id)
+        content_type = ContentType.objects.get_for_id(content_type_id)
+        context_object = content_type.get_object_for_this_type(id = object_id)
+    except ObjectDoesNotExist:
+        #the objects were deleted before the task ran
+        return
+    badges.evaluate_badges(
+                event = event,
+                actor = actor,
+                context_object = context_object,
+                timestamp = timestamp
+            )
+
+@task(ignore_result = True)
+def refresh_question_count_celery_task(
+    scope = None,
+    query = None,
+    tags = None,
+    author = None,
+    user_id = None):
+    """recounts the questions matching the search,
+    for the cached counter of the question list
+    """
+    search_state = SearchState(
+                        scope = scope,
+                        sort = None,
+                        query = query,
+                        tags = tags,
+                        author = author,
+                        page = None,
+                        user_logged_in = user_id is not None
+                    )
+    if user_id is None:
+        user = AnonymousUser()
+    else:
+        user = User.objects.get(id = user_id)
+    Thread.objects.refresh_cached_count(
+                        search_state = search_state,
+                        request_user = user
+                    )
+
+@periodic_task(
+    run_every=datetime.timedelta(seconds=VIEW_COUNT_FLUSH_INTERVAL or 60),
+    ignore_result=True
+)
+def flush_view_counts_celery_task():
+    """saves the buffered thread view counts,
+    runs when the celerybeat is enabled"""
+    Thread.objects.flush_view_counts()
+
+@periodic_task(
+    run_every=datetime.timedelta(seconds=LAST_SEEN_UPDATE_INTERVAL or 60),
+    ignore_result=True
+)
+def flush_last_seen_celery_task():
+    """saves the buffered times of the last visits of the users"""
+    flush_last_seen()
+
+@periodic_task(
+    run_every=datetime.timedelta(seconds=mail.OUTBOX_DRAIN_INTERVAL),
+    ignore_result=True
+)
+def send_spooled_messages_celery_task():
+    """sends email messages spooled to the outbox directory,
+    runs when the celerybeat is enabled"""
+    if mail.get_outbox_dir():
+        mail.send_spooled_messages()
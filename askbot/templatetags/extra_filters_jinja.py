@@ -4,13 +4,11 @@ import re
 import time
 import urllib
 from coffin import template as coffin_template
-from django.core import exceptions as django_exceptions
 from django.utils.translation import ugettext as _
 from django.contrib.humanize.templatetags import humanize
 from django.template import defaultfilters
 from django.core.urlresolvers import reverse, resolve
 from django.http import Http404
-from askbot import exceptions as askbot_exceptions
 from askbot.conf import settings as askbot_settings
 from django.conf import settings as django_settings
 from askbot.skins import utils as skin_utils
@@ -161,13 +159,14 @@ register.filter(
             jinja2_only = True
         )
 
-def make_template_filter_from_permission_assertion(
-                                assertion_name = None,
-                                filter_name = None,
-                                allowed_exception = None
+def make_template_filter_from_post_permission(
+                                action = None,
+                                filter_name = None
                             ):
-    """a decorator-like function that will create a True/False test from
-    permission assertion
+    """a decorator-like function that will create a True/False test
+    from the matrix of the post permissions of the user,
+    see :mod:`askbot.models.permissions`, the matrix is evaluated
+    once per request by ``User.precache_post_permissions()``
     """
     def filter_function(user, post):
 
@@ -177,21 +176,7 @@ def make_template_filter_from_permission_assertion(
         if user.is_anonymous():
             return False
 
-        assertion = getattr(user, assertion_name)
-        if allowed_exception:
-            try:
-                assertion(post)
-                return True
-            except allowed_exception:
-                return True
-            except django_exceptions.PermissionDenied:
-                return False
-        else:
-            try:
-                assertion(post)
-                return True
-            except django_exceptions.PermissionDenied:
-                return False
+        return action in user.get_post_permissions(post)
 
     register.filter(filter_name, filter_function)
     return filter_function
@@ -203,65 +188,64 @@ def can_moderate_user(user, other_user):
         return True
     return False
 
-can_flag_offensive = make_template_filter_from_permission_assertion(
-                        assertion_name = 'assert_can_flag_offensive',
-                        filter_name = 'can_flag_offensive',
-                        allowed_exception = askbot_exceptions.DuplicateCommand
+can_flag_offensive = make_template_filter_from_post_permission(
+                        action = 'flag_offensive',
+                        filter_name = 'can_flag_offensive'
                     )
 
-can_remove_flag_offensive = make_template_filter_from_permission_assertion(
-                        assertion_name = 'assert_can_remove_flag_offensive',
-                        filter_name = 'can_remove_flag_offensive',
+can_remove_flag_offensive = make_template_filter_from_post_permission(
+                        action = 'remove_flag_offensive',
+                        filter_name = 'can_remove_flag_offensive'
                     )
 
-can_remove_all_flags_offensive = make_template_filter_from_permission_assertion(
-                        assertion_name = 'assert_can_remove_all_flags_offensive',
-                        filter_name = 'can_remove_all_flags_offensive',
+can_remove_all_flags_offensive = make_template_filter_from_post_permission(
+                        action = 'remove_all_flags_offensive',
+                        filter_name = 'can_remove_all_flags_offensive'
                     )
 
-can_post_comment = make_template_filter_from_permission_assertion(
-                        assertion_name = 'assert_can_post_comment',
+can_post_comment = make_template_filter_from_post_permission(
+                        action = 'post_comment',
                         filter_name = 'can_post_comment'
                     )
 
-can_edit_comment = make_template_filter_from_permission_assertion(
-                        assertion_name = 'assert_can_edit_comment',
+can_edit_comment = make_template_filter_from_post_permission(
+                        action = 'edit_comment',
                         filter_name = 'can_edit_comment'
                     )
 
-can_close_question = make_template_filter_from_permission_assertion(
-                        assertion_name = 'assert_can_close_question',
+can_close_question = make_template_filter_from_post_permission(
+                        action = 'close_question',
                         filter_name = 'can_close_question'
                     )
 
-can_delete_comment = make_template_filter_from_permission_assertion(
-                        assertion_name = 'assert_can_delete_comment',
+can_delete_comment = make_template_filter_from_post_permission(
+                        action = 'delete_comment',
                         filter_name = 'can_delete_comment'
                     )
 
 #this works for questions, answers and comments
-can_delete_post = make_template_filter_from_permission_assertion(
-                        assertion_name = 'assert_can_delete_post',
+can_delete_post = make_template_filter_from_post_permission(
+                        action = 'delete_post',
                         filter_name = 'can_delete_post'
                     )
 
-can_reopen_question = make_template_filter_from_permission_assertion(
-                        assertion_name = 'assert_can_reopen_question',
+can_reopen_question = make_template_filter_from_post_permission(
+                        action = 'reopen_question',
                         filter_name = 'can_reopen_question'
                     )
 
-can_edit_post = make_template_filter_from_permission_assertion(
-                        assertion_name = 'assert_can_edit_post',
+can_edit_post = make_template_filter_from_post_permission(
+                        action = 'edit_post',
                         filter_name = 'can_edit_post'
                     )
 
-can_retag_question = make_template_filter_from_permission_assertion(
-                        assertion_name = 'assert_can_retag_question',
+can_retag_question = make_template_filter_from_post_permission(
+                        action = 'retag_question',
                         filter_name = 'can_retag_question'
                     )
 
-can_accept_best_answer = make_template_filter_from_permission_assertion(
-                        assertion_name = 'assert_can_accept_best_answer',
+can_accept_best_answer = make_template_filter_from_post_permission(
+                        action = 'accept_best_answer',
                         filter_name = 'can_accept_best_answer'
                     )
 
@@ -18,5 +18,6 @@ from askbot.tests.reply_by_email_tests import *
 from askbot.tests.widget_tests import *
 from askbot.tests.category_tree_tests import CategoryTreeTests
 from askbot.tests.user_model_tests import UserModelTests
+from askbot.tests.user_model_tests import LastSeenBufferTests
 from askbot.tests.utils_tests import *
 from askbot.tests.view_context_tests import *
@@ -4,7 +4,9 @@ from django.test.client import Client
 from askbot.tests.utils import AskbotTestCase
 from askbot.conf import settings
 from askbot import models
+from askbot.models import badges
 from askbot.models.badges import award_badges_signal
+from askbot.models.user import LAST_SEEN_BUFFER
 
 class BadgeTests(AskbotTestCase):
 
@@ -500,8 +502,77 @@ class BadgeTests(AskbotTestCase):
         prev_visit_count = settings.ENTHUSIAST_BADGE_MIN_DAYS - 1
         self.u1.consecutive_days_visit_count = prev_visit_count
         self.u1.save()
+        #drop the visits buffered by the other tests
+        LAST_SEEN_BUFFER.pop_all()
         self.assert_have_badge('enthusiast', self.u1, 0)
         self.client.login(method = 'force', user_id = self.u1.id)
         self.client.get('/' + django_settings.ASKBOT_URL)
         self.assert_have_badge('enthusiast', self.u1, 1)
 
+
+class BadgeRegistryTests(AskbotTestCase):
+
+    def setUp(self):
+        self.u1 = self.create_user(username = 'user1')
+        self.u2 = self.create_user(username = 'user2')
+
+    def test_held_badge_is_skipped_without_queries(self):
+        badge = badges.get_badge_instance(badges.Commentator)
+        question = self.post_question(user = self.u2)
+        self.assertTrue(
+            badge.award(self.u1, question, datetime.datetime.now())
+        )
+        self.assertTrue(badge.is_held_by(self.u1))
+        self.assertNumQueries(
+            0, badge.consider_award, self.u1, question, None
+        )
+        self.assertEquals(
+            models.Award.objects.filter(
+                user = self.u1, badge__slug = 'commentator'
+            ).count(),
+            1
+        )
+
+    def test_deleted_award_is_removed_from_held_badges(self):
+        badge = badges.get_badge_instance(badges.Organizer)
+        question = self.post_question(user = self.u2)
+        badge.award(self.u1, question, datetime.datetime.now())
+        self.assertTrue(badge.is_held_by(self.u1))
+        models.Award.objects.filter(user = self.u1).delete()
+        self.assertFalse(badge.is_held_by(self.u1))
+
+    def test_registry_is_rebuilt_when_settings_change(self):
+        old_value = settings.COMMENTATOR_BADGE_MIN_COMMENTS
+        badge = badges.get_badge_instance(badges.Commentator)
+        self.assertTrue(badge is badges.get_badge_instance(badges.Commentator))
+        settings.update('COMMENTATOR_BADGE_MIN_COMMENTS', old_value + 1)
+        new_badge = badges.get_badge_instance(badges.Commentator)
+        self.assertFalse(badge is new_badge)
+        settings.update('COMMENTATOR_BADGE_MIN_COMMENTS', old_value)
+
+    def test_stale_badge_data_is_reloaded(self):
+        badge = badges.get_badge_instance(badges.Supporter)
+        stored = badge.get_stored_data()
+        badges._badge_data['supporter'] = models.BadgeData(
+                                                id = stored.id + 1000,
+                                                slug = 'supporter'
+                                            )
+        question = self.post_question(user = self.u2)
+        self.u1.upvote(question)
+        award = models.Award.objects.get(user = self.u1)
+        self.assertEquals(award.badge.id, stored.id)
+        self.assertEquals(badge.get_stored_data().awarded_count, 1)
+
+    def test_badges_awarded_in_celery_task(self):
+        django_settings.ASKBOT_AWARD_BADGES_ASYNC = True
+        try:
+            question = self.post_question(user = self.u2)
+            self.u1.upvote(question)
+        finally:
+            django_settings.ASKBOT_AWARD_BADGES_ASYNC = False
+        self.assertEquals(
+            models.Award.objects.filter(
+                user = self.u1, badge__slug = 'supporter'
+            ).count(),
+            1
+        )
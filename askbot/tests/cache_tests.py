@@ -24,3 +24,26 @@ class CacheTests(AskbotTestCase):
         #second hit to the same question should give fewer queries
         self.assertTrue(counter > len(connection.queries))
         settings.DEBUG = False
+
+
+class LivesettingsSnapshotTests(AskbotTestCase):
+
+    def test_update_invalidates_snapshot(self):
+        from askbot.conf import settings as askbot_settings
+        backup = askbot_settings.MIN_REP_TO_VOTE_UP
+        askbot_settings.update('MIN_REP_TO_VOTE_UP', backup + 1)
+        self.assertEqual(askbot_settings.MIN_REP_TO_VOTE_UP, backup + 1)
+        askbot_settings.update('MIN_REP_TO_VOTE_UP', backup)
+        self.assertEqual(askbot_settings.MIN_REP_TO_VOTE_UP, backup)
+
+    def test_settings_are_read_from_snapshot(self):
+        from askbot.conf import settings as askbot_settings
+        askbot_settings.on_request_started()
+        askbot_settings.MIN_REP_TO_VOTE_UP
+        lookup_count = askbot_settings.get_backend_lookup_count()
+        askbot_settings.MIN_REP_TO_VOTE_UP
+        askbot_settings.MIN_REP_TO_VOTE_DOWN
+        self.assertEqual(
+            askbot_settings.get_backend_lookup_count(),
+            lookup_count
+        )
@@ -258,6 +258,64 @@ class UserLikeTagTests(AskbotTestCase):
         self.assert_affinity_is('like', False)
         self.assert_affinity_is('dislike', False)
 
+class InstantNotificationSubscriberTests(AskbotTestCase):
+    """tests of the resolution of the instant email
+    notification subscribers on the user ids"""
+
+    def setUp(self):
+        self.asker = self.create_user(
+                            username = 'asker',
+                            notification_schedule = {'q_ask': 'i'}
+                        )
+        self.answerer = self.create_user(
+                            username = 'answerer',
+                            notification_schedule = {'q_ans': 'w'}
+                        )
+        #does not subscribe to the entire forum
+        self.reader = self.create_user(username = 'reader')
+        self.question = self.post_question(user = self.asker)
+
+    def get_subscribers(self, post):
+        return post.get_instant_notification_subscribers(
+                                    potential_subscribers = set(),
+                                    mentioned_users = set(),
+                                    exclude_list = set()
+                                )
+
+    def test_schedules_are_cached(self):
+        user_ids = [self.asker.id, self.reader.id]
+        schedules = models.EmailFeedSetting.objects.get_schedules(user_ids)
+        self.assertEqual(schedules[self.asker.id]['q_ask'], 'i')
+        self.assertNumQueries(
+            0, models.EmailFeedSetting.objects.get_schedules, user_ids
+        )
+
+    def test_subscribers(self):
+        answer = self.post_answer(user = self.answerer, question = self.question)
+        self.assertEqual(self.get_subscribers(answer), set([self.asker]))
+
+        #change of the subscription clears the cached schedule
+        feed = models.EmailFeedSetting.objects.get(
+                                    subscriber = self.answerer,
+                                    feed_type = 'q_ans'
+                                )
+        feed.frequency = 'i'
+        feed.save()
+        self.assertEqual(
+            self.get_subscribers(answer),
+            set([self.asker, self.answerer])
+        )
+
+    def test_forum_subscribers_must_subscribe_to_instant_emails(self):
+        self.reader.email_tag_filter_strategy = const.INCLUDE_ALL
+        self.reader.save()
+        self.assertFalse(self.reader in self.get_subscribers(self.question))
+        self.reader.notification_subscriptions.filter(
+                                            feed_type = 'q_all'
+                                        ).update(frequency = 'i')
+        self.assertTrue(self.reader in self.get_subscribers(self.question))
+
+
 class GlobalTagSubscriberGetterTests(AskbotTestCase):
     """tests for the :meth:`~askbot.models.Question.get_global_tag_based_subscribers`
     """
@@ -369,6 +427,28 @@ class GlobalTagSubscriberGetterTests(AskbotTestCase):
             reason = 'bad'
         )
 
+    def test_wildcard_index_follows_user_selections(self):
+        """wildcard index is updated when the user
+        adds and removes wildcards"""
+        self.set_email_tag_filter_strategy(const.INCLUDE_INTERESTING)
+        askbot_settings.update('USE_WILDCARD_TAGS', True)
+        self.u1.mark_tags(wildcards = ('*',), reason = 'good', action = 'add')
+        self.u2.mark_tags(wildcards = ('go*',), reason = 'bad', action = 'add')
+        self.u2.mark_tags(wildcards = ('go*',), reason = 'good', action = 'add')
+        self.assert_subscribers_are(
+            expected_subscribers = set([self.u1, self.u2]),
+            reason = 'good'
+        )
+        self.assertEquals(
+            models.WildcardTagPrefix.objects.filter(user = self.u2).count(),
+            1
+        )
+        self.u1.mark_tags(wildcards = ('*',), reason = 'good', action = 'remove')
+        self.assert_subscribers_are(
+            expected_subscribers = set([self.u2,]),
+            reason = 'good'
+        )
+
 class CommentTests(AskbotTestCase):
     """unfortunately, not very useful tests,
     as assertions of type "user can" are not inside
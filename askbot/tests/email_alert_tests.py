@@ -2,10 +2,16 @@ import datetime
 import functools
 import copy
 import time
+import os
+import shutil
+import smtplib
+import tempfile
+from StringIO import StringIO
 from django.conf import settings as django_settings
 from django.core import management
 from django.core import serializers
 import django.core.mail
+from django.core.mail.backends import locmem
 from django.core.urlresolvers import reverse
 from django.test import TestCase
 from django.test.client import Client
@@ -800,6 +806,50 @@ class TagFollowedInstantWholeForumEmailAlertTests(utils.AskbotTestCase):
             self.user1.email in outbox[0].recipients()
         )
 
+class ChunkedDelayedEmailAlertTests(utils.AskbotTestCase):
+    """digests are built for chunks of users"""
+    def setUp(self):
+        self.create_user(
+            username = 'user1',
+            notification_schedule = {'q_all': 'w'},
+        )
+        self.create_user(
+            username = 'user2',
+            notification_schedule = {'q_all': 'w'},
+        )
+        self.create_user(username = 'user3')
+
+    def test_users_in_separate_chunks_receive_digests(self):
+        self.post_question(user = self.user3, tags = 'one two')
+        management.call_command('send_email_alerts', chunk_size = 1)
+        outbox = django.core.mail.outbox
+        recipients = set([message.recipients()[0] for message in outbox])
+        self.assertEqual(
+            recipients,
+            set([self.user1.email, self.user2.email])
+        )
+        #feeds are marked reported, so the digests are not repeated
+        management.call_command('send_email_alerts', chunk_size = 1)
+        self.assertEqual(len(django.core.mail.outbox), 2)
+
+    def test_ignored_tags_are_excluded(self):
+        self.user1.email_tag_filter_strategy = const.EXCLUDE_IGNORED
+        self.user1.save()
+        self.post_question(user = self.user3, tags = 'one two')
+        self.user1.mark_tags(tagnames = ('one',), reason = 'bad', action = 'add')
+        management.call_command('send_email_alerts')
+        outbox = django.core.mail.outbox
+        self.assertEqual(len(outbox), 1)
+        self.assertEqual(outbox[0].recipients(), [self.user2.email])
+
+    def test_phase_timings_are_reported(self):
+        output = StringIO()
+        management.call_command(
+            'send_email_alerts', verbosity = 2, stdout = output
+        )
+        self.assertTrue('subscriptions' in output.getvalue())
+        self.assertTrue('total' in output.getvalue())
+
 class EmailReminderTestCase(utils.AskbotTestCase):
     #subclass must define these (example below)
     #enable_setting_name = 'ENABLE_UNANSWERED_REMINDERS'
@@ -1017,3 +1067,146 @@ class MailMessagesTests(utils.AskbotTestCase):
         user = self.create_user('user')
         message = messages.ask_for_signature(user, footer_code = 'nothing')
         self.assertTrue(user.username in message)
+
+
+class CountingEmailBackend(locmem.EmailBackend):
+    """email backend which counts opened connections
+    and can simulate failures of the mail server"""
+    opened_count = 0
+    errors = list()
+
+    def __init__(self, *args, **kwargs):
+        super(CountingEmailBackend, self).__init__(*args, **kwargs)
+        self.is_open = False
+
+    def open(self):
+        if not self.is_open:
+            self.is_open = True
+            CountingEmailBackend.opened_count += 1
+
+    def close(self):
+        self.is_open = False
+
+    def send_messages(self, messages):
+        if CountingEmailBackend.errors:
+            raise CountingEmailBackend.errors.pop(0)
+        return super(CountingEmailBackend, self).send_messages(messages)
+
+
+class MailDeliveryTests(TestCase):
+    def setUp(self):
+        self.old_backend = django_settings.EMAIL_BACKEND
+        django_settings.EMAIL_BACKEND = \
+            'askbot.tests.email_alert_tests.CountingEmailBackend'
+        CountingEmailBackend.opened_count = 0
+        CountingEmailBackend.errors = list()
+        self.old_messages_per_connection = mail.MESSAGES_PER_CONNECTION
+        self.old_retry_delay = mail.RETRY_DELAY
+        mail.RETRY_DELAY = 0
+
+    def tearDown(self):
+        django_settings.EMAIL_BACKEND = self.old_backend
+        mail.MESSAGES_PER_CONNECTION = self.old_messages_per_connection
+        mail.RETRY_DELAY = self.old_retry_delay
+
+    def build_messages(self, count):
+        return [
+            mail.build_message(
+                subject_line = 'subject %d' % number,
+                body_text = 'body',
+                recipient_list = ['user%d@example.com' % number]
+            ) for number in range(count)
+        ]
+
+    def test_connection_is_reused_for_batch(self):
+        mail.MESSAGES_PER_CONNECTION = 2
+        failures = mail.send_messages(self.build_messages(5))
+        self.assertEqual(failures, [])
+        self.assertEqual(len(django.core.mail.outbox), 5)
+        self.assertEqual(CountingEmailBackend.opened_count, 3)
+
+    def test_transient_failure_is_retried(self):
+        CountingEmailBackend.errors = [smtplib.SMTPServerDisconnected()]
+        failures = mail.send_messages(
+                            self.build_messages(2),
+                            retries = mail.SEND_RETRIES
+                        )
+        self.assertEqual(failures, [])
+        self.assertEqual(len(django.core.mail.outbox), 2)
+        self.assertEqual(CountingEmailBackend.opened_count, 2)
+
+    def test_transient_failure_is_not_retried_by_default(self):
+        mail.RETRY_DELAY = 60
+        CountingEmailBackend.errors = [smtplib.SMTPServerDisconnected()]
+        start_time = time.time()
+        failures = mail.send_messages(self.build_messages(2))
+        self.assertTrue(time.time() - start_time < 5)
+        self.assertEqual(len(failures), 1)
+        self.assertEqual(failures[0][0].to, ['user0@example.com'])
+        self.assertEqual(len(django.core.mail.outbox), 1)
+
+    def test_permanent_failure_is_not_retried(self):
+        CountingEmailBackend.errors = [
+            smtplib.SMTPRecipientsRefused({'user0@example.com': (550, 'no')})
+        ]
+        failures = mail.send_messages(self.build_messages(2))
+        self.assertEqual(len(failures), 1)
+        self.assertEqual(failures[0][0].to, ['user0@example.com'])
+        self.assertEqual(len(django.core.mail.outbox), 1)
+
+    def test_messages_are_spooled_to_outbox(self):
+        outbox_dir = tempfile.mkdtemp()
+        django_settings.ASKBOT_EMAIL_OUTBOX_DIR = outbox_dir
+        try:
+            mail.send_mail(
+                subject_line = 'subject',
+                body_text = 'body',
+                recipient_list = ['user@example.com']
+            )
+            self.assertEqual(len(django.core.mail.outbox), 0)
+            self.assertEqual(len(os.listdir(outbox_dir)), 1)
+            self.assertEqual(mail.send_spooled_messages(), 1)
+            self.assertEqual(len(django.core.mail.outbox), 1)
+            self.assertEqual(os.listdir(outbox_dir), [])
+        finally:
+            del django_settings.ASKBOT_EMAIL_OUTBOX_DIR
+            shutil.rmtree(outbox_dir)
+
+    def test_unreadable_spooled_message_is_failed(self):
+        outbox_dir = tempfile.mkdtemp()
+        try:
+            mail.spool_messages(self.build_messages(2), outbox_dir)
+            broken_file = open(os.path.join(outbox_dir, '0-broken.msg'), 'wb')
+            broken_file.write('not a pickle')
+            broken_file.close()
+            self.assertEqual(mail.send_spooled_messages(outbox_dir), 2)
+            self.assertEqual(len(django.core.mail.outbox), 2)
+            self.assertEqual(os.listdir(outbox_dir), ['0-broken.failed'])
+        finally:
+            shutil.rmtree(outbox_dir)
+
+    def test_stale_claimed_message_is_sent(self):
+        outbox_dir = tempfile.mkdtemp()
+        try:
+            mail.spool_messages(self.build_messages(2), outbox_dir)
+            #both messages were claimed by the workers,
+            #one of which was stopped long ago
+            names = sorted(os.listdir(outbox_dir))
+            for name in names:
+                path = os.path.join(outbox_dir, name)
+                os.rename(path, path[:-4] + mail.SENDING_MESSAGE_SUFFIX)
+            stale_path = os.path.join(
+                            outbox_dir,
+                            names[0][:-4] + mail.SENDING_MESSAGE_SUFFIX
+                        )
+            stale_time = time.time() - mail.SENDING_TIMEOUT - 1
+            os.utime(stale_path, (stale_time, stale_time))
+
+            self.assertEqual(mail.send_spooled_messages(outbox_dir), 1)
+            self.assertEqual(django.core.mail.outbox[0].to, ['user0@example.com'])
+            self.assertEqual(
+                os.listdir(outbox_dir),
+                [names[1][:-4] + mail.SENDING_MESSAGE_SUFFIX]
+            )
+        finally:
+            shutil.rmtree(outbox_dir)
@@ -1,7 +1,11 @@
+import copy
+from StringIO import StringIO
 from django.core import management
 from django.contrib import auth
+from django.utils import simplejson
 from askbot.tests.utils import AskbotTestCase
 from askbot import models
+from askbot.management.commands import askbot_benchmark
 
 class ManagementCommandTests(AskbotTestCase):
     def test_add_askbot_user(self):
@@ -51,3 +55,70 @@ class ManagementCommandTests(AskbotTestCase):
         user_two = models.User.objects.get(pk=2)
         self.assertEqual(user_two.gold, number_of_gold) 
         self.assertEqual(user_two.reputation, reputation)
+
+
+    def run_benchmark(self, **options):
+        output = StringIO()
+        management.call_command(
+                        'askbot_benchmark',
+                        interactive = False,
+                        users = 5,
+                        threads = 6,
+                        tags = 4,
+                        groups = 1,
+                        requests = 2,
+                        alert_runs = 1,
+                        stdout = output,
+                        **options
+                    )
+        return simplejson.loads(output.getvalue())
+
+    def test_askbot_benchmark(self):
+        report = self.run_benchmark()
+        self.assertEqual(
+            sorted(report['scenarios'].keys()),
+            sorted(askbot_benchmark.SCENARIOS)
+        )
+        for name, scenario in report['scenarios'].items():
+            self.assertEqual(scenario['errors'], 0, name)
+            self.assertTrue(scenario['queries']['max'] > 0, name)
+            self.assertTrue(
+                scenario['latency_ms']['p50'] <= scenario['latency_ms']['p99']
+            )
+        #denormalized counts follow the generated content
+        self.assertEqual(models.Thread.objects.count(), 6)
+        for thread in models.Thread.objects.all():
+            answers = thread.posts.get_answers().filter(deleted = False)
+            self.assertEqual(thread.answer_count, answers.count())
+            question = thread._question_post()
+            self.assertEqual(
+                question.comment_count,
+                models.Post.objects.get_comments().filter(
+                                            parent = question
+                                        ).count()
+            )
+            self.assertEqual(question.score, thread.score)
+        for tag in models.Tag.objects.all():
+            self.assertEqual(tag.used_count, tag.threads.count())
+        #answers were posted by the runner of the benchmark
+        runner = models.User.objects.get(username__startswith = 'benchmark_runner')
+        self.assertEqual(runner.posts.get_answers().count(), 2)
+
+    def test_askbot_benchmark_baseline(self):
+        report = {'scenarios': {
+            'vote': {
+                'latency_ms': {'p50': 10.0, 'p90': 20.0},
+                'queries': {'mean': 10.0}
+            },
+            'answer': {
+                'latency_ms': {'p50': 10.0, 'p90': 20.0},
+                'queries': {'mean': 10.0}
+            },
+        }}
+        baseline = copy.deepcopy(report)
+        baseline['scenarios']['vote']['queries']['mean'] = 5.0
+        regressions = askbot_benchmark.compare_reports(report, baseline, 20)
+        self.assertEqual(regressions, ['vote'])
+        changes = report['scenarios']['vote']['change_from_baseline']
+        self.assertEqual(changes['queries_mean'], 100.0)
+        self.assertEqual(changes['latency_ms_p50'], 0.0)
@@ -1,5 +1,8 @@
 from django.conf import settings as django_settings
+from django.core import cache
+from django.db import connection
 from askbot.tests.utils import AskbotTestCase
+from askbot.conf import settings as askbot_settings
 from askbot.utils import markup
 
 class MarkupTest(AskbotTestCase):
@@ -22,3 +25,52 @@ class MarkupTest(AskbotTestCase):
         text = "oh hai @user1 how are you?"
         output = markup.extract_mentioned_name_seeds(text)
         self.assertEquals(output, set(['user1']))
+
+    def test_parser_is_reused_until_settings_change(self):
+        version = askbot_settings.get_snapshot_version()
+        self.assertNotEqual(version, None)
+        parser = markup.get_parser()
+        self.assertTrue(markup.get_parser() is parser)
+        backup = askbot_settings.ENABLE_AUTO_LINKING
+        askbot_settings.update('ENABLE_AUTO_LINKING', not backup)
+        try:
+            #each change of the settings makes a new unique version
+            self.assertNotEqual(askbot_settings.get_snapshot_version(), version)
+            self.assertFalse(markup.get_parser() is parser)
+        finally:
+            askbot_settings.update('ENABLE_AUTO_LINKING', backup)
+        self.assertNotEqual(askbot_settings.get_snapshot_version(), version)
+
+    def test_markdown_to_html_is_cached(self):
+        text = 'some *emphasized* text'
+        key = markup.get_html_cache_key(text)
+        cache.cache.delete(key)
+        html = markup.markdown_to_html(text)
+        self.assertEqual(html, '<p>some <em>emphasized</em> text</p>\n')
+        self.assertEqual(cache.cache.get(key), html)
+        cache.cache.set(key, 'cached html')
+        self.assertEqual(markup.markdown_to_html(text), 'cached html')
+
+    def count_queries(self, func):
+        old_debug_cursor = connection.use_debug_cursor
+        connection.use_debug_cursor = True
+        start = len(connection.queries)
+        try:
+            func()
+        finally:
+            connection.use_debug_cursor = old_debug_cursor
+        return len(connection.queries) - start
+
+    def test_mentions_are_found_with_one_query(self):
+        self.create_user('user2')
+        question = self.post_question(user = self.u1)
+        question.text = 'hi @user2'
+        count = self.count_queries(question.parse_post_text)
+        question.text = 'hi @user2 and @someone and @nobody'
+        self.assertNumQueries(count, question.parse_post_text)
+        question.text = 'hi @user2'
+        data = question.parse_post_text()
+        self.assertEqual(
+            [user.username for user in data['newly_mentioned_users']],
+            ['user2']
+        )
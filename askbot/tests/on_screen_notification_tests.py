@@ -13,6 +13,7 @@ from django.test import TestCase
 from askbot import models
 from askbot import const
 from askbot.tests.utils import create_user
+from askbot.tests.utils import AskbotTestCase
 
 
 def get_re_notif_after(timestamp):
@@ -622,3 +623,120 @@ class OnScreenUpdateNotificationTests(TestCase):
         )
 
 
+
+
+class InboxResponseCountTests(AskbotTestCase):
+    """tests of the incremental updates of the response counts"""
+
+    def setUp(self):
+        self.asker = self.create_user('asker')
+        self.responder = self.create_user('responder', status = 'm')
+        self.question = self.post_question(user = self.asker)
+
+    def get_counts(self):
+        user = models.User.objects.get(id = self.asker.id)
+        return user.new_response_count, user.seen_response_count
+
+    def get_memos(self):
+        return models.ActivityAuditStatus.objects.filter(user = self.asker)
+
+    def test_response_increments_new_count(self):
+        self.post_answer(user = self.responder, question = self.question)
+        self.assertEqual(self.get_counts(), (1, 0))
+        self.post_comment(user = self.responder, parent_post = self.question)
+        self.assertEqual(self.get_counts(), (2, 0))
+
+    def test_set_status_moves_responses(self):
+        self.post_answer(user = self.responder, question = self.question)
+        self.post_comment(user = self.responder, parent_post = self.question)
+        memos = self.get_memos()
+        manager = models.ActivityAuditStatus.objects
+        seen = models.ActivityAuditStatus.STATUS_SEEN
+        self.assertEqual(manager.set_status(memos, seen), 2)
+        self.assertEqual(self.get_counts(), (0, 2))
+        #statuses that are already set are not counted again
+        self.assertEqual(manager.set_status(memos, seen), 0)
+        self.assertEqual(self.get_counts(), (0, 2))
+        new = models.ActivityAuditStatus.STATUS_NEW
+        manager.set_status(memos.filter(id = memos[0].id), new)
+        self.assertEqual(self.get_counts(), (1, 1))
+
+    def test_delete_responses_decrements_counts(self):
+        self.post_answer(user = self.responder, question = self.question)
+        self.post_comment(user = self.responder, parent_post = self.question)
+        models.ActivityAuditStatus.objects.delete_responses(self.get_memos())
+        self.assertEqual(self.get_counts(), (0, 0))
+
+    def test_deleted_comment_decrements_count(self):
+        comment = self.post_comment(
+                            user = self.responder,
+                            parent_post = self.question
+                        )
+        self.assertEqual(self.get_counts(), (1, 0))
+        comment.delete()
+        self.assertEqual(self.get_counts(), (0, 0))
+
+    def test_recount_fixes_drift(self):
+        self.post_answer(user = self.responder, question = self.question)
+        models.User.objects.filter(id = self.asker.id).update(
+            new_response_count = 5, seen_response_count = 3
+        )
+        self.asker.update_response_counts()
+        self.assertEqual(self.get_counts(), (1, 0))
+
+
+class ActivityFanOutTests(AskbotTestCase):
+    """tests of the bulk creation of the activity recipients"""
+
+    def setUp(self):
+        self.author = self.create_user('author')
+        self.question = self.post_question(user = self.author)
+        self.users = [
+            self.create_user('reader%d' % number) for number in range(3)
+        ]
+
+    def create_mentions(self, users):
+        return models.Activity.objects.create_new_mentions(
+                        mentioned_by = self.author,
+                        mentioned_whom = users,
+                        mentioned_in = self.question,
+                        mentioned_at = datetime.datetime.now()
+                    )
+
+    def test_mentions_are_created_for_each_user(self):
+        activities = self.create_mentions(self.users)
+        self.assertEqual(len(activities), 3)
+        mentioned_users = set([
+            activity.get_mentioned_user() for activity in activities
+        ])
+        self.assertEqual(mentioned_users, set(self.users))
+        for user in self.users:
+            user = models.User.objects.get(id = user.id)
+            self.assertEqual(user.new_response_count, 1)
+            mentions = models.Activity.objects.get_mentions(
+                                                mentioned_whom = user,
+                                                mentioned_in = self.question
+                                            )
+            self.assertEqual(mentions.count(), 1)
+
+    def test_number_of_queries_does_not_depend_on_recipients(self):
+        activity = models.Activity(
+                        user = self.author,
+                        activity_type = const.TYPE_ACTIVITY_ANSWER,
+                        content_object = self.question
+                    )
+        activity.save()
+        self.assertNumQueries(2, activity.add_recipients, self.users[:1])
+        self.assertNumQueries(2, activity.add_recipients, self.users[1:])
+        self.assertEqual(
+            models.User.objects.filter(
+                id__in = [user.id for user in self.users],
+                new_response_count = 1
+            ).count(),
+            3
+        )
+        #mentions are counted the same way
+        self.assertNumQueries(
+            4, self.create_mentions, [self.create_user('other1')]
+        )
+        self.assertNumQueries(4, self.create_mentions, self.users)
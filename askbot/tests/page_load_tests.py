@@ -1,6 +1,8 @@
+import datetime
 from askbot.search.state_manager import SearchState
 from django.test import signals
 from django.conf import settings
+from django.contrib.auth.models import AnonymousUser
 from django.core.urlresolvers import reverse
 from django.core import management
 from django.core.cache.backends.dummy import DummyCache
@@ -12,6 +14,7 @@ import coffin.template
 
 from askbot import models
 from askbot.utils.slug import slugify
+from askbot.utils import response_cache
 from askbot.deployment import package_utils
 from askbot.tests.utils import AskbotTestCase
 from askbot.conf import settings as askbot_settings
@@ -568,9 +571,241 @@ class AvatarTests(AskbotTestCase):
                             )
 
 
+class KeysetPaginationTests(AskbotTestCase):
+
+    def setUp(self):
+        #question counts cached by the other tests are not used
+        self.use_private_cache()
+        self.user = self.create_user()
+        start = datetime.datetime(2012, 1, 1)
+        self.threads = list()
+        for i in range(11):
+            question = self.post_question(
+                            title='question %d' % i,
+                            timestamp=start + datetime.timedelta(hours=i % 4)
+                        )
+            #some threads share values of the sort columns
+            models.Thread.objects.filter(id=question.thread_id).update(
+                                                score=i % 3,
+                                                answer_count=i % 2
+                                            )
+            self.threads.append(question.thread_id)
+
+    def get_search_state(self, sort):
+        return SearchState(
+            scope='all', sort=sort, query=None, tags=None,
+            author=None, page=None, user_logged_in=False
+        )
+
+    def get_expected_ids(self, sort):
+        orderby = models.question.QUESTION_ORDER_BY_MAP[sort]
+        field_name = orderby.lstrip('-')
+        threads = models.Thread.objects.filter(id__in=self.threads)
+        keys = [(getattr(thread, field_name), thread.id) for thread in threads]
+        keys.sort(reverse=orderby.startswith('-'))
+        return [thread_id for value, thread_id in keys]
+
+    def test_cursors_walk_all_threads(self):
+        for sort in models.question.KEYSET_SORT_METHODS:
+            qs, meta_data = models.Thread.objects.run_advanced_search(
+                                request_user=AnonymousUser(),
+                                search_state=self.get_search_state(sort)
+                            )
+            forward_ids = list()
+            cursor = None
+            pages = list()
+            while True:
+                page = models.Thread.objects.get_keyset_page(
+                            qs, sort=sort, cursor=cursor, page_size=3
+                        )
+                pages.append(page)
+                forward_ids.extend([thread.id for thread in page.object_list])
+                if not page.has_next:
+                    break
+                cursor = page.next_cursor
+            self.assertEqual(forward_ids, self.get_expected_ids(sort))
+            self.assertEqual(len(pages), 4)
+            self.assertFalse(pages[0].has_previous)
+
+            backward_ids = list()
+            page = pages[-1]
+            while page.has_previous:
+                page = models.Thread.objects.get_keyset_page(
+                            qs, sort=sort, cursor=page.previous_cursor,
+                            page_size=3
+                        )
+                backward_ids = [t.id for t in page.object_list] + backward_ids
+            self.assertEqual(backward_ids, forward_ids[:9])
+
+    @with_settings({'DEFAULT_QUESTIONS_PAGE_SIZE': '10'})
+    def test_questions_page_links_to_cursors(self):
+        settings.ASKBOT_QUESTIONS_KEYSET_PAGINATION = True
+        try:
+            response = self.client.get(reverse('questions'))
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.context['questions_count'], 11)
+            next_cursor = response.context['keyset_page'].next_cursor
+            self.assertTrue(('cursor:%s/' % next_cursor) in response.content)
+
+            search_state = response.context['search_state']
+            url = search_state.change_cursor(next_cursor).full_url()
+            response = self.client.get(url, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+            data = simplejson.loads(response.content)
+            self.assertTrue('cursor:b.' in data['paginator'])
+            self.assertTrue('question 0' in data['questions'])
+        finally:
+            settings.ASKBOT_QUESTIONS_KEYSET_PAGINATION = False
+
+    def test_question_count_is_cached(self):
+        search_state = self.get_search_state('age-desc')
+        anon = AnonymousUser()
+        qs, meta_data = models.Thread.objects.run_advanced_search(
+                                request_user=anon, search_state=search_state
+                            )
+        self.assertEqual(
+            models.Thread.objects.get_cached_count(
+                qs, search_state=search_state, request_user=anon
+            ),
+            11
+        )
+        self.post_question()
+        self.assertNumQueries(
+            0, models.Thread.objects.get_cached_count,
+            qs, search_state=search_state, request_user=anon
+        )
+        self.assertEqual(
+            models.Thread.objects.refresh_cached_count(
+                search_state=search_state, request_user=anon
+            ),
+            12
+        )
+
+
+class SearchResultCacheTests(AskbotTestCase):
+
+    def setUp(self):
+        self.use_private_cache()
+        self.user = self.create_user()
+        self.questions = list()
+        for i in range(5):
+            self.questions.append(self.post_question(title='question %d' % i))
+
+    def get_search_state(self, scope='all', page=None):
+        return SearchState(
+            scope=scope, sort='age-desc', query=None, tags=None,
+            author=None, page=page, user_logged_in=True
+        )
+
+    def get_page(self, search_state, user=None):
+        paginator, page, meta_data = models.Thread.objects.get_search_page(
+                                            request_user=user or AnonymousUser(),
+                                            search_state=search_state,
+                                            page_size=2
+                                        )
+        return paginator.count, page.number, [t.title for t in page.object_list]
+
+    def test_page_is_taken_from_cache(self):
+        search_state = self.get_search_state(page=2)
+        expected = (5, 2, ['question 2', 'question 1'])
+        self.assertEqual(self.get_page(search_state), expected)
+        #one query loads the threads of the cached page
+        self.assertNumQueries(1, self.get_page, search_state)
+        self.assertEqual(self.get_page(search_state), expected)
+
+    def test_new_content_invalidates_cache(self):
+        search_state = self.get_search_state()
+        self.assertEqual(
+            self.get_page(search_state), (5, 1, ['question 4', 'question 3'])
+        )
+        self.post_question(title='question 5')
+        self.assertEqual(
+            self.get_page(search_state), (6, 1, ['question 5', 'question 4'])
+        )
+
+    def test_results_are_cached_per_visibility_class(self):
+        search_state = self.get_search_state()
+        anon = AnonymousUser()
+        anon_key = models.question.get_search_result_cache_key(
+                                                search_state, anon, 2
+                                            )
+        user_key = models.question.get_search_result_cache_key(
+                                                search_state, self.user, 2
+                                            )
+        self.assertNotEqual(anon_key, user_key)
+        self.assertEqual(
+            models.question.get_search_result_cache_key(
+                self.get_search_state(scope='favorite'), self.user, 2
+            ),
+            None
+        )
+        self.get_page(search_state, user=self.user)
+        self.assertNotEqual(cache.cache.get(user_key), None)
+        self.assertEqual(cache.cache.get(anon_key), None)
+
+    def test_out_of_range_page_is_replaced_by_first(self):
+        self.assertEqual(
+            self.get_page(self.get_search_state(page=10)),
+            (5, 1, ['question 4', 'question 3'])
+        )
+
+
+class AnonymousResponseCacheTests(AskbotTestCase):
+
+    def setUp(self):
+        self.use_private_cache()
+        self.user = self.create_user()
+        self.question = self.post_question(title='cached question')
+        self.url = self.question.get_absolute_url()
+        #the greeting message shown on the first visit
+        #makes the page not cacheable
+        self.client.get(reverse('faq'))
+
+    def test_question_page_is_cached_until_thread_changes(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.context, None)
+        etag = response['ETag']
+        self.assertTrue(response.has_header('Last-Modified'))
+
+        response = self.client.get(self.url)
+        self.assertEqual(response.context, None)
+        self.assertEqual(response['ETag'], etag)
+
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        self.post_answer(question=self.question, body_text='a fresh answer')
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertTrue('a fresh answer' in response.content)
+
+    def test_question_list_is_cached_until_content_changes(self):
+        url = reverse('questions')
+        response = self.client.get(url)
+        self.assertNotEqual(response.context, None)
+        response = self.client.get(url)
+        self.assertEqual(response.context, None)
+        self.assertTrue('cached question' in response.content)
+
+        self.post_question(title='another question')
+        response = self.client.get(url)
+        self.assertTrue('another question' in response.content)
+
+    def test_pages_of_registered_users_are_not_cached(self):
+        self.client.login(method='force', user_id=self.user.id)
+        response = self.client.get(self.url)
+        self.assertFalse(response.has_header('ETag'))
+        response = self.client.get(self.url)
+        self.assertNotEqual(response.context, None)
+
+
 class QuestionPageRedirectTests(AskbotTestCase):
 
     def setUp(self):
+        #pages are loaded repeatedly to inspect the context
+        self.old_timeout = response_cache.RESPONSE_CACHE_TIMEOUT
+        response_cache.RESPONSE_CACHE_TIMEOUT = 0
         self.create_user()
 
         self.q = self.post_question()
@@ -585,6 +820,9 @@ class QuestionPageRedirectTests(AskbotTestCase):
         self.c.old_comment_id = 301
         self.c.save()
 
+    def tearDown(self):
+        response_cache.RESPONSE_CACHE_TIMEOUT = self.old_timeout
+
     def test_show_bare_question(self):
         resp = self.client.get(self.q.get_absolute_url())
         self.assertEqual(200, resp.status_code)
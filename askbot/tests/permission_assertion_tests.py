@@ -4,8 +4,10 @@ from django.core.urlresolvers import reverse
 from django.conf import settings
 from django.test import TestCase
 from django.core import exceptions
+from django.utils import simplejson
 from askbot.tests import utils
 from askbot.conf import settings as askbot_settings
+from askbot import exceptions as askbot_exceptions
 from askbot import models
 from askbot.templatetags import extra_filters_jinja as template_filters
 from askbot.tests.utils import skipIf, AskbotTestCase
@@ -1618,3 +1620,144 @@ class ClosedForumTests(utils.AskbotTestCase):
         self.client.login(username=self.other_user.username, password=self.password)
         response = self.client.get(self.test_url)
         self.assertEquals(response.status_code, 200)
+
+
+class PostPermissionMatrixTests(utils.AskbotTestCase):
+    """the batch evaluated permissions must agree
+    with the permission assertions"""
+
+    ASSERTIONS = {
+        'question': (
+            'close_question', 'delete_post', 'edit_post',
+            'flag_offensive', 'post_comment', 'remove_all_flags_offensive',
+            'remove_flag_offensive', 'reopen_question', 'retag_question',
+        ),
+        'answer': (
+            'accept_best_answer', 'delete_post', 'edit_post',
+            'flag_offensive', 'post_comment', 'remove_all_flags_offensive',
+            'remove_flag_offensive',
+        ),
+        'comment': (
+            'delete_comment', 'delete_post', 'edit_comment', 'edit_post',
+            'flag_offensive', 'remove_all_flags_offensive',
+            'remove_flag_offensive',
+        ),
+    }
+
+    def setUp(self):
+        self.create_user()
+        self.create_user(username = 'other_user', status = 'm')
+        self.create_user(username = 'third_user')
+        self.question = self.post_question()
+        self.answer = self.post_answer(question = self.question)
+        self.other_answer = self.post_answer(
+                                    question = self.question,
+                                    user = self.other_user
+                                )
+        models.Post.objects.filter(id = self.other_answer.id).update(score = 1)
+        self.wiki_question = self.post_question(
+                                    user = self.other_user,
+                                    wiki = True
+                                )
+        old_timestamp = datetime.datetime.now() - datetime.timedelta(1)
+        self.old_comment = self.post_comment(
+                                    parent_post = self.question,
+                                    timestamp = old_timestamp
+                                )
+        #the old comment is not the last one
+        self.post_comment(parent_post = self.question, user = self.other_user)
+        self.comment = self.post_comment(
+                                    parent_post = self.answer,
+                                    user = self.other_user
+                                )
+        self.other_user.flag_post(self.question)
+        self.other_user.flag_post(self.other_answer)
+        self.other_user.set_status('a')
+        self.other_user.save()
+
+    def get_posts(self):
+        post_ids = (
+            self.question.id, self.answer.id, self.other_answer.id,
+            self.wiki_question.id, self.old_comment.id, self.comment.id,
+        )
+        return list(models.Post.objects.filter(id__in = post_ids))
+
+    def is_allowed(self, user, action, post):
+        assertion = getattr(user, 'assert_can_' + action)
+        try:
+            assertion(post)
+        except askbot_exceptions.DuplicateCommand:
+            #the flag control is shown on the flagged posts
+            return action == 'flag_offensive'
+        except exceptions.PermissionDenied:
+            return False
+        return True
+
+    def assert_matrix_matches_assertions(self, user):
+        posts = self.get_posts()
+        permissions = models.get_post_permissions(user, posts)
+        for post in posts:
+            for action in self.ASSERTIONS[post.post_type]:
+                self.assertEqual(
+                    action in permissions[post.id],
+                    self.is_allowed(user, action, post),
+                    '%s %s %s' % (user.username, action, post.post_type)
+                )
+
+    def test_matrix_matches_assertions(self):
+        for user in (self.user, self.other_user, self.third_user):
+            for status in ('a', 'w', 's', 'b', 'm', 'admin'):
+                for reputation in (1, 100000):
+                    if status == 'admin':
+                        user.set_status('a')
+                        user.set_admin_status()
+                    else:
+                        user.remove_admin_status()
+                        user.set_status(status)
+                    user.reputation = reputation
+                    user.save()
+                    self.assert_matrix_matches_assertions(user)
+
+    def test_anonymous_user_cannot_act(self):
+        from django.contrib.auth.models import AnonymousUser
+        permissions = models.get_post_permissions(
+                                            AnonymousUser(),
+                                            self.get_posts()
+                                        )
+        self.assertEqual(set().union(*permissions.values()), set())
+
+    def test_filters_read_precached_permissions(self):
+        posts = self.get_posts()
+        self.third_user.reputation = 100000
+        self.third_user.precache_post_permissions(posts)
+        def render_filters():
+            for post in posts:
+                template_filters.can_edit_post(self.third_user, post)
+                template_filters.can_flag_offensive(self.third_user, post)
+                template_filters.can_delete_post(self.third_user, post)
+        self.assertNumQueries(0, render_filters)
+
+    def test_permissions_are_evaluated_in_few_queries(self):
+        posts = self.get_posts()
+        self.user.reputation = 100000
+        self.assertNumQueries(
+            4, models.get_post_permissions, self.user, posts
+        )
+
+    def test_ajax_permissions(self):
+        self.user.set_password('pass')
+        self.user.save()
+        client = Client()
+        client.login(username = self.user.username, password = 'pass')
+        response = client.get(
+            reverse('get_post_permissions'),
+            {'post_ids': '%d,%d' % (self.question.id, self.comment.id)},
+            HTTP_X_REQUESTED_WITH = 'XMLHttpRequest'
+        )
+        data = simplejson.loads(response.content)
+        permissions = data['permissions']
+        self.assertEqual(set(permissions.keys()), set([
+            str(self.question.id), str(self.comment.id)
+        ]))
+        self.assertTrue('edit_post' in permissions[str(self.question.id)])
+        self.assertFalse('edit_comment' in permissions[str(self.comment.id)])
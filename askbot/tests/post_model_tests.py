@@ -1,24 +1,33 @@
 import copy
 import datetime
 from operator import attrgetter
+import os
+import tempfile
 import time
+from askbot.search import backends as search_backends
+from askbot.search import similarity
 from askbot.search.state_manager import SearchState
 from askbot.skins.loaders import get_template
 from django.contrib.auth.models import User
-from django.core import cache, urlresolvers
+from django.core import cache, management, urlresolvers
 from django.core.cache.backends.dummy import DummyCache
 from django.core.cache.backends.locmem import LocMemCache
 
 from django.core.exceptions import ValidationError
+from django.conf import settings as django_settings
 from askbot.tests.utils import AskbotTestCase
 from askbot.models import Post
 from askbot.models import PostRevision
 from askbot.models import Thread
+from askbot.models.question import VIEW_COUNT_BUFFER
 from askbot.models import Tag
+from askbot.models import TagCooccurrence
 from askbot.models import Group
 from askbot.search.state_manager import DummySearchState
 from django.utils import simplejson
 from askbot.conf import settings as askbot_settings
+from askbot.utils.diff import textDiff as htmldiff
+from askbot.utils.html import sanitize_html
 
 
 class PostModelTests(AskbotTestCase):
@@ -77,6 +86,46 @@ class PostModelTests(AskbotTestCase):
         self.assertEqual(3, question.revisions.all()[0].revision)
         self.assertEqual(3, question.revisions.count())
 
+    def test_post_revision_diff_is_stored(self):
+        question = self.post_question(user=self.u1, body_text='first text')
+        first = question.revisions.get(revision=1)
+        self.assertTrue('first text' in first.diff)
+        question.apply_edit(edited_by=self.u1, text='second text', comment='c')
+        second = question.revisions.get(revision=2)
+        self.assertEqual(
+            second.diff,
+            htmldiff(sanitize_html(first.html), sanitize_html(second.html))
+        )
+
+    def test_post_revision_diff_is_built_for_old_revisions(self):
+        question = self.post_question(user=self.u1, body_text='first text')
+        question.apply_edit(edited_by=self.u1, text='second text', comment='c')
+        question.revisions.update(diff=None)
+        management.call_command('build_revision_diffs')
+        second = question.revisions.get(revision=2)
+        self.assertEqual(second.diff, second.get_diff())
+        self.assertEqual(question.revisions.filter(diff=None).count(), 0)
+
+    def test_comment_revision_has_no_diff(self):
+        question = self.post_question(user=self.u1)
+        comment = self.post_comment(user=self.u1, parent_post=question)
+        revision = comment.revisions.get(revision=1)
+        self.assertEqual(revision.diff, None)
+        management.call_command('build_revision_diffs')
+        self.assertEqual(comment.revisions.get(revision=1).diff, None)
+
+    def test_revisions_view_reads_stored_diffs(self):
+        question = self.post_question(user=self.u1)
+        question.apply_edit(edited_by=self.u1, text='second text', comment='c')
+        question.revisions.filter(revision=2).update(diff='stored diff')
+        #diff of the first revision is computed on the first view
+        question.revisions.filter(revision=1).update(diff=None)
+        url = urlresolvers.reverse('question_revisions', args=(question.id,))
+        response = self.client.get(url)
+        self.assertTrue('stored diff' in response.content)
+        first = question.revisions.get(revision=1)
+        self.assertEqual(first.diff, first.get_diff())
+
     def test_comment_ordering_by_date(self):
         self.user = self.u1
         q = self.post_question()
@@ -211,6 +260,139 @@ class ThreadTagModelsTests(AskbotTestCase):
         self.assertListEqual([3, 2, 2, 2, 1], [t.local_used_count for t in tags])
         self.assertListEqual([3, 2, 2, 2, 2], [t.used_count for t in tags])
 
+    def test_related_tags_from_cooccurrence(self):
+        tags = Tag.objects.get_related_to_tags(['tag1'], [])
+        self.assertListEqual(
+            ['tag1', 'tag2', 'tag3', 'tag4', 'tag5', 'tag6'],
+            [t.name for t in tags]
+        )
+        self.assertListEqual([2, 2, 2, 1, 1, 1], [t.local_used_count for t in tags])
+
+        tags = Tag.objects.get_related_to_tags(['tag1', 'tag6'], ['tag2'])
+        self.assertListEqual(
+            ['tag1', 'tag3', 'tag6', 'tag4', 'tag5'], [t.name for t in tags]
+        )
+        self.assertListEqual([3, 3, 3, 2, 2], [t.local_used_count for t in tags])
+
+        self.q4.thread.retag(
+            retagged_by=self.q4.author,
+            retagged_at=datetime.datetime.now(),
+            tagnames='tag1 tag6'
+        )
+        tags = Tag.objects.get_related_to_tags(['tag1'], [])
+        self.assertListEqual(
+            ['tag1', 'tag2', 'tag3', 'tag6'], [t.name for t in tags]
+        )
+        self.assertListEqual([2, 1, 1, 1], [t.local_used_count for t in tags])
+
+        #recounting from scratch gives the same result
+        TagCooccurrence.objects.rebuild(
+            Thread.tags.through.objects.order_by(
+                'thread', 'tag'
+            ).values_list('thread', 'tag')
+        )
+        rebuilt_tags = Tag.objects.get_related_to_tags(['tag1'], [])
+        self.assertListEqual(
+            [(t.name, t.local_used_count) for t in tags],
+            [(t.name, t.local_used_count) for t in rebuilt_tags]
+        )
+
+    def test_related_tags_for_search_state(self):
+        search_state = SearchState.get_empty().add_tag('tag6')
+        tags = Tag.objects.get_related_to_search_state(
+            search_state=search_state,
+            threads=[self.q3.thread],
+            ignored_tag_names=[]
+        )
+        self.assertEqual(tags[0].name, 'tag6')
+        self.assertEqual(tags[0].local_used_count, 2)
+        self.assertEqual(len(tags), 6)
+
+        #free-text search counts tags of the given threads
+        search_state = SearchState(scope=None, sort=None, query='anything', tags='tag6', author=None, page=None, user_logged_in=None)
+        tags = Tag.objects.get_related_to_search_state(
+            search_state=search_state,
+            threads=[self.q3.thread],
+            ignored_tag_names=[]
+        )
+        self.assertListEqual(['tag6'], [t.name for t in tags])
+        self.assertListEqual([1], [t.local_used_count for t in tags])
+
+    def get_tag1_cooccurrence(self):
+        return [
+            (t.name, t.local_used_count)
+            for t in Tag.objects.get_related_to_tags(['tag1'], [])
+        ]
+
+    def test_cooccurrence_follows_deleted_threads(self):
+        before = self.get_tag1_cooccurrence()
+        admin = self.create_user('admin', status='d')
+        admin.delete_question(self.q4)
+        self.assertListEqual(
+            [('tag1', 1), ('tag2', 1), ('tag3', 1)],
+            self.get_tag1_cooccurrence()
+        )
+        #deleted threads are not counted by the rebuild
+        management.call_command('rebuild_tag_cooccurrence', verbosity=0)
+        self.assertListEqual(
+            [('tag1', 1), ('tag2', 1), ('tag3', 1)],
+            self.get_tag1_cooccurrence()
+        )
+
+        admin.restore_post(self.q4)
+        self.assertListEqual(before, self.get_tag1_cooccurrence())
+
+        Thread.objects.get(id=self.q4.thread_id).delete()
+        self.assertListEqual(
+            [('tag1', 1), ('tag2', 1), ('tag3', 1)],
+            self.get_tag1_cooccurrence()
+        )
+
+    def test_retag_of_deleted_question_is_not_counted(self):
+        admin = self.create_user('admin', status='d')
+        admin.delete_question(self.q4)
+        self.q4.thread.retag(
+            retagged_by=admin,
+            retagged_at=datetime.datetime.now(),
+            tagnames='tag1 tag2 tag3 tag4 tag5 tag6 tag7'
+        )
+        self.assertListEqual(
+            [('tag1', 1), ('tag2', 1), ('tag3', 1)],
+            self.get_tag1_cooccurrence()
+        )
+        admin.restore_post(self.q4)
+        after_restore = self.get_tag1_cooccurrence()
+        management.call_command('rebuild_tag_cooccurrence', verbosity=0)
+        self.assertListEqual(after_restore, self.get_tag1_cooccurrence())
+
+    def test_cooccurrence_count_does_not_go_below_zero(self):
+        tag_ids = list(
+            Tag.objects.filter(name__in=['tag1', 'tag2']).values_list('id', flat=True)
+        )
+        TagCooccurrence.objects.update_counts(tag_ids, [])
+        TagCooccurrence.objects.update_counts(tag_ids, [])
+        TagCooccurrence.objects.update_counts(tag_ids, [])
+        counts = TagCooccurrence.objects.filter(
+                                tag__in=tag_ids, related_tag__in=tag_ids
+                            ).values_list('count', flat=True)
+        self.assertEqual(set([0]), set(counts))
+
+    def test_related_tags_for_search_state_with_groups(self):
+        groups_enabled_backup = askbot_settings.GROUPS_ENABLED
+        askbot_settings.update('GROUPS_ENABLED', True)
+        try:
+            search_state = SearchState.get_empty().add_tag('tag6')
+            tags = Tag.objects.get_related_to_search_state(
+                search_state=search_state,
+                threads=[self.q3.thread],
+                ignored_tag_names=[]
+            )
+        finally:
+            askbot_settings.update('GROUPS_ENABLED', groups_enabled_backup)
+        #counted over the visible threads, not from the co-occurrence
+        self.assertListEqual(['tag6'], [t.name for t in tags])
+        self.assertListEqual([1], [t.local_used_count for t in tags])
+
     def test_run_adv_search_1(self):
         ss = SearchState.get_empty()
         qs, meta_data = Thread.objects.run_advanced_search(request_user=self.user, search_state=ss)
@@ -297,6 +479,182 @@ class ThreadTagModelsTests(AskbotTestCase):
             self.assertTrue(thread.last_activity_by is thread._last_activity_by_cache)
 
 
+class SimilarThreadsTests(AskbotTestCase):
+
+    def setUp(self):
+        self.user = self.create_user()
+        self.q1 = self.post_question(
+                        title='installing the package', tags='tag1 tag2 tag3'
+                    )
+        self.q2 = self.post_question(
+                        title='other question', tags='tag3 tag4 tag5'
+                    )
+        self.q3 = self.post_question(
+                        title='package fails', tags='tag1 tag2'
+                    )
+        self.q4 = self.post_question(title='unrelated', tags='tag9')
+
+    def get_similar_titles(self, question):
+        thread = Thread.objects.get(id=question.thread_id)
+        return [item['title'] for item in thread.get_similar_threads().data()]
+
+    def test_similar_threads_are_ranked(self):
+        self.assertEqual(
+            self.get_similar_titles(self.q1),
+            ['package fails', 'other question']
+        )
+        self.assertEqual(self.get_similar_titles(self.q4), [])
+
+    def test_retag_updates_similar_threads(self):
+        self.q4.thread.retag(
+            retagged_by=self.user,
+            retagged_at=datetime.datetime.now(),
+            tagnames='tag4 tag5'
+        )
+        self.assertEqual(self.get_similar_titles(self.q4), ['other question'])
+
+    def test_deleted_questions_are_not_shown(self):
+        self.user.delete_question(self.q3)
+        thread = Thread.objects.get(id=self.q1.thread_id)
+        thread.similar_thread_ids = None
+        self.assertEqual(thread.get_similar_thread_ids(), [self.q2.thread_id])
+
+    def test_lazy_computation_keeps_lists_of_neighbors(self):
+        Thread.objects.get(id=self.q3.thread_id).get_similar_thread_ids()
+        thread = Thread.objects.get(id=self.q1.thread_id)
+        self.assertEqual(thread.similar_thread_ids, None)
+        thread.get_similar_thread_ids()
+        neighbor = Thread.objects.get(id=self.q3.thread_id)
+        self.assertNotEqual(neighbor.similar_thread_ids, None)
+
+    def test_index_ranks_all_candidates_without_limit(self):
+        index = similarity.build_index()
+        thread_id = self.q1.thread_id
+        self.assertEqual(
+            len(index.get_neighbors(thread_id, max_candidates=1)), 1
+        )
+        self.assertEqual(
+            index.get_neighbors(thread_id, max_candidates=None),
+            [self.q3.thread_id, self.q2.thread_id]
+        )
+
+    def test_rebuild_command_matches_incremental_update(self):
+        thread_ids = [q.thread_id for q in (self.q1, self.q2, self.q3)]
+        incremental = dict(
+            (thread_id, Thread.objects.get(id=thread_id).get_similar_thread_ids())
+            for thread_id in thread_ids
+        )
+        Thread.objects.all().update(similar_thread_ids=None)
+        management.call_command('rebuild_similar_threads', verbosity=0)
+        for thread_id in thread_ids:
+            thread = Thread.objects.get(id=thread_id)
+            self.assertEqual(
+                similarity.parse_thread_ids(thread.similar_thread_ids),
+                incremental[thread_id]
+            )
+
+
+class InvertedIndexSearchTests(AskbotTestCase):
+
+    def setUp(self):
+        self.old_backend = getattr(django_settings, 'ASKBOT_SEARCH_BACKEND', None)
+        self.old_path = getattr(django_settings, 'ASKBOT_SEARCH_INDEX_PATH', None)
+        handle, self.index_path = tempfile.mkstemp()
+        os.close(handle)
+        django_settings.ASKBOT_SEARCH_BACKEND = \
+            'askbot.search.backends.inverted_index.InvertedIndexBackend'
+        django_settings.ASKBOT_SEARCH_INDEX_PATH = self.index_path
+
+        self.user = self.create_user()
+        self.q1 = self.post_question(
+                        title='python decorators',
+                        body_text='how do decorators wrap functions?',
+                        tags='python'
+                    )
+        self.q2 = self.post_question(
+                        title='python lists',
+                        body_text='sorting the lists of numbers',
+                        tags='python lists'
+                    )
+        self.post_answer(question=self.q2, body_text='use sorted, not decorators')
+
+    def tearDown(self):
+        if self.old_backend is None:
+            del django_settings.ASKBOT_SEARCH_BACKEND
+        else:
+            django_settings.ASKBOT_SEARCH_BACKEND = self.old_backend
+        if self.old_path is None:
+            del django_settings.ASKBOT_SEARCH_INDEX_PATH
+        else:
+            django_settings.ASKBOT_SEARCH_INDEX_PATH = self.old_path
+        os.remove(self.index_path)
+
+    def search(self, query):
+        return search_backends.get_backend().search(query)
+
+    def test_results_are_ranked(self):
+        self.assertEqual(
+            self.search('decorators'), [self.q1.thread_id, self.q2.thread_id]
+        )
+        self.assertEqual(self.search('Python lists'), [self.q2.thread_id])
+        self.assertEqual(self.search('python missing'), [])
+        threads = Thread.objects.get_for_query('decorators')
+        self.assertEqual(
+            [thread.id for thread in threads.order_by('-relevance')],
+            [self.q1.thread_id, self.q2.thread_id]
+        )
+
+    def test_index_follows_edits_and_deletions(self):
+        self.edit_question(
+            user=self.user, question=self.q1, title='python decorators',
+            body_text='a zebra question', tags='python'
+        )
+        self.assertEqual(self.search('zebra'), [self.q1.thread_id])
+        self.assertEqual(self.search('wrap'), [])
+        comment = self.post_comment(parent_post=self.q2, body_text='giraffe')
+        self.assertEqual(self.search('giraffe'), [self.q2.thread_id])
+        self.user.delete_comment(comment)
+        self.assertEqual(self.search('giraffe'), [])
+        self.user.delete_question(self.q1)
+        self.assertEqual(self.search('decorators'), [self.q2.thread_id])
+        self.user.restore_post(self.q1)
+        self.assertEqual(
+            self.search('decorators'), [self.q1.thread_id, self.q2.thread_id]
+        )
+
+    def test_retag_updates_index(self):
+        self.q1.thread.retag(
+            retagged_by=self.user,
+            retagged_at=datetime.datetime.now(),
+            tagnames='metaprogramming'
+        )
+        self.assertEqual(self.search('metaprogramming'), [self.q1.thread_id])
+
+    def test_rebuild_command_matches_incremental_update(self):
+        expected = self.search('python')
+        os.remove(self.index_path)
+        self.assertEqual(self.search('python'), [])
+        management.call_command(
+            'rebuild_search_index', batch_size=1, verbosity=0
+        )
+        self.assertEqual(self.search('python'), expected)
+
+    def test_updates_during_rebuild_are_kept(self):
+        def get_batches():
+            yield [self.q1.thread_id]
+            #the threads change after they were indexed by the rebuild
+            self.edit_question(
+                user=self.user, question=self.q1, title='python decorators',
+                body_text='a zebra question', tags='python'
+            )
+            self.user.delete_question(self.q2)
+            yield [self.q2.thread_id]
+        search_backends.get_backend().rebuild(get_batches())
+        self.assertEqual(self.search('zebra'), [self.q1.thread_id])
+        self.assertEqual(self.search('lists'), [])
+        self.assertFalse(os.path.exists(self.index_path + '.changes'))
+
+
 class ThreadRenderLowLevelCachingTests(AskbotTestCase):
     def setUp(self):
         self.create_user()
@@ -418,6 +776,36 @@ class ThreadRenderLowLevelCachingTests(AskbotTestCase):
         )
 
 
+    def test_cached_summary_is_split_at_tag_placeholders(self):
+        thread = self.q.thread
+        thread.update_summary_html()
+        segments = cache.cache.get(thread.SUMMARY_CACHE_KEY_TPL % thread.id)
+        self.assertEqual(sorted(segments[1::2]), ['tag1', 'tag2', 'tag3'])
+        self.assertEqual(
+            thread.get_cached_summary_html(),
+            ''.join([
+                i % 2 and '<<<%s>>>' % segment or segment
+                for i, segment in enumerate(segments)
+            ])
+        )
+
+    def test_tag_urls_are_memoized_per_search_state(self):
+        ss = SearchState.get_empty()
+        thread = self.q.thread
+        html = thread.get_summary_html(search_state=ss)
+
+        def fail(tag):
+            raise AssertionError('tag url is computed again')
+        ss.add_tag = fail
+        self.assertEqual(thread.get_summary_html(search_state=ss), html)
+        #memoized urls are not shared by the derived states
+        derived = SearchState.get_empty().add_tag('tag1')
+        self.assertEqual(
+            derived.get_tag_url('tag2'),
+            derived.add_tag('tag2').full_url()
+        )
+        self.assertNotEqual(derived.get_tag_url('tag2'), ss.get_tag_url('tag2'))
+
 
 class ThreadRenderCacheUpdateTests(AskbotTestCase):
     def setUp(self):
@@ -431,11 +819,7 @@ class ThreadRenderCacheUpdateTests(AskbotTestCase):
         self.user2.reputation = 10000
         self.user2.save()
 
-        self.old_cache = cache.cache
-        cache.cache = LocMemCache('', {})  # Enable local caching
-
-    def tearDown(self):
-        cache.cache = self.old_cache  # Restore caching
+        self.use_private_cache()  # Enable local caching
 
     def _html_for_question(self, q):
         context = {
@@ -597,6 +981,8 @@ class ThreadRenderCacheUpdateTests(AskbotTestCase):
         self.assertEqual(html, thread.get_cached_summary_html())
 
     def test_view_count(self):
+        #discard views buffered by other tests
+        VIEW_COUNT_BUFFER.pop_all()
         question = self.post_question()
         self.assertEqual(0, question.thread.view_count)
         self.assertEqual(0, Thread.objects.all()[0].view_count)
@@ -609,6 +995,8 @@ class ThreadRenderCacheUpdateTests(AskbotTestCase):
             HTTP_ACCEPT_LANGUAGE='en',
             HTTP_USER_AGENT='Mozilla Gecko'
         )
+        #view counts are buffered until flushed
+        Thread.objects.flush_view_counts()
         thread = Thread.objects.all()[0]
         self.assertEqual(1, thread.view_count)
 
@@ -616,6 +1004,34 @@ class ThreadRenderCacheUpdateTests(AskbotTestCase):
         html = self._html_for_question(thread._question_post())
         self.assertEqual(html, thread.get_cached_summary_html())
 
+    def test_buffered_view_count(self):
+        VIEW_COUNT_BUFFER.pop_all()
+        question = self.post_question()
+        thread = question.thread
+        thread.increase_view_count()
+        thread.increase_view_count()
+        #pending views are visible on the instance
+        self.assertEqual(2, thread.view_count)
+        self.assertEqual(0, Thread.objects.get(id=thread.id).view_count)
+        self.assertEqual(1, Thread.objects.flush_view_counts())
+        self.assertEqual(2, Thread.objects.get(id=thread.id).view_count)
+
+    def test_question_visit_does_not_flush_view_counts(self):
+        VIEW_COUNT_BUFFER.pop_all()
+        question = self.post_question()
+        self.client.logout()
+        self.client.get(
+            urlresolvers.reverse('question', kwargs={'id': question.id}),
+            {},
+            follow=True,
+            HTTP_ACCEPT_LANGUAGE='en',
+            HTTP_USER_AGENT='Mozilla Gecko'
+        )
+        #the view is saved only by the periodic task or the command
+        self.assertEqual(0, Thread.objects.get(id=question.thread.id).view_count)
+        management.call_command('flush_view_counts')
+        self.assertEqual(1, Thread.objects.get(id=question.thread.id).view_count)
+
     def test_question_upvote_downvote(self):
         question = self.post_question()
         question.score = 5
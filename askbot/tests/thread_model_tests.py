@@ -2,7 +2,10 @@ from askbot.tests.utils import AskbotTestCase
 from askbot.conf import settings as askbot_settings
 from askbot import models
 from askbot.models.tag import get_global_group
+from askbot.search.state_manager import SearchState
 import django.core.mail
+from django.contrib.auth.models import AnonymousUser
+from django.core import cache
 from django.core.urlresolvers import reverse
 
 class ThreadModelTestsWithGroupsEnabled(AskbotTestCase):
@@ -60,6 +63,58 @@ class ThreadModelTestsWithGroupsEnabled(AskbotTestCase):
         user = self.reload_object(self.user)
         self.assertEqual(user.new_response_count, 1)
 
+    def test_summary_cache_per_group_visibility(self):
+        question = self.post_question(self.user)
+        self.post_answer(user=self.admin, question=question, is_private=True)
+        thread = question.thread
+        search_state = SearchState.get_empty()
+
+        user_html = thread.get_summary_html(search_state, visitor=self.user)
+        admin_html = thread.get_summary_html(search_state, visitor=self.admin)
+        self.assertNotEqual(user_html, admin_html)
+        self.assertNotEqual(thread.get_cached_summary_html(self.user), None)
+        self.assertNotEqual(thread.get_cached_summary_html(self.admin), None)
+
+        #anonymous visitors and the user share the same visibility
+        anon_html = thread.get_summary_html(search_state, visitor=AnonymousUser())
+        self.assertEqual(anon_html, user_html)
+
+        #change of the thread groups drops the cached summaries
+        thread.make_public()
+        self.assertEqual(thread.get_cached_summary_html(self.user), None)
+
+    def test_summary_rendered_before_change_is_not_used(self):
+        question = self.post_question(self.user)
+        thread = question.thread
+        #a slow request starts rendering the summary
+        meta = thread.get_group_summary_meta()
+        thread.update_summary_html()
+        thread.get_summary_html(SearchState.get_empty(), visitor=self.user)
+        html = thread.get_cached_summary_html(self.user)
+        #and caches it after the thread has changed
+        cache.cache.set(
+            thread.get_group_summary_cache_key(meta, self.user), 'stale'
+        )
+        self.assertEqual(thread.get_cached_summary_html(self.user), html)
+
+    def test_cached_post_data_per_group_visibility(self):
+        question = self.post_question(self.user)
+        answer = self.post_answer(
+                        user=self.admin, question=question, is_private=True
+                    )
+        thread = question.thread
+        post_data = thread.get_cached_post_data(user=self.admin)
+        self.assertEqual(post_data[1], [answer])
+        post_data = thread.get_cached_post_data(user=self.user)
+        self.assertEqual(post_data[1], [])
+        #second request for the same visibility does not hit the database
+        self.assertNumQueries(0, thread.get_cached_post_data, user=self.user)
+
+        self.admin.edit_answer(answer, is_private=False)
+        thread = self.reload_object(thread)
+        post_data = thread.get_cached_post_data(user=self.user)
+        self.assertEqual(post_data[1], [answer])
+
     def test_answer_to_private_question_is_not_globally_visible(self):
         question = self.post_question(user=self.admin, is_private=True)
         answer = self.post_answer(question=question, user=self.admin, is_private=False)
@@ -80,6 +135,33 @@ class ThreadModelTestsWithGroupsEnabled(AskbotTestCase):
             False
         )
 
+    def test_thread_shared_with_group_recursively(self):
+        question = self.post_question(user=self.user)
+        answer = self.post_answer(question=question, user=self.admin)
+        self.post_comment(user=self.admin, parent_post=question)
+        self.post_comment(user=self.admin, parent_post=answer)
+        thread = question.thread
+        group = self.create_group()
+
+        thread.add_to_groups([group], recursive=True)
+        memberships = models.PostToGroup.objects.filter(group=group)
+        self.assertEqual(
+            set(memberships.values_list('post', flat=True)),
+            set(thread.posts.values_list('id', flat=True))
+        )
+        #existing memberships are not added again, the number
+        #of queries does not depend on the number of posts
+        self.assertNumQueries(
+            2,
+            models.PostToGroup.objects.add_posts_to_groups,
+            thread.posts.all(),
+            [group]
+        )
+        self.assertEqual(memberships.count(), 4)
+
+        thread.remove_from_groups([group], recursive=True)
+        self.assertEqual(memberships.count(), 0)
+
 
     def test_restrictive_response_publishing(self):
         #restrictive model should work even with groups
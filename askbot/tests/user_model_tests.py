@@ -1,7 +1,10 @@
+import datetime
+from django.core import management
 from askbot.tests.utils import AskbotTestCase
 from django.contrib.auth.models import User
 from askbot import models
 from askbot.models.tag import format_personal_group_name
+from askbot.models.user import LAST_SEEN_BUFFER, flush_last_seen
 
 class UserModelTests(AskbotTestCase):
     """test user model"""
@@ -15,3 +18,69 @@ class UserModelTests(AskbotTestCase):
                                                 group=group, user=user
                                             )
         self.assertEqual(memberships.count(), 1)
+
+
+class LastSeenBufferTests(AskbotTestCase):
+    """tests of the buffered updates of the last visit time"""
+
+    def setUp(self):
+        LAST_SEEN_BUFFER.pop_all()
+        self.user = self.create_user('visitor')
+
+    def get_user(self):
+        return User.objects.get(id = self.user.id)
+
+    def test_visits_of_same_day_are_buffered(self):
+        now = datetime.datetime.now()
+        User.objects.filter(id = self.user.id).update(last_seen = now)
+        later = now + datetime.timedelta(0, 1)
+        models.record_user_visit(self.get_user(), later)
+        self.assertEqual(self.get_user().last_seen, now)
+        self.assertEqual(LAST_SEEN_BUFFER.get_pending(self.user.id), later)
+
+        self.assertEqual(flush_last_seen(), 1)
+        self.assertEqual(self.get_user().last_seen, later)
+        self.assertEqual(LAST_SEEN_BUFFER.get_pending(self.user.id), None)
+
+    def test_flush_updates_many_users(self):
+        other_user = self.create_user('other_visitor')
+        now = datetime.datetime.now()
+        User.objects.all().update(last_seen = now)
+        later = now + datetime.timedelta(0, 1)
+        models.record_user_visit(self.get_user(), later)
+        models.record_user_visit(User.objects.get(id = other_user.id), later)
+        self.assertEqual(flush_last_seen(batch_size = 1), 2)
+        self.assertEqual(User.objects.filter(last_seen = later).count(), 2)
+
+    def test_visits_are_flushed_by_the_command_only(self):
+        now = datetime.datetime.now()
+        User.objects.filter(id = self.user.id).update(last_seen = now)
+        for seconds in range(1, 4):
+            later = now + datetime.timedelta(0, seconds)
+            models.record_user_visit(self.get_user(), later)
+        #the visits do not write to the database
+        self.assertEqual(self.get_user().last_seen, now)
+        management.call_command('flush_last_seen')
+        self.assertEqual(self.get_user().last_seen, later)
+
+    def test_first_visit_of_day_counts_consecutive_days(self):
+        yesterday = datetime.datetime.now() - datetime.timedelta(1)
+        User.objects.filter(id = self.user.id).update(
+            last_seen = yesterday, consecutive_days_visit_count = 2
+        )
+        now = datetime.datetime.now()
+        models.record_user_visit(self.get_user(), now)
+        user = self.get_user()
+        self.assertEqual(user.last_seen, now)
+        self.assertEqual(user.consecutive_days_visit_count, 3)
+        #second visit of the day does not change the count
+        models.record_user_visit(user, now + datetime.timedelta(0, 1))
+        self.assertEqual(self.get_user().consecutive_days_visit_count, 3)
+
+    def test_missed_day_resets_consecutive_days(self):
+        before = datetime.datetime.now() - datetime.timedelta(3)
+        User.objects.filter(id = self.user.id).update(
+            last_seen = before, consecutive_days_visit_count = 2
+        )
+        models.record_user_visit(self.get_user(), datetime.datetime.now())
+        self.assertEqual(self.get_user().consecutive_days_visit_count, 0)
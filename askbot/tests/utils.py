@@ -1,5 +1,8 @@
 """utility functions used by Askbot test cases
 """
+import uuid
+from django.core import cache
+from django.core.cache.backends.locmem import LocMemCache
 from django.test import TestCase
 from functools import wraps
 from askbot import models
@@ -242,6 +245,17 @@ class AskbotTestCase(TestCase):
             by_email=by_email
         )
 
+    def use_private_cache(self):
+        """replaces ``cache.cache`` with a new empty local memory
+        cache until the end of the test, so that the test does not
+        see the entries left by the other tests, the shared cache,
+        which keeps the live settings, is not cleared
+        """
+        old_cache = cache.cache
+        cache.cache = LocMemCache('askbot-test-%s' % uuid.uuid4().hex, {})
+        self.addCleanup(cache.cache.clear)
+        self.addCleanup(setattr, cache, 'cache', old_cache)
+
     def reload_object(self, obj):
         """reloads model object from the database
         """
@@ -1,4 +1,16 @@
+import StringIO
+import sys
+from django.contrib.auth.models import User
+from django.core import management
+from django.core import cache
+from django.core.urlresolvers import reverse
+from django.http import HttpResponse
 from django.test import TestCase
+from django.test.client import RequestFactory
+from django.utils import simplejson
+from askbot.skins.loaders import get_template, render_template
+from askbot.tests.utils import AskbotTestCase
+from askbot.utils import profiling
 from askbot.utils.url_utils import urls_equal
 
 class UrlUtilsTests(TestCase):
@@ -15,3 +27,107 @@ class UrlUtilsTests(TestCase):
         self.assertTrue(e('http://cnn.com/path', 'http://cnn.com/path/', True))
         self.assertFalse(e('http://cnn.com/path', 'http://cnn.com/path/'))
         
+
+
+class ProfilingTests(AskbotTestCase):
+
+    def setUp(self):
+        self.use_private_cache()
+        self.old_cache = cache.cache
+        self.old_enabled = profiling.PROFILING_ENABLED
+        profiling.PROFILING_ENABLED = True
+
+    def tearDown(self):
+        cache.cache = self.old_cache
+        profiling.PROFILING_ENABLED = self.old_enabled
+        profiling.stop_sample()
+
+    def test_rolling_histogram_keeps_latest_values(self):
+        histogram = profiling.RollingHistogram(3)
+        for value in (100, 1, 2, 3):
+            histogram.add(value)
+        summary = histogram.get_summary((1, 2))
+        self.assertEqual(summary['buckets'], [1, 1, 1])
+        self.assertEqual(summary['sum'], 6)
+        self.assertEqual(summary['max'], 3)
+
+    def test_summaries_of_processes_are_merged(self):
+        stats1 = profiling.ProfilingStats()
+        stats2 = profiling.ProfilingStats()
+        sample = dict.fromkeys(profiling.METRICS, 0)
+        for wall_time in (3, 4, 20):
+            sample['wall_time'] = wall_time
+            stats1.add('view', sample)
+        sample['wall_time'] = 2000
+        stats2.add('view', sample)
+        summary = profiling.describe_summary(
+            profiling.merge_summaries(
+                [stats1.get_summary(), stats2.get_summary()]
+            )
+        )
+        wall_time = summary['views']['view']['wall_time']
+        self.assertEqual(summary['views']['view']['count'], 4)
+        self.assertEqual(wall_time['mean'], 2027 / 4.0)
+        self.assertEqual(wall_time['p50'], 5)
+        self.assertEqual(wall_time['p99'], 2000)
+
+    def test_middleware_records_request(self):
+        from askbot.middleware.profiling import ProfilingMiddleware
+        stats = profiling.ProfilingStats(slowest_count = 1)
+        middleware = ProfilingMiddleware(stats = stats)
+        request = RequestFactory().get('/')
+
+        def view(request):
+            list(User.objects.all()[:1])
+            cache.cache.get('some-key')
+            cache.cache.set('some-key', 1)
+            template = get_template('widgets/user_list.html')
+            return HttpResponse(render_template(template, {'users': []}))
+
+        view(request)#load the settings and the template
+        middleware.process_request(request)
+        middleware.process_view(request, view, (), {})
+        middleware.process_response(request, view(request))
+
+        summary = stats.get_summary()
+        view_name = view.__module__ + '.view'
+        view_summary = summary['views'][view_name]
+        self.assertEqual(view_summary['count'], 1)
+        self.assertEqual(view_summary['sql_count']['sum'], 1)
+        self.assertEqual(view_summary['cache_gets']['sum'], 1)
+        self.assertEqual(view_summary['cache_sets']['sum'], 1)
+        self.assertTrue(view_summary['template_time']['sum'] > 0)
+        self.assertEqual(summary['slowest'][0]['view'], view_name)
+        self.assertEqual(summary['slowest'][0]['path'], '/')
+
+    def test_stats_view_is_for_admins_and_moderators_only(self):
+        user = self.create_user()
+        user.set_password('pass')
+        user.save()
+        self.client.login(username = user.username, password = 'pass')
+        response = self.client.get(reverse('profiling_stats'))
+        self.assertEqual(response.status_code, 403)
+
+        user.set_status('m')
+        response = self.client.get(reverse('profiling_stats'))
+        self.assertEqual(response.status_code, 200)
+
+        user.set_admin_status()
+        user.save()
+        response = self.client.get(reverse('profiling_stats'))
+        self.assertEqual(response.status_code, 200)
+        data = simplejson.loads(response.content)
+        self.assertEqual(data['slowest'], [])
+
+    def test_command_prints_published_stats(self):
+        stats = profiling.ProfilingStats()
+        stats.add('some.view', dict.fromkeys(profiling.METRICS, 1))
+        profiling.publish(stats)
+        old_stdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+        try:
+            management.call_command('show_profiling_stats')
+            output = sys.stdout.getvalue()
+        finally:
+            sys.stdout = old_stdout
+        self.assertTrue('some.view' in output)
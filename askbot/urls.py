@@ -65,6 +65,7 @@ urlpatterns = patterns('',
             r'(%s)?' % r'/tags:(?P<tags>[\w+.#,-]+)' + # Should match: const.TAG_CHARS + ','; TODO: Is `#` char decoded by the time URLs are processed ??
             r'(%s)?' % r'/author:(?P<author>\d+)' +
             r'(%s)?' % r'/page:(?P<page>\d+)' +
+            r'(%s)?' % r'/cursor:(?P<cursor>[\w.\-]+)' +
         r'/$'),
 
         views.readers.questions,
@@ -117,6 +118,11 @@ urlpatterns = patterns('',
         views.commands.get_users_info,
         name='get_users_info'
     ),
+    url(
+        r'^get-post-permissions/',
+        views.commands.get_post_permissions,
+        name='get_post_permissions'
+    ),
     url(
         r'^get-editor/',
         views.commands.get_editor,
@@ -218,6 +224,11 @@ urlpatterns = patterns('',
         views.meta.list_suggested_tags,
         name = 'list_suggested_tags'
     ),
+    url(
+        r'^profiling-stats/$',
+        views.meta.profiling_stats,
+        name = 'profiling_stats'
+    ),
     url(#ajax only
         r'^%s$' % 'moderate-suggested-tag',
         views.commands.moderate_suggested_tag,
@@ -0,0 +1,161 @@
+"""Cache-backed buffers of integer counters,
+used to accumulate frequent increments (like thread view counts)
+and apply them to the database in bulk later,
+and of the latest values of frequently updated fields
+(like the time of the last visit of the user).
+
+Counters are stored per "generation". When the buffer is
+flushed, the generation is switched, so that the new increments
+go to the fresh keys, while the values of the previous
+generation are read and deleted by the flusher.
+
+The buffer is best-effort: with a volatile cache backend
+some increments may be lost on eviction, which is acceptable
+for the statistical counters.
+"""
+import time
+from django.core import cache  # import cache, not from cache import cache, to be able to monkey-patch cache.cache in test cases
+
+#long enough to survive between the flushes
+BUFFER_TIMEOUT = 24 * 60 * 60
+#max number of keys to read from the cache at once
+GET_MANY_CHUNK_SIZE = 500
+
+
+class CachedCounterBuffer(object):
+    """accumulates increments of counters per object id
+    in the cache
+    """
+
+    def __init__(self, name):
+        self.name = name
+
+    def get_generation_key(self):
+        return '%s-generation' % self.name
+
+    def get_slot_count_key(self, generation):
+        return '%s-%d-slot-count' % (self.name, generation)
+
+    def get_slot_key(self, generation, slot):
+        return '%s-%d-slot-%d' % (self.name, generation, slot)
+
+    def get_value_key(self, generation, obj_id):
+        return '%s-%d-value-%d' % (self.name, generation, obj_id)
+
+    def get_generation(self):
+        """returns current generation of the buffer"""
+        key = self.get_generation_key()
+        generation = cache.cache.get(key)
+        if generation is None:
+            #use time, so that the generation does not repeat
+            #older values when the cache entry is evicted
+            cache.cache.add(key, int(time.time()), BUFFER_TIMEOUT)
+            generation = cache.cache.get(key)
+        return generation
+
+    def is_enabled(self):
+        """``False`` if the cache does not keep the values,
+        like the dummy cache, then nothing can be buffered"""
+        return self.get_generation() is not None
+
+    def register(self, generation, obj_id):
+        """records id of the object which has counter
+        in the given generation, so that the flusher
+        could find it without scanning the keys"""
+        count_key = self.get_slot_count_key(generation)
+        cache.cache.add(count_key, 0, BUFFER_TIMEOUT)
+        try:
+            slot = cache.cache.incr(count_key)
+        except ValueError:
+            #key expired just after we've added it
+            slot = 1
+            cache.cache.set(count_key, slot, BUFFER_TIMEOUT)
+        cache.cache.set(self.get_slot_key(generation, slot), obj_id, BUFFER_TIMEOUT)
+
+    def increment(self, obj_id, delta=1):
+        """increments buffered counter of the object
+        and returns the pending (not yet flushed) value"""
+        generation = self.get_generation()
+        key = self.get_value_key(generation, obj_id)
+        if cache.cache.add(key, delta, BUFFER_TIMEOUT):
+            self.register(generation, obj_id)
+            return delta
+        try:
+            return cache.cache.incr(key, delta)
+        except ValueError:
+            cache.cache.set(key, delta, BUFFER_TIMEOUT)
+            self.register(generation, obj_id)
+            return delta
+
+    def get_pending(self, obj_id):
+        """returns value of the counter which
+        was not yet flushed"""
+        generation = self.get_generation()
+        key = self.get_value_key(generation, obj_id)
+        return cache.cache.get(key) or 0
+
+    def get_many(self, keys):
+        """reads values from the cache in chunks"""
+        values = dict()
+        for start in range(0, len(keys), GET_MANY_CHUNK_SIZE):
+            chunk = keys[start:start + GET_MANY_CHUNK_SIZE]
+            values.update(cache.cache.get_many(chunk))
+        return values
+
+    def pop_all(self):
+        """switches the buffer to the new generation,
+        returns dictionary of object id -> accumulated value
+        from the previous generation and deletes them
+        from the cache
+        """
+        generation = self.get_generation()
+        try:
+            cache.cache.incr(self.get_generation_key())
+        except ValueError:
+            cache.cache.set(
+                    self.get_generation_key(), generation + 1, BUFFER_TIMEOUT
+                )
+
+        count_key = self.get_slot_count_key(generation)
+        slot_count = cache.cache.get(count_key) or 0
+        slot_keys = [
+            self.get_slot_key(generation, slot)
+            for slot in range(1, slot_count + 1)
+        ]
+        obj_ids = set(self.get_many(slot_keys).values())
+
+        value_keys = dict(
+            (self.get_value_key(generation, obj_id), obj_id)
+            for obj_id in obj_ids
+        )
+        values = self.get_many(value_keys.keys())
+
+        for key in slot_keys + value_keys.keys() + [count_key]:
+            cache.cache.delete(key)
+
+        result = dict()
+        for key, value in values.items():
+            if value:
+                result[value_keys[key]] = value
+        return result
+
+
+class CachedValueBuffer(CachedCounterBuffer):
+    """keeps the latest value of a field per object id
+    in the cache, the older values are overwritten
+    """
+
+    def set(self, obj_id, value):
+        """buffers the new value of the object"""
+        generation = self.get_generation()
+        key = self.get_value_key(generation, obj_id)
+        if cache.cache.add(key, value, BUFFER_TIMEOUT):
+            self.register(generation, obj_id)
+        else:
+            cache.cache.set(key, value, BUFFER_TIMEOUT)
+
+    def get_pending(self, obj_id):
+        """returns the value which was not yet
+        flushed, or ``None``"""
+        generation = self.get_generation()
+        return cache.cache.get(self.get_value_key(generation, obj_id))
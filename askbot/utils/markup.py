@@ -5,14 +5,67 @@ Twitter-style @mentions"""
 
 import re
 import logging
+import threading
+from django.conf import settings as django_settings
+from django.core import cache  # import cache, not from cache import cache, to be able to monkey-patch cache.cache in test cases
+from django.utils.encoding import smart_str
+from django.utils.hashcompat import md5_constructor
 from askbot import const
 from askbot.conf import settings as askbot_settings
+from askbot.utils.html import sanitize_html
 from markdown2 import Markdown
 #url taken from http://regexlib.com/REDetails.aspx?regexp_id=501 by Brian Bothwell
 URL_RE = re.compile("((?<!(href|.src|data)=['\"])((http|https|ftp)\://([a-zA-Z0-9\.\-]+(\:[a-zA-Z0-9\.&amp;%\$\-]+)*@)*((25[0-5]|2[0-4][0-9]|[0-1]{1}[0-9]{2}|[1-9]{1}[0-9]{1}|[1-9])\.(25[0-5]|2[0-4][0-9]|[0-1]{1}[0-9]{2}|[1-9]{1}[0-9]{1}|[1-9]|0)\.(25[0-5]|2[0-4][0-9]|[0-1]{1}[0-9]{2}|[1-9]{1}[0-9]{1}|[1-9]|0)\.(25[0-5]|2[0-4][0-9]|[0-1]{1}[0-9]{2}|[1-9]{1}[0-9]{1}|[0-9])|localhost|([a-zA-Z0-9\-]+\.)*[a-zA-Z0-9\-]+\.(com|edu|gov|int|mil|net|org|biz|arpa|info|name|pro|aero|coop|museum|[a-zA-Z]{2}))(\:[0-9]+)*(/($|[a-zA-Z0-9\.\,\?\'\\\+&amp;%\$#\=~_\-]+))*))")
 
+#rendered html of the markdown texts is cached for this many seconds,
+#0 disables the cache
+MARKDOWN_CACHE_TIMEOUT = getattr(
+                            django_settings,
+                            'ASKBOT_MARKDOWN_CACHE_TIMEOUT',
+                            const.LONG_TIME
+                        )
+
+#parser instances keep state while converting the text,
+#so each thread has own instance
+_parser = threading.local()
+
 def get_parser():
-    """returns an instance of configured ``markdown2`` parser
+    """returns an instance of configured ``markdown2`` parser,
+    the instance is reused until the live settings change
+    """
+    version = askbot_settings.get_snapshot_version()
+    if version is None:
+        #settings are not available yet
+        return create_parser()
+    if getattr(_parser, 'version', None) != version:
+        _parser.instance = create_parser()
+        _parser.version = version
+    return _parser.instance
+
+def get_html_cache_key(text):
+    digest = md5_constructor(smart_str(text)).hexdigest()
+    return 'markdown-html-%s-%s' % (
+                        askbot_settings.get_snapshot_version(), digest
+                    )
+
+def markdown_to_html(text):
+    """returns sanitized html rendered from the markdown ``text``,
+    results are cached by the hash of the text and
+    the version of the live settings
+    """
+    if MARKDOWN_CACHE_TIMEOUT == 0 or \
+        askbot_settings.get_snapshot_version() is None:
+        return sanitize_html(get_parser().convert(text))
+
+    key = get_html_cache_key(text)
+    html = cache.cache.get(key)
+    if html is None:
+        html = sanitize_html(get_parser().convert(text))
+        cache.cache.set(key, html, MARKDOWN_CACHE_TIMEOUT)
+    return html
+
+def create_parser():
+    """returns a new instance of configured ``markdown2`` parser
     """
     extras = ['link-patterns', 'video']  
 
@@ -0,0 +1,325 @@
+"""Performance statistics of the requests, collected by the
+:class:`askbot.middleware.profiling.ProfilingMiddleware`.
+
+For each profiled request a "sample" is recorded - the wall and
+the cpu time, number and time of the sql queries, number of the
+cache reads and writes and the time of the template rendering.
+
+Every process keeps the latest samples of each view in the rolling
+histograms and, every ``ASKBOT_PROFILING_PUBLISH_INTERVAL`` seconds,
+publishes the summary (counts per bucket) to the cache, so that the
+summaries of all processes can be merged and shown by the
+``show_profiling_stats`` management command and the moderator-only
+json view ``profiling_stats``.
+
+Optionally, the requests are run under the ``cProfile`` profiler
+and the profiles of the slowest requests are saved into the
+``ASKBOT_PROFILING_DUMP_DIR``, to be examined with ``pstats``.
+
+Django settings:
+
+* ``ASKBOT_PROFILING_ENABLED`` - profile all requests
+* ``ASKBOT_PROFILING_SAMPLE_RATE`` - percentage of the requests
+  to profile, when not all requests are profiled
+* ``ASKBOT_PROFILING_WINDOW`` - number of the latest samples
+  kept per view
+* ``ASKBOT_PROFILING_DUMP_DIR`` - directory for the cProfile dumps,
+  profiler is not used if not set
+* ``ASKBOT_PROFILING_SLOWEST_COUNT`` - number of the slowest
+  requests for which the dumps are kept
+"""
+import heapq
+import os
+import socket
+import threading
+import time
+from django.conf import settings as django_settings
+from django.core import cache  # import cache, not from cache import cache, to be able to monkey-patch cache.cache in test cases
+
+PROFILING_ENABLED = getattr(django_settings, 'ASKBOT_PROFILING_ENABLED', False)
+PROFILING_SAMPLE_RATE = getattr(
+                            django_settings,
+                            'ASKBOT_PROFILING_SAMPLE_RATE',
+                            0
+                        )
+PROFILING_WINDOW = getattr(django_settings, 'ASKBOT_PROFILING_WINDOW', 1000)
+PROFILING_DUMP_DIR = getattr(django_settings, 'ASKBOT_PROFILING_DUMP_DIR', None)
+PROFILING_SLOWEST_COUNT = getattr(
+                            django_settings,
+                            'ASKBOT_PROFILING_SLOWEST_COUNT',
+                            10
+                        )
+PROFILING_PUBLISH_INTERVAL = getattr(
+                            django_settings,
+                            'ASKBOT_PROFILING_PUBLISH_INTERVAL',
+                            60
+                        )
+#published summaries expire if the process is gone
+PUBLISHED_SUMMARY_TIMEOUT = 24 * 60 * 60
+PROCESS_LIST_CACHE_KEY = 'profiling-processes'
+
+#times are in milliseconds
+TIME_METRICS = ('wall_time', 'cpu_time', 'sql_time', 'template_time')
+COUNT_METRICS = ('sql_count', 'cache_gets', 'cache_sets')
+METRICS = TIME_METRICS + COUNT_METRICS
+#upper edges of the histogram buckets, the last bucket is unbounded
+TIME_BUCKETS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+_current = threading.local()
+
+
+def get_buckets(metric):
+    if metric in TIME_METRICS:
+        return TIME_BUCKETS
+    return COUNT_BUCKETS
+
+def start_sample():
+    """starts recording of the sample of the current request"""
+    _current.sample = dict.fromkeys(METRICS, 0)
+    return _current.sample
+
+def stop_sample():
+    """returns sample of the current request and stops the recording"""
+    sample = getattr(_current, 'sample', None)
+    _current.sample = None
+    return sample
+
+def add_to_sample(metric, value):
+    """adds value to the metric of the sample of the current request,
+    if the request is profiled"""
+    sample = getattr(_current, 'sample', None)
+    if sample is not None:
+        sample[metric] += value
+
+
+class CacheCallCounter(object):
+    """wraps the cache backend and counts the reads
+    and the writes of the profiled requests"""
+    GET_METHODS = ('get', 'get_many', 'has_key')
+    SET_METHODS = ('set', 'set_many', 'add', 'incr', 'decr')
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    def __getattr__(self, name):
+        attr = getattr(self.backend, name)
+        if name in self.GET_METHODS:
+            metric = 'cache_gets'
+        elif name in self.SET_METHODS:
+            metric = 'cache_sets'
+        else:
+            return attr
+        def counted(*args, **kwargs):
+            add_to_sample(metric, 1)
+            return attr(*args, **kwargs)
+        return counted
+
+    def __contains__(self, key):
+        add_to_sample('cache_gets', 1)
+        return key in self.backend
+
+def install_cache_counter():
+    """wraps ``django.core.cache.cache`` with the counter,
+    modules which use ``cache.cache`` will be counted"""
+    if not isinstance(cache.cache, CacheCallCounter):
+        cache.cache = CacheCallCounter(cache.cache)
+
+
+class RollingHistogram(object):
+    """keeps the latest ``size`` values of a metric"""
+
+    def __init__(self, size):
+        self.size = size
+        self.values = list()
+        self.position = 0
+
+    def add(self, value):
+        if len(self.values) < self.size:
+            self.values.append(value)
+        else:
+            self.values[self.position] = value
+            self.position = (self.position + 1) % self.size
+
+    def get_summary(self, buckets):
+        """returns dictionary with the counts of the values
+        per bucket, sum and max of the values"""
+        counts = [0] * (len(buckets) + 1)
+        for value in self.values:
+            index = 0
+            while index < len(buckets) and value > buckets[index]:
+                index += 1
+            counts[index] += 1
+        return {
+            'buckets': counts,
+            'sum': sum(self.values),
+            'max': max(self.values or [0]),
+        }
+
+
+class ProfilingStats(object):
+    """statistics of the profiled requests of this process, per view,
+    and the list of the slowest requests"""
+
+    def __init__(
+            self,
+            window = PROFILING_WINDOW,
+            slowest_count = PROFILING_SLOWEST_COUNT
+        ):
+        self.window = window
+        self.slowest_count = slowest_count
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.views = dict()
+        #heap of (wall time, request info) tuples
+        self.slowest = list()
+        self.published_at = 0
+
+    def add(self, view_name, sample):
+        self.lock.acquire()
+        try:
+            histograms = self.views.get(view_name)
+            if histograms is None:
+                histograms = dict()
+                for metric in METRICS:
+                    histograms[metric] = RollingHistogram(self.window)
+                self.views[view_name] = histograms
+            for metric in METRICS:
+                histograms[metric].add(sample[metric])
+        finally:
+            self.lock.release()
+
+    def is_slowest(self, wall_time):
+        """``True`` if the request with the given time
+        is one of the slowest"""
+        if len(self.slowest) < self.slowest_count:
+            return True
+        return wall_time > self.slowest[0][0]
+
+    def add_slowest(self, wall_time, info):
+        """adds the request to the list of the slowest,
+        returns information about the request pushed
+        out of the list or ``None``"""
+        self.lock.acquire()
+        try:
+            if len(self.slowest) < self.slowest_count:
+                heapq.heappush(self.slowest, (wall_time, info))
+                return None
+            if wall_time > self.slowest[0][0]:
+                return heapq.heapreplace(self.slowest, (wall_time, info))[1]
+            return info
+        finally:
+            self.lock.release()
+
+    def get_summary(self):
+        self.lock.acquire()
+        try:
+            views = dict()
+            for view_name, histograms in self.views.items():
+                summary = {'count': len(histograms['wall_time'].values)}
+                for metric in METRICS:
+                    summary[metric] = histograms[metric].get_summary(
+                                                        get_buckets(metric)
+                                                    )
+                views[view_name] = summary
+            slowest = [info for wall_time, info in sorted(self.slowest)]
+            slowest.reverse()
+            return {'views': views, 'slowest': slowest}
+        finally:
+            self.lock.release()
+
+
+def merge_summaries(summaries):
+    """merges summaries of several processes into one"""
+    views = dict()
+    slowest = list()
+    for summary in summaries:
+        slowest.extend(summary['slowest'])
+        for view_name, view_summary in summary['views'].items():
+            merged = views.get(view_name)
+            if merged is None:
+                merged = {'count': 0}
+                for metric in METRICS:
+                    merged[metric] = {
+                        'buckets': [0] * (len(get_buckets(metric)) + 1),
+                        'sum': 0,
+                        'max': 0
+                    }
+                views[view_name] = merged
+            merged['count'] += view_summary['count']
+            for metric in METRICS:
+                histogram = merged[metric]
+                other = view_summary[metric]
+                histogram['buckets'] = [
+                    a + b for a, b in zip(histogram['buckets'], other['buckets'])
+                ]
+                histogram['sum'] += other['sum']
+                histogram['max'] = max(histogram['max'], other['max'])
+    slowest.sort(key = lambda info: info['wall_time'], reverse = True)
+    return {'views': views, 'slowest': slowest[:PROFILING_SLOWEST_COUNT]}
+
+def get_percentile(histogram, buckets, percent):
+    """returns estimate of the percentile - upper edge
+    of the bucket where it falls, max value for the last bucket"""
+    total = sum(histogram['buckets'])
+    if total == 0:
+        return 0
+    threshold = total * percent / 100.0
+    running = 0
+    for index, count in enumerate(histogram['buckets']):
+        running += count
+        if running >= threshold:
+            if index < len(buckets):
+                return min(buckets[index], histogram['max'])
+            break
+    return histogram['max']
+
+def describe_summary(summary):
+    """adds mean and percentiles of the metrics to the summary"""
+    for view_summary in summary['views'].values():
+        count = view_summary['count']
+        for metric in METRICS:
+            histogram = view_summary[metric]
+            buckets = get_buckets(metric)
+            if count:
+                histogram['mean'] = float(histogram['sum']) / count
+            else:
+                histogram['mean'] = 0
+            for percent in (50, 90, 99):
+                histogram['p%d' % percent] = \
+                            get_percentile(histogram, buckets, percent)
+    return summary
+
+def get_process_cache_key():
+    return 'profiling-%s-%d' % (socket.gethostname(), os.getpid())
+
+def publish(stats):
+    """saves summary of the statistics of this process in the cache"""
+    key = get_process_cache_key()
+    keys = cache.cache.get(PROCESS_LIST_CACHE_KEY) or list()
+    if key not in keys:
+        keys.append(key)
+        cache.cache.set(PROCESS_LIST_CACHE_KEY, keys, PUBLISHED_SUMMARY_TIMEOUT)
+    cache.cache.set(key, stats.get_summary(), PUBLISHED_SUMMARY_TIMEOUT)
+    stats.published_at = time.time()
+
+def maybe_publish(stats):
+    if time.time() - stats.published_at > PROFILING_PUBLISH_INTERVAL:
+        publish(stats)
+
+def get_published_summary():
+    """returns merged and described summary
+    of the statistics of all processes"""
+    keys = cache.cache.get(PROCESS_LIST_CACHE_KEY) or list()
+    summaries = cache.cache.get_many(keys).values()
+    return describe_summary(merge_summaries(summaries))
+
+def clear_published_summaries():
+    keys = cache.cache.get(PROCESS_LIST_CACHE_KEY) or list()
+    for key in keys + [PROCESS_LIST_CACHE_KEY]:
+        cache.cache.delete(key)
+
+#statistics of this process
+PROCESS_STATS = ProfilingStats()
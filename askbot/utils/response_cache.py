@@ -0,0 +1,144 @@
+"""Cache of the complete responses of the question
+and the question list pages for the anonymous visitors.
+
+Cached responses are keyed by the url, the language, the skin,
+the version of the live settings and the version of the content
+shown on the page:
+
+* for the question page - version of the thread, changed
+  by :func:`bump_thread_version` when the thread or any of its
+  posts is changed, see :meth:`askbot.models.Thread.invalidate_cached_data`
+* for the question list - generation of the whole content,
+  see :func:`askbot.models.question.get_content_generation`
+
+The same keys are used as the ETag values, so that the browsers
+and the proxies can revalidate the pages with the conditional requests.
+
+The CSRF token of the visitor who caused the caching of the page
+is replaced in the cached copy by the token of each next visitor.
+"""
+import calendar
+import time
+from django.conf import settings as django_settings
+from django.core import cache  # import cache, not from cache import cache, to be able to monkey-patch cache.cache in test cases
+from django.http import HttpResponse, HttpResponseNotModified
+from django.middleware.csrf import get_token
+from django.utils.cache import patch_vary_headers
+from django.utils.encoding import smart_str
+from django.utils.hashcompat import md5_constructor
+from django.utils.http import http_date, parse_etags, parse_http_date_safe
+from django.utils.http import quote_etag
+from django.utils import translation
+from askbot import const
+from askbot.conf import settings as askbot_settings
+
+#responses are cached for at most this many seconds, 0 disables the cache
+RESPONSE_CACHE_TIMEOUT = getattr(
+                            django_settings,
+                            'ASKBOT_RESPONSE_CACHE_TIMEOUT',
+                            600
+                        )
+CSRF_TOKEN_PLACEHOLDER = '__askbot_csrf_token__'
+
+
+def get_thread_version_cache_key(thread_id):
+    return 'thread-version-%d' % thread_id
+
+def get_thread_version(thread_id):
+    """returns the version of the content of the thread,
+    the counter starts from the current time, so that
+    versions used before the counter was evicted from
+    the cache are not reused"""
+    key = get_thread_version_cache_key(thread_id)
+    version = cache.cache.get(key)
+    if version is None:
+        cache.cache.add(key, int(time.time() * 1000), const.LONG_TIME)
+        version = cache.cache.get(key)
+    return version
+
+def bump_thread_version(thread_id):
+    """makes the cached pages of the thread stale"""
+    try:
+        cache.cache.incr(get_thread_version_cache_key(thread_id))
+    except ValueError:
+        #counter is not in the cache, it will be started anew
+        pass
+
+def is_cacheable_request(request):
+    """``True`` for GET requests of the anonymous visitors
+    who have no messages waiting to be shown"""
+    if RESPONSE_CACHE_TIMEOUT == 0 or request.method != 'GET':
+        return False
+    if request.user.is_authenticated():
+        return False
+    session = getattr(request, 'session', None)
+    return session is None or 'messages' not in session
+
+def get_cache_key(request, *versions):
+    """returns the cache key of the response,
+    ``versions`` are versions of the content shown on the page"""
+    key = '%s:%s:%s:%s:%s:%s' % (
+                request.get_full_path(),
+                request.is_ajax(),
+                translation.get_language(),
+                askbot_settings.ASKBOT_DEFAULT_SKIN,
+                askbot_settings.get_snapshot_version(),
+                ':'.join([str(version) for version in versions])
+            )
+    return 'response-' + md5_constructor(smart_str(key)).hexdigest()
+
+def is_not_modified(request, etag, last_modified = None):
+    """``True`` if the copy of the page held by the client
+    is fresh, as told by the headers of the conditional request"""
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if if_none_match:
+        try:
+            return etag in parse_etags(if_none_match)
+        except ValueError:
+            return False
+    if_modified_since = request.META.get('HTTP_IF_MODIFIED_SINCE')
+    if if_modified_since and last_modified:
+        if_modified_since = parse_http_date_safe(if_modified_since)
+        timestamp = calendar.timegm(last_modified.utctimetuple())
+        return if_modified_since is not None and timestamp <= if_modified_since
+    return False
+
+def set_validators(response, etag, last_modified = None):
+    """adds headers allowing the conditional requests"""
+    response['ETag'] = quote_etag(etag)
+    if last_modified:
+        timestamp = calendar.timegm(last_modified.utctimetuple())
+        response['Last-Modified'] = http_date(timestamp)
+    #pages of the registered users are different
+    patch_vary_headers(response, ('Cookie',))
+    return response
+
+def get_response(request, key, last_modified = None):
+    """returns the response to the conditional request
+    or the cached response, with the CSRF token of the visitor,
+    or ``None`` if the response is not in the cache"""
+    if is_not_modified(request, key, last_modified):
+        return set_validators(HttpResponseNotModified(), key, last_modified)
+    cached = cache.cache.get(key)
+    if cached is None:
+        return None
+    content, content_type = cached
+    token = get_token(request)
+    if token:
+        content = content.replace(CSRF_TOKEN_PLACEHOLDER, token)
+    response = HttpResponse(content, content_type = content_type)
+    return set_validators(response, key, last_modified)
+
+def save_response(request, key, response, last_modified = None):
+    """caches the successful response, returns the response
+    with the validators for the conditional requests"""
+    if response.status_code != 200:
+        return response
+    content = response.content
+    token = request.META.get('CSRF_COOKIE')
+    if token:
+        content = content.replace(token, CSRF_TOKEN_PLACEHOLDER)
+    cache.cache.set(
+        key, (content, response['Content-Type']), RESPONSE_CACHE_TIMEOUT
+    )
+    return set_validators(response, key, last_modified)
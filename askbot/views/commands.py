@@ -27,6 +27,7 @@ from askbot import forms
 from askbot.conf import should_show_sort_by_relevance
 from askbot.conf import settings as askbot_settings
 from askbot.models.tag import get_global_group
+from askbot.models.permissions import format_post_permissions
 from askbot.utils import category_tree
 from askbot.utils import decorators
 from askbot.utils import url_utils
@@ -67,12 +68,17 @@ def manage_inbox(request):
                     )
 
                     action_type = post_data['action_type']
+                    memo_manager = models.ActivityAuditStatus.objects
                     if action_type == 'delete':
-                        memo_set.delete()
+                        memo_manager.delete_responses(memo_set)
                     elif action_type == 'mark_new':
-                        memo_set.update(status = models.ActivityAuditStatus.STATUS_NEW)
+                        memo_manager.set_status(
+                            memo_set, models.ActivityAuditStatus.STATUS_NEW
+                        )
                     elif action_type == 'mark_seen':
-                        memo_set.update(status = models.ActivityAuditStatus.STATUS_SEEN)
+                        memo_manager.set_status(
+                            memo_set, models.ActivityAuditStatus.STATUS_SEEN
+                        )
                     elif action_type == 'remove_flag':
                         for memo in memo_set:
                             activity_type = memo.activity.activity_type
@@ -122,9 +128,9 @@ def manage_inbox(request):
                                 body_text = unicode(body_text),
                                 recipient_list = [post.author.email,]
                             )
-                            memo.delete()
-
-                    user.update_response_counts()
+                            memo_manager.delete_responses(
+                                memo_manager.filter(id = memo.id)
+                            )
 
                     response_data['success'] = True
                     data = simplejson.dumps(response_data)
@@ -528,6 +534,22 @@ def get_html_template(request):
         'html': get_template(template_name).render()
     }
 
+@decorators.ajax_only
+@decorators.get_only
+def get_post_permissions(request):
+    """returns the actions which the user can perform
+    on the posts, given as comma separated ``post_ids``,
+    see :mod:`askbot.models.permissions`"""
+    post_ids = request.GET.get('post_ids', '').split(',')
+    post_ids = post_ids[:const.POST_PERMISSIONS_BATCH_SIZE]
+    post_ids = [IntegerField().clean(post_id) for post_id in post_ids]
+    posts = models.Post.objects.filter(id__in = post_ids)
+    if request.user.is_authenticated():
+        permissions = request.user.precache_post_permissions(posts)
+    else:
+        permissions = dict([(post.id, set()) for post in posts])
+    return {'permissions': format_post_permissions(permissions)}
+
 @decorators.get_only
 def get_tag_list(request):
     """returns tags to use in the autocomplete
@@ -1134,7 +1156,11 @@ def moderate_suggested_tag(request):
         else:
             if tag.threads.count() > len(threads):
                 for thread in threads:
+                    tag_ids = list(thread.tags.values_list('id', flat = True))
                     thread.tags.remove(tag)
+                    models.TagCooccurrence.objects.update_counts(
+                        tag_ids, set(tag_ids) - set([tag.id])
+                    )
                 tag.used_count = tag.threads.count()
                 tag.save()
             elif tag.status == models.Tag.STATUS_SUGGESTED:
@@ -13,6 +13,7 @@ from django.utils.translation import ugettext as _
 from django.views import static
 from django.views.decorators import csrf
 from django.db.models import Max, Count
+from django.utils import simplejson
 from askbot import skins
 from askbot.conf import settings as askbot_settings
 from askbot.forms import FeedbackForm
@@ -25,6 +26,7 @@ from askbot.skins.loaders import get_template, render_into_skin, render_text_int
 from askbot.utils.decorators import admins_only
 from askbot.utils.forms import get_next_url
 from askbot.utils import functions
+from askbot.utils import profiling
 
 def generic_view(request, template = None, page_class = None):
     """this may be not necessary, since it is just a rewrite of render_into_skin"""
@@ -210,3 +212,13 @@ def list_suggested_tags(request):
         'paginator_context' : paginator_context,
     }
     return render_into_skin('list_suggested_tags.html', data, request)
+
+@admins_only
+def profiling_stats(request):
+    """returns statistics of the profiled requests
+    of all processes as json, see :mod:`askbot.utils.profiling`,
+    available only to the site administrators and moderators"""
+    #statistics of this process are published right away
+    profiling.publish(profiling.PROCESS_STATS)
+    data = simplejson.dumps(profiling.get_published_summary())
+    return HttpResponse(data, mimetype = 'application/json')
@@ -28,20 +28,21 @@ from django.conf import settings
 
 import askbot
 from askbot import exceptions
-from askbot.utils.diff import textDiff as htmldiff
 from askbot.forms import AnswerForm, ShowQuestionForm
 from askbot import conf
 from askbot import models
 from askbot import schedules
 from askbot.models.tag import Tag
+from askbot.models.permissions import format_post_permissions
 from askbot import const
 from askbot.utils import functions
-from askbot.utils.html import sanitize_html
+from askbot.utils import response_cache
 from askbot.utils.decorators import anonymous_forbidden, ajax_only, get_only
 from askbot.search.state_manager import SearchState, DummySearchState
 from askbot.templatetags import extra_tags
 from askbot.conf import settings as askbot_settings
 from askbot.skins.loaders import render_into_skin, get_template #jinja2 template loading enviroment
+from askbot.skins.loaders import render_template
 from askbot.views import context
 
 # used in index page
@@ -76,29 +77,62 @@ def questions(request, **kwargs):
     if request.method != 'GET':
         return HttpResponseNotAllowed(['GET'])
 
+    #pages shown to the anonymous visitors are cached
+    #until the next change of the content
+    cache_key = None
+    if response_cache.is_cacheable_request(request):
+        cache_key = response_cache.get_cache_key(
+                            request, models.question.get_content_generation()
+                        )
+        response = response_cache.get_response(request, cache_key)
+        if response is not None:
+            return response
+
     search_state = SearchState(
                     user_logged_in=request.user.is_authenticated(),
                     **kwargs
                 )
     page_size = int(askbot_settings.DEFAULT_QUESTIONS_PAGE_SIZE)
 
-    qs, meta_data = models.Thread.objects.run_advanced_search(
-                        request_user=request.user, search_state=search_state
-                    )
-    if meta_data['non_existing_tags']:
-        search_state = search_state.remove_tags(meta_data['non_existing_tags'])
-
-    paginator = Paginator(qs, page_size)
-    if paginator.num_pages < search_state.page:
-        search_state.page = 1
-    page = paginator.page(search_state.page)
-    page.object_list = list(page.object_list) # evaluate the queryset
+    use_keyset = getattr(settings, 'ASKBOT_QUESTIONS_KEYSET_PAGINATION', False) \
+                    and search_state.sort in models.question.KEYSET_SORT_METHODS
+    if use_keyset:
+        qs, meta_data = models.Thread.objects.run_advanced_search(
+                            request_user=request.user, search_state=search_state
+                        )
+        if meta_data['non_existing_tags']:
+            search_state = search_state.remove_tags(meta_data['non_existing_tags'])
+        #page is located by the cursor instead of the offset
+        #and the count is taken from the cache
+        page = models.Thread.objects.get_keyset_page(
+                                qs,
+                                sort=search_state.sort,
+                                cursor=search_state.cursor,
+                                page_size=page_size
+                            )
+        q_count = models.Thread.objects.get_cached_count(
+                                qs,
+                                search_state=search_state,
+                                request_user=request.user
+                            )
+    else:
+        #page of the results is taken from the cache when possible
+        paginator, page, meta_data = models.Thread.objects.get_search_page(
+                                request_user=request.user,
+                                search_state=search_state,
+                                page_size=page_size
+                            )
+        if meta_data['non_existing_tags']:
+            search_state = search_state.remove_tags(meta_data['non_existing_tags'])
+        search_state.page = page.number
+        q_count = paginator.count
 
     # INFO: Because for the time being we need question posts and thread authors
     #       down the pipeline, we have to precache them in thread objects
     models.Thread.objects.precache_view_data_hack(threads=page.object_list)
 
-    related_tags = Tag.objects.get_related_to_search(
+    related_tags = Tag.objects.get_related_to_search_state(
+                        search_state=search_state,
                         threads=page.object_list,
                         ignored_tag_names=meta_data.get('ignored_tag_names',[])
                     )
@@ -112,19 +146,22 @@ def questions(request, **kwargs):
                                     ).only('id', 'username', 'gravatar')
                         )
 
-    paginator_context = {
-        'is_paginated' : (paginator.count > page_size),
+    if use_keyset:
+        paginator_context = None
+    else:
+        paginator_context = {
+            'is_paginated' : (paginator.count > page_size),
 
-        'pages': paginator.num_pages,
-        'page': search_state.page,
-        'has_previous': page.has_previous(),
-        'has_next': page.has_next(),
-        'previous': page.previous_page_number(),
-        'next': page.next_page_number(),
+            'pages': paginator.num_pages,
+            'page': search_state.page,
+            'has_previous': page.has_previous(),
+            'has_next': page.has_next(),
+            'previous': page.previous_page_number(),
+            'next': page.next_page_number(),
 
-        'base_url' : search_state.query_string(),
-        'page_size' : page_size,
-    }
+            'base_url' : search_state.query_string(),
+            'page_size' : page_size,
+        }
 
     # We need to pass the rss feed url based
     # on the search state to the template.
@@ -145,15 +182,19 @@ def questions(request, **kwargs):
     reset_method_count = len(filter(None, [search_state.query, search_state.tags, meta_data.get('author_name', None)]))
 
     if request.is_ajax():
-        q_count = paginator.count
-
         question_counter = ungettext('%(q_num)s question', '%(q_num)s questions', q_count)
         question_counter = question_counter % {'q_num': humanize.intcomma(q_count),}
 
-        if q_count > page_size:
+        if use_keyset:
+            show_paginator = page.has_previous or page.has_next
+        else:
+            show_paginator = q_count > page_size
+            paginator_context = functions.setup_paginator(paginator_context)
+        if show_paginator:
             paginator_tpl = get_template('main_page/paginator.html', request)
-            paginator_html = paginator_tpl.render(Context({
-                'context': functions.setup_paginator(paginator_context),
+            paginator_html = render_template(paginator_tpl, Context({
+                'context': paginator_context,
+                'keyset_page': use_keyset and page or None,
                 'questions_count': q_count,
                 'page_size' : page_size,
                 'search_state': search_state,
@@ -162,7 +203,7 @@ def questions(request, **kwargs):
             paginator_html = ''
 
         questions_tpl = get_template('main_page/questions_loop.html', request)
-        questions_html = questions_tpl.render(Context({
+        questions_html = render_template(questions_tpl, Context({
             'threads': page,
             'search_state': search_state,
             'reset_method_count': reset_method_count,
@@ -189,7 +230,7 @@ def questions(request, **kwargs):
             'used_count': humanize.intcomma(tag.local_used_count)
         } for tag in related_tags]
 
-        return HttpResponse(simplejson.dumps(ajax_data), mimetype = 'application/json')
+        response = HttpResponse(simplejson.dumps(ajax_data), mimetype = 'application/json')
 
     else: # non-AJAX branch
 
@@ -208,7 +249,8 @@ def questions(request, **kwargs):
             'page_size': page_size,
             'query': search_state.query,
             'threads' : page,
-            'questions_count' : paginator.count,
+            'keyset_page': use_keyset and page or None,
+            'questions_count' : q_count,
             'reset_method_count': reset_method_count,
             'scope': search_state.scope,
             'show_sort_by_relevance': conf.should_show_sort_by_relevance(),
@@ -226,7 +268,11 @@ def questions(request, **kwargs):
             'feed_url': context_feed_url,
         }
 
-        return render_into_skin('main_page.html', template_data, request)
+        response = render_into_skin('main_page.html', template_data, request)
+
+    if cache_key:
+        return response_cache.save_response(request, cache_key, response)
+    return response
 
 
 def tags(request):#view showing a listing of available tags - plain list
@@ -318,6 +364,37 @@ def tags(request):#view showing a listing of available tags - plain list
 
     return render_into_skin('tags.html', data, request)
 
+def record_question_visit(request, question_post):
+    """counts visits of the question page, the view count
+    is updated once per session and change of the thread"""
+    if functions.not_a_robot_request(request):
+        #todo: merge view counts per user and per session
+        #1) view count per session
+        thread = question_post.thread
+        update_view_count = False
+        if 'question_view_times' not in request.session:
+            request.session['question_view_times'] = {}
+
+        last_seen = request.session['question_view_times'].get(question_post.id, None)
+
+        if thread.last_activity_by_id != request.user.id:
+            if last_seen:
+                if last_seen < thread.last_activity_at:
+                    update_view_count = True
+            else:
+                update_view_count = True
+
+        request.session['question_view_times'][question_post.id] = \
+                                                    datetime.datetime.now()
+
+        #2) run the slower jobs in a celery task
+        from askbot import tasks
+        tasks.record_question_visit.delay(
+            question_post = question_post,
+            user = request.user,
+            update_view_count = update_view_count
+        )
+
 @csrf.csrf_protect
 #@cache_page(60 * 5)
 def question(request, id):#refactor - long subroutine. display question body, answers and comments
@@ -382,6 +459,23 @@ def question(request, id):#refactor - long subroutine. display question body, an
                         ))
         return HttpResponseRedirect(question_url)
 
+    #pages shown to the anonymous visitors are cached
+    #until the next change of the thread
+    cache_key = None
+    thread = question_post.thread
+    if response_cache.is_cacheable_request(request):
+        cache_key = response_cache.get_cache_key(
+                            request,
+                            answer_sort_method,
+                            response_cache.get_thread_version(thread.id),
+                            thread.last_activity_at
+                        )
+        response = response_cache.get_response(
+                            request, cache_key, thread.last_activity_at
+                        )
+        if response is not None:
+            record_question_visit(request, question_post)
+            return response
 
     #resolve comment and answer permalinks
     #they go first because in theory both can be moved to another question
@@ -438,8 +532,6 @@ def question(request, id):#refactor - long subroutine. display question body, an
             request.user.message_set.create(message = unicode(error))
             return HttpResponseRedirect(reverse('question', kwargs = {'id': id}))
 
-    thread = question_post.thread
-
     logging.debug('answer_sort_method=' + unicode(answer_sort_method))
 
     #load answers and post id's->athor_id mapping
@@ -483,35 +575,7 @@ def question(request, id):#refactor - long subroutine. display question body, an
         return HttpResponseRedirect(question_post.get_absolute_url())
     page_objects = objects_list.page(show_page)
 
-    #count visits
-    #import ipdb; ipdb.set_trace()
-    if functions.not_a_robot_request(request):
-        #todo: split this out into a subroutine
-        #todo: merge view counts per user and per session
-        #1) view count per session
-        update_view_count = False
-        if 'question_view_times' not in request.session:
-            request.session['question_view_times'] = {}
-
-        last_seen = request.session['question_view_times'].get(question_post.id, None)
-
-        if thread.last_activity_by_id != request.user.id:
-            if last_seen:
-                if last_seen < thread.last_activity_at:
-                    update_view_count = True
-            else:
-                update_view_count = True
-
-        request.session['question_view_times'][question_post.id] = \
-                                                    datetime.datetime.now()
-
-        #2) run the slower jobs in a celery task
-        from askbot import tasks
-        tasks.record_question_visit.delay(
-            question_post = question_post,
-            user = request.user,
-            update_view_count = update_view_count
-        )
+    record_question_visit(request, question_post)
 
     paginator_data = {
         'is_paginated' : (objects_list.count > const.ANSWERS_PAGE_SIZE),
@@ -555,6 +619,16 @@ def question(request, id):#refactor - long subroutine. display question body, an
         request.user.is_authenticated() and request.user.can_post_comment()
     )
 
+    #permissions to act on the posts shown on the page,
+    #evaluated once for all posts, used by the page scripts
+    post_permissions = dict()
+    if request.user.is_authenticated():
+        page_posts = [question_post] + list(page_objects.object_list)
+        for post in list(page_posts):
+            page_posts.extend(post.get_cached_comments())
+        post_permissions = request.user.precache_post_permissions(page_posts)
+    post_permissions = format_post_permissions(post_permissions)
+
     user_already_gave_answer = False
     previous_answer = None
     if request.user.is_authenticated():
@@ -582,6 +656,7 @@ def question(request, id):#refactor - long subroutine. display question body, an
         'user_votes': user_votes,
         'user_post_id_list': user_post_id_list,
         'user_can_post_comment': user_can_post_comment,#in general
+        'post_permissions_json': simplejson.dumps(post_permissions),
         'user_already_gave_answer': user_already_gave_answer,
         'previous_answer': previous_answer,
         'tab_id' : answer_sort_method,
@@ -599,7 +674,12 @@ def question(request, id):#refactor - long subroutine. display question body, an
 
     data.update(context.get_for_tag_editor())
 
-    return render_into_skin('question.html', data, request)
+    response = render_into_skin('question.html', data, request)
+    if cache_key:
+        return response_cache.save_response(
+                            request, cache_key, response, thread.last_activity_at
+                        )
+    return response
 
 def revisions(request, id, post_type = None):
     assert post_type in ('question', 'answer')
@@ -607,14 +687,15 @@ def revisions(request, id, post_type = None):
     revisions = list(models.PostRevision.objects.filter(post=post))
     revisions.reverse()
     for i, revision in enumerate(revisions):
+        if revision.diff is None:
+            #diffs of the older revisions are computed on the first view,
+            #unless they were built by the build_revision_diffs command
+            if i == 0:
+                revision.update_diff()
+            else:
+                revision.update_diff(previous_revision = revisions[i-1])
         if i == 0:
-            revision.diff = sanitize_html(revisions[i].html)
             revision.summary = _('initial version')
-        else:
-            revision.diff = htmldiff(
-                sanitize_html(revisions[i-1].html),
-                sanitize_html(revision.html)
-            )
 
     data = {
         'page_class':'revisions-page',
@@ -587,22 +587,18 @@ def __generate_comments_json(obj, user):#non-view generates json data for the po
     models.Post.objects.precache_comments(for_posts=[obj], visitor=user)
     comments = obj._cached_comments
 
+    if user and user.is_authenticated():
+        permissions = user.precache_post_permissions(comments)
+    else:
+        permissions = dict()
+
     # {"Id":6,"PostId":38589,"CreationDate":"an hour ago","Text":"hello there!","UserDisplayName":"Jarrod Dixon","UserUrl":"/users/3/jarrod-dixon","DeleteUrl":null}
     json_comments = []
     for comment in comments:
 
-        if user and user.is_authenticated():
-            try:
-                user.assert_can_delete_comment(comment)
-                #/posts/392845/comments/219852/delete
-                #todo translate this url
-                is_deletable = True
-            except exceptions.PermissionDenied:
-                is_deletable = False
-            is_editable = template_filters.can_edit_comment(comment.author, comment)
-        else:
-            is_deletable = False
-            is_editable = False
+        actions = permissions.get(comment.id, ())
+        is_deletable = 'delete_comment' in actions
+        is_editable = 'edit_comment' in actions
 
 
         comment_owner = comment.author
@@ -667,8 +663,9 @@ def edit_comment(request):
 
     request.user.edit_comment(comment_post=comment_post, body_text = request.POST['comment'])
 
-    is_deletable = template_filters.can_delete_comment(comment_post.author, comment_post)
-    is_editable = template_filters.can_edit_comment(comment_post.author, comment_post)
+    actions = request.user.get_post_permissions(comment_post)
+    is_deletable = 'delete_comment' in actions
+    is_editable = 'edit_comment' in actions
     tz = ' ' + template_filters.TIMEZONE_STR
 
     tz = template_filters.TIMEZONE_STR